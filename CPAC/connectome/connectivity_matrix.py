@@ -98,9 +98,8 @@ def compute_connectome_nilearn(in_rois, in_file, method, atlas_name):
 
     Parameters
     ----------
-    in_rois : Niimg-like object
-        http://nilearn.github.io/manipulating_images/input_output.html#niimg-like-objects
-        Region definitions, as one image of labels.
+    in_rois : str
+        path to region definitions, as one image of labels
 
     in_file : str
         path to timeseries image
@@ -114,22 +113,19 @@ def compute_connectome_nilearn(in_rois, in_file, method, atlas_name):
     -------
     numpy.ndarray or NotImplemented
     """
-    from nilearn.input_data import NiftiLabelsMasker
-    from nipype.utils.tmpdirs import TemporaryDirectory
+    from CPAC.timeseries.utils import extract_roi_timeseries
+    from CPAC.utils import zscore
     tool = 'Nilearn'
     output = connectome_name(atlas_name, tool, method)
     method = get_connectome_method(method, tool)
     if method is NotImplemented:
         return NotImplemented
-    with TemporaryDirectory() as cache_dir:
-        masker = NiftiLabelsMasker(labels_img=in_rois,
-                                standardize=True,
-                                verbose=True,
-                                memory=cache_dir,
-                                memory_level=3)
-        timeser = masker.fit_transform(in_file)
-        correlation_measure = ConnectivityMeasure(kind=method)
-        corr_matrix = correlation_measure.fit_transform([timeser])[0]
+    # the mean timeseries of each label, standardized like
+    # NiftiLabelsMasker(standardize=True)
+    timeser, _ = extract_roi_timeseries(in_file, in_rois)[0]
+    timeser = zscore(timeser, 1).T
+    correlation_measure = ConnectivityMeasure(kind=method)
+    corr_matrix = correlation_measure.fit_transform([timeser])[0]
     np.fill_diagonal(corr_matrix, 1)
     np.savetxt(output, corr_matrix, delimiter='\t')
     return output
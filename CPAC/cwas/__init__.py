@@ -1,6 +1,6 @@
-from .pipeline import joint_mask, \
-                      nifti_cwas, \
-                      create_cwas
+from .cwas import joint_mask, \
+                  nifti_cwas
+from .pipeline import create_cwas
 
 __all__ = ['create_cwas',
            'joint_mask',
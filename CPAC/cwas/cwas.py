@@ -1,6 +1,7 @@
 import os
 
 import nibabel as nb
+from nipype import logging
 import numpy as np
 import pandas as pd
 import scipy.stats
@@ -8,13 +9,16 @@ from scipy.stats import t
 from numpy import inf
 
 from CPAC.cwas.mdmr import mdmr
-from CPAC.utils import correlation
+from CPAC.utils import correlation, zscore
 
 from CPAC.pipeline.cpac_ga_model_generator import (create_merge_mask,
                                                    create_merged_copefile)
 
+logger = logging.getLogger('nipype.workflow')
+SUBDIST_MEMORY_GB = 1.0
 
-def joint_mask(subjects, mask_file=None):
+
+def joint_mask(subjects, mask_file=None, out_dir=None):
     """
     Creates a joint mask (intersection) common to all the subjects in a provided list
     and a provided mask
@@ -25,6 +29,9 @@ def joint_mask(subjects, mask_file=None):
         A length `N` list of file paths of the nifti files of subjects
     mask_file : string
         Path to a mask file in nifti format
+    out_dir : string, optional
+        Directory of the joint mask, if it's created; defaults to the
+        current working directory
     
     Returns
     -------
@@ -34,20 +41,29 @@ def joint_mask(subjects, mask_file=None):
     """
     if not mask_file:
         files = list(subjects.values())
-        cope_file = os.path.join(os.getcwd(), 'joint_cope.nii.gz')
-        mask_file = os.path.join(os.getcwd(), 'joint_mask.nii.gz')
+        out_dir = out_dir or os.getcwd()
+        cope_file = os.path.join(out_dir, 'joint_cope.nii.gz')
+        mask_file = os.path.join(out_dir, 'joint_mask.nii.gz')
         create_merged_copefile(files, cope_file)
         create_merge_mask(cope_file, mask_file)
     return mask_file
 
 
-def calc_mdmrs(D, regressor, cols, permutations):
+def calc_mdmrs(D, regressor, cols, permutations, low_memory=False,
+               pvalue_precision=None):
     cols = np.array(cols, dtype=np.int32)
-    F_set, p_set = mdmr(D, regressor, cols, permutations)
+    F_set, p_set = mdmr(D, regressor, cols, permutations,
+                        low_memory=low_memory,
+                        pvalue_precision=pvalue_precision)
     return F_set, p_set
 
 
-def calc_subdists(subjects_data, voxel_range):
+def calc_subdists_voxelwise(subjects_data, voxel_range):
+    """
+    Reference (voxel-by-voxel) implementation of :func:`calc_subdists`.
+
+    Kept for validation and benchmarking of the block engine.
+    """
     subjects, voxels, _ = subjects_data.shape
     D = np.zeros((len(voxel_range), subjects, subjects))
     for i, v in enumerate(voxel_range):
@@ -62,10 +78,112 @@ def calc_subdists(subjects_data, voxel_range):
     return D
 
 
-def calc_cwas(subjects_data, regressor, regressor_selected_cols, permutations, voxel_range):
-    D = calc_subdists(subjects_data, voxel_range)
+def subdist_block_size(subjects, voxels, memory_gb=SUBDIST_MEMORY_GB):
+    """
+    Number of seed voxels whose connectivity profiles fit in
+    ``memory_gb`` at once.
+
+    Parameters
+    ----------
+    subjects : int
+
+    voxels : int
+
+    memory_gb : float
+
+    Returns
+    -------
+    int
+    """
+    bytes_per_seed = subjects * voxels * np.dtype(np.float64).itemsize
+    return max(1, int(memory_gb * 1024 ** 3 // bytes_per_seed))
+
+
+def calc_subdists(subjects_data, voxel_range, memory_gb=SUBDIST_MEMORY_GB,
+                  z_scored=False):
+    """
+    Subject-by-subject distances of seed-based connectivity maps.
+
+    Each subject's timeseries are z-scored once. The ``voxel_range`` is
+    then streamed through in blocks of seeds sized to ``memory_gb``; for
+    each block, the seed × whole-brain connectivity of every subject is a
+    single matrix product, and the Fisher-transformed maps (excluding the
+    seed itself) are correlated across subjects. The result matches
+    :func:`calc_subdists_voxelwise` to floating-point tolerance.
+
+    Parameters
+    ----------
+    subjects_data : ndarray
+        subjects × voxels × timepoints
+
+    voxel_range : ndarray
+        indices of the seed voxels
+
+    memory_gb : float, optional
+        approximate budget for the connectivity profiles of one block
+
+    z_scored : bool, optional
+        ``subjects_data`` is already z-scored along time (e.g., a
+        read-only memory map from :func:`cache_subjects_data`), so it is
+        used as-is rather than copied
+
+    Returns
+    -------
+    D : ndarray
+        len(voxel_range) × subjects × subjects distance matrices
+    """
+    subjects, voxels, timepoints = subjects_data.shape
+    voxel_range = np.asarray(voxel_range, dtype=int)
+    D = np.zeros((len(voxel_range), subjects, subjects))
+    if not len(voxel_range):
+        return D
+
+    if z_scored:
+        zdata = subjects_data
+    else:
+        zdata = np.empty(subjects_data.shape, dtype=np.float64)
+        for si in range(subjects):
+            zdata[si] = zscore(subjects_data[si], 1)
+
+    block_size = subdist_block_size(subjects, voxels, memory_gb)
+    profiles = np.empty((min(block_size, len(voxel_range)), subjects, voxels))
+    for start in range(0, len(voxel_range), block_size):
+        seeds = voxel_range[start:start + block_size]
+        block = profiles[:len(seeds)]
+        seed_index = np.arange(len(seeds))
+
+        for si in range(subjects):
+            block[:, si] = np.dot(zdata[si, seeds], zdata[si].T)
+        block /= timepoints
+        np.clip(block, -0.9999, 0.9999, out=block)
+        np.arctanh(block, out=block)
+
+        # z-score each map across voxels, leaving the seed voxel out
+        seed_values = block[seed_index, :, seeds].copy()
+        n = voxels - 1
+        mean = (block.sum(axis=2) - seed_values) / n
+        block -= mean[..., np.newaxis]
+        seed_values -= mean
+        sd = np.sqrt(((block ** 2).sum(axis=2) - seed_values ** 2) / n)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            block /= sd[..., np.newaxis]
+        block[seed_index, :, seeds] = 0.0
+        np.copyto(block, 0.0, where=np.isnan(block))
+
+        r = np.matmul(block, block.transpose(0, 2, 1)) / n
+        D[start:start + len(seeds)] = np.clip(r, -1.0, 1.0)
+
+    D = np.sqrt(2.0 * (1.0 - D))
+    return D
+
+
+def calc_cwas(subjects_data, regressor, regressor_selected_cols, permutations,
+              voxel_range, low_memory=False, pvalue_precision=None,
+              z_scored=False):
+    D = calc_subdists(subjects_data, voxel_range, z_scored=z_scored)
     F_set, p_set = calc_mdmrs(
-        D, regressor, regressor_selected_cols, permutations)
+        D, regressor, regressor_selected_cols, permutations,
+        low_memory=low_memory, pvalue_precision=pvalue_precision)
     return F_set, p_set
 
 def pval_to_zval(p_set, permu):
@@ -76,7 +194,8 @@ def pval_to_zval(p_set, permu):
     return zvals
 
 def nifti_cwas(subjects, mask_file, regressor_file, participant_column,
-               columns_string, permutations, voxel_range):
+               columns_string, permutations, voxel_range, low_memory=False,
+               pvalue_precision=None):
     """
     Performs CWAS for a group of subjects
     
@@ -95,6 +214,12 @@ def nifti_cwas(subjects, mask_file, regressor_file, participant_column,
     voxel_range : ndarray
         Indexes from range of voxels (inside the mask) to perform cwas on.
         Index ordering is based on the np.where(mask) command
+    low_memory : boolean, optional
+        Stream MDMR permutations in chunks instead of holding every
+        permuted hat matrix in memory
+    pvalue_precision : float or None, optional
+        With `low_memory`, stop permuting a voxel once its p-value is
+        known to this relative precision
     
     Returns
     -------
@@ -107,6 +232,48 @@ def nifti_cwas(subjects, mask_file, regressor_file, participant_column,
         easier
         
     """
+    subject_ids = list(subjects.keys())
+    subject_files = list(subjects.values())
+    regressor, regressor_selected_cols = load_cwas_regressor(
+        regressor_file, participant_column, columns_string, subject_ids)
+    mask = nb.load(mask_file).get_fdata().astype('bool')
+    mask_indices = np.where(mask)
+    subjects_data = np.array([
+        nb.load(subject_file).get_fdata().astype('float64')[mask_indices]
+        for subject_file in subject_files
+    ])
+
+    F_set, p_set = calc_cwas(subjects_data, regressor, regressor_selected_cols,
+                             permutations, voxel_range, low_memory,
+                             pvalue_precision)
+    F_file, p_file = save_cwas_batch(F_set, p_set, os.getcwd())
+
+    return F_file, p_file, voxel_range
+
+
+def load_cwas_regressor(regressor_file, participant_column, columns_string,
+                        subject_ids):
+    """
+    Read the phenotypic regressor file for a CWAS
+
+    Parameters
+    ----------
+    regressor_file : string
+        file path to regressor CSV or TSV file (phenotypic info)
+    participant_column : string
+        name of the participant ID column in the regressor file
+    columns_string : string
+        comma-separated string of regressor labels
+    subject_ids : list of strings
+        participant IDs, in the order of the subjects' data
+
+    Returns
+    -------
+    regressor : ndarray
+        subjects × regressors design
+    regressor_selected_cols : ndarray
+        indices of the regressors of interest
+    """
     try:
         regressor_data = pd.read_table(regressor_file,
                                        sep=None, engine="python",
@@ -126,9 +293,6 @@ def nifti_cwas(subjects, mask_file, regressor_file, participant_column,
     if participant_column in columns_string:
         raise ValueError('Participant column can not be a regressor.')
 
-    subject_ids = list(subjects.keys())
-    subject_files = list(subjects.values())
-
     # check for inconsistency with leading zeroes
     # (sometimes, the sub_ids from individual will be something like
     #  '0002601' and the phenotype will have '2601')
@@ -161,25 +325,28 @@ def nifti_cwas(subjects, mask_file, regressor_file, participant_column,
         regressor = regressor[:, np.newaxis]
     elif len(regressor.shape) != 2:
         raise ValueError('Bad regressor shape: %s' % str(regressor.shape))
-    if len(subject_files) != regressor.shape[0]:
+    if len(subject_ids) != regressor.shape[0]:
         raise ValueError('Number of subjects does not match regressor size')
-    mask = nb.load(mask_file).get_fdata().astype('bool')
-    mask_indices = np.where(mask)
-    subjects_data = np.array([
-        nb.load(subject_file).get_fdata().astype('float64')[mask_indices]
-        for subject_file in subject_files
-    ])
+    return regressor, regressor_selected_cols
 
-    F_set, p_set = calc_cwas(subjects_data, regressor, regressor_selected_cols,
-                             permutations, voxel_range)
-    cwd = os.getcwd()
-    F_file = os.path.join(cwd, 'pseudo_F.npy')
-    p_file = os.path.join(cwd, 'significance_p.npy')
+
+def save_cwas_batch(F_set, p_set, out_dir):
+    """
+    Save the pseudo-F statistics and p-values of a batch of voxels
+
+    Returns
+    -------
+    F_file : string
+
+    p_file : string
+    """
+    F_file = os.path.join(out_dir, 'pseudo_F.npy')
+    p_file = os.path.join(out_dir, 'significance_p.npy')
 
     np.save(F_file, F_set)
     np.save(p_file, p_set)
 
-    return F_file, p_file, voxel_range
+    return F_file, p_file
 
 
 def create_cwas_batches(mask_file, batches):
@@ -188,6 +355,185 @@ def create_cwas_batches(mask_file, batches):
     return np.array_split(np.arange(voxels), batches)
 
 
+def cache_subjects_data(subject_files, mask_file, out_file):
+    """
+    Load every subject's in-mask timeseries once, z-score them along time
+    and write them to a single subjects × voxels × timepoints ``.npy``
+    file that batches can memory-map instead of re-reading the NIfTIs.
+
+    Parameters
+    ----------
+    subject_files : list of strings
+        4D NIfTI files, in subject order
+    mask_file : string
+        Path to a mask file in nifti format
+    out_file : string
+        Path of the ``.npy`` file to write
+
+    Returns
+    -------
+    out_file : string
+    """
+    mask = nb.load(mask_file).get_fdata().astype('bool')
+    mask_indices = np.where(mask)
+    voxels = mask.sum(dtype=int)
+    subjects_data = None
+    for si, subject_file in enumerate(subject_files):
+        data = nb.load(subject_file).get_fdata().astype('float64')
+        data = zscore(data[mask_indices], 1)
+        if subjects_data is None:
+            subjects_data = np.lib.format.open_memmap(
+                out_file, mode='w+', dtype=np.float64,
+                shape=(len(subject_files), voxels, data.shape[-1]))
+        elif data.shape[-1] != subjects_data.shape[-1]:
+            raise ValueError('Number of timepoints in %s (%d) does not match '
+                             'the other subjects (%d)' % (
+                                 subject_file, data.shape[-1],
+                                 subjects_data.shape[-1]))
+        subjects_data[si] = data
+    subjects_data.flush()
+    del subjects_data
+    return out_file
+
+
+def cwas_batch(subjects_data_file, regressor, regressor_selected_cols,
+               permutations, voxel_range, out_dir, low_memory=False,
+               pvalue_precision=None):
+    """
+    Run CWAS on one batch of voxels from a file written by
+    :func:`cache_subjects_data`, which is memory-mapped read-only so
+    concurrent batches share the same pages.
+
+    Returns
+    -------
+    F_file : string
+
+    p_file : string
+
+    voxel_range : ndarray
+    """
+    subjects_data = np.load(subjects_data_file, mmap_mode='r')
+    F_set, p_set = calc_cwas(subjects_data, regressor, regressor_selected_cols,
+                             permutations, voxel_range, low_memory,
+                             pvalue_precision, z_scored=True)
+    os.makedirs(out_dir, exist_ok=True)
+    F_file, p_file = save_cwas_batch(F_set, p_set, out_dir)
+    return F_file, p_file, voxel_range
+
+
+def run_cwas_batches(subjects, mask_file, regressor_file, participant_column,
+                     columns_string, permutations, batches, working_dir,
+                     n_procs=1, low_memory=False, pvalue_precision=None):
+    """
+    Load the group data once and run CWAS voxel batches on a local process
+    pool, yielding each batch as it finishes.
+
+    Parameters
+    ----------
+    subjects : dict of strings:strings
+        A length `N` dict of id and file paths of the nifti files of subjects
+    mask_file : string
+        Path to a mask file in nifti format
+    regressor_file, participant_column, columns_string, permutations
+        see :func:`nifti_cwas`
+    batches : integer
+        Number of voxel batches
+    working_dir : string
+        Directory for the memory-mapped group data and the batch results
+    n_procs : integer, optional
+        Number of worker processes
+    low_memory, pvalue_precision
+        see :func:`nifti_cwas`
+
+    Yields
+    ------
+    F_file : string
+
+    p_file : string
+
+    voxel_range : ndarray
+    """
+    from concurrent.futures import as_completed, ProcessPoolExecutor
+    from time import perf_counter
+
+    os.makedirs(working_dir, exist_ok=True)
+    regressor, regressor_selected_cols = load_cwas_regressor(
+        regressor_file, participant_column, columns_string,
+        list(subjects.keys()))
+
+    start = perf_counter()
+    subjects_data_file = cache_subjects_data(
+        list(subjects.values()), mask_file,
+        os.path.join(working_dir, 'subjects_data.npy'))
+    logger.info('Loaded %d CWAS subjects into %s in %.1fs', len(subjects),
+                subjects_data_file, perf_counter() - start)
+
+    voxel_ranges = create_cwas_batches(mask_file, batches)
+    args = [(subjects_data_file, regressor, regressor_selected_cols,
+             permutations, voxel_range,
+             os.path.join(working_dir, f'cwas_batch_{i}'), low_memory,
+             pvalue_precision) for i, voxel_range in enumerate(voxel_ranges)]
+
+    def _log_batch(i, done, elapsed):
+        logger.info('CWAS batch %d (%d voxels) finished in %.1fs [%d/%d]',
+                    i, len(voxel_ranges[i]), elapsed, done, len(voxel_ranges))
+
+    if n_procs <= 1:
+        for i, batch_args in enumerate(args):
+            result, elapsed = _timed_cwas_batch(*batch_args)
+            _log_batch(i, i + 1, elapsed)
+            yield result
+        return
+
+    with ProcessPoolExecutor(max_workers=n_procs) as executor:
+        futures = {executor.submit(_timed_cwas_batch, *batch_args): i
+                   for i, batch_args in enumerate(args)}
+        for done, future in enumerate(as_completed(futures), 1):
+            result, elapsed = future.result()
+            _log_batch(futures[future], done, elapsed)
+            yield result
+
+
+def cwas_volumes(subjects, mask_file, regressor_file, participant_column,
+                 columns_string, permutations, batches, z_score, n_procs=1,
+                 low_memory=False, pvalue_precision=None, out_dir=None):
+    """
+    Run :func:`run_cwas_batches` in the current working directory (e.g.,
+    a workflow node's) and merge each batch into the volumes as it
+    finishes.
+
+    Parameters
+    ----------
+    subjects, mask_file, regressor_file, participant_column, columns_string
+        see :func:`run_cwas_batches`
+    permutations, batches, n_procs, low_memory, pvalue_precision
+        see :func:`run_cwas_batches`
+    z_score : list
+        see :func:`merge_cwas_batches`
+    out_dir : string, optional
+        directory of the volumes; defaults to the current working
+        directory
+
+    Returns
+    -------
+    F_file, p_file, log_p_file, one_p_file, z_file : string
+    """
+    return merge_cwas_batches(
+        run_cwas_batches(subjects, mask_file, regressor_file,
+                         participant_column, columns_string, permutations,
+                         batches, os.getcwd(), n_procs=n_procs,
+                         low_memory=low_memory,
+                         pvalue_precision=pvalue_precision),
+        mask_file, z_score, permutations, out_dir=out_dir)
+
+
+def _timed_cwas_batch(*args):
+    from time import perf_counter
+    start = perf_counter()
+    result = cwas_batch(*args)
+    return result, perf_counter() - start
+
+
 def volumize(mask_image, data):
     mask_data = mask_image.get_fdata().astype('bool')
     volume = np.zeros_like(mask_data, dtype=data.dtype)
@@ -199,17 +545,38 @@ def volumize(mask_image, data):
     )
 
 
-def merge_cwas_batches(cwas_batches, mask_file, z_score, permutations):
-    _, _, voxel_range = zip(*cwas_batches)
-    voxels = np.array(np.concatenate(voxel_range))
+def merge_cwas_batches(cwas_batches, mask_file, z_score, permutations,
+                       out_dir=None):
+    """
+    Assemble CWAS batches into volumes
 
+    Parameters
+    ----------
+    cwas_batches : iterable of tuples
+        (F_file, p_file, voxel_range) for each batch. May be a generator
+        (e.g., :func:`run_cwas_batches`), in which case batches are merged
+        as they finish.
+    mask_file : string
+    z_score : list
+    permutations : integer
+    out_dir : string, optional
+        defaults to the current working directory
+
+    Returns
+    -------
+    F_file, p_file, log_p_file, one_p_file, z_file : string
+    """
     mask_image = nb.load(mask_file)
+    voxels = mask_image.get_fdata().astype('bool').sum(dtype=int)
 
-    F_set = np.zeros_like(voxels, dtype=np.float64)
-    p_set = np.zeros_like(voxels, dtype=np.float64)
+    F_set = np.zeros(voxels, dtype=np.float64)
+    p_set = np.zeros(voxels, dtype=np.float64)
+    merged = 0
     for F_file, p_file, voxel_range in cwas_batches:
         F_set[voxel_range] = np.load(F_file)
         p_set[voxel_range] = np.load(p_file)
+        merged += len(voxel_range)
+        logger.info('Merged CWAS batch: %d/%d voxels', merged, voxels)
 
     log_p_set = -np.log10(p_set)
     one_p_set = 1 - p_set
@@ -219,7 +586,7 @@ def merge_cwas_batches(cwas_batches, mask_file, z_score, permutations):
     log_p_vol = volumize(mask_image, log_p_set)
     one_p_vol = volumize(mask_image, one_p_set)
 
-    cwd = os.getcwd()
+    cwd = out_dir or os.getcwd()
     F_file = os.path.join(cwd, 'pseudo_F_volume.nii.gz')
     p_file = os.path.join(cwd, 'p_significance_volume.nii.gz')
     log_p_file = os.path.join(cwd, 'neglog_p_significance_volume.nii.gz')
@@ -232,18 +599,18 @@ def merge_cwas_batches(cwas_batches, mask_file, z_score, permutations):
 
     if 1 in z_score:
         zvals = pval_to_zval(p_set, permutations)
-        z_file = zstat_image(zvals, mask_file)
+        z_file = zstat_image(zvals, mask_file, out_dir)
     else:
         z_file = None
 
     return F_file, p_file, log_p_file, one_p_file, z_file
 
-def zstat_image(zvals, mask_file):
+def zstat_image(zvals, mask_file, out_dir=None):
     mask_image = nb.load(mask_file)
 
     z_vol = volumize(mask_image, zvals)
 
-    cwd = os.getcwd()
+    cwd = out_dir or os.getcwd()
     z_file = os.path.join(cwd, 'zstat.nii.gz')
  
     z_vol.to_filename(z_file)
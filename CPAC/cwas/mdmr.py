@@ -1,5 +1,7 @@
 import numpy as np
 
+PERMUTATION_CHUNK_SIZE = 500
+
 def check_rank(X):
     k    = X.shape[1]
     rank = np.linalg.matrix_rank(X)
@@ -19,6 +21,43 @@ def gower(D):
     G = C.dot(A).dot(C)
     return G
 
+def gower_upper(D):
+    """
+    Upper triangle (including the diagonal) of the Gower-centred matrix of
+    a symmetric distance matrix, as a flat vector.
+    """
+    n = D.shape[0]
+    return gower(D)[np.triu_indices(n)]
+
+def upper_weights(n):
+    """
+    Weights that turn a dot product of two upper-triangle vectors of
+    symmetric ``n`` × ``n`` matrices into the trace of their product.
+    """
+    rows, cols = np.triu_indices(n)
+    return np.where(rows == cols, 1.0, 2.0)
+
+def nuisance_basis(x, cols):
+    """
+    Orthonormal basis of the columns of ``x`` that are not permuted.
+    """
+    other_cols = [i for i in range(x.shape[1]) if i not in cols]
+    if not other_cols:
+        return np.zeros((x.shape[0], 0))
+    Q0, _ = np.linalg.qr(x[:, other_cols])
+    return Q0
+
+def gen_h2_upper(x, cols, indexperm, Q0):
+    """
+    Upper triangle of ``gen_h2(x, cols, indexperm)`` using a precomputed
+    QR of the nuisance columns: the permuted columns of interest are
+    residualised against ``Q0`` and only that small block is factorised.
+    """
+    Xp = x[indexperm][:, cols]
+    R = Xp - Q0.dot(Q0.T.dot(Xp))
+    Q1, _ = np.linalg.qr(R)
+    return Q1.dot(Q1.T)[np.triu_indices(x.shape[0])]
+
 def gen_h2(x, cols, indexperm):
     H = gen_h(x, cols, indexperm)
     other_cols = [i for i in range(x.shape[1]) if i not in cols]
@@ -69,7 +108,47 @@ def ftest_fast(Hs, IHs, Gs, df_among, df_resid, **ssq_kwrds):
     F = (SS_among / df_among) / (SS_resid / df_resid)
     return F
 
-def mdmr(D, X, columns, permutations):
+def mdmr(D, X, columns, permutations, low_memory=False,
+         chunk_size=PERMUTATION_CHUNK_SIZE, pvalue_precision=None):
+    """
+    Multivariate distance matrix regression.
+
+    Parameters
+    ----------
+    D : ndarray
+        voxels × subjects × subjects distance matrices
+
+    X : ndarray
+        subjects × regressors design
+
+    columns : ndarray
+        columns of the design (after an intercept is prepended) to permute
+
+    permutations : int
+        number of permutations, including the unpermuted design
+
+    low_memory : bool, optional
+        stream permutations in chunks of ``chunk_size`` instead of
+        materialising every permuted hat matrix (see :func:`mdmr_low_memory`)
+
+    chunk_size : int, optional
+        permutations per chunk when ``low_memory``
+
+    pvalue_precision : float or None, optional
+        when ``low_memory``, stop permuting a voxel once its p-value is
+        known to this relative precision
+
+    Returns
+    -------
+    F : ndarray
+        pseudo-F statistic per voxel
+
+    p : ndarray
+        permutation p-value per voxel
+    """
+    if low_memory:
+        return mdmr_low_memory(D, X, columns, permutations, chunk_size,
+                               pvalue_precision)
 
     check_rank(X)
     
@@ -107,3 +186,102 @@ def mdmr(D, X, columns, permutations):
 
     return F_perms[0, :], p_vals
 
+
+def mdmr_low_memory(D, X, columns, permutations,
+                    chunk_size=PERMUTATION_CHUNK_SIZE, pvalue_precision=None):
+    """
+    Permutation-streamed MDMR.
+
+    Same statistic and permutations as :func:`mdmr`, with memory bounded
+    by the number of voxels and ``chunk_size`` rather than the number of
+    permutations:
+
+    * only the upper triangles of the (symmetric) Gower and hat matrices
+      are stored;
+    * the nuisance columns are factorised once, so each permutation only
+      needs a QR of the residualised columns of interest;
+    * the residual sum of squares is derived from the permutation-invariant
+      traces, so ``I - H`` is never formed;
+    * permutations are generated and evaluated ``chunk_size`` at a time.
+
+    With ``pvalue_precision``, a voxel stops being permuted once
+    ``ceil(1 / pvalue_precision ** 2)`` permuted statistics have reached
+    its observed statistic (Besag & Clifford's sequential Monte Carlo
+    p-value, whose relative standard error is about ``pvalue_precision``).
+    Its p-value is then the proportion of the permutations it saw.
+
+    Parameters
+    ----------
+    see :func:`mdmr`
+
+    Returns
+    -------
+    F : ndarray
+
+    p : ndarray
+    """
+    check_rank(X)
+
+    subjects = X.shape[0]
+    if subjects != D.shape[1]:
+        raise Exception("# of subjects incompatible between X and D")
+
+    voxels = D.shape[0]
+    weights = upper_weights(subjects)
+    Gs = np.zeros((len(weights), voxels))
+    for di in range(voxels):
+        Gs[:, di] = gower_upper(D[di])
+
+    X1 = np.hstack((np.ones((subjects, 1)), X))
+    columns = np.array(columns, dtype=int)
+    regressors = X1.shape[1]
+    df_among = len(columns)
+    df_resid = subjects - regressors
+
+    Q0 = nuisance_basis(X1, columns)
+    H0 = Q0.dot(Q0.T)[np.triu_indices(subjects)]
+    SS_total = (weights * (np.eye(subjects)[np.triu_indices(subjects)]
+                           - H0)).dot(Gs)
+
+    def ftest(H2s, G, SS_resid_total):
+        SS_among = (H2s * weights[:, np.newaxis]).T.dot(G)
+        SS_resid = SS_resid_total - SS_among
+        return (SS_among / df_among) / (SS_resid / df_resid)
+
+    H2 = gen_h2_upper(X1, columns, np.arange(subjects), Q0)
+    F = ftest(H2[:, np.newaxis], Gs, SS_total)[0]
+
+    stop_at = None
+    if pvalue_precision:
+        stop_at = int(np.ceil(1.0 / pvalue_precision ** 2))
+
+    exceed = np.zeros(voxels, dtype=int)
+    seen = np.full(voxels, permutations, dtype=int)
+    active = np.arange(voxels)
+    done = 1
+    while done < permutations and len(active):
+        chunk = min(chunk_size, permutations - done)
+        H2s = np.zeros((len(weights), chunk))
+        for i in range(chunk):
+            H2s[:, i] = gen_h2_upper(X1, columns,
+                                     np.random.permutation(subjects), Q0)
+        F_perms = ftest(H2s, Gs[:, active], SS_total[active])
+        done += chunk
+
+        if stop_at is None:
+            exceed[active] += (F_perms >= F[active]).sum(axis=0)
+            continue
+
+        hits = np.cumsum(F_perms >= F[active], axis=0)
+        stopped = hits[-1] >= stop_at
+        stopping = active[stopped]
+        # number of permutations at which each stopping voxel hit the limit
+        seen[stopping] = done - chunk + 1 + \
+            np.argmax(hits[:, stopped] >= stop_at, axis=0)
+        exceed[stopping] = stop_at
+        exceed[active[~stopped]] += hits[-1, ~stopped]
+        active = active[~stopped]
+
+    p_vals = exceed.astype('float') / seen
+
+    return F, p_vals
@@ -9,14 +9,11 @@ from CPAC.utils.interfaces.function import Function
 
 from .cwas import (
     joint_mask,
-    create_cwas_batches,
-    merge_cwas_batches,
-    nifti_cwas,
-    zstat_image,
+    cwas_volumes,
 )
 
 
-def create_cwas(name='cwas', working_dir=None, crash_dir=None):
+def create_cwas(name='cwas', working_dir=None, crash_dir=None, n_procs=1):
     """
     Connectome Wide Association Studies
     
@@ -26,6 +23,12 @@ def create_cwas(name='cwas', working_dir=None, crash_dir=None):
     ----------
     name : string, optional
         Name of the workflow.
+    working_dir : string, optional
+        Base directory of the workflow
+    crash_dir : string, optional
+        Directory for crash files
+    n_procs : integer, optional
+        Number of processes to run voxel batches on
         
     Returns
     -------
@@ -48,7 +51,15 @@ def create_cwas(name='cwas', working_dir=None, crash_dir=None):
         inputspec.f_samples : int
             Number of permutation samples to draw from the pseudo F distribution
         inputspec.parallel_nodes : integer
-            Number of nodes to create and potentially parallelize over
+            Number of voxel batches, run on a pool of `n_procs` processes
+        inputspec.low_memory : boolean
+            Stream MDMR permutations in chunks (default False)
+        inputspec.pvalue_precision : float or None
+            With low_memory, relative p-value precision at which to stop
+            permuting a voxel (default None, run every permutation)
+        inputspec.out_dir : string or None
+            Directory of the output volumes (default None, the CWAS
+            node's directory)
         
     Workflow Outputs::
 
@@ -108,8 +119,14 @@ def create_cwas(name='cwas', working_dir=None, crash_dir=None):
                                                        'columns',
                                                        'permutations',
                                                        'parallel_nodes',
-                                                       'z_score']),
+                                                       'z_score',
+                                                       'low_memory',
+                                                       'pvalue_precision',
+                                                       'out_dir']),
                         name='inputspec')
+    inputspec.inputs.low_memory = False
+    inputspec.inputs.pvalue_precision = None
+    inputspec.inputs.out_dir = None
 
     outputspec = pe.Node(util.IdentityInterface(fields=['F_map',
                                                         'p_map',
@@ -118,25 +135,30 @@ def create_cwas(name='cwas', working_dir=None, crash_dir=None):
                                                         'z_map']),
                          name='outputspec')
 
-    ccb = pe.Node(Function(input_names=['mask_file',
-                                        'batches'],
-                           output_names='batch_list',
-                           function=create_cwas_batches,
-                           as_module=True),
-                  name='cwas_batches')
-
-    ncwas = pe.MapNode(Function(input_names=['subjects',
-                                             'mask_file',
-                                             'regressor_file',
-                                             'participant_column',
-                                             'columns_string',
-                                             'permutations',
-                                             'voxel_range'],
-                                output_names=['result_batch'],
-                                function=nifti_cwas,
-                                as_module=True),
-                       name='cwas_batch',
-                       iterfield='voxel_range')
+    # the group data is loaded once, in this node's directory, its voxel
+    # batches run on a pool of n_procs processes, and each batch is merged
+    # into the volumes as it finishes
+    ncwas = pe.Node(Function(input_names=['subjects',
+                                          'mask_file',
+                                          'regressor_file',
+                                          'participant_column',
+                                          'columns_string',
+                                          'permutations',
+                                          'batches',
+                                          'z_score',
+                                          'n_procs',
+                                          'low_memory',
+                                          'pvalue_precision',
+                                          'out_dir'],
+                             output_names=['F_file',
+                                           'p_file',
+                                           'neglog_p_file',
+                                           'one_p_file',
+                                           'z_file'],
+                             function=cwas_volumes,
+                             as_module=True),
+                    name='cwas_volumes', n_procs=n_procs)
+    ncwas.inputs.n_procs = n_procs
 
     jmask = pe.Node(Function(input_names=['subjects',
                                           'mask_file'],
@@ -145,31 +167,12 @@ def create_cwas(name='cwas', working_dir=None, crash_dir=None):
                              as_module=True),
                     name='joint_mask')
 
-    mcwasb = pe.Node(Function(input_names=['cwas_batches',
-                                           'mask_file',
-                                           'z_score',
-                                           'permutations'],
-                              output_names=['F_file',
-                                            'p_file',
-                                            'neglog_p_file',
-                                            'one_p_file',
-                                            'z_file'],
-                              function=merge_cwas_batches,
-                              as_module=True),
-                     name='cwas_volumes')
-
     #Compute the joint mask
     workflow.connect(inputspec, 'subjects',
                      jmask, 'subjects')
     workflow.connect(inputspec, 'roi',
                      jmask, 'mask_file')
 
-    #Create batches based on the joint mask
-    workflow.connect(jmask, 'joint_mask',
-                     ccb, 'mask_file')
-    workflow.connect(inputspec, 'parallel_nodes',
-                     ccb, 'batches')
-
     #Compute CWAS over batches of voxels
     workflow.connect(jmask, 'joint_mask',
                      ncwas, 'mask_file')
@@ -183,24 +186,22 @@ def create_cwas(name='cwas', working_dir=None, crash_dir=None):
                      ncwas, 'participant_column')
     workflow.connect(inputspec, 'columns',
                      ncwas, 'columns_string')
+    workflow.connect(inputspec, 'low_memory',
+                     ncwas, 'low_memory')
+    workflow.connect(inputspec, 'pvalue_precision',
+                     ncwas, 'pvalue_precision')
 
-    workflow.connect(ccb, 'batch_list',
-                     ncwas, 'voxel_range')
-
-    #Merge the computed CWAS data
-    workflow.connect(ncwas, 'result_batch',
-                     mcwasb, 'cwas_batches')
-    workflow.connect(jmask, 'joint_mask',
-                     mcwasb, 'mask_file')
+    workflow.connect(inputspec, 'parallel_nodes',
+                     ncwas, 'batches')
     workflow.connect(inputspec, 'z_score',
-                     mcwasb, 'z_score')
-    workflow.connect(inputspec, 'permutations',
-                     mcwasb, 'permutations')
-
-    workflow.connect(mcwasb, 'F_file', outputspec, 'F_map')
-    workflow.connect(mcwasb, 'p_file', outputspec, 'p_map')
-    workflow.connect(mcwasb, 'neglog_p_file', outputspec, 'neglog_p_map')
-    workflow.connect(mcwasb, 'one_p_file', outputspec, 'one_p_map')
-    workflow.connect(mcwasb, 'z_file', outputspec, 'z_map')
+                     ncwas, 'z_score')
+    workflow.connect(inputspec, 'out_dir',
+                     ncwas, 'out_dir')
+
+    workflow.connect(ncwas, 'F_file', outputspec, 'F_map')
+    workflow.connect(ncwas, 'p_file', outputspec, 'p_map')
+    workflow.connect(ncwas, 'neglog_p_file', outputspec, 'neglog_p_map')
+    workflow.connect(ncwas, 'one_p_file', outputspec, 'one_p_map')
+    workflow.connect(ncwas, 'z_file', outputspec, 'z_map')
 
     return workflow
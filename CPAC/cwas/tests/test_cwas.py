@@ -1,5 +1,6 @@
 import pytest
 from CPAC.pipeline.nipype_pipeline_engine.plugins import MultiProcPlugin
+from CPAC.utils.pytest import benchmark
 
 
 @pytest.mark.skip(reason='requires RegressionTester')
@@ -323,3 +324,188 @@ def test_distances():
     ffile = op.join(sdir, "iq_meanFD+age+sex.mdmr", "fperms_FSIQ.desc")
     fperms = np.array(robjects.r("as.matrix(attach.big.matrix('%s'))" % ffile))
     n = np.sqrt(dmats.shape[0])
+
+
+@pytest.mark.parametrize('memory_gb', [1e-5, 1e-3, 1.0])
+def test_calc_subdists_blocks(memory_gb):
+    """The block engine should match the voxelwise loop for any block size"""
+    import numpy as np
+    from CPAC.cwas.cwas import calc_subdists, calc_subdists_voxelwise
+
+    rng = np.random.default_rng(11)
+    subjects_data = rng.standard_normal((6, 120, 40))
+    # constant voxel in one subject
+    subjects_data[2, 7] = 1.0
+    voxel_range = np.array([0, 7, 8, 50, 119])
+
+    expected = calc_subdists_voxelwise(subjects_data, voxel_range)
+    result = calc_subdists(subjects_data, voxel_range, memory_gb=memory_gb)
+    assert result.shape == expected.shape
+    assert np.allclose(1 - result ** 2 / 2, 1 - expected ** 2 / 2,
+                       atol=1e-12)
+
+
+@benchmark
+def test_calc_subdists_benchmark():
+    """Compare the block engine to the voxelwise loop on synthetic data"""
+    import time
+    import numpy as np
+    from CPAC.cwas.cwas import calc_subdists, calc_subdists_voxelwise
+
+    rng = np.random.default_rng(42)
+    subjects_data = rng.standard_normal((20, 1000, 100))
+    voxel_range = np.arange(0, 1000, 10)
+
+    start = time.perf_counter()
+    expected = calc_subdists_voxelwise(subjects_data, voxel_range)
+    voxelwise_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result = calc_subdists(subjects_data, voxel_range)
+    block_time = time.perf_counter() - start
+
+    print(f'calc_subdists: voxelwise {voxelwise_time:.3f}s, '
+          f'blocks {block_time:.3f}s '
+          f'({voxelwise_time / block_time:.1f}× speed-up)')
+    assert np.allclose(1 - result ** 2 / 2, 1 - expected ** 2 / 2,
+                       atol=1e-12)
+    assert block_time < voxelwise_time
+
+
+@pytest.mark.parametrize('columns', [[1], [1, 2], [0, 1, 2, 3]])
+def test_mdmr_low_memory(columns):
+    """Streamed MDMR should reproduce the dense implementation"""
+    import numpy as np
+    from CPAC.cwas.mdmr import mdmr
+
+    rng = np.random.default_rng(3)
+    points = rng.standard_normal((20, 25, 4))
+    D = np.sqrt(((points[:, :, np.newaxis] - points[:, np.newaxis]) ** 2
+                 ).sum(axis=-1))
+    X = rng.standard_normal((25, 3))
+    columns = np.array(columns)
+
+    np.random.seed(0)
+    F_dense, p_dense = mdmr(D, X, columns, 300)
+    np.random.seed(0)
+    F_low, p_low = mdmr(D, X, columns, 300, low_memory=True, chunk_size=64)
+    assert np.allclose(F_dense, F_low)
+    assert np.array_equal(p_dense, p_low)
+
+    # early stopping only stops voxels whose p-value is already large
+    np.random.seed(0)
+    F_stop, p_stop = mdmr(D, X, columns, 300, low_memory=True,
+                          chunk_size=64, pvalue_precision=0.2)
+    assert np.allclose(F_dense, F_stop)
+    stopped = p_stop != p_dense
+    assert np.all(p_stop[stopped] >= 25 / 300)
+
+
+def _cwas_inputs(tmp_path):
+    """Random participants in a small mask, and an age regressor"""
+    import nibabel as nb
+    import numpy as np
+    import pandas as pd
+
+    rng = np.random.default_rng(5)
+    mask = np.zeros((4, 4, 3))
+    mask[1:4, :, 1:] = 1
+    nb.Nifti1Image(mask, np.eye(4)).to_filename(tmp_path / 'mask.nii.gz')
+    subjects = {}
+    for i in range(8):
+        subjects[f'sub-{i}'] = str(tmp_path / f'sub-{i}.nii.gz')
+        nb.Nifti1Image(rng.standard_normal((4, 4, 3, 30)),
+                       np.eye(4)).to_filename(subjects[f'sub-{i}'])
+    pd.DataFrame({'participant': list(subjects),
+                  'age': rng.uniform(8, 20, 8)}
+                 ).to_csv(tmp_path / 'pheno.csv', index=False)
+    return mask.astype(bool), subjects, (
+        str(tmp_path / 'mask.nii.gz'), str(tmp_path / 'pheno.csv'),
+        'participant', 'age', 20)
+
+
+@pytest.mark.parametrize('n_procs', [1, 2])
+def test_run_cwas_batches(monkeypatch, tmp_path, n_procs):
+    """Pooled batches over the cached group data should match nifti_cwas"""
+    import nibabel as nb
+    import numpy as np
+    from CPAC.cwas.cwas import merge_cwas_batches, nifti_cwas, \
+        run_cwas_batches
+
+    monkeypatch.chdir(tmp_path)
+    mask, subjects, args = _cwas_inputs(tmp_path)
+
+    batches = run_cwas_batches(subjects, *args, 3,
+                               str(tmp_path / 'work'), n_procs=n_procs)
+    (tmp_path / 'out').mkdir()
+    F_file, p_file, _, _, _ = merge_cwas_batches(
+        batches, str(tmp_path / 'mask.nii.gz'), [0], 20,
+        out_dir=str(tmp_path / 'out'))
+    assert F_file.startswith(str(tmp_path / 'out'))
+
+    expected = np.load(nifti_cwas(subjects, *args,
+                                  np.arange(mask.sum()))[0])
+    F_set = nb.load(F_file).get_fdata()[mask]
+    assert np.allclose(F_set, expected)
+
+
+@pytest.mark.parametrize('n_procs', [1, 2])
+def test_create_cwas(monkeypatch, tmp_path, n_procs):
+    """The CWAS workflow runs its batches on a pool within its node"""
+    import nibabel as nb
+    import numpy as np
+    from CPAC.cwas.cwas import nifti_cwas
+    from CPAC.cwas.pipeline import create_cwas
+
+    monkeypatch.chdir(tmp_path)
+    mask, subjects, args = _cwas_inputs(tmp_path)
+    working_dir = tmp_path / 'work'
+    workflow = create_cwas('MDMR_rest', str(working_dir),
+                           str(tmp_path / 'crash'), n_procs=n_procs)
+    for field, value in zip(['roi', 'regressor', 'participant_column',
+                             'columns', 'permutations'], args):
+        setattr(workflow.inputs.inputspec, field, value)
+    workflow.inputs.inputspec.subjects = subjects
+    workflow.inputs.inputspec.parallel_nodes = 3
+    workflow.inputs.inputspec.z_score = [1]
+    workflow.inputs.inputspec.out_dir = str(tmp_path / 'out')
+    (tmp_path / 'out').mkdir()
+    if n_procs == 1:
+        workflow.run(plugin='Linear')
+    else:
+        workflow.run(plugin=MultiProcPlugin({'n_procs': n_procs}),
+                     plugin_args={'n_procs': n_procs})
+
+    # the batches ran in the CWAS node's directory
+    assert (working_dir / 'MDMR_rest' / 'cwas_volumes').is_dir()
+    assert not (tmp_path / 'cwas_batch_0').exists()
+    expected = np.load(nifti_cwas(subjects, *args,
+                                  np.arange(mask.sum()))[0])
+    F_set = nb.load(tmp_path / 'out' / 'pseudo_F_volume.nii.gz'
+                    ).get_fdata()[mask]
+    assert np.allclose(F_set, expected)
+    assert (tmp_path / 'out' / 'zstat.nii.gz').exists()
+
+
+def test_cwas_volumes_merge_as_batches_finish(monkeypatch, tmp_path):
+    """Each batch is merged before the next one runs"""
+    from CPAC.cwas import cwas
+
+    monkeypatch.chdir(tmp_path)
+    _, subjects, args = _cwas_inputs(tmp_path)
+    events = []
+    timed_cwas_batch = cwas._timed_cwas_batch
+
+    def _timed(*batch_args):
+        events.append('run')
+        return timed_cwas_batch(*batch_args)
+
+    def _merged(cwas_batches, *merge_args, **kwargs):
+        for _ in cwas_batches:
+            events.append('merge')
+        return (None,) * 5
+
+    monkeypatch.setattr(cwas, '_timed_cwas_batch', _timed)
+    monkeypatch.setattr(cwas, 'merge_cwas_batches', _merged)
+    cwas.cwas_volumes(subjects, *args, 3, [0])
+    assert events == ['run', 'merge'] * 3
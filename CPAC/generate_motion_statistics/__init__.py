@@ -16,6 +16,8 @@
 # License along with C-PAC. If not, see <https://www.gnu.org/licenses/>.
 """Functions for generating motion statistics"""
 from .generate_motion_statistics import (motion_power_statistics,
+                                        batch_motion_statistics,
+                                        calculate_motion_statistics,
                                         calculate_FD_P,
                                         calculate_FD_J,
                                         gen_motion_parameters,
@@ -27,9 +29,11 @@ from .utils import affine_file_from_params_file, affine_from_params
 __all__ = [
     'affine_file_from_params_file',
     'affine_from_params',
+    'batch_motion_statistics',
     'calculate_DVARS',
     'calculate_FD_P',
     'calculate_FD_J',
+    'calculate_motion_statistics',
     'gen_motion_parameters',
     'gen_power_parameters',
     'ImageTo1D',
@@ -329,6 +329,67 @@ def motion_power_statistics(name='motion_stats',
     return wf
 
 
+def framewise_displacement_power(motion_params):
+    """
+    Framewise displacement as per Power et al., 2012, of every volume
+
+    Parameters
+    ----------
+    motion_params : ~numpy.ndarray
+        (timepoints x 6) movement parameters
+        (roll pitch yaw in degrees, dS dL dP in mm)
+
+    Returns
+    -------
+    fd : ~numpy.ndarray
+        (timepoints,) framewise displacement, 0 for the first volume
+    """
+    motion_params = np.atleast_2d(motion_params)
+    deltas = np.abs(np.diff(motion_params, axis=0))
+    fd = deltas[:, 3:6].sum(axis=1) + \
+        (50 * np.pi / 180) * deltas[:, 0:3].sum(axis=1)
+    return np.insert(fd, 0, 0)
+
+
+def framewise_displacement_jenkinson(transforms, center=None, rmax=80.0):
+    """
+    Framewise displacement as per Jenkinson et al., 2002, of every volume,
+    from the relative transform between consecutive volumes
+
+    Parameters
+    ----------
+    transforms : ~numpy.ndarray
+        (timepoints x 12) top three rows of each volume's 4x4 affine
+
+    center : ~numpy.ndarray, optional
+        volume center (defaults to the origin)
+
+    rmax : float
+        radius (mm) of the sphere representing the brain (FSL's default)
+
+    Returns
+    -------
+    fd : ~numpy.ndarray
+        (timepoints,) framewise displacement, 0 for the first volume
+    """
+    transforms = np.atleast_2d(transforms)
+    center = np.zeros((3, 1)) if center is None else np.asarray(
+        center, dtype=np.float64).reshape((3, 1))
+    affines = np.zeros((transforms.shape[0], 4, 4))
+    affines[:, :3, :] = transforms.reshape(-1, 3, 4)
+    affines[:, 3, 3] = 1
+
+    fd = np.zeros(transforms.shape[0])
+    if transforms.shape[0] < 2:
+        return fd
+    M = affines[1:] @ np.linalg.inv(affines[:-1]) - np.eye(4)
+    A = M[:, 0:3, 0:3]
+    b = M[:, 0:3, 3:4] + A @ center
+    fd[1:] = np.sqrt((rmax * rmax / 5) * (A * A).sum(axis=(1, 2)) +
+                     (b * b).sum(axis=(1, 2)))
+    return fd
+
+
 def calculate_FD_P(in_file):
     """
     Method to calculate Framewise Displacement (FD)  as per Power et al., 2012
@@ -347,15 +408,7 @@ def calculate_FD_P(in_file):
         Frame-wise displacement mat
     """
 
-    motion_params = np.genfromtxt(in_file).T
-
-    rotations = np.transpose(np.abs(np.diff(motion_params[0:3, :])))
-    translations = np.transpose(np.abs(np.diff(motion_params[3:6, :])))
-
-    fd = np.sum(translations, axis=1) + \
-         (50 * np.pi / 180) * np.sum(rotations, axis=1)
-
-    fd = np.insert(fd, 0, 0)
+    fd = framewise_displacement_power(np.genfromtxt(in_file))
 
     out_file = os.path.join(os.getcwd(), 'FD.1D')
     np.savetxt(out_file, fd)
@@ -423,35 +476,7 @@ def calculate_FD_J(in_file: str, calc_from: LITERAL['affine', 'rms'],
     >>> os.unlink(fdj_file)
     """
     if calc_from == 'affine':
-        if center is None:
-            center = np.zeros((3, 1))
-        else:
-            center = np.asarray(center).reshape((3, 1))
-        pm_ = np.genfromtxt(in_file)
-
-        pm = np.zeros((pm_.shape[0], pm_.shape[1] + 4))
-        pm[:, :12] = pm_
-        pm[:, 12:] = [0.0, 0.0, 0.0, 1.0]
-
-        # The default radius (as in FSL) of a sphere represents the brain
-        rmax = 80.0
-
-        T_rb_prev = pm[0].reshape(4, 4)
-
-        fd = np.zeros(pm.shape[0])
-
-        for i in range(1, pm.shape[0]):
-            T_rb = pm[i].reshape(4, 4)
-
-            M = np.dot(T_rb, np.linalg.inv(T_rb_prev)) - np.eye(4)
-            A = M[0:3, 0:3]
-            b = M[0:3, 3:4] + A @ center
-
-            fd[i] = np.sqrt(
-                (rmax * rmax / 5) * np.trace(np.dot(A.T, A)) + np.dot(b.T, b)
-            )
-
-            T_rb_prev = T_rb
+        fd = framewise_displacement_jenkinson(np.genfromtxt(in_file), center)
 
     elif calc_from == 'rms':
         rel_rms = np.loadtxt(in_file)
@@ -489,55 +514,27 @@ def find_volume_center(img_file : str) -> np.ndarray:
     return center
 
 
-def gen_motion_parameters(movement_parameters, max_displacement,
-                          motion_correct_tool, rels_displacement=None):
+def motion_parameters_info(mot, maxdisp):
     """
-    Method to calculate all the movement parameters
+    Summary movement parameters of a run
 
     Parameters
     ----------
-    max_displacement : string
-        path of file with maximum displacement (in mm) for brain voxels
-        in each volume
+    mot : ~numpy.ndarray
+        (6 x timepoints) movement parameters
+        (roll pitch yaw dS dL dP)
 
-    movement_parameters : string
-        path of 1D file containing six movement/motion parameters
-        (3 Translation, 3 Rotations) in different columns
-        (roll pitch yaw dS  dL  dP)
+    maxdisp : ~numpy.ndarray
+        maximum displacement (in mm) of brain voxels in each volume
 
     Returns
     -------
-    out_file : string
-        path to csv file containing various motion parameters
-
-    info : text
-        contains information about motion parameters
-
-    maxdisp : array
-        max displacement value
-
-    relsdisp : array
-        rels displacement value
+    info : list of tuples
+        (name, value) of each motion parameter
     """
-    mot = np.genfromtxt(movement_parameters).T
-
     # Relative RMS of translation
     rms = np.sqrt(mot[3] ** 2 + mot[4] ** 2 + mot[5] ** 2)
 
-    # remove any other information other than matrix from
-    # max displacement file. AFNI adds information to the file
-    if motion_correct_tool == '3dvolreg':
-        maxdisp = np.loadtxt(max_displacement)
-        relsdisp = []
-        relsdisp = pd.DataFrame(relsdisp)
-
-    elif motion_correct_tool == 'mcflirt':
-        # TODO: mcflirt outputs absdisp, instead of maxdisp
-        maxdisp = np.loadtxt(max_displacement)
-
-        # rels_disp output only for mcflirt
-        relsdisp = np.loadtxt(rels_displacement)
-
     abs_relative = lambda v: np.abs(np.diff(v))
     max_relative = lambda v: np.max(abs_relative(v))
     avg_relative = lambda v: np.mean(abs_relative(v))
@@ -578,6 +575,56 @@ def gen_motion_parameters(movement_parameters, max_displacement,
         ('Mean_Abs_dL-R', avg_abs(mot[4])),
         ('Mean_Abs_dP-A', avg_abs(mot[5])),
     ]
+    return info
+
+
+def gen_motion_parameters(movement_parameters, max_displacement,
+                          motion_correct_tool, rels_displacement=None):
+    """
+    Method to calculate all the movement parameters
+
+    Parameters
+    ----------
+    max_displacement : string
+        path of file with maximum displacement (in mm) for brain voxels
+        in each volume
+
+    movement_parameters : string
+        path of 1D file containing six movement/motion parameters
+        (3 Translation, 3 Rotations) in different columns
+        (roll pitch yaw dS  dL  dP)
+
+    Returns
+    -------
+    out_file : string
+        path to csv file containing various motion parameters
+
+    info : text
+        contains information about motion parameters
+
+    maxdisp : array
+        max displacement value
+
+    relsdisp : array
+        rels displacement value
+    """
+    mot = np.genfromtxt(movement_parameters).T
+
+    # remove any other information other than matrix from
+    # max displacement file. AFNI adds information to the file
+    if motion_correct_tool == '3dvolreg':
+        maxdisp = np.loadtxt(max_displacement)
+        relsdisp = []
+        relsdisp = pd.DataFrame(relsdisp)
+
+    elif motion_correct_tool == 'mcflirt':
+        # TODO: mcflirt outputs absdisp, instead of maxdisp
+        maxdisp = np.loadtxt(max_displacement)
+
+        # rels_disp output only for mcflirt
+        relsdisp = np.loadtxt(rels_displacement)
+
+    info = motion_parameters_info(mot, maxdisp)
 
     out_file = os.path.join(os.getcwd(), 'motion_parameters.txt')
     with open(out_file, 'w') as f:
@@ -590,6 +637,56 @@ def gen_motion_parameters(movement_parameters, max_displacement,
     return out_file, info, maxdisp, relsdisp
 
 
+def power_parameters_info(fdp, dvars, fdj=None,
+                          motion_correct_tool='3dvolreg'):
+    """
+    Power parameters for scrubbing
+
+    Parameters
+    ----------
+    fdp : ~numpy.ndarray
+        framewise displacement (FD as per power et al., 2012)
+    dvars : ~numpy.ndarray
+        DVARS
+    fdj : ~numpy.ndarray, optional
+        framewise displacement (FD as per jenkinson et al., 2002)
+
+    Returns
+    -------
+    info : list of tuples
+        (name, value) of each power parameter
+    """
+    # Mean (across time/frames) of the absolute values
+    # for Framewise Displacement (FD)
+    meanFD_Power = np.mean(fdp)
+
+    # Mean DVARS
+    meanDVARS = np.mean(dvars)
+
+    if motion_correct_tool == '3dvolreg' and fdj is not None:
+        # Mean FD Jenkinson
+        meanFD_Jenkinson = np.mean(fdj)
+
+        # Root mean square (RMS; across time/frames)
+        # of the absolute values for FD
+        rmsFDJ = np.sqrt(np.mean(fdj))
+
+        # Mean of the top quartile of FD is $FDquartile
+        quat = int(len(fdj) / 4)
+        FDJquartile = np.mean(np.sort(fdj)[::-1][:quat])
+
+        return [
+            ('MeanFD_Power', meanFD_Power),
+            ('MeanFD_Jenkinson', meanFD_Jenkinson),
+            ('rootMeanSquareFD', rmsFDJ),
+            ('FDquartile(top1/4thFD)', FDJquartile),
+            ('MeanDVARS', meanDVARS)]
+
+    return [
+        ('MeanFD_Power', meanFD_Power),
+        ('MeanDVARS', meanDVARS)]
+
+
 def gen_power_parameters(fdp=None, fdj=None, dvars=None,
                          motion_correct_tool='3dvolreg'):
     """
@@ -613,49 +710,9 @@ def gen_power_parameters(fdp=None, fdj=None, dvars=None,
     """
     import numpy as np
 
-    meanFD_Power = []
-    meanDVARS = []
-    meanFD_Jenkinson = []
-    rmsFDJ = []
-    FDJquartile = []
-
-    if fdp:
-        fdp_data = np.loadtxt(fdp)
-        dvars_data = np.loadtxt(dvars)
-
-        # Mean (across time/frames) of the absolute values
-        # for Framewise Displacement (FD)
-        meanFD_Power = np.mean(fdp_data)
-
-        # Mean DVARS
-        meanDVARS = np.mean(dvars_data)
-
-        if motion_correct_tool == '3dvolreg':
-            if fdj:
-                fdj_data = np.loadtxt(fdj)
-
-                # Mean FD Jenkinson
-                meanFD_Jenkinson = np.mean(fdj_data)
-
-                # Root mean square (RMS; across time/frames)
-                # of the absolute values for FD
-                rmsFDJ = np.sqrt(np.mean(fdj_data))
-
-                # Mean of the top quartile of FD is $FDquartile
-                quat = int(len(fdj_data) / 4)
-                FDJquartile = np.mean(np.sort(fdj_data)[::-1][:quat])
-
-                info = [
-                    ('MeanFD_Power', meanFD_Power),
-                    ('MeanFD_Jenkinson', meanFD_Jenkinson),
-                    ('rootMeanSquareFD', rmsFDJ),
-                    ('FDquartile(top1/4thFD)', FDJquartile),
-                    ('MeanDVARS', meanDVARS)]
-
-        elif motion_correct_tool == 'mcflirt':
-            info = [
-                ('MeanFD_Power', meanFD_Power),
-                ('MeanDVARS', meanDVARS)]
+    info = power_parameters_info(
+        np.loadtxt(fdp), np.loadtxt(dvars),
+        np.loadtxt(fdj) if fdj else None, motion_correct_tool)
 
     out_file = os.path.join(os.getcwd(), 'pow_params.txt')
     with open(out_file, 'a') as f:
@@ -715,6 +772,36 @@ class ImageTo1D(AFNICommand):
     output_spec = ImageTo1DOutputSpec
 
 
+def masked_dvars(func_brain, mask, chunk_size=4096):
+    """
+    DVARS as per power's method, differencing only the in-mask voxels
+
+    Parameters
+    ----------
+    func_brain : string (nifti file)
+        path to motion correct functional data
+    mask : string (nifti file)
+        path to brain only mask for functional data
+    chunk_size : int
+        voxels differenced at a time (in double precision)
+
+    Returns
+    -------
+    dvars : ~numpy.ndarray
+        (timepoints - 1,) RMS over the mask of each volume's change
+    """
+    from CPAC.utils.data_cache import load_image_data
+    mask_data = nb.load(mask).get_fdata().astype('bool')
+    masked = np.array(load_image_data(func_brain, dtype=np.float32
+                                      )[mask_data], dtype=np.float32)
+    sum_squares = np.zeros(max(masked.shape[1] - 1, 0))
+    for start in range(0, masked.shape[0], chunk_size):
+        sum_squares += np.square(np.diff(
+            masked[start:start + chunk_size].astype(np.float64),
+            axis=1)).sum(axis=0)
+    return np.sqrt(sum_squares / max(masked.shape[0], 1))
+
+
 def calculate_DVARS(func_brain, mask):
     """
     Method to calculate DVARS as per power's method
@@ -733,19 +820,7 @@ def calculate_DVARS(func_brain, mask):
     dvars: array
         file containing array of DVARS calculation for each voxel
     """
-    import numpy as np
-    import nibabel as nb
-    rest_data = nb.load(func_brain).get_fdata().astype(np.float32)
-    mask_data = nb.load(mask).get_fdata().astype('bool')
-
-    # square of relative intensity value for each voxel across every timepoint
-    data = np.square(np.diff(rest_data, axis=3))
-
-    # applying mask, getting the data in the brain only
-    data = data[mask_data]
-
-    # square root and mean across all timepoints inside mask
-    dvars = np.sqrt(np.mean(data, axis=0))
+    dvars = masked_dvars(func_brain, mask)
 
     out_file = os.path.join(os.getcwd(), 'DVARS.txt')
     np.savetxt(out_file, dvars)
@@ -821,3 +896,96 @@ def get_allmotion(fdj, fdp, maxdisp, motion, power, relsdisp=None, dvars=None):
                                  index=False)
 
     return all_motion_val, summary_motion_power
+
+
+def calculate_motion_statistics(movement_parameters, max_displacement,
+                                func_brain, mask,
+                                motion_correct_tool='3dvolreg',
+                                transformations=None, rels_displacement=None,
+                                center=None):
+    """
+    FD-P, FD-J, DVARS and the motion and power parameters of a run, in
+    one pass over its motion files and masked functional data
+
+    Parameters
+    ----------
+    movement_parameters : string
+        path of 1D file containing six movement/motion parameters
+        (roll pitch yaw dS  dL  dP)
+    max_displacement : string
+        path of file with maximum displacement (in mm) for brain voxels
+        in each volume
+    func_brain : string (nifti file)
+        path to motion correct functional data
+    mask : string (nifti file)
+        path to brain only mask for functional data
+    motion_correct_tool : string
+        one of {'3dvolreg', 'mcflirt'}
+    transformations : string, optional
+        matrix transformations from volume alignment file path, to
+        calculate FD-J from (3dvolreg)
+    rels_displacement : string, optional
+        FDRMS (*_rel.rms) file path, to read FD-J from (mcflirt)
+    center : ~numpy.ndarray, optional
+        volume center for the from-affine FD-J
+
+    Returns
+    -------
+    statistics : dict
+        'FDP', 'FDJ' and 'DVARS' arrays (0 for the first volume), and
+        'motion' and 'power' parameters as lists of (name, value)
+    """
+    mot = np.genfromtxt(movement_parameters)
+    fdp = framewise_displacement_power(mot)
+    if transformations:
+        fdj = framewise_displacement_jenkinson(np.genfromtxt(transformations),
+                                               center)
+    elif rels_displacement:
+        fdj = np.append(0, np.loadtxt(rels_displacement))
+    else:
+        fdj = None
+    dvars = np.insert(masked_dvars(func_brain, mask), 0, 0)
+    return {'FDP': fdp, 'FDJ': fdj, 'DVARS': dvars,
+            'motion': motion_parameters_info(
+                mot.T, np.loadtxt(max_displacement)),
+            'power': power_parameters_info(fdp, dvars, fdj,
+                                           motion_correct_tool)}
+
+
+def batch_motion_statistics(participants, out_file=None):
+    """
+    Motion and power parameters of many participants' runs, for group QC
+
+    Parameters
+    ----------
+    participants : dict
+        {participant/run label: keyword arguments of
+        :func:`calculate_motion_statistics`}
+    out_file : string, optional
+        path of a TSV file to write the table to
+
+    Returns
+    -------
+    summary : ~pandas.DataFrame
+        one row of motion and power parameters per participant/run
+
+    Examples
+    --------
+    >>> batch_motion_statistics({
+    ...     'sub-1_task-rest': {
+    ...         'movement_parameters': 'sub-1/rest_mc.1D',
+    ...         'max_displacement': 'sub-1/max_disp.1D',
+    ...         'func_brain': 'sub-1/rest_mc.nii.gz',
+    ...         'mask': 'sub-1/rest_mask.nii.gz',
+    ...         'transformations': 'sub-1/rest_mc.aff12.1D'}},
+    ...     'desc-summary_motion.tsv')  # doctest: +SKIP
+    """
+    rows = {}
+    for label, files in participants.items():
+        statistics = calculate_motion_statistics(**files)
+        rows[label] = dict(statistics['motion'] + statistics['power'])
+    summary = pd.DataFrame.from_dict(rows, orient='index')
+    summary.index.name = 'participant'
+    if out_file:
+        summary.to_csv(out_file, sep='\t')
+    return summary
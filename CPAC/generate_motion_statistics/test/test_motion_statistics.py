@@ -0,0 +1,100 @@
+import os
+
+import nibabel as nb
+import numpy as np
+import pytest
+
+from CPAC.generate_motion_statistics import batch_motion_statistics, \
+    calculate_DVARS, calculate_FD_J, calculate_FD_P, \
+    calculate_motion_statistics, gen_motion_parameters, gen_power_parameters
+from CPAC.generate_motion_statistics.utils import affine_from_params
+
+
+def _fdj_loop(transforms, center):
+    """Reference: one 4x4 inverse per volume"""
+    rmax = 80.0
+    center = np.asarray(center).reshape((3, 1))
+    fd = np.zeros(transforms.shape[0])
+    for i in range(1, transforms.shape[0]):
+        previous, current = np.eye(4), np.eye(4)
+        previous[:3] = transforms[i - 1].reshape(3, 4)
+        current[:3] = transforms[i].reshape(3, 4)
+        M = current @ np.linalg.inv(previous) - np.eye(4)
+        A = M[0:3, 0:3]
+        b = M[0:3, 3:4] + A @ center
+        fd[i] = np.sqrt((rmax * rmax / 5) * np.trace(A.T @ A) + b.T @ b)
+    return fd
+
+
+@pytest.fixture
+def run(tmp_path):
+    rng = np.random.default_rng(0)
+    timepoints = 50
+    params = np.cumsum(rng.normal(0, 0.05, (timepoints, 6)), axis=0)
+    transforms = affine_from_params(params)[:, :3].reshape(timepoints, 12)
+    data = rng.normal(1000, 20, (7, 6, 5, timepoints)).astype(np.float32)
+    mask = np.zeros((7, 6, 5))
+    mask[1:-1, 1:-1, 1:-1] = 1
+    paths = {'movement_parameters': tmp_path / 'rest_mc.1D',
+             'max_displacement': tmp_path / 'max_disp.1D',
+             'transformations': tmp_path / 'rest_mc.aff12.1D',
+             'func_brain': tmp_path / 'rest_mc.nii.gz',
+             'mask': tmp_path / 'rest_mask.nii.gz'}
+    np.savetxt(paths['movement_parameters'], params)
+    np.savetxt(paths['max_displacement'],
+               np.abs(rng.normal(0, 0.3, timepoints)))
+    np.savetxt(paths['transformations'], transforms)
+    nb.Nifti1Image(data, np.eye(4)).to_filename(paths['func_brain'])
+    nb.Nifti1Image(mask, np.eye(4)).to_filename(paths['mask'])
+    return {key: str(value) for key, value in paths.items()}
+
+
+def test_calculate_FD_J(monkeypatch, tmp_path, run):
+    monkeypatch.chdir(tmp_path)
+    center = np.array([10.0, -4.0, 22.5])
+    _, fdj = calculate_FD_J(run['transformations'], 'affine', center)
+    assert np.allclose(fdj, _fdj_loop(
+        np.genfromtxt(run['transformations']), center))
+
+
+def test_calculate_DVARS(monkeypatch, tmp_path, run):
+    monkeypatch.chdir(tmp_path)
+    data = nb.load(run['func_brain']).get_fdata()
+    mask = nb.load(run['mask']).get_fdata().astype(bool)
+    expected = np.sqrt(np.mean(np.square(np.diff(data, axis=3))[mask],
+                               axis=0))
+    _, dvars = calculate_DVARS(run['func_brain'], run['mask'])
+    assert dvars[0] == 0
+    assert np.allclose(dvars[1:], expected)
+
+
+def test_calculate_motion_statistics(monkeypatch, tmp_path, run):
+    """One pass should match the per-statistic workflow functions"""
+    monkeypatch.chdir(tmp_path)
+    statistics = calculate_motion_statistics(**run)
+    fdp_file, fdp = calculate_FD_P(run['movement_parameters'])
+    fdj_file, fdj = calculate_FD_J(run['transformations'], 'affine')
+    dvars_file, dvars = calculate_DVARS(run['func_brain'], run['mask'])
+    assert np.allclose(statistics['FDP'], fdp)
+    assert np.allclose(statistics['FDJ'], fdj)
+    assert np.allclose(statistics['DVARS'], dvars)
+    _, motion, _, _ = gen_motion_parameters(run['movement_parameters'],
+                                            run['max_displacement'],
+                                            '3dvolreg')
+    assert statistics['motion'] == motion
+    np.savetxt(dvars_file, dvars)
+    _, power = gen_power_parameters(fdp_file, fdj_file, dvars_file)
+    assert [name for name, _ in statistics['power']] == [
+        name for name, _ in power]
+    assert np.allclose([value for _, value in statistics['power']],
+                       [value for _, value in power])
+
+
+def test_batch_motion_statistics(tmp_path, run):
+    out_file = str(tmp_path / 'desc-summary_motion.tsv')
+    summary = batch_motion_statistics({'sub-1': run, 'sub-2': run}, out_file)
+    assert list(summary.index) == ['sub-1', 'sub-2']
+    assert 'MeanFD_Jenkinson' in summary.columns
+    assert os.path.exists(out_file)
+    assert np.allclose(summary.loc['sub-1', 'MeanDVARS'], np.mean(
+        calculate_motion_statistics(**run)['DVARS']))
@@ -1,8 +1,12 @@
 import numpy as np
 
-from CPAC.utils import correlation
+from CPAC.utils import check_random_state, correlation
 
-from .utils import p_from_null, phase_randomize
+from .utils import centered_spectrum, p_from_null, permutation_nulls, \
+    permutation_seeds, phase_randomize, phase_shift
+
+# voxels phase-randomized at a time by isc_null
+ISC_CHUNK_SIZE = 1000
 
 
 def isc(D, std=None, collapse_subj=True):
@@ -94,3 +98,71 @@ def isc_permutation(permutation, D, masked, collapse_subj=True, random_state=0):
         min_null = np.min(ISC_null)
 
     return permutation, min_null, max_null
+
+
+def loo_correlation(F, power):
+    """Leave-one-out correlation of each subject with the sum of the other
+    subjects, from the weighted spectra of :func:`centered_spectrum`.
+
+    Parameters
+    ----------
+    F : numpy.ndarray
+        voxel × frequency × subject spectrum.
+    power : numpy.ndarray
+        voxel × subject power of ``F``, which phase shifts leave unchanged.
+
+    Returns
+    -------
+    numpy.ndarray
+        voxel × subject correlations.
+    """
+    group_sum = F.sum(axis=2)
+    cross = np.einsum('vfs,vf->vs', F, np.conj(group_sum)).real
+    cov = cross - power
+    var = power * (np.einsum('vf,vf->v', group_sum,
+                             np.conj(group_sum)).real[:, np.newaxis] -
+                   2 * cross + power)
+    r = np.zeros_like(cov)
+    np.divide(cov, np.sqrt(var), out=r, where=var > 0)
+    return np.clip(r, -1.0, 1.0)
+
+
+def isc_null(spectrum, timepoints, random_state, collapse_subj=True,
+             chunk_size=ISC_CHUNK_SIZE):
+    """Minimum and maximum ISC of one phase-randomized permutation of a
+    spectrum from :func:`centered_spectrum`, equivalent to
+    :func:`isc_permutation` with the same ``random_state``"""
+    random_state = check_random_state(random_state)
+    min_null = 1
+    max_null = -1
+    for start in range(0, spectrum.shape[0], chunk_size):
+        chunk = spectrum[start:start + chunk_size]
+        # the shifts are drawn voxel by voxel, so drawing them chunk by
+        # chunk gives the same random numbers as a single draw
+        ISC_null = loo_correlation(
+            phase_shift(chunk, timepoints, random_state),
+            np.einsum('vfs,vfs->vs', chunk, np.conj(chunk)).real)
+        if collapse_subj:
+            ISC_null = ISC_null.mean(axis=1)
+        max_null = max(np.max(ISC_null), max_null)
+        min_null = min(np.min(ISC_null), min_null)
+    return min_null, max_null
+
+
+def isc_permutations(D, masked, permutations, collapse_subj=True,
+                     random_state=0, n_procs=1):
+    """Null distributions of the minimum and maximum ISC over
+    ``permutations`` phase randomizations of ``D``.
+
+    The spectrum of the masked data is computed once and shared by all
+    permutations, each of which draws its phase shifts from its own seed.
+
+    Returns
+    -------
+    min_null, max_null : numpy.ndarray
+    """
+    D = D[masked]
+    return permutation_nulls(isc_null, centered_spectrum(D),
+                             permutation_seeds(permutations, random_state),
+                             n_procs=n_procs, timepoints=D.shape[1],
+                             collapse_subj=collapse_subj)
@@ -1,7 +1,8 @@
 import numpy as np
 from CPAC.utils import correlation
 
-from .utils import p_from_null, phase_randomize
+from .utils import centered_spectrum, p_from_null, permutation_nulls, \
+    permutation_seeds, phase_randomize, phase_shift
 
 
 def isfc(D, std=None, collapse_subj=True):
@@ -96,3 +97,61 @@ def isfc_permutation(permutation, D, masked, collapse_subj=True, random_state=0)
         min_null = np.min(ISFC_null)
 
     return permutation, min_null, max_null
+
+
+def isfc_null(spectrum, timepoints, random_state, collapse_subj=True):
+    """Minimum and maximum ISFC of one phase-randomized permutation of a
+    spectrum from :func:`CPAC.isc.utils.centered_spectrum`, equivalent to
+    :func:`isfc_permutation` with the same ``random_state``"""
+    min_null = 1
+    max_null = -1
+
+    F = phase_shift(spectrum, timepoints, random_state)
+    n_vox, _, n_subj = F.shape
+    norm = np.sqrt(np.einsum('vfs,vfs->vs', F, np.conj(F)).real)
+    group_sum = F.sum(axis=2)
+
+    if collapse_subj:
+        ISFC_null = np.zeros((n_vox, n_vox))
+
+    for loo_subj in range(n_subj):
+        loo_subj_F = F[:, :, loo_subj]
+        others_F = group_sum - loo_subj_F
+        others_norm = np.sqrt(np.einsum('vf,vf->v', others_F,
+                                        np.conj(others_F)).real)
+        ISFC_subj = np.zeros((n_vox, n_vox))
+        var = np.outer(norm[:, loo_subj], others_norm)
+        np.divide(np.dot(loo_subj_F, np.conj(others_F).T).real,
+                  var, out=ISFC_subj, where=var > 0)
+        ISFC_subj = np.clip(ISFC_subj, -1.0, 1.0)
+        ISFC_subj = (ISFC_subj + ISFC_subj.T) / 2
+
+        if collapse_subj:
+            ISFC_null += ISFC_subj
+        else:
+            max_null = max(np.max(ISFC_subj), max_null)
+            min_null = min(np.min(ISFC_subj), min_null)
+
+    if collapse_subj:
+        ISFC_null /= n_subj
+        max_null = np.max(ISFC_null)
+        min_null = np.min(ISFC_null)
+
+    return min_null, max_null
+
+
+def isfc_permutations(D, masked, permutations, collapse_subj=True,
+                      random_state=0, n_procs=1):
+    """Null distributions of the minimum and maximum ISFC over
+    ``permutations`` phase randomizations of ``D``, sharing one spectrum of
+    the masked data across all permutations.
+
+    Returns
+    -------
+    min_null, max_null : numpy.ndarray
+    """
+    D = D[masked]
+    return permutation_nulls(isfc_null, centered_spectrum(D),
+                             permutation_seeds(permutations, random_state),
+                             n_procs=n_procs, timepoints=D.shape[1],
+                             collapse_subj=collapse_subj)
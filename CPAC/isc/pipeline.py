@@ -20,20 +20,16 @@ import nibabel as nb
 from CPAC.isc.isc import (
     isc,
     isc_significance,
-    isc_permutation,
+    isc_permutations,
 )
 
 from CPAC.isc.isfc import (
     isfc,
     isfc_significance,
-    isfc_permutation,
+    isfc_permutations,
 )
 
 
-def _permutations(perm):
-    return range(perm)
-
-
 def load_data(subjects):
     subject_ids = list(subjects.keys())
     subject_files = list(subjects[i] for i in subject_ids)
@@ -151,15 +147,14 @@ def node_isc_significance(ISC, min_null, max_null, two_sided=False):
     return f
 
 
-def node_isc_permutation(permutation, D, masked, collapse_subj=True, random_state=0):
+def node_isc_permutations(permutations, D, masked, collapse_subj=True,
+                         random_state=0, n_procs=1):
     D = np.load(D)
     masked = np.load(masked)
-    permutation, min_null, max_null = isc_permutation(permutation,
-                                                      D,
-                                                      masked,
-                                                      collapse_subj,
-                                                      random_state)
-    return permutation, min_null, max_null
+    min_null, max_null = isc_permutations(D, masked, permutations,
+                                          collapse_subj, random_state,
+                                          n_procs)
+    return min_null, max_null
 
 
 def node_isfc(D, std=None, collapse_subj=True):
@@ -184,18 +179,18 @@ def node_isfc_significance(ISFC, min_null, max_null, two_sided=False):
     return f
 
 
-def node_isfc_permutation(permutation, D, masked, collapse_subj=True, random_state=0):
+def node_isfc_permutations(permutations, D, masked, collapse_subj=True,
+                          random_state=0, n_procs=1):
     D = np.load(D)
     masked = np.load(masked)
-    permutation, min_null, max_null = isfc_permutation(permutation,
-                                                       D,
-                                                       masked,
-                                                       collapse_subj,
-                                                       random_state)
-    return permutation, min_null, max_null
+    min_null, max_null = isfc_permutations(D, masked, permutations,
+                                           collapse_subj, random_state,
+                                           n_procs)
+    return min_null, max_null
 
 
-def create_isc(name='isc', output_dir=None, working_dir=None, crash_dir=None):
+def create_isc(name='isc', output_dir=None, working_dir=None, crash_dir=None,
+               n_procs=1):
     """
     Inter-Subject Correlation
     
@@ -203,6 +198,8 @@ def create_isc(name='isc', output_dir=None, working_dir=None, crash_dir=None):
     ----------
     name : string, optional
         Name of the workflow.
+    n_procs : integer, optional
+        Number of processes to run the permutations on
         
     Returns
     -------
@@ -281,17 +278,19 @@ def create_isc(name='isc', output_dir=None, working_dir=None, crash_dir=None):
                                 as_module=True),
                        name='ISC')
 
-    permutations_node = pe.MapNode(Function(input_names=['permutation',
-                                                         'D',
-                                                         'masked',
-                                                         'collapse_subj',
-                                                         'random_state'],
-                                            output_names=['permutation',
-                                                          'min_null',
-                                                          'max_null'],
-                                            function=node_isc_permutation,
-                                            as_module=True),
-                                   name='ISC_permutation', iterfield='permutation')
+    permutations_node = pe.Node(Function(input_names=['permutations',
+                                                      'D',
+                                                      'masked',
+                                                      'collapse_subj',
+                                                      'random_state',
+                                                      'n_procs'],
+                                         output_names=['min_null',
+                                                       'max_null'],
+                                         function=node_isc_permutations,
+                                         as_module=True),
+                                name='ISC_permutations', n_procs=n_procs)
+    # the permutations' worker pool is the node's allocation
+    permutations_node.inputs.n_procs = n_procs
 
     significance_node = pe.Node(Function(input_names=['ISC',
                                                       'min_null',
@@ -313,7 +312,7 @@ def create_isc(name='isc', output_dir=None, working_dir=None, crash_dir=None):
         (data_node, permutations_node, [('D', 'D')]),
         (isc_node, permutations_node, [('masked', 'masked')]),
         (inputspec, permutations_node, [('collapse_subj', 'collapse_subj')]),
-        (inputspec, permutations_node, [(('permutations', _permutations), 'permutation')]),
+        (inputspec, permutations_node, [('permutations', 'permutations')]),
         (inputspec, permutations_node, [('random_state', 'random_state')]),
 
         (permutations_node, significance_node, [('min_null', 'min_null')]),
@@ -335,7 +334,7 @@ def create_isc(name='isc', output_dir=None, working_dir=None, crash_dir=None):
 
 
 def create_isfc(name='isfc', output_dir=None, working_dir=None,
-                crash_dir=None):
+                crash_dir=None, n_procs=1):
     """
     Inter-Subject Functional Correlation
     
@@ -343,6 +342,8 @@ def create_isfc(name='isfc', output_dir=None, working_dir=None,
     ----------
     name : string, optional
         Name of the workflow.
+    n_procs : integer, optional
+        Number of processes to run the permutations on
         
     Returns
     -------
@@ -419,17 +420,19 @@ def create_isfc(name='isfc', output_dir=None, working_dir=None,
                                 as_module=True),
                        name='ISFC')
 
-    permutations_node = pe.MapNode(Function(input_names=['permutation',
-                                                         'D',
-                                                         'masked',
-                                                         'collapse_subj',
-                                                         'random_state'],
-                                            output_names=['permutation',
-                                                          'min_null',
-                                                          'max_null'],
-                                            function=node_isfc_permutation,
-                                            as_module=True),
-                                   name='ISFC_permutation', iterfield='permutation')
+    permutations_node = pe.Node(Function(input_names=['permutations',
+                                                      'D',
+                                                      'masked',
+                                                      'collapse_subj',
+                                                      'random_state',
+                                                      'n_procs'],
+                                         output_names=['min_null',
+                                                       'max_null'],
+                                         function=node_isfc_permutations,
+                                         as_module=True),
+                                name='ISFC_permutations', n_procs=n_procs)
+    # the permutations' worker pool is the node's allocation
+    permutations_node.inputs.n_procs = n_procs
 
     significance_node = pe.Node(Function(input_names=['ISFC',
                                                       'min_null',
@@ -451,7 +454,7 @@ def create_isfc(name='isfc', output_dir=None, working_dir=None,
         (data_node, permutations_node, [('D', 'D')]),
         (isfc_node, permutations_node, [('masked', 'masked')]),
         (inputspec, permutations_node, [('collapse_subj', 'collapse_subj')]),
-        (inputspec, permutations_node, [(('permutations', _permutations), 'permutation')]),
+        (inputspec, permutations_node, [('permutations', 'permutations')]),
         (inputspec, permutations_node, [('random_state', 'random_state')]),
 
         (permutations_node, significance_node, [('min_null', 'min_null')]),
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+from scipy.fftpack import fft, ifft
+
+from CPAC.isc.isc import isc_permutation, isc_permutations
+from CPAC.isc.isfc import isfc_permutation, isfc_permutations
+from CPAC.isc.pipeline import create_isc
+from CPAC.isc.utils import permutation_seeds, phase_randomize
+
+
+@pytest.mark.parametrize('timepoints', [40, 41])
+def test_phase_randomize(timepoints):
+    D = np.random.default_rng(0).standard_normal((5, timepoints, 3))
+    F = fft(D, axis=1)
+    pos_freq = np.arange(1, (timepoints + 1) // 2)
+    neg_freq = timepoints - pos_freq
+    shift = np.random.RandomState(42).rand(5, len(pos_freq), 3) * 2 * np.pi
+    F[:, pos_freq, :] *= np.exp(1j * shift)
+    F[:, neg_freq, :] *= np.exp(-1j * shift)
+    assert np.allclose(phase_randomize(D, 42), np.real(ifft(F, axis=1)))
+
+
+@pytest.mark.parametrize('timepoints', [40, 41])
+@pytest.mark.parametrize('collapse_subj', [True, False])
+@pytest.mark.parametrize('n_procs', [1, 2])
+@pytest.mark.parametrize('permutation_funcs', [
+    (isc_permutation, isc_permutations),
+    (isfc_permutation, isfc_permutations)])
+def test_permutations(timepoints, collapse_subj, n_procs,
+                      permutation_funcs):
+    permutation, permutations = permutation_funcs
+    D = np.random.default_rng(1).standard_normal((30, timepoints, 6))
+    masked = np.ones(30, dtype=bool)
+    masked[5] = False
+
+    expected = np.array([
+        permutation(i, D, masked, collapse_subj, seed)[1:]
+        for i, seed in enumerate(permutation_seeds(7, random_state=3))]).T
+    result = permutations(D, masked, 7, collapse_subj, random_state=3,
+                          n_procs=n_procs)
+
+    assert np.allclose(result, expected, atol=1e-6)
+    # every permutation draws its own phase shifts
+    assert len(np.unique(result[1])) == 7
+
+
+def test_create_isc(tmp_path):
+    rng = np.random.default_rng(2)
+    subjects = {}
+    for subject in range(4):
+        subjects[f'sub-{subject}'] = str(tmp_path / f'sub-{subject}.csv')
+        np.savetxt(subjects[f'sub-{subject}'],
+                   rng.standard_normal((50, 8)))
+
+    wf = create_isc(output_dir=str(tmp_path / 'out'),
+                    working_dir=str(tmp_path / 'work'),
+                    crash_dir=str(tmp_path / 'crash'), n_procs=2)
+    assert wf.get_node('ISC_permutations').n_procs == 2
+    wf.inputs.inputspec.subjects = subjects
+    wf.inputs.inputspec.permutations = 20
+    wf.inputs.inputspec.collapse_subj = True
+    wf.run(plugin='Linear')
+
+    p = np.loadtxt(tmp_path / 'out' / 'significance.csv', delimiter=',')
+    assert p.shape == (8,)
+    assert ((p >= 0) & (p <= 1)).all()
@@ -1,7 +1,19 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing.shared_memory import SharedMemory
+
 import numpy as np
-from scipy.fftpack import fft, ifft
+from scipy.fft import irfft, rfft
 
 from CPAC.utils import check_random_state
+from CPAC.utils.monitoring import getLogger
+
+logger = getLogger('nipype.workflow')
+
+# permutations handed to a worker at a time
+PERMUTATION_BATCH_SIZE = 50
+
+# base spectrum of the worker processes, attached from shared memory
+_shared = {}
 
 
 def ecdf(x):
@@ -10,24 +22,136 @@ def ecdf(x):
     return lambda q: yp[np.searchsorted(xp, q, side="right")]
 
 
+def positive_frequencies(timepoints):
+    """Indices of the real FFT bins whose phase is randomized, ie every bin
+    but the mean and, for an even number of timepoints, the Nyquist bin"""
+    return np.arange(1, (timepoints + 1) // 2)
+
+
 def phase_randomize(D, random_state=0):
     random_state = check_random_state(random_state)
 
-    F = fft(D, axis=1)
-    if D.shape[1] % 2 == 0:
-        pos_freq = np.arange(1, D.shape[1] // 2)
-        neg_freq = np.arange(D.shape[1] - 1, D.shape[1] // 2, -1)
-    else:
-        pos_freq = np.arange(1, (D.shape[1] - 1) // 2 + 1)
-        neg_freq = np.arange(D.shape[1] - 1, (D.shape[1] - 1) // 2, -1)
+    F = rfft(D, axis=1)
+    pos_freq = positive_frequencies(D.shape[1])
 
     shift = random_state.rand(D.shape[0], len(pos_freq),
                               D.shape[2]) * 2 * np.pi
 
     F[:, pos_freq, :] *= np.exp(1j * shift)
-    F[:, neg_freq, :] *= np.exp(-1j * shift)
 
-    return np.real(ifft(F, axis=1))
+    return irfft(F, n=D.shape[1], axis=1)
+
+
+def centered_spectrum(D):
+    """Real FFT of a voxel × time × subject array along time, weighted so
+    that ``np.real(np.sum(X * np.conj(Y)))`` over the frequency axis is
+    proportional to the cross-product of the demeaned time series.
+
+    Phase randomization leaves the magnitudes of this spectrum unchanged,
+    so it only has to be computed once for all permutations.
+    """
+    F = rfft(D, axis=1)
+    weights = np.full(F.shape[1], np.sqrt(2))
+    weights[0] = 0
+    if D.shape[1] % 2 == 0:
+        weights[-1] = 1
+    F *= weights[:, np.newaxis]
+    return F
+
+
+def phase_shift(spectrum, timepoints, random_state):
+    """Apply the random phase shifts of :func:`phase_randomize` to a
+    spectrum from :func:`centered_spectrum`, drawing the same random
+    numbers for the same ``random_state``.
+
+    The rotations are evaluated in single precision, which is an order of
+    magnitude faster than double precision trigonometry and well below the
+    resolution of a null distribution.
+    """
+    random_state = check_random_state(random_state)
+    pos_freq = slice(1, (timepoints + 1) // 2)
+    shift = (random_state.rand(spectrum.shape[0], pos_freq.stop - 1,
+                               spectrum.shape[2]) *
+             2 * np.pi).astype(np.float32)
+    rotation = np.empty(shift.shape, dtype=np.complex64)
+    np.cos(shift, out=rotation.real)
+    np.sin(shift, out=rotation.imag)
+    F = spectrum.copy()
+    F[:, pos_freq, :] *= rotation
+    return F
+
+
+def permutation_seeds(permutations, random_state=0):
+    """One seed per permutation, so that every permutation draws different
+    phase shifts and the null distributions are reproducible regardless of
+    the order in which the permutations are run"""
+    random_state = check_random_state(random_state)
+    return random_state.randint(np.iinfo(np.int32).max, size=permutations)
+
+
+def _attach_spectrum(name, shape, dtype):
+    shm = SharedMemory(name=name)
+    _shared['shm'] = shm
+    _shared['spectrum'] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _null_batch(null_function, permutations, seeds, kwargs):
+    spectrum = _shared['spectrum']
+    return permutations, [
+        null_function(spectrum, random_state=seed, **kwargs)
+        for seed in seeds]
+
+
+def permutation_nulls(null_function, spectrum, seeds, n_procs=1,
+                      batch_size=PERMUTATION_BATCH_SIZE, **kwargs):
+    """Run ``null_function(spectrum, random_state=seed, **kwargs)`` for
+    every seed and gather the (min, max) pairs it returns.
+
+    With ``n_procs`` > 1, the permutations run in batches on a process
+    pool whose workers share ``spectrum`` through shared memory instead of
+    each receiving a copy.
+
+    Returns
+    -------
+    min_null, max_null : numpy.ndarray
+        Minimum and maximum statistic of each permutation.
+    """
+    permutations = len(seeds)
+    min_null = np.empty(permutations)
+    max_null = np.empty(permutations)
+
+    if n_procs <= 1:
+        for permutation, seed in enumerate(seeds):
+            min_null[permutation], max_null[permutation] = \
+                null_function(spectrum, random_state=seed, **kwargs)
+        return min_null, max_null
+
+    shm = SharedMemory(create=True, size=spectrum.nbytes)
+    try:
+        np.ndarray(spectrum.shape, dtype=spectrum.dtype,
+                   buffer=shm.buf)[:] = spectrum
+        with ProcessPoolExecutor(
+                max_workers=n_procs, initializer=_attach_spectrum,
+                initargs=(shm.name, spectrum.shape, spectrum.dtype)
+        ) as executor:
+            futures = [
+                executor.submit(_null_batch, null_function,
+                                np.arange(start, min(start + batch_size,
+                                                     permutations)),
+                                seeds[start:start + batch_size], kwargs)
+                for start in range(0, permutations, batch_size)
+            ]
+            done = 0
+            for future in as_completed(futures):
+                batch, nulls = future.result()
+                min_null[batch], max_null[batch] = np.array(nulls).T
+                done += len(batch)
+                logger.debug('Permutations %d/%d', done, permutations)
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return min_null, max_null
 
 
 def p_from_null(X, 
@@ -568,7 +568,7 @@ def anat_longitudinal_wf(subject_id, sub_list, config):
         wf.run()
 
         # now, just write out a copy of the above to each session
-        config.pipeline_setup['pipeline_name'] = orig_pipe_name
+        config['pipeline_setup', 'pipeline_name'] = orig_pipe_name
         for session in sub_list:
 
             unique_id = session['unique_id']
@@ -621,7 +621,7 @@ def anat_longitudinal_wf(subject_id, sub_list, config):
                            select_sess, 'warp_path', {}, "",
                            select_node_name)
 
-            config.pipeline_setup['pipeline_name'] = orig_pipe_name
+            config['pipeline_setup', 'pipeline_name'] = orig_pipe_name
             excl = ['space-template_desc-brain_T1w',
                     'space-T1w_desc-brain_mask']
 
@@ -3,8 +3,261 @@ import nipype.interfaces.utility as util
 
 
 
-def median_angle_correct(target_angle_deg, realigned_file):
+N_COMPONENTS = 5
+"""Principal components whose angles with every voxel are saved"""
+
+
+def normalized_timeseries(realigned_file, chunk_size=4096):
+    """
+    Demeaned, unit-norm timeseries of the non-zero voxels of an image
+
+    Parameters
+    ----------
+    realigned_file : str
+
+    chunk_size : int
+        voxels normalized at a time (in double precision)
+
+    Returns
+    -------
+    Yn : float32 array of shape (voxels, timepoints)
+
+    mask : boolean array
+        non-zero voxels
+
+    norms : array of shape (voxels,)
+        norm of each demeaned timeseries
+
+    global_signal : array of shape (timepoints,)
+        mean demeaned timeseries over voxels
+
+    normalized_mean : array of shape (timepoints,)
+        mean normalized timeseries over voxels
+    """
+    import numpy as np
+    from CPAC.utils.data_cache import load_image_data
+
+    data = load_image_data(realigned_file, dtype=np.float32)
+    mask = np.any(data != 0, axis=-1)
+    Yn = np.array(data[mask], dtype=np.float32)
+    del data
+    norms = np.zeros(Yn.shape[0])
+    global_signal = np.zeros(Yn.shape[1])
+    normalized_mean = np.zeros(Yn.shape[1])
+    for start in range(0, Yn.shape[0], chunk_size):
+        chunk = Yn[start:start + chunk_size].astype(np.float64)
+        chunk -= chunk.mean(axis=1, keepdims=True)
+        global_signal += chunk.sum(axis=0)
+        norm = np.sqrt((chunk * chunk).sum(axis=1))
+        norms[start:start + chunk_size] = norm
+        chunk /= np.where(norm > 0, norm, 1)[:, np.newaxis]
+        normalized_mean += chunk.sum(axis=0)
+        Yn[start:start + chunk_size] = chunk
+    return (Yn, mask, norms, global_signal / Yn.shape[0],
+            normalized_mean / Yn.shape[0])
+
+
+def leading_components(Yn, realigned_file=None, components_file=None,
+                       svd_method='truncated', chunk_size=4096):
+    """
+    Leading left singular vectors of the (timepoints × voxels) normalized
+    data, read from ``components_file`` if it was saved for the same
+    image, computed from the timepoints × timepoints Gram matrix otherwise
+
+    Parameters
+    ----------
+    Yn : array of shape (voxels, timepoints)
+
+    realigned_file : str, optional
+        image ``Yn`` is from, to match against ``components_file``
+
+    components_file : str, optional
+        ``.npz`` written by :func:`save_components`
+
+    svd_method : str
+        'truncated' or 'randomized', see
+        :func:`CPAC.nuisance.utils.compcor.top_eigenvectors`
+
+    chunk_size : int
+
+    Returns
+    -------
+    array of shape (timepoints, N_COMPONENTS)
+    """
+    import numpy as np
+    from CPAC.nuisance.utils.compcor import gram_product, top_eigenvectors
+    if components_file:
+        saved = np.load(components_file)
+        if str(saved['realigned_file']) == str(realigned_file) and \
+                saved['components'].shape[0] == Yn.shape[1]:
+            return saved['components']
+    n_components = min(N_COMPONENTS, *Yn.shape)
+    components = top_eigenvectors(
+        lambda vectors: gram_product(Yn, vectors, chunk_size), Yn.shape[1],
+        n_components, svd_method)
+    # deterministic signs
+    return components * np.sign(components[
+        np.abs(components).argmax(axis=0), np.arange(n_components)])
+
+
+def save_components(components, realigned_file):
+    """Save an image's leading components for :func:`leading_components`
+
+    Returns
+    -------
+    components_file : str
+    """
+    import os
+    import numpy as np
+    components_file = os.path.join(os.getcwd(), 'components_U5_Yn.npz')
+    np.savez(components_file, components=components,
+             realigned_file=str(realigned_file))
+    return components_file
+
+
+def _oriented(pc, reference):
+    """``pc`` with the sign that correlates positively with ``reference``"""
+    from scipy.stats import pearsonr
+    return pc if pearsonr(reference, pc)[0] >= 0 else -pc
+
+
+def _voxel_angles(vectors, Yn, chunk_size=4096):
+    """Angles (radians) between unit vectors and each voxel's normalized
+    timeseries, shape (vectors, voxels)"""
+    import numpy as np
+    angles = np.empty((vectors.shape[1], Yn.shape[0]))
+    for start in range(0, Yn.shape[0], chunk_size):
+        angles[:, start:start + chunk_size] = np.arccos(np.clip(
+            vectors.T @ Yn[start:start + chunk_size].astype(np.float64).T,
+            -1, 1))
+    return angles
+
+
+def median_angle_correct(target_angle_deg, realigned_file,
+                         components_file=None, svd_method='truncated',
+                         chunk_size=4096):
+    """
+    Performs median angle correction on fMRI data.  Median angle correction algorithm
+    based on [1]_.
+
+    Only the non-zero voxels are held in memory (in single precision),
+    only the leading principal components are computed, the angles are
+    shifted in place in chunks of voxels, and the corrected image is
+    written one volume at a time.
+
+    Parameters
+    ----------
+    target_angle_deg : float
+        Target median angle to adjust the time-series data.
+    realigned_file : string
+        Path of a realigned nifti file.
+    components_file : string, optional
+        Path of the components saved by :func:`calc_median_angle_params`
+        for the same file, to skip recomputing them.
+    svd_method : string, optional
+        'truncated' (exact) or 'randomized'.
+    chunk_size : int, optional
+        Voxels processed at a time.
+
+    Returns
+    -------
+    corrected_file : string
+        Path of corrected file (nifti file).
+    angles_file : string
+        Path of numpy file (.npy file) containing the angles (in radians) of all voxels with 
+        the 5 largest principal components.
+
+    References
+    ----------
+    .. [1] H. He and T. T. Liu, "A geometric view of global signal confounds in resting-state functional MRI," NeuroImage, Sep. 2011.
+
     """
+    import numpy as np
+    import nibabel as nb
+    import os
+    from CPAC.median_angle.median_angle import _oriented, _voxel_angles, \
+        leading_components, normalized_timeseries
+    from CPAC.utils.nifti_utils import write_masked_timeseries
+
+    Yn, mask, _, global_signal, _ = normalized_timeseries(realigned_file,
+                                                          chunk_size)
+    U = leading_components(Yn, realigned_file, components_file, svd_method,
+                           chunk_size)
+    PC1 = _oriented(U[:, 0], global_signal)
+
+    angles_U5_Yn = _voxel_angles(U, Yn, chunk_size)
+    theta = _voxel_angles(PC1[:, np.newaxis], Yn, chunk_size)[0]
+    median_angle = np.median(theta)
+    angle_shift = (np.pi / 180) * target_angle_deg - median_angle
+    if angle_shift > 0:
+        # shift every voxel's timeseries away from PC1, in place
+        for start in range(0, Yn.shape[0], chunk_size):
+            A = Yn[start:start + chunk_size].astype(np.float64)
+            x = A - np.outer(A @ PC1, PC1)
+            x_norm = np.sqrt((x * x).sum(axis=1, keepdims=True))
+            x /= np.where(x_norm > 0, x_norm, 1)
+            theta_new = theta[start:start + chunk_size, np.newaxis] + \
+                angle_shift
+            Yn[start:start + chunk_size] = (np.cos(theta_new) * PC1 +
+                                            np.sin(theta_new) * x)
+    # else: 'Median Angle >= Target Angle, skipping correction'
+
+    corrected_file = os.path.join(os.getcwd(), 'median_angle_corrected.nii.gz')
+    angles_file = os.path.join(os.getcwd(), 'angles_U5_Yn.npy')
+
+    np.save(angles_file, angles_U5_Yn)
+    write_masked_timeseries(Yn, mask, nb.load(realigned_file),
+                            corrected_file)
+
+    return corrected_file, angles_file
+
+
+def calc_median_angle_params(subject, svd_method='truncated',
+                             chunk_size=4096):
+    """
+    Calculates median angle parameters of a subject
+
+    Parameters
+    ----------
+    subject : string
+        Path of a subject's nifti file.
+    svd_method : string, optional
+        'truncated' (exact) or 'randomized'.
+    chunk_size : int, optional
+        Voxels processed at a time.
+
+    Returns
+    -------
+    mean_bold : float
+        Mean bold amplitude of a subject. 
+    median_angle : float
+        Median angle of a subject.
+    components_file : string
+        Path of the subject's leading principal components, for
+        :func:`median_angle_correct`.
+    """
+    import numpy as np
+    from CPAC.median_angle.median_angle import _oriented, _voxel_angles, \
+        leading_components, normalized_timeseries, save_components
+
+    Yn, _, norms, _, normalized_mean = normalized_timeseries(subject,
+                                                             chunk_size)
+    U = leading_components(Yn, svd_method=svd_method, chunk_size=chunk_size)
+    PC1 = _oriented(U[:, 0], normalized_mean)
+    median_angle = np.median(_voxel_angles(PC1[:, np.newaxis], Yn,
+                                           chunk_size)[0])
+    median_angle *= 180.0/np.pi
+    # standard deviation of each demeaned timeseries
+    mean_bold = (norms / np.sqrt(Yn.shape[1])).mean()
+
+    return mean_bold, median_angle, save_components(U, subject)
+
+
+def median_angle_correct_full_svd(target_angle_deg, realigned_file):
+    """
+    Reference (float64, full SVD) implementation of
+    :func:`median_angle_correct`, kept for validation.
+
     Performs median angle correction on fMRI data.  Median angle correction algorithm
     based on [1]_.
     
@@ -88,8 +341,11 @@ def median_angle_correct(target_angle_deg, realigned_file):
 
     return corrected_file, angles_file
 
-def calc_median_angle_params(subject):
+def calc_median_angle_params_full_svd(subject):
     """
+    Reference (float64, full SVD) implementation of
+    :func:`calc_median_angle_params`, kept for validation.
+
     Calculates median angle parameters of a subject
     
     Parameters
@@ -186,6 +442,9 @@ def create_median_angle_correction(name='median_angle_correction'):
             Realigned nifti file of a subject
         inputspec.target_angle : integer
             Target angle in degrees to correct the median angle to
+        inputspec.components_file : string (.npz file), optional
+            Leading principal components of the subject, from
+            ``outputspec.components_files`` of the target angle workflow
             
     Workflow Outputs::
     
@@ -221,15 +480,19 @@ def create_median_angle_correction(name='median_angle_correction'):
     """
     median_angle_correction = pe.Workflow(name=name)
     
+    # components_file is optional; without it, the components are computed
     inputspec = pe.Node(util.IdentityInterface(fields=['subject',
-                                                       'target_angle']),
+                                                       'target_angle',
+                                                       'components_file'],
+                                               mandatory_inputs=False),
                         name='inputspec')
     outputspec = pe.Node(util.IdentityInterface(fields=['subject',
                                                         'pc_angles']),
                          name='outputspec')
     
     mac = pe.Node(util.Function(input_names=['target_angle_deg',
-                                             'realigned_file'],
+                                             'realigned_file',
+                                             'components_file'],
                                 output_names=['corrected_file',
                                               'angles_file'],
                                 function=median_angle_correct),
@@ -239,6 +502,8 @@ def create_median_angle_correction(name='median_angle_correction'):
                                     mac, 'realigned_file')
     median_angle_correction.connect(inputspec, 'target_angle',
                                     mac, 'target_angle_deg')
+    median_angle_correction.connect(inputspec, 'components_file',
+                                    mac, 'components_file')
     median_angle_correction.connect(mac, 'corrected_file',
                                     outputspec, 'subject')
     median_angle_correction.connect(mac, 'angles_file',
@@ -272,6 +537,9 @@ def create_target_angle(name='target_angle'):
     
         outputspec.target_angle : float
             Target angle over the provided group of subjects.
+        outputspec.components_files : list (.npz files)
+            Leading principal components of each subject, to reuse in
+            the median angle correction.
             
     Target Angle procedure:
     
@@ -303,12 +571,14 @@ def create_target_angle(name='target_angle'):
     
     inputspec = pe.Node(util.IdentityInterface(fields=['subjects']),
                         name='inputspec')
-    outputspec = pe.Node(util.IdentityInterface(fields=['target_angle']),
+    outputspec = pe.Node(util.IdentityInterface(fields=['target_angle',
+                                                        'components_files']),
                          name='outputspec')
     
     cmap = pe.MapNode(util.Function(input_names=['subject'],
                                     output_names=['mean_bold',
-                                                  'median_angle'],
+                                                  'median_angle',
+                                                  'components_file'],
                                     function=calc_median_angle_params),
                       name='median_angle_params',
                       iterfield=['subject'])
@@ -327,5 +597,7 @@ def create_target_angle(name='target_angle'):
                          cta, 'median_angles')
     target_angle.connect(cta, 'target_angle',
                          outputspec, 'target_angle')
+    target_angle.connect(cmap, 'components_file',
+                         outputspec, 'components_files')
     
     return target_angle
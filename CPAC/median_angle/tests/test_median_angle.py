@@ -0,0 +1,105 @@
+import os
+
+import nibabel as nb
+import numpy as np
+import pytest
+from nipype.interfaces.base import isdefined
+
+from CPAC.median_angle import median_angle
+
+
+def _synthetic_run(tmp_path, shape=(9, 8, 6), timepoints=80, seed=0):
+    """Write a synthetic BOLD run with a strong global signal and an
+    all-zero background"""
+    rng = np.random.default_rng(seed)
+    global_signal = rng.standard_normal(timepoints)
+    data = (rng.uniform(0.5, 2, shape + (1,)) * global_signal +
+            rng.standard_normal(shape + (timepoints,)) + 100
+            ).astype(np.float32)
+    data[:2] = 0
+    in_file = str(tmp_path / 'bold.nii.gz')
+    nb.Nifti1Image(data, np.diag([2, 2, 3, 1])).to_filename(in_file)
+    return in_file
+
+
+def _run(tmp_path, name, function, *args, **kwargs):
+    os.makedirs(tmp_path / name)
+    cwd = os.getcwd()
+    os.chdir(tmp_path / name)
+    try:
+        return function(*args, **kwargs)
+    finally:
+        os.chdir(cwd)
+
+
+@pytest.mark.parametrize('target_angle', [90, 10])
+@pytest.mark.parametrize('svd_method', ['truncated', 'randomized'])
+def test_median_angle_correct(tmp_path, svd_method, target_angle):
+    """Corrected image and angles should match the full SVD's"""
+    in_file = _synthetic_run(tmp_path)
+    expected = _run(tmp_path, 'full_svd',
+                    median_angle.median_angle_correct_full_svd,
+                    target_angle, in_file)
+    result = _run(tmp_path, svd_method, median_angle.median_angle_correct,
+                  target_angle, in_file, svd_method=svd_method,
+                  chunk_size=50)
+    expected_img, result_img = nb.load(expected[0]), nb.load(result[0])
+    assert result_img.get_data_dtype() == np.float32
+    assert np.allclose(result_img.affine, expected_img.affine)
+    assert np.allclose(result_img.get_fdata(), expected_img.get_fdata(),
+                       atol=1e-4)
+    # principal components are only defined up to sign; the trailing
+    # components of this noise are too close for a randomized SVD to
+    # single out
+    rows = slice(None) if svd_method == 'truncated' else slice(1)
+    expected_angles, result_angles = (np.load(expected[1])[rows],
+                                      np.load(result[1])[rows])
+    assert np.allclose(np.minimum(np.abs(result_angles - expected_angles),
+                                  np.abs(result_angles + expected_angles -
+                                         np.pi)), 0, atol=1e-3)
+
+
+def test_calc_median_angle_params(tmp_path):
+    in_file = _synthetic_run(tmp_path)
+    expected = median_angle.calc_median_angle_params_full_svd(in_file)
+    mean_bold, angle, components_file = _run(
+        tmp_path, 'params', median_angle.calc_median_angle_params, in_file)
+    assert np.allclose((mean_bold, angle), expected)
+    # the correction reuses the saved components
+    components = np.load(components_file)['components']
+    saved = np.load(components_file)
+    np.savez(components_file, components=-components,
+             realigned_file=saved['realigned_file'])
+    reused = _run(tmp_path, 'reused', median_angle.median_angle_correct,
+                  90, in_file, components_file)
+    computed = _run(tmp_path, 'computed', median_angle.median_angle_correct,
+                    90, in_file)
+    assert np.allclose(np.load(reused[1]), np.pi - np.load(computed[1]))
+    assert np.allclose(nb.load(reused[0]).get_fdata(),
+                       nb.load(computed[0]).get_fdata())
+    # components of another image are not reused
+    other_file = str(tmp_path / 'other.nii.gz')
+    nb.load(in_file).to_filename(other_file)
+    assert np.allclose(np.load(_run(
+        tmp_path, 'other', median_angle.median_angle_correct, 90,
+        other_file, components_file)[1]), np.load(computed[1]))
+
+
+def test_median_angle_correction_workflow(tmp_path):
+    """The workflow runs without the optional components file"""
+    in_file = _synthetic_run(tmp_path)
+    workflow = median_angle.create_median_angle_correction()
+    workflow.base_dir = str(tmp_path / 'work')
+    workflow.inputs.inputspec.subject = in_file
+    workflow.inputs.inputspec.target_angle = 90
+    inputspec = workflow.get_node('inputspec')
+    inputspec.base_dir = str(tmp_path / 'inputspec')
+    assert not isdefined(inputspec.run().outputs.components_file)
+    result = workflow.run()
+    node, = [node for node in result.nodes()
+             if node.name == 'median_angle_correct']
+    expected = _run(tmp_path, 'computed', median_angle.median_angle_correct,
+                    90, in_file)
+    assert np.allclose(nb.load(node.result.outputs.corrected_file
+                               ).get_fdata(),
+                       nb.load(expected[0]).get_fdata())
@@ -0,0 +1,438 @@
+# Copyright (C) 2024  C-PAC Developers
+
+# This file is part of C-PAC.
+
+# C-PAC is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+
+# C-PAC is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+# License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with C-PAC. If not, see <https://www.gnu.org/licenses/>.
+"""In-process voxel-wise network centrality.
+
+The masked data are detrended and standardized once, after which the
+voxel × voxel correlation matrix is only ever computed in blocks of rows
+(``Z[rows] @ Z.T``) on a thread pool. Each block is thresholded as soon as
+it is computed and reduced to degree sums, a sparse block of the
+thresholded similarity matrix (for eigenvector centrality, when it fits
+in the memory budget) or local functional connectivity density, so the
+full matrix is never held in memory.
+
+The measures follow AFNI's 3dDegreeCentrality, 3dECM and 3dLFCD: a linear
+trend is removed from every voxel (AFNI's default ``-polort 1``), voxels
+are connected if their correlation exceeds the threshold, and sparsity
+thresholds are given in percent of all connections.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import nibabel as nb
+import numpy as np
+from scipy import signal, sparse
+
+from CPAC.pipeline.schema import valid_options
+from CPAC.utils.data_cache import load_image_data
+
+MAX_BLOCK_ROWS = 512
+"""Most voxels (rows of the similarity matrix) per block"""
+BLOCK_BYTES_PER_ELEMENT = 16
+"""Scratch memory per similarity matrix element of a block: the float32
+correlations plus the mask, weights and histogram indices derived from
+them"""
+SPARSE_BYTES_PER_EDGE = 8
+"""Memory per stored edge of the sparse similarity matrix (float32 value
+and int32 column index)"""
+SPARSITY_BINS = 2 ** 16
+"""Histogram bins used to locate a sparsity threshold before refining it
+exactly"""
+ECM_MAX_ITER = 1000
+ECM_EPS = 0.001
+
+
+def standardize(data):
+    """Detrend voxel timeseries and scale them so that the dot product of
+    two voxels is their Pearson correlation.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        voxels × timepoints
+
+    Returns
+    -------
+    numpy.ndarray
+        float32 voxels × timepoints array. Voxels without variance are
+        all zeros.
+    """
+    data = signal.detrend(np.asarray(data, dtype=np.float64), axis=1)
+    norms = np.linalg.norm(data, axis=1)
+    standardized = np.zeros(data.shape, dtype=np.float32)
+    np.divide(data, norms[:, np.newaxis], out=standardized,
+              where=norms[:, np.newaxis] > 0, casting='unsafe')
+    return standardized
+
+
+def block_rows(n_voxels, num_threads=1, memory_gb=1.0, reserved_bytes=0):
+    """Number of rows per similarity block that keeps ``num_threads``
+    concurrent blocks within a memory budget
+
+    Parameters
+    ----------
+    n_voxels : int
+
+    num_threads : int
+
+    memory_gb : float
+
+    reserved_bytes : int
+        memory already in use, e.g. by the data
+
+    Returns
+    -------
+    int
+    """
+    available = memory_gb * 1024 ** 3 - reserved_bytes
+    per_row = n_voxels * BLOCK_BYTES_PER_ELEMENT * num_threads
+    return int(np.clip(available // per_row, 1, MAX_BLOCK_ROWS))
+
+
+class BlockedSimilarity:
+    """Thresholded voxel × voxel correlations, computed block by block
+
+    Parameters
+    ----------
+    standardized : numpy.ndarray
+        voxels × timepoints output of :func:`standardize`
+
+    num_threads : int
+
+    memory_gb : float
+        memory budget for the blocks and any stored sparse similarity
+        matrix
+    """
+    def __init__(self, standardized, num_threads=1, memory_gb=1.0):
+        self.data = standardized
+        self.n_voxels = len(standardized)
+        self.num_threads = max(int(num_threads), 1)
+        self.budget = memory_gb * 1024 ** 3 - standardized.nbytes
+        self.rows = block_rows(self.n_voxels, self.num_threads, memory_gb,
+                               standardized.nbytes)
+        self.threshold = None
+
+    def __repr__(self):
+        return (f'BlockedSimilarity({self.n_voxels} voxels, '
+                f'{self.rows} rows per block, threshold={self.threshold})')
+
+    def correlations(self, start, stop):
+        """Correlations of voxels ``start:stop`` with all voxels, with
+        self-connections set to -inf"""
+        block = self.data[start:stop] @ self.data.T
+        block[np.arange(stop - start), np.arange(start, stop)] = -np.inf
+        return block
+
+    def map_blocks(self, function):
+        """Apply ``function(start, stop, correlations)`` to every block on
+        the thread pool
+
+        Returns
+        -------
+        list
+            results in block order
+        """
+        def apply(start):
+            stop = min(start + self.rows, self.n_voxels)
+            return function(start, stop, self.correlations(start, stop))
+
+        starts = range(0, self.n_voxels, self.rows)
+        if self.num_threads == 1:
+            return [apply(start) for start in starts]
+        with ThreadPoolExecutor(self.num_threads) as pool:
+            return list(pool.map(apply, starts))
+
+    def set_correlation_threshold(self, threshold):
+        """Connect voxels whose correlation exceeds ``threshold``"""
+        self.threshold = np.float32(threshold)
+
+    def set_sparsity_threshold(self, sparsity):
+        """Connect the ``sparsity`` percent most correlated pairs of voxels
+
+        A histogram of all correlations locates the bin that contains the
+        threshold, and a second pass selects the exact threshold from the
+        correlations in that bin.
+        """
+        # every connection appears twice in the similarity matrix
+        n_edges = self.n_voxels * (self.n_voxels - 1) // 2
+        keep = 2 * int(np.clip(round(sparsity / 100 * n_edges), 1, n_edges))
+
+        def bins(correlations):
+            return np.minimum(((np.clip(correlations, -1, 1) + 1) *
+                               (SPARSITY_BINS / 2)).astype(np.int32),
+                              SPARSITY_BINS - 1)
+
+        def histogram(start, stop, correlations):
+            counts = np.bincount(bins(correlations).ravel(),
+                                 minlength=SPARSITY_BINS)
+            counts[0] -= stop - start  # self-connections
+            return counts
+
+        counts = np.sum(self.map_blocks(histogram), axis=0)
+        from_top = np.cumsum(counts[::-1])
+        threshold_bin = SPARSITY_BINS - 1 - int(np.searchsorted(from_top,
+                                                                keep))
+        keep -= from_top[SPARSITY_BINS - 2 - threshold_bin] if \
+            threshold_bin < SPARSITY_BINS - 1 else 0
+
+        def in_bin(start, stop, correlations):
+            return correlations[(bins(correlations) == threshold_bin) &
+                                np.isfinite(correlations)]
+
+        candidates = np.concatenate(self.map_blocks(in_bin))
+        threshold = np.partition(candidates, len(candidates) - keep)[
+            len(candidates) - keep]
+        self.threshold = np.nextafter(threshold, np.float32(-np.inf))
+
+    def degree(self, store=False):
+        """Binarized and weighted degree centrality
+
+        Parameters
+        ----------
+        store : bool
+            also return the thresholded similarity matrix, if it fits in
+            the memory budget
+
+        Returns
+        -------
+        binarized, weighted : numpy.ndarray
+
+        matrix : scipy.sparse.csr_matrix or None
+            weighted similarity matrix if ``store`` and it fit in the
+            budget
+        """
+        lock = threading.Lock()
+        stored = {'blocks': {}, 'edges': 0, 'fits': store}
+        scratch = self.rows * self.n_voxels * BLOCK_BYTES_PER_ELEMENT * \
+            self.num_threads
+
+        def reduce(start, stop, correlations):
+            connected = correlations > self.threshold
+            weights = np.where(connected, correlations, 0)
+            if stored['fits']:
+                block = sparse.csr_matrix(weights)
+                with lock:
+                    stored['edges'] += block.nnz
+                    if stored['edges'] * SPARSE_BYTES_PER_EDGE > \
+                            self.budget - scratch:
+                        # fall back to recomputing blocks
+                        stored['fits'] = False
+                        stored['blocks'].clear()
+                    if stored['fits']:
+                        stored['blocks'][start] = block
+            return connected.sum(axis=1), weights.sum(axis=1,
+                                                      dtype=np.float64)
+
+        blocks = self.map_blocks(reduce)
+        binarized = np.concatenate([block[0] for block in blocks])
+        weighted = np.concatenate([block[1] for block in blocks])
+        matrix = sparse.vstack([stored['blocks'][start] for start in
+                                sorted(stored['blocks'])], format='csr') if \
+            stored['fits'] else None
+        return binarized.astype(np.float64), weighted, matrix
+
+    def eigenvector(self, matrix=None, max_iter=ECM_MAX_ITER, eps=ECM_EPS):
+        """Binarized and weighted eigenvector centrality by power iteration
+
+        Parameters
+        ----------
+        matrix : scipy.sparse.csr_matrix, optional
+            stored thresholded similarity matrix. Without it every
+            iteration recomputes the similarity blocks.
+
+        max_iter : int
+
+        eps : float
+            stop once the unit-norm centrality vectors change by less
+            than this
+
+        Returns
+        -------
+        binarized, weighted : numpy.ndarray
+        """
+        if matrix is not None:
+            binary = matrix.copy()
+            binary.data[:] = 1
+
+            def product(vectors):
+                return np.column_stack([binary @ vectors[:, 0],
+                                        matrix @ vectors[:, 1]])
+        else:
+            def product(vectors):
+                def multiply(start, stop, correlations):
+                    connected = correlations > self.threshold
+                    return np.column_stack([
+                        connected @ vectors[:, 0],
+                        np.where(connected, correlations, 0) @
+                        vectors[:, 1]])
+                return np.concatenate(self.map_blocks(multiply))
+
+        vectors = np.full((self.n_voxels, 2), 1 / np.sqrt(self.n_voxels))
+        for _ in range(max_iter):
+            updated = product(vectors)
+            norms = np.linalg.norm(updated, axis=0)
+            updated = np.divide(updated, norms, out=np.zeros_like(updated),
+                                where=norms > 0)
+            converged = np.linalg.norm(updated - vectors, axis=0) < eps
+            vectors = updated
+            if converged.all():
+                break
+        return vectors[:, 0], vectors[:, 1]
+
+    def lfcd(self, neighbors):
+        """Binarized and weighted local functional connectivity density:
+        the number and summed correlation of the voxels reachable from
+        each voxel through face-adjacent voxels that are connected to it
+
+        Parameters
+        ----------
+        neighbors : numpy.ndarray
+            voxels × 6 indices of each voxel's face neighbours, -1 where
+            there is none
+
+        Returns
+        -------
+        binarized, weighted : numpy.ndarray
+        """
+        def grow(start, stop, correlations):
+            visited = np.full(self.n_voxels, -1)
+            binarized = np.zeros(stop - start)
+            weighted = np.zeros(stop - start)
+            for row, seed in enumerate(range(start, stop)):
+                connected = correlations[row] > self.threshold
+                visited[seed] = seed
+                frontier = np.array([seed])
+                while len(frontier):
+                    candidates = np.unique(neighbors[frontier].ravel())
+                    candidates = candidates[candidates >= 0]
+                    candidates = candidates[(visited[candidates] != seed) &
+                                            connected[candidates]]
+                    visited[candidates] = seed
+                    binarized[row] += len(candidates)
+                    weighted[row] += correlations[row, candidates].sum()
+                    frontier = candidates
+            return binarized, weighted
+
+        blocks = self.map_blocks(grow)
+        return (np.concatenate([block[0] for block in blocks]),
+                np.concatenate([block[1] for block in blocks]))
+
+
+def face_neighbors(mask):
+    """Indices of the face-adjacent in-mask voxels of every in-mask voxel
+
+    Parameters
+    ----------
+    mask : numpy.ndarray
+        3D boolean mask
+
+    Returns
+    -------
+    numpy.ndarray
+        in-mask voxels × 6, -1 where a neighbour is outside the mask
+    """
+    index = np.full(np.array(mask.shape) + 2, -1)
+    index[1:-1, 1:-1, 1:-1][mask] = np.arange(mask.sum())
+    coordinates = np.argwhere(mask) + 1
+    neighbors = []
+    for axis in range(3):
+        for step in (-1, 1):
+            shifted = coordinates.copy()
+            shifted[:, axis] += step
+            neighbors.append(index[tuple(shifted.T)])
+    return np.column_stack(neighbors)
+
+
+def calc_centrality(in_file, template, method_option, weight_options,
+                    threshold_option, threshold, num_threads=1,
+                    memory_gb=1.0):
+    """Compute voxel-wise network centrality in-process and write one
+    NIfTI image per weight option, like
+    :py:func:`~CPAC.network_centrality.utils.sep_nifti_subbriks` does for
+    the AFNI tools.
+
+    Parameters
+    ----------
+    in_file : str
+        path to the 4D functional image
+
+    template : str
+        path to the mask; centrality is computed for its nonzero voxels
+
+    method_option : str
+        one of ``valid_options['centrality']['method_options']``
+
+    weight_options : list of str
+        one or more of ``valid_options['centrality']['weight_options']``
+
+    threshold_option : str
+        'Correlation threshold' or 'Sparsity threshold' (significance
+        thresholds are converted to correlation thresholds upstream)
+
+    threshold : float
+        correlation threshold, or sparsity in percent
+
+    num_threads : int
+
+    memory_gb : float
+
+    Returns
+    -------
+    outfile_list : list of str
+        paths to the outputs, in the order of
+        ``valid_options['centrality']['weight_options']``
+    """
+    mask_img = nb.load(template)
+    data = load_image_data(in_file)
+    mask = mask_img.get_fdata().astype(bool)
+    if data.shape[:3] != mask.shape:
+        raise ValueError(f'Functional data {data.shape[:3]} and centrality '
+                         f'mask {mask.shape} must be on the same grid.')
+    standardized = standardize(data[mask])
+    del data
+    # voxels without variance have no connections
+    varying = standardized.any(axis=1)
+    mask[mask] = varying
+    standardized = standardized[varying]
+
+    similarity = BlockedSimilarity(standardized, num_threads, memory_gb)
+    if threshold_option == 'Sparsity threshold':
+        similarity.set_sparsity_threshold(threshold)
+    else:
+        similarity.set_correlation_threshold(threshold)
+
+    if method_option == 'degree_centrality':
+        binarized, weighted, _ = similarity.degree()
+    elif method_option == 'eigenvector_centrality':
+        matrix = similarity.degree(store=True)[2]
+        binarized, weighted = similarity.eigenvector(matrix)
+    else:
+        binarized, weighted = similarity.lfcd(face_neighbors(mask))
+    measures = dict(zip(valid_options['centrality']['weight_options'],
+                        (binarized, weighted)))
+
+    outfile_list = []
+    for weight_option in valid_options['centrality']['weight_options']:
+        if weight_option not in weight_options:
+            continue
+        out_data = np.zeros(mask.shape)
+        out_data[mask] = measures[weight_option]
+        out_file = os.path.join(os.getcwd(),
+                                f'{method_option}_{weight_option}.nii.gz')
+        nb.Nifti1Image(out_data, mask_img.affine).to_filename(out_file)
+        outfile_list.append(out_file)
+    return outfile_list
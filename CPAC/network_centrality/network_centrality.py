@@ -18,6 +18,7 @@ from pathlib import Path
 from typing import Optional, Union
 from nipype.interfaces.afni.preprocess import DegreeCentrality, LFCD
 from nipype.pipeline.engine import Workflow
+from CPAC.network_centrality.core import calc_centrality
 from CPAC.network_centrality.utils import ThresholdOptionError
 from CPAC.pipeline.schema import valid_options
 from CPAC.utils.docs import docstring_parameter
@@ -33,16 +34,17 @@ def create_centrality_wf(wf_name: str, method_option: str,
                          weight_options: LIST[str], threshold_option: str,
                          threshold: float, num_threads: Optional[int] = 1,
                          memory_gb: Optional[float] = 1.0,
-                         base_dir: Optional[Union[Path, str]] = None
-                         ) -> Workflow:
+                         base_dir: Optional[Union[Path, str]] = None,
+                         engine: Optional[str] = 'AFNI') -> Workflow:
     """
-    Function to create the afni-based centrality workflow.
+    Function to create the afni-based or native centrality workflow.
 
     .. seealso::
 
         * :py:func:`~CPAC.network_centrality.pipeline.connect_centrality_workflow`
         * :py:func:`~CPAC.network_centrality.utils.create_merge_node`
         * :py:func:`~CPAC.network_centrality.utils.sep_nifti_subbriks`
+        * :py:func:`~CPAC.network_centrality.core.calc_centrality`
 
     Parameters
     ----------
@@ -63,11 +65,15 @@ def create_centrality_wf(wf_name: str, method_option: str,
         default=1.0
     base_dir : path or str, optional
         the base directory for the workflow; default=None
+    engine : string, optional
+        'AFNI' to run the AFNI centrality tools or 'native' to compute
+        centrality in-process with blocked sparse similarity;
+        default='AFNI'
 
     Returns
     -------
     centrality_wf : nipype Workflow
-        the initialized nipype workflow for the afni centrality command
+        the initialized nipype workflow for the centrality calculation
 
     Notes
     -----
@@ -117,6 +123,47 @@ def create_centrality_wf(wf_name: str, method_option: str,
     output_node = pe.Node(util.IdentityInterface(fields=['outfile_list']),
                           name='outputspec')
 
+    if engine == 'native':
+        if (method_option == 'local_functional_connectivity_density' and
+                threshold_option == 'Sparsity threshold'):
+            raise ThresholdOptionError(threshold_option, method_option)
+        centrality_node = pe.Node(
+            Function(input_names=['in_file', 'template', 'method_option',
+                                  'weight_options', 'threshold_option',
+                                  'threshold', 'num_threads', 'memory_gb'],
+                     output_names=['outfile_list'],
+                     function=calc_centrality, as_module=True),
+            name='native_centrality', mem_gb=memory_gb, n_procs=num_threads)
+        centrality_node.inputs.method_option = method_option
+        centrality_node.inputs.weight_options = weight_options
+        centrality_node.inputs.threshold_option = (
+            'Correlation threshold' if threshold_option ==
+            'Significance threshold' else threshold_option)
+        centrality_node.inputs.num_threads = num_threads
+        centrality_node.inputs.memory_gb = memory_gb
+        centrality_wf.connect([
+            (input_node, centrality_node, [('in_file', 'in_file'),
+                                           ('template', 'template')]),
+            (centrality_node, output_node, [('outfile_list',
+                                             'outfile_list')])])
+        if threshold_option == 'Significance threshold':
+            convert_thr_node = pe.Node(
+                Function(input_names=['datafile',
+                                      'p_value',
+                                      'two_tailed'],
+                         output_names=['rvalue_threshold'],
+                         function=utils.convert_pvalue_to_r),
+                name='convert_threshold')
+            centrality_wf.connect([(input_node, convert_thr_node,
+                                    [('in_file', 'datafile'),
+                                     ('threshold', 'p_value')]),
+                                   (convert_thr_node, centrality_node,
+                                    [('rvalue_threshold', 'threshold')])])
+        else:
+            centrality_wf.connect(input_node, 'threshold',
+                                  centrality_node, 'threshold')
+        return centrality_wf
+
     # Degree centrality
     if method_option == 'degree_centrality':
         afni_centrality_node = pe.Node(DegreeCentrality(environ={
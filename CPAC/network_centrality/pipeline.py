@@ -117,7 +117,8 @@ def connect_centrality_workflow(workflow, c, resample_functional_to_template,
         create_centrality_wf(wf_name, method_option,
                              c.network_centrality[method_option][
                                  'weight_options'], threshold_option,
-                             threshold, num_threads, memory)
+                             threshold, num_threads, memory,
+                             engine=c.network_centrality['engine'])
 
     workflow.connect(resample_functional_to_template, 'out_file',
                      afni_centrality_wf, 'inputspec.in_file')
@@ -16,7 +16,12 @@
 # License along with C-PAC. If not, see <https://www.gnu.org/licenses/>.
 from itertools import combinations
 from pathlib import Path
+import nibabel as nib
+import numpy as np
 import pytest
+from scipy import ndimage
+from CPAC.network_centrality.core import BlockedSimilarity, face_neighbors, \
+    standardize
 from CPAC.network_centrality.network_centrality import create_centrality_wf
 from CPAC.pipeline.schema import valid_options
 from CPAC.utils.interfaces.afni import AFNI_SEMVER
@@ -62,3 +67,118 @@ def test_create_centrality_wf(method_option: str, weight_options: LIST[str],
     centrality_wf.inputs.inputspec.template = (_DATA_DIR /
                                                'template.nii.gz').absolute()
     centrality_wf.run()
+
+
+def _dense_reference(standardized, threshold):
+    '''Thresholded similarity matrix built in full'''
+    correlations = standardized.astype(np.float64) @ standardized.T
+    np.fill_diagonal(correlations, -np.inf)
+    connected = correlations > threshold
+    return connected, np.where(connected, correlations, 0)
+
+
+@pytest.fixture
+def centrality_data():
+    '''Small masked dataset with spatially smooth signals'''
+    rng = np.random.default_rng(0)
+    data = rng.standard_normal((7, 6, 5, 40))
+    data += np.cumsum(np.cumsum(data, axis=0), axis=1) / 4
+    mask = np.ones(data.shape[:3], dtype=bool)
+    mask[0, 0] = False
+    return data, mask
+
+
+@pytest.mark.parametrize('num_threads, memory_gb', [(1, 1.0), (3, 1e-4)])
+def test_blocked_degree(centrality_data, num_threads, memory_gb):
+    data, mask = centrality_data
+    standardized = standardize(data[mask])
+    similarity = BlockedSimilarity(standardized, num_threads, memory_gb)
+    assert similarity.rows < len(standardized) or memory_gb == 1.0
+    similarity.set_correlation_threshold(0.2)
+    binarized, weighted, _ = similarity.degree()
+    connected, weights = _dense_reference(standardized, 0.2)
+    assert np.array_equal(binarized, connected.sum(axis=1))
+    assert np.allclose(weighted, weights.sum(axis=1), atol=1e-4)
+
+    similarity.set_sparsity_threshold(5)
+    binarized = similarity.degree()[0]
+    n_voxels = len(standardized)
+    # each connection is counted from both ends
+    assert abs(binarized.sum() -
+               2 * round(0.05 * n_voxels * (n_voxels - 1) / 2)) <= 2
+
+
+@pytest.mark.parametrize('memory_gb', [1.0, 1e-4])
+def test_blocked_eigenvector(centrality_data, memory_gb):
+    data, mask = centrality_data
+    standardized = standardize(data[mask])
+    similarity = BlockedSimilarity(standardized, 2, memory_gb)
+    similarity.set_correlation_threshold(0.1)
+    matrix = similarity.degree(store=True)[2]
+    assert (matrix is None) == (memory_gb < 1)
+    binarized, weighted = similarity.eigenvector(matrix, eps=1e-9)
+    for centrality, adjacency in zip(
+            (binarized, weighted), _dense_reference(standardized, 0.1)):
+        eigenvalues, eigenvectors = np.linalg.eigh(adjacency.astype(float))
+        expected = np.abs(eigenvectors[:, -1])
+        assert np.allclose(centrality, expected, atol=1e-5)
+
+
+def test_blocked_lfcd(centrality_data):
+    data, mask = centrality_data
+    standardized = standardize(data[mask])
+    similarity = BlockedSimilarity(standardized, 2, 1e-4)
+    similarity.set_correlation_threshold(0.3)
+    binarized, weighted = similarity.lfcd(face_neighbors(mask))
+    connected, weights = _dense_reference(standardized, 0.3)
+    voxel_index = np.full(mask.shape, -1)
+    voxel_index[mask] = np.arange(mask.sum())
+    for seed in range(len(standardized)):
+        component = np.zeros(mask.shape, dtype=bool)
+        component[mask] = connected[seed]
+        component[mask.nonzero()[0][seed], mask.nonzero()[1][seed],
+                  mask.nonzero()[2][seed]] = True
+        labels, _ = ndimage.label(component)
+        members = voxel_index[labels == labels[mask][seed]]
+        members = members[members != seed]
+        assert binarized[seed] == len(members)
+        assert np.isclose(weighted[seed], weights[seed, members].sum(),
+                          atol=1e-4)
+
+
+@pytest.mark.parametrize('method_option',
+                         valid_options['centrality']['method_options'])
+@pytest.mark.parametrize('threshold_option, threshold',
+                         [('Significance threshold', 0.05),
+                          ('Sparsity threshold', 10),
+                          ('Correlation threshold', 0.3)])
+def test_create_native_centrality_wf(centrality_data, method_option,
+                                     threshold_option, threshold, tmp_path):
+    '''Integration test of the native centrality engine'''
+    data, mask = centrality_data
+    in_file = str(tmp_path / 'in_file.nii.gz')
+    template = str(tmp_path / 'template.nii.gz')
+    nib.Nifti1Image(data, np.eye(4)).to_filename(in_file)
+    nib.Nifti1Image(mask.astype(np.uint8), np.eye(4)).to_filename(template)
+    weight_options = valid_options['centrality']['weight_options']
+    args = (f'native_{method_option[0]}{threshold_option[0]}',
+            method_option, weight_options, threshold_option, threshold, 2)
+    if (method_option == 'local_functional_connectivity_density' and
+            threshold_option == 'Sparsity threshold'):
+        with pytest.raises(ValueError):
+            create_centrality_wf(*args, base_dir=tmp_path, engine='native')
+        return
+    centrality_wf = create_centrality_wf(*args, base_dir=tmp_path,
+                                         engine='native')
+    centrality_wf.inputs.inputspec.in_file = in_file
+    centrality_wf.inputs.inputspec.template = template
+    result = centrality_wf.run()
+    outfile_list = [node for node in result.nodes() if
+                    node.name == 'native_centrality'][0].result.outputs.\
+        outfile_list
+    assert [Path(out).name for out in outfile_list] == [
+        f'{method_option}_{weight}.nii.gz' for weight in weight_options]
+    for out_file in outfile_list:
+        out_img = nib.load(out_file)
+        assert out_img.shape == mask.shape
+        assert not out_img.get_fdata()[~mask].any()
@@ -2,50 +2,122 @@ import os
 import numpy as np
 import nibabel as nb
 
+from scipy.fft import irfft, rfft
 from scipy.fftpack import fft, ifft
 
+BANDPASS_CHUNK_SIZE = 10000
+
 
 def ideal_bandpass(data, sample_period, bandpass_freqs):
         # Derived from YAN Chao-Gan 120504 based on REST.
-    sample_freq = 1. / sample_period
     sample_length = data.shape[0]
 
     data_p = np.zeros(int(2**np.ceil(np.log2(sample_length))))
     data_p[:sample_length] = data
 
+    freq_mask = ideal_bandpass_mask(data_p.shape[0], sample_period,
+                                    bandpass_freqs)
+
+    f_data = fft(data_p)
+    f_data[freq_mask != True] = 0.
+    data_bp = np.real_if_close(ifft(f_data)[:sample_length])
+    return data_bp
+
+
+def ideal_bandpass_mask(padded_length, sample_period, bandpass_freqs):
+    """Frequency mask of the ideal bandpass filter for an FFT of
+    ``padded_length`` points.
+
+    Parameters
+    ----------
+    padded_length : int
+        Length of the zero-padded signal.
+    sample_period : float
+        Length of sampling period in seconds.
+    bandpass_freqs : tuple
+        (LowCutoff_HighPass HighCutoff_LowPass)
+
+    Returns
+    -------
+    freq_mask : ndarray
+        Boolean mask over the ``padded_length`` FFT frequencies.
+    """
+    sample_freq = 1. / sample_period
+
     LowCutoff, HighCutoff = bandpass_freqs
 
     if (LowCutoff is None):  # No lower cutoff (low-pass filter)
         low_cutoff_i = 0
     elif (LowCutoff > sample_freq / 2.):
             # Cutoff beyond fs/2 (all-stop filter)
-        low_cutoff_i = int(data_p.shape[0] / 2)
+        low_cutoff_i = int(padded_length / 2)
     else:
         low_cutoff_i = np.ceil(
-            LowCutoff * data_p.shape[0] * sample_period).astype('int')
+            LowCutoff * padded_length * sample_period).astype('int')
 
     if (HighCutoff > sample_freq / 2. or HighCutoff is None):
             # Cutoff beyond fs/2 or unspecified (become a highpass filter)
-        high_cutoff_i = int(data_p.shape[0] / 2)
+        high_cutoff_i = int(padded_length / 2)
     else:
         high_cutoff_i = np.fix(
-                HighCutoff * data_p.shape[0] * sample_period).astype('int')
+                HighCutoff * padded_length * sample_period).astype('int')
 
-    freq_mask = np.zeros_like(data_p, dtype='bool')
+    freq_mask = np.zeros(padded_length, dtype='bool')
     freq_mask[low_cutoff_i:high_cutoff_i + 1] = True
     freq_mask[
-            data_p.shape[0] -
-            high_cutoff_i:data_p.shape[0] + 1 - low_cutoff_i
+            padded_length -
+            high_cutoff_i:padded_length + 1 - low_cutoff_i
         ] = True
+    return freq_mask
 
-    f_data = fft(data_p)
-    f_data[freq_mask != True] = 0.
-    data_bp = np.real_if_close(ifft(f_data)[:sample_length])
-    return data_bp
+
+def ideal_bandpass_batched(data, sample_period, bandpass_freqs,
+                           chunk_size=BANDPASS_CHUNK_SIZE, out=None):
+    """Demeans and ideal-bandpass filters many timeseries at once.
+
+    Equivalent to demeaning each row and calling :func:`ideal_bandpass`
+    on it, but the frequency mask is built once and rows are transformed
+    ``chunk_size`` at a time with a real FFT along the time axis. Single
+    precision input is filtered in single precision.
+
+    Parameters
+    ----------
+    data : ndarray
+        Timeseries × timepoints.
+    sample_period : float
+        Length of sampling period in seconds.
+    bandpass_freqs : tuple
+        (LowCutoff_HighPass HighCutoff_LowPass)
+    chunk_size : int, optional
+        Number of timeseries transformed at a time.
+    out : ndarray, optional
+        Array to write the filtered timeseries to, e.g., ``data`` itself.
+
+    Returns
+    -------
+    out : ndarray
+    """
+    dtype = np.float32 if data.dtype == np.float32 else np.float64
+    if out is None:
+        out = np.empty(data.shape, dtype=dtype)
+    sample_length = data.shape[-1]
+    padded_length = int(2**np.ceil(np.log2(sample_length)))
+    # the mask is symmetric, so the real FFT only needs its first half
+    freq_mask = ideal_bandpass_mask(padded_length, sample_period,
+                                    bandpass_freqs)[:padded_length // 2 + 1]
+
+    for start in range(0, data.shape[0], chunk_size):
+        chunk = np.asarray(data[start:start + chunk_size], dtype=dtype)
+        chunk = chunk - chunk.mean(axis=1, keepdims=True)
+        f_data = rfft(chunk, n=padded_length, axis=1)
+        f_data[:, ~freq_mask] = 0.
+        out[start:start + chunk_size] = irfft(
+            f_data, n=padded_length, axis=1)[:, :sample_length]
+    return out
 
 
 def bandpass_voxels(realigned_file, regressor_file, bandpass_freqs,
-                    sample_period=None):
+                    sample_period=None, voxelwise=False):
     """Performs ideal bandpass filtering on each voxel time-series.
     
     Parameters
@@ -57,6 +129,10 @@ def bandpass_voxels(realigned_file, regressor_file, bandpass_freqs,
     sample_period : float, optional
         Length of sampling period in seconds.  If not specified,
         this value is read from the nifti file provided.
+    voxelwise : bool, optional
+        Filter one column at a time with :func:`ideal_bandpass` instead of
+        in batches with :func:`ideal_bandpass_batched`, e.g., to validate
+        the batched filter.
         
     Returns
     -------
@@ -65,10 +141,6 @@ def bandpass_voxels(realigned_file, regressor_file, bandpass_freqs,
     
     """
     nii = nb.load(realigned_file)
-    data = nii.get_fdata().astype('float64')
-    mask = (data != 0).sum(-1) != 0
-    Y = data[mask].T
-    Yc = Y - np.tile(Y.mean(0), (Y.shape[0], 1))
 
     if not sample_period:
         hdr = nii.header
@@ -77,34 +149,24 @@ def bandpass_voxels(realigned_file, regressor_file, bandpass_freqs,
         if sample_period > 20.0:
             sample_period /= 1000.0
 
-    Y_bp = np.zeros_like(Y)
-    for j in range(Y.shape[1]):
-        Y_bp[:, j] = ideal_bandpass(Yc[:, j], sample_period, bandpass_freqs)
+    if voxelwise:
+        bandpass_image = _bandpass_image_voxelwise
+    else:
+        bandpass_image = _bandpass_image
 
-    data[mask] = Y_bp.T
-    img = nb.Nifti1Image(data, header=nii.header,
-                         affine=nii.affine)
+    img = bandpass_image(nii, sample_period, bandpass_freqs)
     bandpassed_file = os.path.join(os.getcwd(),
                                    'bandpassed_demeaned_filtered.nii.gz')
     img.to_filename(bandpassed_file)
+    del img
 
     regressor_bandpassed_file = None
 
     if regressor_file is not None:
 
         if regressor_file.endswith('.nii.gz') or regressor_file.endswith('.nii'):
-            nii = nb.load(regressor_file)
-            data = nii.get_fdata().astype('float64')
-            mask = (data != 0).sum(-1) != 0
-            Y = data[mask].T
-            Yc = Y - np.tile(Y.mean(0), (Y.shape[0], 1))
-            Y_bp = np.zeros_like(Y)
-            for j in range(Y.shape[1]):
-                Y_bp[:, j] = ideal_bandpass(Yc[:, j], sample_period, bandpass_freqs)
-            data[mask] = Y_bp.T
-            
-            img = nb.Nifti1Image(data, header=nii.header,
-                            affine=nii.affine)
+            img = bandpass_image(nb.load(regressor_file), sample_period,
+                                 bandpass_freqs)
             regressor_bandpassed_file = os.path.join(os.getcwd(),
                                     'regressor_bandpassed_demeaned_filtered.nii.gz')
             img.to_filename(regressor_bandpassed_file)
@@ -122,14 +184,20 @@ def bandpass_voxels(realigned_file, regressor_file, bandpass_freqs,
             
             # usecols=[list]
             regressor = np.loadtxt(regressor_file, skiprows=len(header))
-            Yc = regressor - np.tile(regressor.mean(0), (regressor.shape[0], 1))
-            Y_bp = np.zeros_like(Yc)
 
-            # Modify to allow just 1 regressor column
-            shape = regressor.shape[0] if len(regressor.shape) < 1 else regressor.shape[1]
-            for j in range(shape):
-                Y_bp[:, j] = ideal_bandpass(Yc[:, j], sample_period,
-                                            bandpass_freqs)
+            if voxelwise:
+                Yc = regressor - np.tile(regressor.mean(0), (regressor.shape[0], 1))
+                Y_bp = np.zeros_like(Yc)
+
+                # Modify to allow just 1 regressor column
+                shape = regressor.shape[0] if len(regressor.shape) < 1 else regressor.shape[1]
+                for j in range(shape):
+                    Y_bp[:, j] = ideal_bandpass(Yc[:, j], sample_period,
+                                                bandpass_freqs)
+            else:
+                Y_bp = ideal_bandpass_batched(
+                    regressor.reshape(regressor.shape[0], -1).T,
+                    sample_period, bandpass_freqs).T
 
             regressor_bandpassed_file = os.path.join(os.getcwd(),
                                     'regressor_bandpassed_demeaned_filtered.1D')
@@ -144,6 +212,36 @@ def bandpass_voxels(realigned_file, regressor_file, bandpass_freqs,
     return bandpassed_file, regressor_bandpassed_file
 
 
+def _bandpass_image(nii, sample_period, bandpass_freqs):
+    """Batched, in-place filtering of every non-zero voxel of an image,
+    in single precision if the image is stored in single precision."""
+    dtype = np.float32 if nii.get_data_dtype() == np.float32 \
+        else np.float64
+    data = nii.get_fdata(dtype=dtype)
+    # a voxels × time view of the data, whatever its memory layout
+    order = 'F' if np.isfortran(data) else 'C'
+    voxels = data.reshape(-1, data.shape[-1], order=order)
+    in_mask = np.flatnonzero(voxels.any(axis=1))
+    for start in range(0, len(in_mask), BANDPASS_CHUNK_SIZE):
+        rows = in_mask[start:start + BANDPASS_CHUNK_SIZE]
+        voxels[rows] = ideal_bandpass_batched(voxels[rows], sample_period,
+                                              bandpass_freqs)
+    return nb.Nifti1Image(data, header=nii.header, affine=nii.affine)
+
+
+def _bandpass_image_voxelwise(nii, sample_period, bandpass_freqs):
+    """Column-by-column filtering of every non-zero voxel of an image."""
+    data = nii.get_fdata().astype('float64')
+    mask = (data != 0).sum(-1) != 0
+    Y = data[mask].T
+    Yc = Y - np.tile(Y.mean(0), (Y.shape[0], 1))
+    Y_bp = np.zeros_like(Y)
+    for j in range(Y.shape[1]):
+        Y_bp[:, j] = ideal_bandpass(Yc[:, j], sample_period, bandpass_freqs)
+    data[mask] = Y_bp.T
+    return nb.Nifti1Image(data, header=nii.header, affine=nii.affine)
+
+
 def afni_1dBandpass(in_file, highpass, lowpass, tr=1):
     '''
     Perform AFNI 1dBandpass
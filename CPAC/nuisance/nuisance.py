@@ -16,6 +16,7 @@
 # License along with C-PAC. If not, see <https://www.gnu.org/licenses/>.
 import re
 import os
+from weakref import WeakKeyDictionary
 from CPAC.pipeline.nodeblock import nodeblock
 import numpy as np
 import nibabel as nb
@@ -51,6 +52,7 @@ from CPAC.nuisance.utils.compcor import (
     calc_compcor_components,
     cosine_filter,
     TR_string_to_float)
+from CPAC.nuisance.utils.regression import CENSOR_MODES, regress_nuisance
 
 from CPAC.seg_preproc.utils import erosion, mask_erosion
 
@@ -59,6 +61,11 @@ from CPAC.utils.utils import check_prov_for_regtool
 from .bandpass import (bandpass_voxels, afni_1dBandpass)
 logger = logging.getLogger('nipype.workflow')
 
+_NATIVE_REGRESSION_BATCHES = WeakKeyDictionary()
+"""For each workflow, the native nuisance regression node (and its next
+free slot) of each functional image and brain mask, see
+:func:`connect_native_nuisance_regression`"""
+
 
 def choose_nuisance_blocks(cfg, rpool, generate_only=False):
     '''
@@ -1243,7 +1250,8 @@ def create_regressor_workflow(nuisance_selectors,
 
                     compcor_node = pe.Node(Function(input_names=['data_filename',
                                                                 'num_components',
-                                                                'mask_filename'],
+                                                                'mask_filename',
+                                                                'svd_method'],
                                                     output_names=[
                                                         'compcor_file'],
                                                     function=calc_compcor_components,
@@ -1255,6 +1263,8 @@ def create_regressor_workflow(nuisance_selectors,
                                                 'data_filename'))
 
                     compcor_node.inputs.num_components = regressor_selector['summary']['components']
+                    compcor_node.inputs.svd_method = regressor_selector[
+                        'summary'].get('svd_method', 'truncated')
 
                     nuisance_wf.connect(
                         summary_method_input[0], summary_method_input[1],
@@ -1517,7 +1527,16 @@ def create_regressor_workflow(nuisance_selectors,
     return nuisance_wf
 
 def create_nuisance_regression_workflow(nuisance_selectors,
-                                        name='nuisance_regression'):
+                                        name='nuisance_regression',
+                                        engine='AFNI'):
+    """Nuisance regression of one regressor selector
+
+    With ``engine='native'``, the workflow only gathers the regression's
+    inputs in its ``regressionspec`` node; connect it to a (shared)
+    in-process regression node with
+    :func:`connect_native_nuisance_regression`, which provides the
+    residuals instead of ``outputspec``.
+    """
 
     inputspec = pe.Node(util.IdentityInterface(fields=[
         'selector',
@@ -1609,6 +1628,13 @@ def create_nuisance_regression_workflow(nuisance_selectors,
         else:
             find_censors.inputs.number_of_subsequent_trs_to_censor = 0
 
+    if engine == 'native':
+        return _native_nuisance_regression_inputs(nuisance_selectors,
+                                                  nuisance_wf, inputspec,
+                                                  find_censors if
+                                                  nuisance_selectors.get(
+                                                      'Censor') else None)
+
     # Use 3dTproject to perform nuisance variable regression
     nuisance_regression = pe.Node(interface=afni.TProject(),
                                   name='nuisance_regression',
@@ -1665,7 +1691,7 @@ def create_nuisance_regression_workflow(nuisance_selectors,
                                 nuisance_regression, 'ort')
     else:
         # there's no regressor file generated if only Bandpass in nuisance_selectors
-        if not ('Bandpass' in nuisance_selectors and len(nuisance_selectors.keys()) == 1):
+        if _uses_regressor_file(nuisance_selectors):
             nuisance_wf.connect(inputspec, 'regressor_file',
                                 nuisance_regression, 'ort')
 
@@ -1675,6 +1701,120 @@ def create_nuisance_regression_workflow(nuisance_selectors,
     return nuisance_wf
 
 
+def _uses_regressor_file(nuisance_selectors):
+    """There's no regressor file generated if only Bandpass is selected"""
+    return not ('Bandpass' in nuisance_selectors and
+                len(nuisance_selectors.keys()) == 1)
+
+
+def _native_nuisance_regression_inputs(nuisance_selectors, nuisance_wf,
+                                       inputspec, find_censors=None):
+    """Collect the inputs of a native nuisance regression in a
+    ``regressionspec`` node"""
+    if nuisance_selectors.get('PolyOrt') and \
+            not nuisance_selectors['PolyOrt'].get('degree'):
+        raise ValueError("Polynomial orthogonalization requested, "
+                         "but degree not provided.")
+    custom_file = (nuisance_selectors.get('Custom') or [{}])[0].get('file')
+    if custom_file and custom_file.endswith(('.nii', '.nii.gz')):
+        raise ValueError('Voxelwise custom regressors are only supported '
+                         'by the AFNI nuisance regression engine.')
+
+    regressionspec = pe.Node(util.IdentityInterface(fields=[
+        'functional_file_path',
+        'functional_brain_mask_file_path',
+        'regressor_file',
+        'censor_file_path'
+    ]), name='regressionspec')
+
+    for field in ['functional_file_path', 'functional_brain_mask_file_path',
+                  'regressor_file']:
+        nuisance_wf.connect(inputspec, field, regressionspec, field)
+    if find_censors is not None:
+        nuisance_wf.connect(find_censors, 'out_file',
+                            regressionspec, 'censor_file_path')
+
+    return nuisance_wf
+
+
+def connect_native_nuisance_regression(wf, nuisance_wf, nuisance_selectors,
+                                       functional, mask, capacity, name):
+    """Connect a native nuisance regression workflow (see
+    :func:`create_nuisance_regression_workflow`) to an in-process
+    regression node. Regressions of the same functional image within the
+    same brain mask share one node, which loads the image once and solves
+    every selector against it.
+
+    Parameters
+    ----------
+    wf : Workflow
+
+    nuisance_wf : Workflow
+        workflow from ``create_nuisance_regression_workflow(...,
+        engine='native')``, already connected to its inputs
+
+    nuisance_selectors : dict
+
+    functional, mask : tuple
+        (node, output) connected to the workflow's functional image and
+        brain mask
+
+    capacity : int
+        maximum number of selectors per regression node
+
+    name : str
+        name for a new regression node
+
+    Returns
+    -------
+    tuple
+        (regression node, residuals output) for this selector
+    """
+    batches = _NATIVE_REGRESSION_BATCHES.setdefault(wf, {})
+    key = (*functional, *mask)
+    regression, slot = batches.get(key, (None, capacity))
+    if slot >= capacity:
+        slot = 0
+        regression = pe.Node(Function(
+            input_names=['functional_file_path', 'mask_file_path',
+                         'selectors', 'capacity',
+                         *[f'{field}_{i}' for i in range(capacity) for
+                           field in ['regressor_file', 'censor_file_path']]],
+            output_names=[f'residual_file_path_{i}' for
+                          i in range(capacity)],
+            function=regress_nuisance,
+            as_module=True),
+            name=name,
+            # the masked image in single precision, double-precision
+            # chunks and one output image at a time
+            mem_gb=0.5,
+            mem_x=(12 / 1024 ** 3, 'functional_file_path'))
+        regression.inputs.capacity = capacity
+        regression.inputs.selectors = {}
+        wf.connect(nuisance_wf, 'regressionspec.functional_file_path',
+                   regression, 'functional_file_path')
+        wf.connect(nuisance_wf,
+                   'regressionspec.functional_brain_mask_file_path',
+                   regression, 'mask_file_path')
+    batches[key] = (regression, slot + 1)
+
+    censor = nuisance_selectors.get('Censor')
+    regression.inputs.selectors = {
+        **regression.inputs.selectors,
+        str(slot): {
+            'polort': (nuisance_selectors.get('PolyOrt') or {}).get(
+                'degree', 0),
+            'censor_mode': CENSOR_MODES[censor['method']] if censor else None
+        }}
+    if _uses_regressor_file(nuisance_selectors):
+        wf.connect(nuisance_wf, 'regressionspec.regressor_file',
+                   regression, f'regressor_file_{slot}')
+    if censor:
+        wf.connect(nuisance_wf, 'regressionspec.censor_file_path',
+                   regression, f'censor_file_path_{slot}')
+    return regression, f'residual_file_path_{slot}'
+
+
 def filtering_bold_and_regressors(nuisance_selectors,
                                   name='filtering_bold_and_regressors'):
 
@@ -1710,9 +1850,11 @@ def filtering_bold_and_regressors(nuisance_selectors,
                             function=bandpass_voxels,
                             as_module=True),
                     name='frequency_filter',
+                    # one in-memory copy of the image (up to 8 bytes per
+                    # voxel per timepoint, plus writing overhead); the
+                    # filtered chunks fit within the base estimate
                     mem_gb=0.5,
-                    mem_x=(3811976743057169 / 151115727451828646838272,
-                           'realigned_file')
+                    mem_x=(10 / 1024 ** 3, 'realigned_file')
                 )
 
         frequency_filter.inputs.bandpass_freqs = [
@@ -2526,7 +2668,9 @@ def nuisance_regression(wf, cfg, strat_pool, pipe_num, opt, space, res=None):
                  f'space-{space}_res-{res}_reg-{opt["Name"]}_{pipe_num}')
     nuis_name = f'nuisance_regression_{name_suff}'
 
-    nuis = create_nuisance_regression_workflow(opt, name=nuis_name)
+    engine = cfg['nuisance_corrections', '2-nuisance_regression', 'engine']
+    nuis = create_nuisance_regression_workflow(opt, name=nuis_name,
+                                               engine=engine)
     if bandpass_before:
         nofilter_nuis = nuis.clone(name=f'{nuis.name}-noFilter')
 
@@ -2548,8 +2692,10 @@ def nuisance_regression(wf, cfg, strat_pool, pipe_num, opt, space, res=None):
         match_grid.inputs.resample_mode = 'Cu'
         node, out = strat_pool.get_data('FSL-AFNI-brain-mask')
         wf.connect(node, out, match_grid, 'in_file')
+        mask = (node, out)
         node, out = strat_pool.get_data(desc_keys[0])
         wf.connect(node, out, match_grid, 'master')
+        mask += (node, out)
         wf.connect(match_grid, 'out_file',
                    nuis, 'inputspec.functional_brain_mask_file_path')
         if bandpass_before:
@@ -2558,6 +2704,7 @@ def nuisance_regression(wf, cfg, strat_pool, pipe_num, opt, space, res=None):
                        'inputspec.functional_brain_mask_file_path')
     else:
         node, out = strat_pool.get_data('space-bold_desc-brain_mask')
+        mask = (node, out)
         wf.connect(node, out,
                    nuis, 'inputspec.functional_brain_mask_file_path')
         if bandpass_before:
@@ -2588,6 +2735,16 @@ def nuisance_regression(wf, cfg, strat_pool, pipe_num, opt, space, res=None):
         if bandpass_before:
             wf.connect(node, out, nofilter_nuis, 'inputspec.dvars_file_path')
 
+    def residual_output(regression_wf, functional):
+        if engine == 'native':
+            # every regressor selector of the same image can share one node
+            return connect_native_nuisance_regression(
+                wf, regression_wf, opt, functional, mask,
+                len(cfg['nuisance_corrections', '2-nuisance_regression',
+                        'Regressors'] or []) or 1,
+                f'native_{regression_wf.name}')
+        return regression_wf, 'outputspec.residual_file_path'
+
     if bandpass:
         filt = filtering_bold_and_regressors(opt, name=f'filtering_bold_and_'
                                              f'regressors_{name_suff}')
@@ -2612,14 +2769,14 @@ def nuisance_regression(wf, cfg, strat_pool, pipe_num, opt, space, res=None):
 
             node, out = strat_pool.get_data(desc_keys[0])
             wf.connect(node, out, nuis, 'inputspec.functional_file_path')
+            residuals = residual_output(nuis, (node, out))
 
-            wf.connect(nuis, 'outputspec.residual_file_path',
-                       filt, 'inputspec.functional_file_path')
+            wf.connect(*residuals, filt, 'inputspec.functional_file_path')
 
             outputs = {
                 desc_keys[0]: (filt, 'outputspec.residual_file_path'),
                 desc_keys[1]: (filt, 'outputspec.residual_file_path'),
-                desc_keys[2]: (nuis, 'outputspec.residual_file_path'),
+                desc_keys[2]: residuals,
                 'desc-confounds_timeseries': (filt, 'outputspec.residual_regressor')
             }
 
@@ -2632,20 +2789,22 @@ def nuisance_regression(wf, cfg, strat_pool, pipe_num, opt, space, res=None):
 
             wf.connect(filt, 'outputspec.residual_file_path',
                        nuis, 'inputspec.functional_file_path')
+            residuals = residual_output(
+                nuis, (filt, 'outputspec.residual_file_path'))
 
 
             outputs = {
-                desc_keys[0]: (nuis, 'outputspec.residual_file_path'),
-                desc_keys[1]: (nuis, 'outputspec.residual_file_path'),
-                desc_keys[2]: (nofilter_nuis, 'outputspec.residual_file_path'),
+                desc_keys[0]: residuals,
+                desc_keys[1]: residuals,
+                desc_keys[2]: residual_output(nofilter_nuis, (node, out)),
                 'desc-confounds_timeseries': (filt, 'outputspec.residual_regressor')}
 
     else:
         node, out = strat_pool.get_data(desc_keys[0])
         wf.connect(node, out, nuis, 'inputspec.functional_file_path')
+        residuals = residual_output(nuis, (node, out))
 
-        outputs = {desc_key: (nuis, 'outputspec.residual_file_path') for
-                   desc_key in desc_keys}
+        outputs = {desc_key: residuals for desc_key in desc_keys}
 
     return (wf, outputs)
 
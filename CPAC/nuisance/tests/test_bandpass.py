@@ -0,0 +1,40 @@
+import nibabel as nb
+import numpy as np
+import pytest
+
+from CPAC.nuisance.bandpass import bandpass_voxels, ideal_bandpass, \
+    ideal_bandpass_batched
+
+
+@pytest.mark.parametrize('bandpass_freqs', [[0.01, 0.1], [None, 0.1],
+                                            [0.01, 10.]])
+def test_ideal_bandpass_batched(bandpass_freqs):
+    rng = np.random.default_rng(0)
+    data = rng.standard_normal((25, 137))
+    expected = np.array([ideal_bandpass(row - row.mean(), 0.8,
+                                        bandpass_freqs) for row in data])
+    result = ideal_bandpass_batched(data, 0.8, bandpass_freqs, chunk_size=7)
+    assert np.allclose(result, expected)
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+def test_bandpass_voxels(monkeypatch, tmp_path, dtype):
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.default_rng(1)
+    data = rng.standard_normal((6, 5, 4, 60)).astype(dtype)
+    data[0] = 0
+    img = nb.Nifti1Image(data, np.eye(4))
+    img.header.set_zooms((3., 3., 3., 2.))
+    img.to_filename('bold.nii.gz')
+    np.savetxt('regressors.1D', rng.standard_normal((60, 3)))
+
+    voxelwise = bandpass_voxels('bold.nii.gz', 'regressors.1D',
+                                [0.01, 0.1], voxelwise=True)
+    expected = (nb.load(voxelwise[0]).get_fdata(), np.loadtxt(voxelwise[1]))
+    batched = bandpass_voxels('bold.nii.gz', 'regressors.1D', [0.01, 0.1])
+    result = nb.load(batched[0])
+
+    assert result.get_data_dtype() == dtype
+    assert np.allclose(result.get_fdata(), expected[0],
+                       atol=1e-5 if dtype == np.float32 else 1e-8)
+    assert np.allclose(np.loadtxt(batched[1]), expected[1])
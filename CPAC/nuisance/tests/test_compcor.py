@@ -0,0 +1,114 @@
+import multiprocessing
+import os
+import resource
+import time
+
+import nibabel as nb
+import numpy as np
+import pytest
+
+from CPAC.nuisance.utils import compcor
+from CPAC.utils.pytest import benchmark
+
+
+def _synthetic_run(tmp_path, shape, timepoints, components=6, seed=0,
+                   extension='.nii.gz'):
+    """Write a synthetic BOLD run with a few strong shared signals, drift
+    and an all-zero background, and a mask of part of the volume"""
+    rng = np.random.default_rng(seed)
+    signals = rng.standard_normal((components, timepoints)) * np.arange(
+        components, 0, -1)[:, np.newaxis]
+    data = (rng.standard_normal(shape + (components,)) @ signals +
+            rng.standard_normal(shape + (timepoints,)) +
+            0.01 * np.arange(timepoints) + 100).astype(np.float32)
+    data[:2] = 0
+    # constant voxel inside the mask
+    data[shape[0] // 2, shape[1] // 2, shape[2] // 2] = 3
+    mask = np.zeros(shape)
+    mask[2:-1, 1:-1, 1:-1] = 1
+    in_file = str(tmp_path / f'bold{extension}')
+    mask_file = str(tmp_path / f'mask{extension}')
+    nb.Nifti1Image(data, np.eye(4)).to_filename(in_file)
+    nb.Nifti1Image(mask, np.eye(4)).to_filename(mask_file)
+    return in_file, mask_file
+
+
+@pytest.mark.parametrize('svd_method', compcor.SVD_METHODS)
+def test_calc_compcor_components(monkeypatch, tmp_path, svd_method):
+    """Components should match the full SVD's up to sign"""
+    monkeypatch.chdir(tmp_path)
+    in_file, mask_file = _synthetic_run(tmp_path, (10, 8, 6), 120)
+    expected = np.loadtxt(compcor.calc_compcor_components_full_svd(
+        in_file, 5, mask_file))
+    result = np.loadtxt(compcor.calc_compcor_components(
+        in_file, 5, mask_file, svd_method, chunk_size=50))
+    assert result.shape == expected.shape
+    assert np.allclose(np.abs((expected * result).sum(axis=0)), 1, atol=1e-5)
+    assert np.all(result[np.abs(result).argmax(axis=0), range(5)] > 0)
+
+
+def test_calc_compcor_components_invalid(tmp_path):
+    in_file, mask_file = _synthetic_run(tmp_path, (6, 5, 4), 20)
+    with pytest.raises(ValueError):
+        compcor.calc_compcor_components(in_file, 0, mask_file)
+    with pytest.raises(ValueError):
+        compcor.calc_compcor_components(in_file, 5, mask_file, 'full')
+
+
+@pytest.mark.parametrize('remove_mean', [True, False])
+def test_cosine_filter(monkeypatch, tmp_path, remove_mean):
+    """Chunked filtering should match the whole-image lstsq"""
+    in_file, _ = _synthetic_run(tmp_path, (10, 8, 6), 120)
+    outputs = {}
+    for name, function in [('lstsq', compcor.cosine_filter_lstsq),
+                           ('chunked', compcor.cosine_filter)]:
+        os.makedirs(tmp_path / name)
+        monkeypatch.chdir(tmp_path / name)
+        kwargs = {} if name == 'lstsq' else {'chunk_size': 37}
+        outputs[name] = nb.load(function(
+            in_file, 2.0, remove_mean=remove_mean, **kwargs)).get_fdata()
+    assert not outputs['chunked'][:2].any()
+    assert np.allclose(outputs['chunked'], outputs['lstsq'], atol=1e-4)
+
+
+def _measure(function, *args):
+    """Run ``function`` and return its wall time and this process's peak
+    RSS (GB). Run in a fresh process per measurement."""
+    start = time.perf_counter()
+    function(*args)
+    wall_time = time.perf_counter() - start
+    return wall_time, resource.getrusage(
+        resource.RUSAGE_SELF).ru_maxrss / 1024 ** 2
+
+
+@benchmark
+@pytest.mark.parametrize('timepoints', [1200])
+def test_compcor_benchmark(monkeypatch, tmp_path, timepoints):
+    """Compare wall time and peak RSS with the full-SVD CompCor and
+    whole-image cosine filter on a long multiband-like run"""
+    monkeypatch.chdir(tmp_path)
+    in_file, mask_file = _synthetic_run(tmp_path, (24, 28, 24), timepoints,
+                                        extension='.nii')
+    context = multiprocessing.get_context('spawn')
+    runs = [
+        ('CompCor', 'full SVD', compcor.calc_compcor_components_full_svd,
+         (in_file, 5, mask_file)),
+        ('CompCor', 'truncated', compcor.calc_compcor_components,
+         (in_file, 5, mask_file, 'truncated')),
+        ('CompCor', 'randomized', compcor.calc_compcor_components,
+         (in_file, 5, mask_file, 'randomized')),
+        ('cosine filter', 'lstsq', compcor.cosine_filter_lstsq,
+         (in_file, 0.8)),
+        ('cosine filter', 'chunked', compcor.cosine_filter, (in_file, 0.8)),
+    ]
+    results = {}
+    for step, engine, function, args in runs:
+        with context.Pool(1) as pool:
+            results[step, engine] = pool.apply(_measure, (function, *args))
+        print(f'{step} ({engine}, {timepoints} TRs): '
+              f'{results[step, engine][0]:.1f}s, '
+              f'peak RSS {results[step, engine][1]:.2f} GB')
+    assert results['CompCor', 'truncated'][1] < results[
+        'CompCor', 'full SVD'][1]
+    assert results['cosine filter', 'chunked'][1] < results[
+        'cosine filter', 'lstsq'][1]
@@ -0,0 +1,155 @@
+import nibabel as nb
+import numpy as np
+import pytest
+
+from CPAC.nuisance.nuisance import connect_native_nuisance_regression, \
+    create_nuisance_regression_workflow
+from CPAC.nuisance.utils import regression
+from CPAC.pipeline import nipype_pipeline_engine as pe
+import nipype.interfaces.utility as util
+
+
+def _lstsq_residuals(data, design, keep, censor_mode):
+    """Reference: separate lstsq fit of each voxel"""
+    data = data.astype(np.float64)
+    if censor_mode == 'NTRP':
+        data = data @ regression.interpolation_weights(keep).T
+        keep = np.ones_like(keep)
+    betas = np.linalg.lstsq(design[keep], data[:, keep].T, rcond=None)[0]
+    residuals = data - (design @ betas).T
+    if censor_mode == 'KILL':
+        return residuals[:, keep]
+    residuals[:, ~keep] = 0
+    return residuals
+
+
+@pytest.fixture
+def run(tmp_path):
+    rng = np.random.default_rng(0)
+    shape, timepoints = (6, 5, 4), 60
+    data = (rng.standard_normal(shape + (timepoints,)) * 10 + 500 +
+            np.linspace(0, 20, timepoints)).astype(np.float32)
+    mask = np.zeros(shape)
+    mask[1:-1, 1:-1, 1:] = 1
+    regressors = rng.standard_normal((timepoints, 3))
+    censor = np.ones(timepoints, dtype=int)
+    censor[[0, 10, 11, 40, 59]] = 0
+    paths = {name: str(tmp_path / filename) for name, filename in [
+        ('bold', 'bold.nii.gz'), ('mask', 'mask.nii.gz'),
+        ('regressors', 'nuisance_regressors.1D'), ('censor', 'censors.tsv')]}
+    nb.Nifti1Image(data, np.eye(4)).to_filename(paths['bold'])
+    nb.Nifti1Image(mask, np.eye(4)).to_filename(paths['mask'])
+    with open(paths['regressors'], 'w', encoding='utf-8') as regressor_file:
+        regressor_file.write('# C-PAC\n# Nuisance regressors:\n# a\tb\tc\n')
+        np.savetxt(regressor_file, regressors, delimiter='\t')
+    np.savetxt(paths['censor'], censor, fmt='%d', header='censor',
+               comments='')
+    return paths, data, mask.astype(bool), regressors, censor.astype(bool)
+
+
+def test_read_censor_file(run):
+    paths, _, _, _, censor = run
+    assert np.array_equal(
+        regression.read_censor_file(paths['censor'], censor.size), censor)
+    assert regression.read_censor_file(None, 4).all()
+    with pytest.raises(ValueError):
+        regression.read_censor_file(paths['censor'], censor.size + 1)
+
+
+@pytest.mark.parametrize('censor_mode', ['KILL', 'ZERO', 'NTRP'])
+def test_project_out(run, censor_mode):
+    _, data, mask, regressors, keep = run
+    masked = data[mask]
+    design = np.column_stack([regression.legendre_basis(keep.size, 2),
+                              regressors])
+    expected = _lstsq_residuals(masked, design, keep, censor_mode)
+    result = regression.project_out(masked, design, keep, censor_mode,
+                                    chunk_size=7)
+    assert result.shape == expected.shape
+    assert np.allclose(result, expected, atol=1e-3)
+
+
+def test_project_out_spike_regressors(run):
+    """Spike regressors of killed volumes leave the design rank-deficient"""
+    _, data, mask, regressors, keep = run
+    spikes = np.eye(keep.size)[:, ~keep]
+    design = np.column_stack([regression.legendre_basis(keep.size, 0),
+                              regressors, spikes])
+    result = regression.project_out(data[mask], design, keep, 'KILL')
+    expected = _lstsq_residuals(data[mask], design[:, :4], keep, 'KILL')
+    assert np.allclose(result, expected, atol=1e-3)
+
+
+def test_regress_nuisance(monkeypatch, tmp_path, run):
+    """Several selectors are solved against one load of the image"""
+    monkeypatch.chdir(tmp_path)
+    paths, data, mask, regressors, keep = run
+    residuals = regression.regress_nuisance(
+        paths['bold'], paths['mask'],
+        {'0': {'polort': 1, 'censor_mode': None},
+         '2': {'polort': 0, 'censor_mode': 'ZERO'}},
+        capacity=3, regressor_file_0=paths['regressors'],
+        regressor_file_2=paths['regressors'],
+        censor_file_path_2=paths['censor'])
+    assert residuals[1] is None
+    all_volumes = np.ones_like(keep)
+    for residual_file, polort, censor in [(residuals[0], 1, all_volumes),
+                                          (residuals[2], 0, keep)]:
+        result = nb.load(residual_file).get_fdata()
+        assert result.shape == data.shape
+        assert not result[~mask].any()
+        design = np.column_stack([
+            regression.legendre_basis(keep.size, polort), regressors])
+        assert np.allclose(result[mask], _lstsq_residuals(
+            data[mask], design, censor, 'ZERO'), atol=1e-3)
+
+
+def test_native_workflow_shares_node():
+    """Selectors regressing the same image share one regression node"""
+    wf = pe.Workflow(name='native_nuisance')
+    source = pe.Node(util.IdentityInterface(fields=['bold', 'mask']),
+                     name='source')
+    selectors = [{'Name': 'first', 'PolyOrt': {'degree': 2},
+                  'GlobalSignal': {'summary': 'Mean'}},
+                 {'Name': 'second', 'GlobalSignal': {'summary': 'Mean'},
+                  'Censor': {'method': 'Interpolate',
+                             'thresholds': [{'type': 'FD_J', 'value': 0.5}]}}]
+    nodes = []
+    for selector in selectors:
+        nuis = create_nuisance_regression_workflow(
+            selector, name=f'nuisance_regression_{selector["Name"]}',
+            engine='native')
+        wf.connect(source, 'bold', nuis, 'inputspec.functional_file_path')
+        wf.connect(source, 'mask',
+                   nuis, 'inputspec.functional_brain_mask_file_path')
+        nodes.append(connect_native_nuisance_regression(
+            wf, nuis, selector, (source, 'bold'), (source, 'mask'), 2,
+            f'native_{nuis.name}'))
+    assert nodes[0][0] is nodes[1][0]
+    assert [output for _, output in nodes] == ['residual_file_path_0',
+                                               'residual_file_path_1']
+    assert nodes[0][0].inputs.selectors == {
+        '0': {'polort': 2, 'censor_mode': None},
+        '1': {'polort': 0, 'censor_mode': 'NTRP'}}
+    # a third selector doesn't fit
+    nuis = create_nuisance_regression_workflow(
+        selectors[0], name='nuisance_regression_third', engine='native')
+    assert connect_native_nuisance_regression(
+        wf, nuis, selectors[0], (source, 'bold'), (source, 'mask'), 2,
+        f'native_{nuis.name}')[0] is not nodes[0][0]
+    # nor are nodes shared across workflows
+    other = pe.Workflow(name='other')
+    nuis = create_nuisance_regression_workflow(
+        selectors[1], name='nuisance_regression_other', engine='native')
+    regression, output = connect_native_nuisance_regression(
+        other, nuis, selectors[1], (source, 'bold'), (source, 'mask'), 2,
+        f'native_{nuis.name}')
+    assert regression is not nodes[0][0]
+    assert output == 'residual_file_path_0'
+
+
+def test_native_voxelwise_custom_regressors():
+    with pytest.raises(ValueError):
+        create_nuisance_regression_workflow(
+            {'Name': 'custom', 'Custom': [{'file': 'regressors.nii.gz'}]},
+            engine='native')
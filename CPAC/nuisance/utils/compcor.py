@@ -8,8 +8,285 @@ from scipy.linalg import svd
 
 iflogger = logging.getLogger('nipype.interface')
 
+CHUNK_SIZE = 4096
+"""Voxels processed at a time by the chunked CompCor and cosine filter"""
+SVD_METHODS = ('truncated', 'randomized')
 
-def calc_compcor_components(data_filename, num_components, mask_filename):
+
+def calc_compcor_components(data_filename, num_components, mask_filename,
+                            svd_method='truncated', random_state=0,
+                            chunk_size=CHUNK_SIZE):
+    """
+    Calculate the first ``num_components`` principal components of the
+    detrended, variance-normalized timeseries of the voxels in a mask.
+
+    Only the in-mask voxels are kept in memory (as float32); detrending
+    and normalization are done in float64 chunks of voxels, and only the
+    requested components are computed.
+
+    Parameters
+    ----------
+    data_filename : str
+        4D functional image
+
+    num_components : int
+
+    mask_filename : str
+
+    svd_method : str, optional
+        'truncated' (exact top components from the timepoints × timepoints
+        covariance) or 'randomized' (randomized subspace iteration,
+        approximate but faster for long runs and many components)
+
+    random_state : int, optional
+        seed for 'randomized'
+
+    chunk_size : int, optional
+        voxels per chunk
+
+    Returns
+    -------
+    regressor_file : str
+        path to ``compcor_regressors.1D``, one component per column. The
+        sign of each component is chosen so its largest-magnitude entry is
+        positive.
+    """
+    from CPAC.nuisance.utils.compcor import _chunks, gram_product, \
+        _load_masked_data, _residuals, top_eigenvectors, SVD_METHODS
+
+    if num_components < 1:
+        raise ValueError('Improper value for num_components ({0}), should be >= 1.'.format(num_components))
+    if svd_method not in SVD_METHODS:
+        raise ValueError(f'Improper value for svd_method ({svd_method}), '
+                         f'should be one of {SVD_METHODS}.')
+
+    image_data = _load_masked_data(data_filename, mask_filename)
+
+    # filter out any voxels whose variance equals 0
+    print('Removing zero variance components')
+    image_data = image_data[np.ptp(image_data, axis=1) != 0]
+
+    if image_data.shape.count(0):
+        err = "\n\n[!] No wm or csf signals left after removing those " \
+              "with zero variance.\n\n"
+        raise Exception(err)
+
+    print('Detrending and normalizing data')
+    timepoints = image_data.shape[1]
+    trend = np.column_stack([np.arange(timepoints, dtype=np.float64),
+                             np.ones(timepoints)])
+    trend_pinv = np.linalg.pinv(trend)
+    for chunk in _chunks(len(image_data), chunk_size):
+        residuals = _residuals(image_data[chunk], trend, trend_pinv)
+        image_data[chunk] = residuals / residuals.std(axis=1, keepdims=True)
+
+    print(f'Calculating the first {num_components} components '
+          f'({svd_method} SVD)')
+    num_components = min(num_components, *image_data.shape)
+    components = top_eigenvectors(
+        lambda vectors: gram_product(image_data, vectors, chunk_size),
+        timepoints, num_components, svd_method, random_state)
+    components *= np.sign(components[np.abs(components).argmax(axis=0),
+                                     np.arange(num_components)])
+
+    # write out the resulting regressor file
+    regressor_file = os.path.join(os.getcwd(), 'compcor_regressors.1D')
+    np.savetxt(regressor_file, components, delimiter='\t', fmt='%16g')
+
+    return regressor_file
+
+
+# cosine_filter adapted from nipype 'https://github.com/nipy/nipype/blob/d353f0d879826031334b09d33e9443b8c9b3e7fe/nipype/algorithms/confounds.py'
+def cosine_filter(input_image_path, timestep, period_cut=128, remove_mean=True, axis=-1, failure_mode='error', chunk_size=CHUNK_SIZE):
+    """
+    input_image_path: string
+            Bold image to be filtered.
+    timestep: float
+            'Repetition time (TR) of series (in sec) - derived from image header if unspecified'
+    period_cut: float
+            Minimum period (in sec) for DCT high-pass filter, nipype default value: 128
+    chunk_size: int
+            Voxels filtered at a time
+
+    The image is held in memory as float32; the DCT basis is projected out
+    of the non-zero voxels in float64 chunks with one pseudo-inverse of the
+    design matrix.
+    """
+
+    from CPAC.nuisance.utils.compcor import _chunks, _cosine_drift, \
+        _full_rank, _residuals
+    from CPAC.utils.data_cache import load_image_data
+
+    input_img = nb.load(input_image_path)
+    input_data = load_image_data(input_image_path, dtype=np.float32)
+
+    datashape = input_data.shape
+    timepoints = datashape[axis]
+    if datashape[0] == 0 and failure_mode != 'error':
+        return input_data, np.array([])
+
+    input_data = input_data.reshape((-1, timepoints))
+
+    frametimes = timestep * np.arange(timepoints)
+    X = _full_rank(_cosine_drift(period_cut, frametimes))[0]
+    X_pinv = np.linalg.pinv(X)
+
+    if not remove_mean:
+        X = X[:, :-1]
+        X_pinv = X_pinv[:-1]
+
+    # all-zero (background) voxels stay zero
+    voxels = np.flatnonzero(np.any(input_data != 0, axis=1))
+    output_data = np.zeros(input_data.shape, dtype=np.float32)
+    for chunk in _chunks(len(voxels), chunk_size):
+        output_data[voxels[chunk]] = _residuals(input_data[voxels[chunk]],
+                                                X, X_pinv)
+
+    output_data = output_data.reshape(datashape)
+
+    hdr = input_img.header
+    output_img = nb.Nifti1Image(output_data, header=hdr,
+                                affine=input_img.affine)
+
+    file_name = input_image_path[input_image_path.rindex('/')+1:]
+
+    cosfiltered_img = os.path.join(os.getcwd(), file_name)
+
+    output_img.to_filename(cosfiltered_img)
+
+    return cosfiltered_img
+
+
+def _chunks(length, chunk_size):
+    """Slices covering ``range(length)`` in chunks of ``chunk_size``"""
+    for start in range(0, length, chunk_size):
+        yield slice(start, start + chunk_size)
+
+
+def _residuals(data, design, design_pinv):
+    """
+    Residuals of the least-squares fit of a design to each row of
+    ``data``, in float64
+
+    Parameters
+    ----------
+    data : array of shape (rows, timepoints)
+
+    design : array of shape (timepoints, regressors)
+
+    design_pinv : array of shape (regressors, timepoints)
+        pseudo-inverse of the design (or of a design with more regressors,
+        to remove only part of the fit)
+
+    Returns
+    -------
+    array of shape (rows, timepoints)
+    """
+    data = np.array(data, dtype=np.float64)
+    data -= (data @ design_pinv.T) @ design.T
+    return data
+
+
+def _load_masked_data(data_filename, mask_filename):
+    """
+    Timeseries of the voxels in a mask
+
+    Returns
+    -------
+    float32 array of shape (voxels, timepoints)
+    """
+    from CPAC.utils.data_cache import load_image_data
+
+    try:
+        image_data = load_image_data(data_filename, dtype=np.float32)
+    except:
+        print('Unable to load data from {0}'.format(data_filename))
+        raise
+
+    try:
+        binary_mask = nb.load(mask_filename).get_fdata().astype(np.int16) > 0
+    except:
+        print('Unable to load data from {0}'.format(mask_filename))
+        raise
+
+    if not safe_shape(image_data, binary_mask):
+        raise ValueError('The data in {0} and {1} do not have a consistent shape'.format(data_filename, mask_filename))
+
+    return np.array(image_data[binary_mask], dtype=np.float32)
+
+
+def gram_product(data, vectors, chunk_size=CHUNK_SIZE):
+    """
+    ``data.T @ data @ vectors`` (or ``data.T @ data`` if ``vectors`` is
+    None), accumulated over chunks of rows in float64
+    """
+    timepoints = data.shape[1]
+    product = np.zeros((timepoints, timepoints if vectors is None else
+                        vectors.shape[1]))
+    for chunk in _chunks(len(data), chunk_size):
+        rows = data[chunk].astype(np.float64)
+        product += rows.T @ (rows if vectors is None else rows @ vectors)
+    return product
+
+
+def top_eigenvectors(gram, size, k, svd_method='truncated', random_state=0,
+                      oversamples=10, power_iterations=4):
+    """
+    Leading eigenvectors of a symmetric positive semi-definite matrix
+    ``A`` (here ``Yc @ Yc.T``, so the eigenvectors are the leading left
+    singular vectors of ``Yc``)
+
+    Parameters
+    ----------
+    gram : callable
+        ``gram(vectors)`` returns ``A @ vectors``, ``gram(None)`` returns
+        ``A``
+
+    size : int
+        rows of ``A``
+
+    k : int
+        number of eigenvectors
+
+    svd_method : str
+        'truncated' computes ``A`` and its top ``k`` eigenvectors exactly;
+        'randomized' uses randomized subspace iteration [1]_ with
+        ``oversamples`` extra vectors and ``power_iterations`` passes
+
+    random_state : int
+
+    Returns
+    -------
+    array of shape (size, k)
+        eigenvectors by decreasing eigenvalue
+
+    References
+    ----------
+    .. [1] Halko N, Martinsson PG, Tropp JA (2011). Finding structure with
+           randomness: Probabilistic algorithms for constructing
+           approximate matrix decompositions. SIAM Review 53(2), 217-288.
+           https://doi.org/10.1137/090771806
+    """
+    from scipy.linalg import eigh
+    if svd_method == 'truncated':
+        _, vectors = eigh(gram(None), subset_by_index=[size - k, size - 1])
+        return vectors[:, ::-1]
+    rng = np.random.default_rng(random_state)
+    basis = rng.standard_normal((size, min(k + oversamples, size)))
+    for _ in range(power_iterations):
+        basis = np.linalg.qr(gram(basis))[0]
+    _, vectors = eigh(basis.T @ gram(basis))
+    return basis @ vectors[:, ::-1][:, :k]
+
+
+def calc_compcor_components_full_svd(data_filename, num_components,
+                                     mask_filename):
+    """
+    Reference (float64, full SVD) implementation of
+    :func:`calc_compcor_components`.
+
+    Kept for validation and benchmarking.
+    """
 
     if num_components < 1:
         raise ValueError('Improper value for num_components ({0}), should be >= 1.'.format(num_components))
@@ -60,8 +337,11 @@ def calc_compcor_components(data_filename, num_components, mask_filename):
 
 
 # cosine_filter adapted from nipype 'https://github.com/nipy/nipype/blob/d353f0d879826031334b09d33e9443b8c9b3e7fe/nipype/algorithms/confounds.py'
-def cosine_filter(input_image_path, timestep, period_cut=128, remove_mean=True, axis=-1, failure_mode='error'):
+def cosine_filter_lstsq(input_image_path, timestep, period_cut=128, remove_mean=True, axis=-1, failure_mode='error'):
     """
+    Reference (float64, whole-image ``lstsq``) implementation of
+    :func:`cosine_filter`. Kept for validation and benchmarking.
+
     input_image_path: string
             Bold image to be filtered.
     timestep: float
@@ -0,0 +1,294 @@
+# Copyright (C) 2024  C-PAC Developers
+
+# This file is part of C-PAC.
+
+# C-PAC is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+
+# C-PAC is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+# License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with C-PAC. If not, see <https://www.gnu.org/licenses/>.
+"""In-process nuisance regression (``2-nuisance_regression: engine:
+native``).
+
+Reproduces what C-PAC asks of AFNI's ``3dTproject``: the polynomials up
+to ``polort`` and the columns of the regressor file are projected out of
+every in-mask voxel's timeseries, fitting only the uncensored volumes,
+and censored volumes are removed (``KILL``), zeroed (``ZERO``) or
+interpolated from their neighbours before fitting (``NTRP``). Voxels
+outside the mask are zero.
+
+The masked BOLD data are loaded once (through the data cache, when it is
+enabled) and every regressor selector sharing that image is solved
+against them, with one QR decomposition of each design.
+"""
+import os
+
+import nibabel as nb
+import numpy as np
+from numpy.polynomial import legendre
+from scipy.linalg import qr
+
+from CPAC.utils.data_cache import load_image_data
+
+CENSOR_MODES = {'Kill': 'KILL', 'Zero': 'ZERO', 'Interpolate': 'NTRP',
+                'SpikeRegression': 'KILL'}
+"""3dTproject ``-cenmode`` for each C-PAC censoring method. Spike
+regression keeps 3dTproject's default."""
+
+CHUNK_SIZE = 4096
+"""Voxels regressed at a time"""
+
+
+def legendre_basis(timepoints, degree):
+    """Legendre polynomials of degree 0 through ``degree`` over the run,
+    as used by ``3dTproject -polort``
+
+    Parameters
+    ----------
+    timepoints : int
+
+    degree : int
+
+    Returns
+    -------
+    array of shape (timepoints, degree + 1)
+
+    Examples
+    --------
+    >>> legendre_basis(5, 1)[:, 1]
+    array([-1. , -0.5,  0. ,  0.5,  1. ])
+    """
+    return legendre.legvander(np.linspace(-1, 1, timepoints), degree)
+
+
+def read_censor_file(censor_file_path, timepoints):
+    """Volumes to keep from a censor file (``1`` to keep, ``0`` to censor,
+    optionally under a header line)
+
+    Parameters
+    ----------
+    censor_file_path : str or None
+
+    timepoints : int
+
+    Returns
+    -------
+    boolean array of shape (timepoints,)
+    """
+    if not censor_file_path:
+        return np.ones(timepoints, dtype=bool)
+    values = []
+    with open(censor_file_path, 'r', encoding='utf-8') as censor_file:
+        for line in censor_file:
+            try:
+                values.append(float(line))
+            except ValueError:  # header
+                continue
+    keep = np.array(values) != 0
+    if keep.shape != (timepoints,):
+        raise ValueError(f'Censor file {censor_file_path} has {keep.size} '
+                         f'values for {timepoints} volumes.')
+    return keep
+
+
+def nuisance_design(timepoints, regressor_file=None, polort=0):
+    """Design matrix of polynomials and the columns of a regressor file
+
+    Parameters
+    ----------
+    timepoints : int
+
+    regressor_file : str, optional
+        whitespace-delimited regressors, one row per volume; lines
+        starting with ``#`` are ignored
+
+    polort : int, optional
+
+    Returns
+    -------
+    array of shape (timepoints, regressors)
+    """
+    design = [legendre_basis(timepoints, polort)]
+    if regressor_file:
+        regressors = np.loadtxt(regressor_file, ndmin=2)
+        if regressors.shape[0] != timepoints:
+            raise ValueError(f'Number of time points in {regressor_file} '
+                             f'({regressors.shape[0]}) is inconsistent with '
+                             f'the length of the functional file '
+                             f'({timepoints}).')
+        design.append(regressors)
+    return np.column_stack(design)
+
+
+def orthonormal_basis(design, rtol=1e-10):
+    """Orthonormal basis of the column space of a design, from a QR
+    decomposition with column pivoting that drops dependent columns
+    (e.g. spike regressors of volumes that were censored)
+
+    Parameters
+    ----------
+    design : array of shape (timepoints, regressors)
+
+    rtol : float
+        columns whose pivot is below ``rtol`` times the largest pivot are
+        treated as dependent
+
+    Returns
+    -------
+    array of shape (timepoints, rank)
+    """
+    q, r, _ = qr(design, mode='economic', pivoting=True)
+    pivots = np.abs(np.diag(r))
+    if not pivots.size or not pivots[0]:
+        return q[:, :0]
+    return q[:, :int((pivots > rtol * pivots[0]).sum())]
+
+
+def interpolation_weights(keep):
+    """Linear interpolation of censored volumes from their nearest kept
+    neighbours, as a (timepoints × timepoints) matrix to apply to each
+    timeseries (3dTproject ``-cenmode NTRP``)
+
+    Parameters
+    ----------
+    keep : boolean array of shape (timepoints,)
+
+    Returns
+    -------
+    array of shape (timepoints, timepoints)
+    """
+    timepoints = keep.size
+    kept = np.flatnonzero(keep)
+    weights = np.eye(timepoints)
+    for index in np.flatnonzero(~keep):
+        weights[index, index] = 0
+        after = np.searchsorted(kept, index)
+        if after == 0:
+            weights[index, kept[0]] = 1
+        elif after == kept.size:
+            weights[index, kept[-1]] = 1
+        else:
+            previous, following = kept[after - 1], kept[after]
+            fraction = (index - previous) / (following - previous)
+            weights[index, previous] = 1 - fraction
+            weights[index, following] = fraction
+    return weights
+
+
+def project_out(data, design, keep, censor_mode='KILL',
+                chunk_size=CHUNK_SIZE):
+    """Residuals of every row of ``data`` after projecting out a design
+
+    Parameters
+    ----------
+    data : array of shape (voxels, timepoints)
+
+    design : array of shape (timepoints, regressors)
+
+    keep : boolean array of shape (timepoints,)
+        volumes to fit
+
+    censor_mode : str
+        'KILL', 'ZERO' or 'NTRP'
+
+    chunk_size : int
+        voxels at a time
+
+    Returns
+    -------
+    float32 array of shape (voxels, output timepoints)
+        output timepoints are the kept volumes for 'KILL', all volumes
+        otherwise
+    """
+    if not keep.any():
+        raise ValueError('All volumes are censored.')
+    interpolate = censor_mode == 'NTRP' and not keep.all()
+    fit = np.ones_like(keep) if censor_mode == 'NTRP' else keep
+    basis = orthonormal_basis(design[fit])
+    residuals = np.zeros((data.shape[0], int(
+        keep.sum() if censor_mode == 'KILL' else keep.size)),
+        dtype=np.float32)
+    columns = slice(None) if censor_mode == 'KILL' else fit
+    if interpolate:
+        weights = interpolation_weights(keep)
+    for start in range(0, data.shape[0], chunk_size):
+        chunk = np.array(data[start:start + chunk_size], dtype=np.float64)
+        if interpolate:
+            chunk = chunk @ weights.T
+        chunk = chunk[:, fit]
+        residuals[start:start + chunk_size, columns] = (
+            chunk - (chunk @ basis) @ basis.T)
+    return residuals
+
+
+def regress_nuisance(functional_file_path, mask_file_path, selectors,
+                     capacity=1, chunk_size=CHUNK_SIZE, **slots):
+    """Nuisance regression of one BOLD image for one or more regressor
+    selectors, loading the masked data once
+
+    Parameters
+    ----------
+    functional_file_path : str
+
+    mask_file_path : str
+
+    selectors : dict
+        {slot index (str): {'polort': int, 'censor_mode': str or None}}
+
+    capacity : int
+        number of slots of the node; one output per slot
+
+    chunk_size : int
+
+    slots
+        ``regressor_file_{slot}`` and ``censor_file_path_{slot}`` for each
+        slot in ``selectors``
+
+    Returns
+    -------
+    residual_file_path_0, ..., residual_file_path_{capacity - 1} : str or
+    None
+        residuals for each slot, None for unused slots
+    """
+    img = nb.load(functional_file_path)
+    mask = nb.load(mask_file_path).get_fdata() != 0
+    if mask.shape != img.shape[:3]:
+        raise ValueError(f'The data in {functional_file_path} and '
+                         f'{mask_file_path} do not have a consistent shape.')
+    data = load_image_data(functional_file_path, dtype=np.float32)
+    masked = np.array(data[mask], dtype=np.float32)
+    del data
+    timepoints = masked.shape[1]
+
+    residual_files = [None] * capacity
+    for slot, selector in sorted(selectors.items(), key=lambda s: int(s[0])):
+        censor_mode = selector.get('censor_mode')
+        keep = read_censor_file(slots.get(f'censor_file_path_{slot}')
+                                if censor_mode else None, timepoints)
+        design = nuisance_design(timepoints,
+                                 slots.get(f'regressor_file_{slot}'),
+                                 selector.get('polort', 0))
+        residuals = project_out(masked, design, keep, censor_mode or 'KILL',
+                                chunk_size)
+        out_data = np.zeros(mask.shape + (residuals.shape[1],),
+                            dtype=np.float32)
+        out_data[mask] = residuals
+        del residuals
+        out_img = nb.Nifti1Image(out_data, img.affine, img.header)
+        out_img.set_data_dtype(np.float32)
+        out_dir = os.path.join(os.getcwd(), f'selector_{slot}')
+        os.makedirs(out_dir, exist_ok=True)
+        residual_files[int(slot)] = os.path.join(out_dir,
+                                                 'residuals.nii.gz')
+        out_img.to_filename(residual_files[int(slot)])
+        del out_data, out_img
+    if capacity == 1:
+        return residual_files[0]
+    return tuple(residual_files)
@@ -0,0 +1,217 @@
+# Copyright (C) 2024  C-PAC Developers
+
+# This file is part of C-PAC.
+
+# C-PAC is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+
+# C-PAC is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+# License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with C-PAC. If not, see <https://www.gnu.org/licenses/>.
+"""Copy-on-write dictionaries for resource pools.
+
+A resource pool is nested dictionaries, ``{resource: {pipe_idx: {'data':
+(node, output), 'json': sidecar, ...}}}``. A copy of a
+:class:`CopyOnWriteDict` shares every value with the original; a nested
+dictionary is copied (shallowly, and itself copy-on-write down to the
+configured number of ``levels``) only the first time it's accessed through
+one of the two, so unchanged resources (and the nodes they reference) are
+never duplicated.
+"""
+import os
+import sys
+
+
+class CopyOnWriteDict(dict):
+    """Dictionary whose copies share values until they're accessed
+
+    Parameters
+    ----------
+    levels : int
+        number of levels of nested dictionaries to copy on write (a
+        resource pool's resources, strategies, entries and sidecars are
+        4 levels)
+
+    Examples
+    --------
+    >>> pool = CopyOnWriteDict({'T1w': {'pipe0': {'json': {'Sources': []}}}},
+    ...                        levels=3)
+    >>> pool_copy = pool.copy()
+    >>> pool_copy.shared == {'T1w'}
+    True
+    >>> pool_copy['T1w']['pipe0']['json']['Description'] = 'raw T1w'
+    >>> pool['T1w']['pipe0']['json']
+    {'Sources': []}
+    >>> pool_copy['T1w']['pipe0']['json']
+    {'Sources': [], 'Description': 'raw T1w'}
+    """
+    def __init__(self, *args, levels=4, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.levels = levels
+        self._shared = set()
+
+    def __reduce__(self):
+        # copies and pickles own what they hold
+        return (self.__class__, (dict(dict.items(self)),),
+                {'levels': self.levels, '_shared': set()})
+
+    @property
+    def shared(self):
+        """Keys whose values are still shared with a copy"""
+        return set(self._shared)
+
+    def _own(self, key):
+        """Replace a shared value with a copy before handing it out"""
+        value = super().__getitem__(key)
+        if key in self._shared:
+            self._shared.discard(key)
+            if isinstance(value, CopyOnWriteDict):
+                value = value.copy()
+            elif isinstance(value, dict):
+                if self.levels > 1:
+                    value = CopyOnWriteDict(value, levels=self.levels - 1)
+                    value._shared = set(value)
+                else:
+                    value = dict(value)
+            super().__setitem__(key, value)
+        return value
+
+    def __getitem__(self, key):
+        return self._own(key)
+
+    def __setitem__(self, key, value):
+        self._shared.discard(key)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._shared.discard(key)
+        super().__delitem__(key)
+
+    def copy(self):
+        """Copy that shares all values with this dictionary until either
+        accesses them
+
+        Returns
+        -------
+        CopyOnWriteDict
+        """
+        # values already copied on this side are shared again
+        self._shared = set(self.keys())
+        other = CopyOnWriteDict(super().items(), levels=self.levels)
+        other._shared = set(self._shared)
+        return other
+
+    def get(self, key, default=None):
+        return self._own(key) if key in self else default
+
+    def items(self):
+        return [(key, self._own(key)) for key in list(self.keys())]
+
+    def values(self):
+        return [self._own(key) for key in list(self.keys())]
+
+    def pop(self, key, *default):
+        self._shared.discard(key)
+        return super().pop(key, *default)
+
+    def popitem(self):
+        key, value = super().popitem()
+        self._shared.discard(key)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self._own(key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        self._shared.clear()
+        super().clear()
+
+
+def _sizeof(obj, seen):
+    """Bytes of an object and everything it contains, each object counted
+    once (nodes are counted by reference only)"""
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_sizeof(key, seen) + _sizeof(value, seen)
+                    for key, value in dict.items(obj))
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(_sizeof(item, seen) for item in obj)
+    return size
+
+
+def pool_memory(rpool):
+    """Memory usage of a resource pool's dictionaries
+
+    Parameters
+    ----------
+    rpool : dict
+        ``ResourcePool.rpool``
+
+    Returns
+    -------
+    dict
+        ``resources``, ``strategies``, ``shared`` (resources still shared
+        with a copy), ``sidecar_mb`` (the pool's dictionaries and JSON
+        sidecars, each object counted once) and ``rss_mb`` (the resident
+        memory of this process, if ``psutil`` is available)
+
+    Examples
+    --------
+    >>> report = pool_memory({'T1w': {'pipe0': {'data': (None, 'out'),
+    ...                                         'json': {'Sources': []}}}})
+    >>> report['resources'], report['strategies'], report['shared']
+    (1, 1, 0)
+    """
+    strategies = sum(len(strats) for strats in dict.values(rpool)
+                     if isinstance(strats, dict))
+    report = {'resources': len(rpool), 'strategies': strategies,
+              'shared': len(getattr(rpool, '_shared', ())),
+              'sidecar_mb': round(_sizeof(rpool, set()) / 1024 ** 2, 3),
+              'rss_mb': None}
+    try:
+        import psutil
+        report['rss_mb'] = round(
+            psutil.Process(os.getpid()).memory_info().rss / 1024 ** 2, 1)
+    except ImportError:
+        pass
+    return report
+
+
+def format_memory_report(report):
+    """One line of a :func:`pool_memory` report for the logs
+
+    Parameters
+    ----------
+    report : dict
+
+    Returns
+    -------
+    str
+
+    Examples
+    --------
+    >>> format_memory_report({'resources': 3, 'strategies': 5, 'shared': 1,
+    ...                       'sidecar_mb': 0.25, 'rss_mb': 812.5})
+    '3 resources, 5 strategies (1 resources shared), 0.25 MB of sidecars, 812.5 MB RSS'
+    """
+    line = (f'{report["resources"]} resources, {report["strategies"]} '
+            f'strategies ({report["shared"]} resources shared), '
+            f'{report["sidecar_mb"]} MB of sidecars')
+    if report.get('rss_mb') is not None:
+        line += f', {report["rss_mb"]} MB RSS'
+    return line
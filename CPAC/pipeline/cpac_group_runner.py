@@ -16,6 +16,7 @@
 # License along with C-PAC. If not, see <https://www.gnu.org/licenses/>.
 import os
 import fnmatch
+import re
 from CPAC.pipeline.nipype_pipeline_engine.plugins import MultiProcPlugin
 from CPAC.utils.monitoring import log_nodes_cb
 
@@ -118,7 +119,7 @@ def read_pheno_csv_into_df(pheno_csv, id_label=None):
 
 
 def gather_nifti_globs(pipeline_output_folder, resource_list,
-                       pull_func=False):
+                       pull_func=False, output_index=None):
     # the number of directory levels under each participant's output folder
     # can vary depending on what preprocessing strategies were chosen, and
     # there may be several output filepaths with varying numbers of directory
@@ -126,6 +127,10 @@ def gather_nifti_globs(pipeline_output_folder, resource_list,
 
     # this parses them quickly while also catching each preprocessing strategy
 
+    # with an output_index (CPAC.pipeline.output_index.OutputIndex), the
+    # glob strings are found from the index instead of globbing the output
+    # directory once per level per derivative
+
     import os
     import glob
     import pandas as pd
@@ -175,6 +180,12 @@ def gather_nifti_globs(pipeline_output_folder, resource_list,
     for resource_name in dirs_to_grab:
         glob_string = os.path.join(pipeline_output_folder, "*", "*", 
                                    f"*{resource_name}*")
+        if output_index is not None:
+            for depth, has_nifti in output_index.glob_levels(resource_name):
+                if has_nifti:
+                    nifti_globs.append(os.path.join(
+                        glob_string, *["*"] * (depth - 3)))
+            continue
         # get all glob strings that result in a list of paths where every path
         # ends with a NIFTI file
         prog_string = ".."
@@ -315,7 +326,8 @@ def extract_power_params(power_params_lines, power_params_filepath):
 def create_output_dict_list(nifti_globs, pipeline_output_folder,
                             resource_list, get_motion=False,
                             get_raw_score=False, pull_func=False,
-                            derivatives=None, exts=['nii', 'nii.gz']):
+                            derivatives=None, exts=['nii', 'nii.gz'],
+                            output_index=None):
 
     import os
     import glob
@@ -377,71 +389,80 @@ def create_output_dict_list(nifti_globs, pipeline_output_folder,
     # parse each result of each "valid" glob string
     output_dict_list = {}
 
-    for root, _, files in os.walk(pipeline_output_folder):
-        for filename in files:
+    if not nifti_globs:
+        return output_dict_list
+    matches_glob = re.compile('|'.join(
+        fnmatch.translate(pattern) for pattern in nifti_globs)).match
 
-            filepath = os.path.join(root, filename)
-            if not any(fnmatch.fnmatch(filepath, pattern) for pattern in nifti_globs):
-                continue
+    if output_index is None:
+        filepaths = (os.path.join(root, filename) for root, _, files in
+                     os.walk(pipeline_output_folder) for filename in files)
+    else:
+        filepaths = (os.path.join(pipeline_output_folder, path) for path in
+                     output_index.files(search_dirs))
 
-            if not any(filepath.endswith(ext) for ext in exts):
-                continue
-            relative_filepath = filepath.split(pipeline_output_folder)[1]
-            filepath_pieces = [_f for _f in relative_filepath.split("/") if _f]
+    for filepath in filepaths:
+        if not matches_glob(filepath):
+            continue
 
-            resource_id = '_'.join(filepath_pieces[2].split(".")[0].split("_")[3:])
+        if not any(filepath.endswith(ext) for ext in exts):
+            continue
+        relative_filepath = filepath.split(pipeline_output_folder)[1]
+        filepath_pieces = [_f for _f in relative_filepath.split("/") if _f]
 
-            if resource_id not in search_dirs:
-                continue
+        resource_id = '_'.join(filepath_pieces[2].split(".")[0].split("_")[3:])
 
-            series_id_string = filepath_pieces[2].split("_")[1]
-            strat_info = "_".join(filepath_pieces[2].split("_")[2:3])
+        if resource_id not in search_dirs:
+            continue
 
-            unique_resource_id = (resource_id, strat_info)
+        series_id_string = filepath_pieces[2].split("_")[1]
+        strat_info = "_".join(filepath_pieces[2].split("_")[2:3])
 
-            if unique_resource_id not in output_dict_list.keys():
-                output_dict_list[unique_resource_id] = []
+        unique_resource_id = (resource_id, strat_info)
 
-            unique_id = filepath_pieces[0]
+        if unique_resource_id not in output_dict_list.keys():
+            output_dict_list[unique_resource_id] = []
 
-            series_id = series_id_string.replace("_scan_", "")
-            series_id = series_id.replace("_rest", "")
+        unique_id = filepath_pieces[0]
 
-            new_row_dict = {}
-            new_row_dict["participant_session_id"] = unique_id
-            new_row_dict["participant_id"], new_row_dict["Sessions"] = \
-                unique_id.split('_')
+        series_id = series_id_string.replace("_scan_", "")
+        series_id = series_id.replace("_rest", "")
 
-            new_row_dict["Series"] = series_id
-            new_row_dict["Filepath"] = filepath
+        new_row_dict = {}
+        new_row_dict["participant_session_id"] = unique_id
+        new_row_dict["participant_id"], new_row_dict["Sessions"] = \
+            unique_id.split('_')
 
-            print('{0} - {1} - {2}'.format(
-                unique_id.split("_")[0],
-                series_id,
-                resource_id
-            ))
+        new_row_dict["Series"] = series_id
+        new_row_dict["Filepath"] = filepath
 
-            if get_motion:
-                # if we're including motion measures
-                power_params_file = find_power_params_file(filepath,
-                    resource_id, series_id)
-                power_params_lines = load_text_file(power_params_file,
-                    "power parameters file")
-                meanfd_p, meanfd_j, meandvars = \
-                    extract_power_params(power_params_lines,
-                                         power_params_file)
-                new_row_dict["MeanFD_Power"] = meanfd_p
-                new_row_dict["MeanFD_Jenkinson"] = meanfd_j
-                new_row_dict["MeanDVARS"] = meandvars
+        print('{0} - {1} - {2}'.format(
+            unique_id.split("_")[0],
+            series_id,
+            resource_id
+        ))
 
-            if get_raw_score:
-                # grab raw score for measure mean just in case
-                raw_score_path = grab_raw_score_filepath(filepath,
-                                                         resource_id)
-                new_row_dict["Raw_Filepath"] = raw_score_path
+        if get_motion:
+            # if we're including motion measures
+            power_params_file = find_power_params_file(filepath,
+                resource_id, series_id)
+            power_params_lines = load_text_file(power_params_file,
+                "power parameters file")
+            meanfd_p, meanfd_j, meandvars = \
+                extract_power_params(power_params_lines,
+                                     power_params_file)
+            new_row_dict["MeanFD_Power"] = meanfd_p
+            new_row_dict["MeanFD_Jenkinson"] = meanfd_j
+            new_row_dict["MeanDVARS"] = meandvars
 
-            # unique_resource_id is tuple (resource_id,strat_info)
-            output_dict_list[unique_resource_id].append(new_row_dict)
+        if get_raw_score:
+            # grab raw score for measure mean just in case
+            raw_score_path = grab_raw_score_filepath(filepath,
+                                                     resource_id)
+            new_row_dict["Raw_Filepath"] = raw_score_path
+
+        # unique_resource_id is tuple (resource_id,strat_info)
+        output_dict_list[unique_resource_id].append(new_row_dict)
 
     return output_dict_list
 
@@ -480,23 +501,35 @@ def create_output_df_dict(output_dict_list, inclusion_list=None):
 
 def gather_outputs(pipeline_folder, resource_list, inclusion_list,
                    get_motion, get_raw_score, get_func=False,
-                   derivatives=None):
+                   derivatives=None, index_path=None):
 
-    nifti_globs = gather_nifti_globs(
-        pipeline_folder,
-        resource_list,
-        get_func
-    )
+    from CPAC.pipeline.output_index import OutputIndex
 
-    output_dict_list = create_output_dict_list(
-        nifti_globs,
-        pipeline_folder,
-        resource_list,
-        get_motion,
-        get_raw_score,
-        get_func,
-        derivatives
-    )
+    # walk the output directory once (or only what changed since the last
+    # group run) and find the outputs in the index
+    output_index = OutputIndex(pipeline_folder, index_path)
+    output_index.scan()
+
+    try:
+        nifti_globs = gather_nifti_globs(
+            pipeline_folder,
+            resource_list,
+            get_func,
+            output_index
+        )
+
+        output_dict_list = create_output_dict_list(
+            nifti_globs,
+            pipeline_folder,
+            resource_list,
+            get_motion,
+            get_raw_score,
+            get_func,
+            derivatives,
+            output_index=output_index
+        )
+    finally:
+        output_index.close()
 
     output_df_dict = create_output_df_dict(output_dict_list, inclusion_list)
 
@@ -1235,13 +1268,11 @@ def run_feat(group_config_file, feat=True):
 
 def run_cwas_group(pipeline_dir, out_dir, working_dir, crash_dir, roi_file,
                    regressor_file, participant_column, columns,
-                   permutations, parallel_nodes, plugin_args, z_score, inclusion=None):
+                   permutations, parallel_nodes, plugin_args, z_score, inclusion=None,
+                   low_memory=False, pvalue_precision=None):
 
     import os
-    import numpy as np
-    from multiprocessing import pool
     from CPAC.cwas.pipeline import create_cwas
-    from nipype import config
 
     pipeline_dir = os.path.abspath(pipeline_dir)
 
@@ -1294,10 +1325,13 @@ def run_cwas_group(pipeline_dir, out_dir, working_dir, crash_dir, roi_file,
                 plugin = 'Linear'
             else:
                 plugin = 'MultiProc'
-            
-            cwas_wf = create_cwas(name="MDMR_{0}".format(df_scan),
+
+            name = "MDMR_{0}".format(df_scan)
+            os.makedirs(os.path.join(out_dir, name), exist_ok=True)
+            cwas_wf = create_cwas(name=name,
                                   working_dir=working_dir,
-                                  crash_dir=crash_dir)
+                                  crash_dir=crash_dir,
+                                  n_procs=plugin_args['n_procs'])
             cwas_wf.inputs.inputspec.subjects = func_paths
             cwas_wf.inputs.inputspec.roi = roi_file
             cwas_wf.inputs.inputspec.regressor = regressor_file
@@ -1306,6 +1340,9 @@ def run_cwas_group(pipeline_dir, out_dir, working_dir, crash_dir, roi_file,
             cwas_wf.inputs.inputspec.permutations = permutations
             cwas_wf.inputs.inputspec.parallel_nodes = parallel_nodes
             cwas_wf.inputs.inputspec.z_score = z_score
+            cwas_wf.inputs.inputspec.low_memory = low_memory
+            cwas_wf.inputs.inputspec.pvalue_precision = pvalue_precision
+            cwas_wf.inputs.inputspec.out_dir = os.path.join(out_dir, name)
             cwas_wf.run(plugin=plugin, plugin_args=plugin_args)
 
 
@@ -1336,14 +1373,19 @@ def run_cwas(pipeline_config):
     parallel_nodes = pipeconfig_dct["mdmr"]["parallel_nodes"]
     inclusion = pipeconfig_dct["mdmr"]["inclusion_list"]
     z_score = pipeconfig_dct["mdmr"]["zscore"]
+    low_memory = pipeconfig_dct["mdmr"].get("low_memory", False)
+    pvalue_precision = pipeconfig_dct["mdmr"].get("pvalue_precision")
 
     if not inclusion or "None" in inclusion or "none" in inclusion:
         inclusion = None
+    if not pvalue_precision or str(pvalue_precision).lower() == "none":
+        pvalue_precision = None
 
     run_cwas_group(pipeline, output_dir, working_dir, crash_dir, roi_file,
                    regressor_file, participant_column, columns,
                    permutations, parallel_nodes, plugin_args, z_score,
-                   inclusion=inclusion)
+                   inclusion=inclusion, low_memory=low_memory,
+                   pvalue_precision=pvalue_precision)
 
 
 def find_other_res_template(template_path, new_resolution):
@@ -1383,83 +1425,6 @@ def find_other_res_template(template_path, new_resolution):
     return ref_file
 
 
-def check_cpac_output_image(image_path, reference_path, out_dir=None,
-                            roi_file=False):
-
-    import os
-    import nibabel as nb
-
-    if not out_dir:
-        out_dir = os.getcwd()
-
-    # we want to preserve the original directory structure of the input image,
-    # but place that sub-tree into the BASC working directory (in this case,
-    # 'out_dir')
-    try:
-        orig_dir = "pipeline_{0}".format(image_path.split('pipeline_')[1])
-    except IndexError:
-        if roi_file:
-            orig_dir = os.path.join("ROI_files", os.path.basename(image_path))
-        else:
-            raise IndexError(image_path)
-    out_path = os.path.join(out_dir, 'resampled_input_images', orig_dir)
-
-    # if this was already done
-    if os.path.isfile(out_path):
-        image_path = out_path
-
-    resample = False
-
-    image_nb = nb.load(image_path)
-    ref_nb = nb.load(reference_path)
-
-    # check: do we even need to resample?
-    if int(image_nb.header.get_zooms()[0]) != int(ref_nb.header.get_zooms()[0]):
-        print("Input image resolution is {0}mm\nTemplate image resolution "
-              "is {1}mm\n".format(image_nb.header.get_zooms()[0],
-                                  ref_nb.header.get_zooms()[0]))
-        resample = True
-    if image_nb.shape != ref_nb.shape:
-        print("Input image shape is {0}\nTemplate image shape is "
-              "{1}\n".format(image_nb.shape, ref_nb.shape))
-        resample = True
-
-    if resample:
-        if not os.path.isdir(
-                out_path.replace(os.path.basename(out_path), "")):
-            try:
-                os.makedirs(out_path.replace(os.path.basename(out_path), ""))
-            except:
-                # TODO: better message
-                raise Exception("couldn't make the dirs!")
-
-        print("Resampling input image:\n{0}\n\n..to this reference:\n{1}"
-              "\n\n..and writing this file here:\n{2}"
-              "\n".format(image_path, reference_path, out_path))
-        cmd = ['flirt', '-in', image_path, '-ref', reference_path, '-out',
-               out_path]
-        if roi_file:
-            cmd.append('-interp')
-            cmd.append('nearestneighbour')
-        return cmd
-    else:
-        return resample
-
-
-def resample_cpac_output_image(cmd_args):
-
-    import subprocess
-
-    print("Running:\n{0}\n\n".format(" ".join(cmd_args)))
-    retcode = subprocess.check_output(cmd_args)
-
-    for arg in cmd_args:
-        if 'resampled_input_images' in arg:
-            out_file = arg
-
-    return out_file
-
-
 def launch_PyBASC(pybasc_config):
 
     import subprocess
@@ -1518,7 +1483,7 @@ def run_basc(pipeline_config):
     import os
     import yaml
     from CPAC.utils.datasource import check_for_s3
-    from multiprocessing import pool
+    from CPAC.pipeline.group_resampling import resample_group_inputs
 
     pipeline_config = os.path.abspath(pipeline_config)
 
@@ -1589,21 +1554,11 @@ def run_basc(pipeline_config):
                                                 dl_dir=working_dir)
 
     # resample ROI files if necessary
-    roi_cmd_args = check_cpac_output_image(basc_config_dct['roi_mask_file'],
-                                           ref_file,
-                                           out_dir=working_dir,
-                                           roi_file=True)
-    roi_two_cmd_args = check_cpac_output_image(basc_config_dct['cross_cluster_mask_file'],
-                                               ref_file,
-                                               out_dir=working_dir,
-                                               roi_file=True)
-
-    if roi_cmd_args:
-        roi_file = resample_cpac_output_image(roi_cmd_args)
-        basc_config_dct['roi_mask_file'] = roi_file
-    if roi_two_cmd_args:
-        roi_file_two = resample_cpac_output_image(roi_two_cmd_args)
-        basc_config_dct['cross_cluster_mask_file'] = roi_file_two
+    basc_config_dct['roi_mask_file'], \
+        basc_config_dct['cross_cluster_mask_file'] = resample_group_inputs(
+            [basc_config_dct['roi_mask_file'],
+             basc_config_dct['cross_cluster_mask_file']],
+            ref_file, working_dir, roi_file=True)
 
     pipeline_dir = os.path.abspath(pipeconfig_dct["pipeline_setup"]
                                    ["output_directory"]["source_outputs_path"])
@@ -1690,17 +1645,9 @@ def run_basc(pipeline_config):
             #     into the BASC sub-dir of the working directory
             #         should end up with a new "func_paths" list with all of
             #         these file paths in it
-            ref_file_iterable = [ref_file] * len(func_paths)
-            working_dir_iterable = [scan_working_dir] * len(func_paths)
-            func_cmd_args_list = map(check_cpac_output_image, func_paths,
-                                     ref_file_iterable,
-                                     working_dir_iterable)
-
-            # resample them now
-            if func_cmd_args_list[0]:
-                p = pool.Pool(int(basc_config_dct['proc_mem'][0]))
-                func_paths = p.map(resample_cpac_output_image,
-                                   func_cmd_args_list)
+            func_paths = resample_group_inputs(
+                func_paths, ref_file, scan_working_dir,
+                n_procs=int(basc_config_dct['proc_mem'][0]))
 
             # TODO: add list into basc_config here
             basc_config_dct['subject_file_list'] = func_paths
@@ -1809,7 +1756,8 @@ def run_isc_group(pipeline_dir, out_dir, working_dir, crash_dir,
                 isc_wf = create_isc(name=it_id,
                                     output_dir=unique_out_dir,
                                     working_dir=working_dir,
-                                    crash_dir=crash_dir)
+                                    crash_dir=crash_dir,
+                                    n_procs=num_cpus)
                 isc_wf.inputs.inputspec.subjects = func_paths
                 isc_wf.inputs.inputspec.permutations = permutations
                 isc_wf.inputs.inputspec.std = std_filter
@@ -1841,7 +1789,8 @@ def run_isc_group(pipeline_dir, out_dir, working_dir, crash_dir,
                 isfc_wf = create_isfc(name=it_id,
                                       output_dir=unique_out_dir,
                                       working_dir=working_dir,
-                                      crash_dir=crash_dir)
+                                      crash_dir=crash_dir,
+                                      n_procs=num_cpus)
                 isfc_wf.inputs.inputspec.subjects = func_paths
                 isfc_wf.inputs.inputspec.permutations = permutations
                 isfc_wf.inputs.inputspec.std = std_filter
@@ -1995,7 +1944,10 @@ def run_qpp(group_config_file):
 
             output_df_group = output_df_group.sort_values(by='participant_session_id')
 
-            wf = create_qpp(name="QPP", working_dir=group_working_dir, crash_dir=group_crash_dir)
+            wf = create_qpp(name="QPP", working_dir=group_working_dir,
+                            crash_dir=group_crash_dir,
+                            n_procs=c["pipeline_setup"]["system_config"][
+                                "num_cpus"])
 
             wf.inputs.inputspec.window_length = c["qpp"]["window"]
             wf.inputs.inputspec.permutations = c["qpp"]["permutations"]
@@ -2011,50 +1963,35 @@ def run_qpp(group_config_file):
 
 
 def manage_processes(procss, output_dir, num_parallel=1):
+    """Run processes, at most ``num_parallel`` at a time, starting the
+    next one as soon as one finishes (waiting on the processes' sentinels
+    rather than polling them)
 
-    import os
+    Parameters
+    ----------
+    procss : list of multiprocessing.Process
 
-    # start kicking it off
-    pid = open(os.path.join(output_dir, 'pid_group.txt'), 'w')
+    output_dir : str
+        directory to write the processes' IDs to (``pid_group.txt``)
 
-    jobQueue = []
-    if len(procss) <= num_parallel:
-        """
-        Stream all the subjects as sublist is
-        less than or equal to the number of
-        subjects that need to run
-        """
+    num_parallel : int
+    """
+    import os
+    from multiprocessing.connection import wait
+
+    running = []
+    with open(os.path.join(output_dir, 'pid_group.txt'), 'w',
+              encoding='utf-8') as pid:
         for p in procss:
+            if len(running) >= max(num_parallel, 1):
+                finished = wait([job.sentinel for job in running])
+                for job in [job for job in running
+                            if job.sentinel in finished]:
+                    print('found dead job {0}'.format(job))
+                    running.remove(job)
             p.start()
             print(p.pid, file=pid)
-
-    else:
-        """
-        Stream the subject workflows for preprocessing.
-        At Any time in the pipeline c.numSubjectsAtOnce
-        will run, unless the number remaining is less than
-        the value of the parameter stated above
-        """
-        idx = 0
-        while idx < len(procss):
-            if len(jobQueue) == 0 and idx == 0:
-                idc = idx
-                for p in procss[idc: idc + num_parallel]:
-                    p.start()
-                    print(p.pid, file=pid)
-                    jobQueue.append(p)
-                    idx += 1
-            else:
-                for job in jobQueue:
-                    if not job.is_alive():
-                        print('found dead job {0}'.format(job))
-                        loc = jobQueue.index(job)
-                        del jobQueue[loc]
-                        procss[idx].start()
-                        jobQueue.append(procss[idx])
-                        idx += 1
-
-    pid.close()
+            running.append(p)
 
 
 def run(config_file):
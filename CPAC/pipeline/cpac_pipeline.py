@@ -38,6 +38,7 @@ from indi_aws import aws_utils, fetch_creds
 import CPAC
 
 from CPAC.pipeline.check_outputs import check_outputs
+from CPAC.pipeline.copy_on_write import format_memory_report
 from CPAC.pipeline.engine import NodeBlock, initiate_rpool
 from CPAC.anat_preproc.anat_preproc import (
     freesurfer_reconall,
@@ -214,6 +215,8 @@ from CPAC.pipeline.random_state import set_up_random_state_logger
 from CPAC.pipeline.schema import valid_options
 from CPAC.utils.trimmer import the_trimmer
 from CPAC.utils import Configuration, set_subject
+from CPAC.utils.data_cache import set_up_data_cache
+from CPAC.utils.s3_prefetch import prefetch_s3_inputs, s3_inputs
 from CPAC.utils.docs import version_report
 from CPAC.utils.versioning import REQUIREMENTS
 from CPAC.qc.pipeline import create_qc_workflow
@@ -221,8 +224,11 @@ from CPAC.qc.xcp import qc_xcp
 
 from CPAC.utils.monitoring import getLogger, log_nodes_cb, log_nodes_initial, \
                                   LOGTAIL, set_up_logger, \
-                                  WARNING_FREESURFER_OFF_WITH_DATA
+                                  WARNING_FREESURFER_OFF_WITH_DATA, \
+                                  WorkflowRunError
 from CPAC.utils.monitoring.draw_gantt_chart import resource_report
+from CPAC.utils.monitoring.memory_model import update_memory_model, \
+    write_memory_prediction_report
 from CPAC.utils.utils import (
     check_config_resources,
     check_system_deps,
@@ -262,6 +268,11 @@ def run_workflow(sub_dict, c, run, pipeline_timing_info=None, p_name=None,
     workflow : nipype workflow
         the prepared nipype workflow object containing the parameters
         specified in the config
+
+    Raises
+    ------
+    WorkflowRunError
+        if the workflow fails to run, after its reports are written
     '''
     from CPAC.utils.datasource import bidsier_prefix
 
@@ -319,6 +330,13 @@ def run_workflow(sub_dict, c, run, pipeline_timing_info=None, p_name=None,
     plugin_args['raise_insufficient'] = c['pipeline_setup', 'system_config',
                                           'raise_insufficient']
     plugin_args['status_callback'] = log_nodes_cb
+    memory_model = c['pipeline_setup', 'system_config', 'observed_usage',
+                     'memory_model']
+    if memory_model:
+        plugin_args['memory_model'] = {
+            'store': memory_model,
+            'buffer': c['pipeline_setup', 'system_config', 'observed_usage',
+                        'buffer']}
 
     # perhaps in future allow user to set threads maximum
     # this is for centrality mostly
@@ -330,7 +348,7 @@ def run_workflow(sub_dict, c, run, pipeline_timing_info=None, p_name=None,
     # TODO: TEMPORARY
     # TODO: solve the UNet model hanging issue during MultiProc
     if "UNet" in c.anatomical_preproc['brain_extraction']['using']:
-        c.pipeline_setup['system_config']['max_cores_per_participant'] = 1
+        c['pipeline_setup', 'system_config', 'max_cores_per_participant'] = 1
         logger.info("\n\n[!] LOCKING CPUs PER PARTICIPANT TO 1 FOR U-NET "
                     "MODEL.\n\nThis is a temporary measure due to a known "
                     "issue preventing Nipype's parallelization from running "
@@ -443,16 +461,28 @@ def run_workflow(sub_dict, c, run, pipeline_timing_info=None, p_name=None,
                         check_centrality_lfcd=check_centrality_lfcd)
 
     # absolute paths of the dirs
-    c.pipeline_setup['working_directory']['path'] = os.path.join(
+    c['pipeline_setup', 'working_directory', 'path'] = os.path.join(
         os.path.abspath(c.pipeline_setup['working_directory']['path']),
         p_name)
     if 's3://' not in c.pipeline_setup['output_directory']['path']:
-        c.pipeline_setup['output_directory']['path'] = os.path.abspath(
+        c['pipeline_setup', 'output_directory', 'path'] = os.path.abspath(
             c.pipeline_setup['output_directory']['path'])
 
     if c.pipeline_setup['system_config']['random_seed'] is not None:
         set_up_random_state_logger(log_dir)
 
+    prefetch_threads = c.pipeline_setup['Amazon-AWS'][
+        'input_prefetch_threads']
+    if prefetch_threads and not test_config and s3_inputs(sub_dict):
+        # download the participant's S3 inputs before the workflow's
+        # datasource nodes look for them
+        _, failed = prefetch_s3_inputs(
+            sub_dict, c.pipeline_setup['working_directory']['path'],
+            input_creds_path, prefetch_threads)
+        if failed:
+            logger.warning('%d S3 inputs could not be prefetched; their '
+                           'nodes will try to download them.', len(failed))
+
     try:
         workflow = build_workflow(
             subject_id, sub_dict, c, p_name, num_ants_cores
@@ -494,6 +524,13 @@ def run_workflow(sub_dict, c, run, pipeline_timing_info=None, p_name=None,
         working_dir = os.path.join(
             c.pipeline_setup['working_directory']['path'], workflow.name)
 
+        data_cache = c.pipeline_setup['working_directory']['data_cache']
+        if data_cache['run']:
+            set_up_data_cache(os.path.join(working_dir, 'data_cache'),
+                              data_cache['disk_budget_gb'])
+        else:
+            set_up_data_cache(None)
+
         # if c.write_debugging_outputs:
         #    with open(os.path.join(working_dir, 'resource_pool.pkl'), 'wb') as f:
         #        pickle.dump(strat_list, f)
@@ -754,7 +791,7 @@ Please, make yourself aware of how it works and its assumptions:
                         'Unable to upload CPAC log files in: %s.\nError: %s')
                     logger.error(err_msg, log_dir, exc)
 
-        except Exception:
+        except Exception as exception:
             import traceback
             traceback.print_exc()
             execution_info = """
@@ -770,6 +807,10 @@ CPAC run error:
     System time of start:      {run_start}
     {output_check}
 """
+            # report below, then fail, so the participant isn't counted
+            # as completed
+            raise WorkflowRunError(
+                f'{workflow.name} failed to run: {exception}') from exception
 
         finally:
 
@@ -777,6 +818,10 @@ CPAC run error:
                 if os.path.exists(cb_log_filename):
                     resource_report(cb_log_filename,
                                     num_cores_per_sub, logger)
+                    if memory_model:
+                        write_memory_prediction_report(cb_log_filename,
+                                                       logger)
+                        update_memory_model(memory_model, cb_log_filename)
 
                 logger.info('%s', execution_info.format(
                     workflow=workflow.name,
@@ -1153,6 +1198,10 @@ def connect_pipeline(wf, cfg, rpool, pipeline_blocks):
                 verbose_logger.debug(e.args[0])
                 verbose_logger.debug(rpool)
             raise
+        if cfg.pipeline_setup['Debugging']['verbose']:
+            verbose_logger = getLogger('engine')
+            verbose_logger.debug('Resource pool after %s: %s', nb.get_name(),
+                                 format_memory_report(rpool.memory_report()))
         previous_nb = nb
 
     return wf
@@ -1181,7 +1230,7 @@ def build_workflow(subject_id, sub_dict, cfg, pipeline_name=None,
     except KeyError:
         input_creds_path = None
 
-    cfg.pipeline_setup['input_creds_path'] = input_creds_path
+    cfg['pipeline_setup', 'input_creds_path'] = input_creds_path
 
     """""""""""""""""""""""""""""""""""""""""""""""""""
      PREPROCESSING
@@ -1443,8 +1492,8 @@ def build_workflow(subject_id, sub_dict, cfg, pipeline_name=None,
 
     # Extractions and Derivatives
     tse_atlases, sca_atlases = gather_extraction_maps(cfg)
-    cfg.timeseries_extraction['tse_atlases'] = tse_atlases
-    cfg.seed_based_correlation_analysis['sca_atlases'] = sca_atlases
+    cfg['timeseries_extraction', 'tse_atlases'] = tse_atlases
+    cfg['seed_based_correlation_analysis', 'sca_atlases'] = sca_atlases
 
     if not rpool.check_rpool('space-template_desc-Mean_timeseries') and \
                     'Avg' in tse_atlases:
@@ -1577,4 +1626,8 @@ def build_workflow(subject_id, sub_dict, cfg, pipeline_name=None,
     # Collect all pipeline variants and write to output directory
     rpool.gather_pipes(wf, cfg)
 
+    logger.info('Resource pool memory usage after building the workflow '
+                'for %s: %s', subject_id, format_memory_report(
+                    rpool.memory_report()))
+
     return wf
@@ -17,13 +17,15 @@ License along with C-PAC. If not, see <https://www.gnu.org/licenses/>."""
 import os
 import sys
 import warnings
-from multiprocessing import Process
+from concurrent.futures.process import BrokenProcessPool
 from time import strftime
 import yaml
 from voluptuous.error import Invalid
+from CPAC.pipeline.participant_scheduler import ParticipantQueue
 from CPAC.utils.configuration import check_pname, Configuration, set_subject
 from CPAC.utils.ga import track_run
-from CPAC.utils.monitoring import failed_to_start, log_nodes_cb
+from CPAC.utils.monitoring import failed_to_run, failed_to_start, \
+                                  log_nodes_cb, WorkflowRunError
 from CPAC.longitudinal_pipeline.longitudinal_workflow import \
     anat_longitudinal_wf
 from CPAC.utils.configuration.yaml_template import upgrade_pipeline_to_1_8
@@ -228,7 +230,6 @@ def run(subject_list_file, config_file=None, p_name=None, plugin=None,
 
     # Import packages
     import os
-    import time
 
     from CPAC.pipeline.cpac_pipeline import run_workflow
 
@@ -573,97 +574,31 @@ def run(subject_list_file, config_file=None, p_name=None, plugin=None,
         '''
         # END LONGITUDINAL TEMPLATE PIPELINE
 
-        # If it only allows one, run it linearly
-        if c.pipeline_setup['system_config']['num_participants_at_once'] == 1:
-            for sub in sublist:
-                try:
-                    run_workflow(sub, c, True, pipeline_timing_info,
-                                 p_name, plugin, plugin_args, test_config)
-                except Exception as exception:  # pylint: disable=broad-except
-                    exitcode = 1
-                    failed_to_start(set_subject(sub, c)[2], exception)
-            return exitcode
-
-        # Init job queue
-        job_queue = []
-
-        # Allocate processes
-        processes = [Process(target=run_workflow,
-                             args=(sub, c, True, pipeline_timing_info, p_name,
-                                   plugin, plugin_args, test_config)) for
-                     sub in sublist]
         working_dir = os.path.join(c['pipeline_setup', 'working_directory',
                                      'path'], p_name)
-        # Create pipeline-specific working dir if not exists
-        if not os.path.exists(working_dir):
-            os.makedirs(working_dir)
-        # Set PID context to pipeline-specific file
-        with open(os.path.join(working_dir, 'pid.txt'), 'w', encoding='utf-8'
-                  ) as pid:
-            # If we're allocating more processes than are subjects, run
-            # them all
-            if len(sublist) <= c.pipeline_setup['system_config'][
-                    'num_participants_at_once']:
-                for i, _p in enumerate(processes):
-                    try:
-                        _p.start()
-                        print(_p.pid, file=pid)
-                    # pylint: disable=broad-except
-                    except Exception as exception:
-                        exitcode = 1
-                        failed_to_start(set_subject(sublist[i], c)[2],
-                                        exception)
-            # Otherwise manage resources to run processes incrementally
-            else:
-                idx = 0
-                while idx < len(sublist):
-                    # If the job queue is empty and we haven't started indexing
-                    if len(job_queue) == 0 and idx == 0:
-                        # Init subject process index
-                        idc = idx
-                        # Launch processes (one for each subject)
-                        for _p in processes[idc: idc + c.pipeline_setup[
-                                'system_config']['num_participants_at_once']]:
-                            try:
-                                _p.start()
-                                print(_p.pid, file=pid)
-                                job_queue.append(_p)
-                                idx += 1
-                            # pylint: disable=broad-except
-                            except Exception as exception:
-                                exitcode = 1
-                                failed_to_start(set_subject(sublist[idx],
-                                                            c)[2], exception)
-                    # Otherwise, jobs are running - check them
-                    else:
-                        # Check every job in the queue's status
-                        for job in job_queue:
-                            # If the job is not alive
-                            if not job.is_alive():
-                                # Find job and delete it from queue
-                                print('found dead job ', job)
-                                loc = job_queue.index(job)
-                                del job_queue[loc]
-                                # ...and start the next available
-                                # process (subject)
-                                try:
-                                    processes[idx].start()
-                                    # Append this to job queue and
-                                    # increment index
-                                    # pylint: disable=modified-iterating-list
-                                    job_queue.append(processes[idx])
-                                    idx += 1
-                                # pylint: disable=broad-except
-                                except Exception as exception:
-                                    exitcode = 1
-                                    failed_to_start(set_subject(sublist[idx],
-                                                                c)[2],
-                                                    exception)
-                        # Add sleep so while loop isn't consuming 100% of CPU
-                        time.sleep(2)
-            # set exitcode to 1 if any exception
-            if hasattr(pid, 'exitcode'):
-                exitcode = exitcode or pid.exitcode
-            # Close PID txt file to indicate finish
-            pid.close()
+
+        def _failed(sub, exception):
+            # the failure loggers log the traceback of the active exception
+            try:
+                raise exception
+            except Exception:  # pylint: disable=broad-except
+                if isinstance(exception, (BrokenProcessPool,
+                                          WorkflowRunError)):
+                    # the participant started; its run crashed or failed
+                    failed_to_run(set_subject(sub, c)[2], exception)
+                else:
+                    failed_to_start(set_subject(sub, c)[2], exception)
+
+        system_config = c.pipeline_setup['system_config']
+        queue = ParticipantQueue(
+            sublist, os.path.join(working_dir, 'participant_queue.json'),
+            max_parallel=system_config['num_participants_at_once'],
+            participant_memory_gb=system_config[
+                'maximum_memory_per_participant'],
+            participant_cpus=system_config['max_cores_per_participant'],
+            resume=system_config['participant_queue']['resume'],
+            pid_file=os.path.join(working_dir, 'pid.txt'))
+        exitcode = queue.run(run_workflow,
+                             (c, True, pipeline_timing_info, p_name, plugin,
+                              plugin_args, test_config), _failed)
     return exitcode
@@ -16,8 +16,6 @@
 # License along with C-PAC. If not, see <https://www.gnu.org/licenses/>.
 import ast
 import copy
-import hashlib
-import json
 from itertools import chain
 import logging
 import os
@@ -36,6 +34,8 @@ from CPAC.image_utils.spatial_smoothing import spatial_smoothing
 from CPAC.image_utils.statistical_transforms import z_score_standardize, \
     fisher_z_score_standardize
 from CPAC.pipeline.check_outputs import ExpectedOutputs
+from CPAC.pipeline.copy_on_write import CopyOnWriteDict, pool_memory
+from CPAC.pipeline.strategies import combine_strategies, shared_sidecar
 from CPAC.pipeline.utils import MOVEMENT_FILTER_KEYS, name_fork, source_set
 from CPAC.registration.registration import transform_derivative
 from CPAC.utils.bids_utils import res_in_filename
@@ -64,9 +64,11 @@ class ResourcePool:
     def __init__(self, rpool=None, name=None, cfg=None, pipe_list=None):
 
         if not rpool:
-            self.rpool = {}
-        else:
+            self.rpool = CopyOnWriteDict()
+        elif isinstance(rpool, CopyOnWriteDict):
             self.rpool = rpool
+        else:
+            self.rpool = CopyOnWriteDict(rpool)
 
         if not pipe_list:
             self.pipe_list = []
@@ -196,10 +198,26 @@ class ResourcePool:
         return self.rpool.keys()
 
     def copy_rpool(self):
-        return ResourcePool(rpool=copy.deepcopy(self.get_entire_rpool()),
+        """Copy of the resource pool that shares its resources (and their
+        nodes and JSON sidecars) with this one, copying each only when
+        either pool accesses it"""
+        pool = ResourcePool(rpool=self.get_entire_rpool().copy(),
                             name=self.name,
-                            cfg=self.cfg,
-                            pipe_list=copy.deepcopy(self.pipe_list))
+                            cfg=getattr(self, 'cfg', None),
+                            pipe_list=list(self.pipe_list))
+        pool.set_pool_info(self.info)
+        return pool
+
+    def memory_report(self):
+        """Number of resources and strategies in the pool, how many
+        resources are still shared with a copy, the memory of the pool's
+        dictionaries and sidecars, and this process's resident memory
+
+        Returns
+        -------
+        dict
+        """
+        return pool_memory(self.rpool)
 
     @staticmethod
     def get_raw_label(resource: str) -> str:
@@ -493,8 +511,6 @@ class ResourcePool:
         # TODO: NOTE: NOT COMPATIBLE WITH SUB-RPOOL/STRAT_POOLS
         # TODO: (and it doesn't have to be)
 
-        import itertools
-
         linked_resources = []
         resource_list = []
         if debug:
@@ -519,6 +535,7 @@ class ResourcePool:
                 resource_list.append(resource)
 
         total_pool = []
+        pool_labels = []
         variant_pool = {}
         len_inputs = len(resource_list)
         if debug:
@@ -553,6 +570,7 @@ class ResourcePool:
                 verbose_logger = getLogger('engine')
                 verbose_logger.debug('%s sub_pool: %s\n', resource, sub_pool)
             total_pool.append(sub_pool)
+            pool_labels.append(fetched_resource)
 
         if not total_pool:
             raise LookupError('\n\n[!] C-PAC says: None of the listed '
@@ -568,118 +586,17 @@ class ResourcePool:
         # TODO: and the actual resource is encoded in the tag: of the last item, every time!
         # keying the strategies to the resources, inverting it
         if len_inputs > 1:
-            strats = itertools.product(*total_pool)
-
-            # we now currently have "strats", the combined permutations of all the strategies, as a list of tuples, each tuple combining one version of input each, being one of the permutations.
-            # OF ALL THE DIFFERENT INPUTS. and they are tagged by their fetched inputs with {name}:{strat}.
-            # so, each tuple has ONE STRAT FOR EACH INPUT, so if there are three inputs, each tuple will have 3 items.
+            # one strategy per input, skipping incompatible linked inputs
+            # while the combinations are built
+            strats = combine_strategies(
+                total_pool, pool_labels, linked_resources,
+                lambda label, strat: self.get_json(
+                    *self.generate_prov_string(strat)), variant_pool)
             new_strats = {}
-
-            # get rid of duplicates - TODO: refactor .product
-            strat_str_list = []            
-            strat_list_list = []
-            for strat_tuple in strats:
-                strat_list = list(copy.deepcopy(strat_tuple))
-                strat_str = str(strat_list)
-                if strat_str not in strat_str_list:
-                    strat_str_list.append(strat_str)
-                    strat_list_list.append(strat_list)
-
-            if debug:
-                verbose_logger = getLogger('engine')
-                verbose_logger.debug('len(strat_list_list): %s\n',
-                                     len(strat_list_list))
-            for strat_list in strat_list_list:
-
-                json_dct = {}
-                for strat in strat_list:
-                    # strat is a prov list for a single resource/input
-                    strat_resource, strat_idx = \
-                        self.generate_prov_string(strat)
-                    strat_json = self.get_json(strat_resource,
-                                               strat=strat_idx)
-                    json_dct[strat_resource] = strat_json
-
-                drop = False
-                if linked_resources:
-                    for linked in linked_resources:  # <--- 'linked' is each tuple
-                        if drop:
-                            break
-                        for xlabel in linked:
-                            if drop:
-                                break
-                            xjson = copy.deepcopy(json_dct[xlabel])
-                            for ylabel in linked:
-                                if xlabel == ylabel:
-                                    continue
-                                yjson = copy.deepcopy(json_dct[ylabel])
-                                
-                                if 'CpacVariant' not in xjson:
-                                    xjson['CpacVariant'] = {}
-                                if 'CpacVariant' not in yjson:
-                                    yjson['CpacVariant'] = {}
-                                    
-                                current_strat = []
-                                for key, val in xjson['CpacVariant'].items():
-                                    if isinstance(val, list):
-                                        current_strat.append(val[0])
-                                    else:
-                                        current_strat.append(val)
-                                current_spread = list(set(variant_pool[xlabel]))
-                                for spread_label in current_spread:
-                                    if 'NO-' in spread_label:
-                                        continue
-                                    if spread_label not in current_strat:
-                                        current_strat.append(f'NO-{spread_label}')
-                                
-                                other_strat = []
-                                for key, val in yjson['CpacVariant'].items():
-                                    if isinstance(val, list):
-                                        other_strat.append(val[0])
-                                    else:
-                                        other_strat.append(val)
-                                other_spread = list(set(variant_pool[ylabel]))
-                                for spread_label in other_spread:
-                                    if 'NO-' in spread_label:
-                                        continue
-                                    if spread_label not in other_strat:
-                                        other_strat.append(f'NO-{spread_label}')
-                                
-                                for variant in current_spread:
-                                    in_current_strat = False
-                                    in_other_strat = False
-                                    in_other_spread = False
-
-                                    if variant is None:
-                                        in_current_strat = True
-                                        if None in other_spread:
-                                            in_other_strat = True
-                                    if variant in current_strat:
-                                        in_current_strat = True
-                                    if variant in other_strat:
-                                        in_other_strat = True
-                                    if variant in other_spread:
-                                        in_other_spread = True
-
-                                    if not in_other_strat:
-                                        if in_other_spread:
-                                            if in_current_strat:
-                                                drop = True
-                                                break
-
-                                    if in_other_strat:
-                                        if in_other_spread:
-                                            if not in_current_strat:
-                                                drop = True
-                                                break       
-                                if drop:
-                                    break
-                if drop:
-                    continue
-
-                # make the merged strat label from the multiple inputs
-                # strat_list is actually the merged CpacProvenance lists
-                pipe_idx = str(strat_list)
+            for pipe_idx, strat_list in strats:
+                # the merged strat label from the multiple inputs
+                # (pipe_idx) is str(strat_list), strat_list being the
+                # merged CpacProvenance lists
                 new_strats[pipe_idx] = ResourcePool()     # <----- new_strats is A DICTIONARY OF RESOURCEPOOL OBJECTS!
                 
                 # placing JSON info at one level higher only for copy convenience
@@ -703,7 +620,8 @@ class ResourcePool:
                     data_type = resource.split('_')[-1]
                     if data_type not in new_strats[pipe_idx].rpool['json']['subjson']:
                         new_strats[pipe_idx].rpool['json']['subjson'][data_type] = {}
-                    new_strats[pipe_idx].rpool['json']['subjson'][data_type].update(copy.deepcopy(resource_strat_dct['json']))
+                    new_strats[pipe_idx].rpool['json']['subjson'][data_type].update(
+                        shared_sidecar(resource_strat_dct['json']))
         else:
             new_strats = {}
             for resource_strat_list in total_pool:       # total_pool will have only one list of strats, for the one input
@@ -719,7 +637,8 @@ class ResourcePool:
                     data_type = resource.split('_')[-1]                    
                     if data_type not in new_strats[pipe_idx].rpool['json']['subjson']:
                         new_strats[pipe_idx].rpool['json']['subjson'][data_type] = {}
-                    new_strats[pipe_idx].rpool['json']['subjson'][data_type].update(copy.deepcopy(resource_strat_dct['json']))
+                    new_strats[pipe_idx].rpool['json']['subjson'][data_type].update(
+                        shared_sidecar(resource_strat_dct['json']))
         return new_strats
 
     def derivative_xfm(self, wf, label, connection, json_info, pipe_idx,
@@ -957,6 +876,8 @@ class ResourcePool:
         outputs_logger = getLogger(f'{cfg["subject_id"]}_expectedOutputs')
         expected_outputs = ExpectedOutputs()
 
+        sink_dct = None
+
         if add_excl:
             excl += add_excl
 
@@ -1252,8 +1173,51 @@ class ResourcePool:
                            ds, f'{out_dct["subdir"]}.@data')
                 wf.connect(write_json, 'json_file',
                            ds, f'{out_dct["subdir"]}.@json')
+                sink_dct = out_dct
+        if sink_dct is not None:
+            self.write_config(wf, cfg, sink_dct)
         outputs_logger.info(expected_outputs)
 
+    def write_config(self, wf, cfg, out_dct):
+        '''Write the full configuration once per participant, as
+        ``cpac_config_<CpacConfigHash>.json`` next to the participant's
+        ``anat`` and ``func`` directories, for the sidecars to reference
+        by hash
+
+        Parameters
+        ----------
+        wf : Workflow
+
+        cfg : Configuration
+
+        out_dct : dict
+            output directory info of one of the participant's outputs
+        '''
+        name = f'json_cpac_config_{out_dct["unique_id"]}'
+        if wf.get_node(name) is not None:
+            return
+        write_config = pe.Node(Function(input_names=['json_data',
+                                                     'filename'],
+                                        output_names=['json_file'],
+                                        function=write_output_json,
+                                        imports=['import os',
+                                                 'import json']),
+                               name=name)
+        write_config.inputs.json_data = cfg.dict()
+        write_config.inputs.filename = f'cpac_config_{cfg.fingerprint()}'
+        ds = pe.Node(DataSink(), name=f'sinker_cpac_config_'
+                                      f'{out_dct["unique_id"]}')
+        ds.inputs.parameterization = False
+        ds.inputs.base_directory = out_dct['out_dir']
+        ds.inputs.encrypt_bucket_keys = cfg.pipeline_setup[
+            'Amazon-AWS']['s3_encryption']
+        ds.inputs.container = out_dct['container']
+        if cfg.pipeline_setup['Amazon-AWS'][
+                'aws_output_bucket_credentials']:
+            ds.inputs.creds_path = cfg.pipeline_setup['Amazon-AWS'][
+                'aws_output_bucket_credentials']
+        wf.connect(write_config, 'json_file', ds, '@config')
+
     def node_data(self, resource, **kwargs):
         '''Factory function to create NodeData objects
 
@@ -1414,10 +1378,9 @@ class NodeBlock:
                 opts = [None]
             all_opts += opts
 
-        sidecar_additions = {
-            'CpacConfigHash': hashlib.sha1(json.dumps(cfg.dict(), sort_keys=True).encode('utf-8')).hexdigest(),
-            'CpacConfig': cfg.dict()
-        }
+        # the full configuration is written once per participant by
+        # gather_pipes, as cpac_config_<CpacConfigHash>.json
+        sidecar_additions = {'CpacConfigHash': cfg.fingerprint()}
 
         if cfg['pipeline_setup']['output_directory'].get('user_defined'):
             sidecar_additions['UserDefined'] = cfg['pipeline_setup']['output_directory']['user_defined']
@@ -1564,14 +1527,20 @@ class NodeBlock:
 
                         for label, connection in outs.items():
                             self.check_output(outputs, label, name)
-                            new_json_info = copy.deepcopy(strat_pool.get('json'))
+                            # the inputs' sidecars (subjson) are shared
+                            # between strategies and only read here
+                            json_info = strat_pool.get('json')
+                            subjson = json_info.get('subjson', {})
+                            new_json_info = copy.deepcopy(
+                                {key: value for key, value in json_info.items()
+                                 if key != 'subjson'})
 
                             # transfer over data-specific json info
                             #   for example, if the input data json is _bold and the output is also _bold
                             data_type = label.split('_')[-1]
-                            if data_type in new_json_info['subjson']:
-                                if 'SkullStripped' in new_json_info['subjson'][data_type]:
-                                    new_json_info['SkullStripped'] = new_json_info['subjson'][data_type]['SkullStripped']
+                            if data_type in subjson:
+                                if 'SkullStripped' in subjson[data_type]:
+                                    new_json_info['SkullStripped'] = subjson[data_type]['SkullStripped']
 
                             # determine sources for the outputs, i.e. all input data into the node block                   
                             new_json_info['Sources'] = [x for x in strat_pool.get_entire_rpool() if x != 'json' and x not in replaced_inputs]
@@ -1590,11 +1559,11 @@ class NodeBlock:
                                         # only if the pipeline config template key is entered as the 'Template' field
                                         # otherwise, skip this and take in the literal 'Template' string
                                         try:
-                                            new_json_info['Template'] = new_json_info['subjson'][template_key]['Description']
+                                            new_json_info['Template'] = subjson[template_key]['Description']
                                         except KeyError:
                                             pass
                                     try:
-                                        new_json_info['Resolution'] = new_json_info['subjson'][template_key]['Resolution']
+                                        new_json_info['Resolution'] = subjson[template_key]['Resolution']
                                     except KeyError:
                                         pass
                             else:
@@ -1611,11 +1580,6 @@ class NodeBlock:
                                 if sidecar_key not in new_json_info:
                                     new_json_info[sidecar_key] = sidecar_value
 
-                            try:
-                                del new_json_info['subjson']
-                            except KeyError:
-                                pass
-
                             if fork or len(opts) > 1 or len(all_opts) > 1:
                                 if 'CpacVariant' not in new_json_info:
                                     new_json_info['CpacVariant'] = {}
@@ -1656,14 +1620,14 @@ def wrap_block(node_blocks, interface, wf, cfg, strat_pool, pipe_num, opt):
         # connection system.
 
         # The interface dictionary tells wrap_block to set the EPI field map
-        # in the parent node block's throw-away strat_pool as 'bold', so that
+        # in a copy of the parent node block's strat_pool as 'bold', so that
         # the 'bold_mask_afni' and 'bold_masking' node blocks will see that as
         # the 'bold' input.
 
         # It also tells wrap_block to set the 'desc-brain_bold' output of
         # the 'bold_masking' node block to 'opposite_pe_epi_brain' (what it
-        # actually is) in the parent node block's strat_pool, which gets
-        # returned.
+        # actually is) in that copy of the parent node block's strat_pool,
+        # which gets returned.
 
         # Note 'bold' and 'desc-brain_bold' (all on the left side) are the
         # labels that 'bold_mask_afni' and 'bold_masking' understand/expect
@@ -1688,8 +1652,11 @@ def wrap_block(node_blocks, interface, wf, cfg, strat_pool, pipe_num, opt):
         # the next node.
 
     """
+    # the interface's inputs are set in a copy-on-write fork, so the
+    # parent's pool keeps its own resources
+    parent_pool = strat_pool
+    strat_pool = parent_pool.copy_rpool()
     for block in node_blocks:
-        #new_pool = copy.deepcopy(strat_pool)
         for in_resource, val in interface.items():
             if isinstance(val, tuple):
                 strat_pool.set_data(in_resource, val[0], val[1], {}, "", "",
@@ -1708,6 +1675,8 @@ def wrap_block(node_blocks, interface, wf, cfg, strat_pool, pipe_num, opt):
                                     {}, "", "")
         sub_num += 1
         strat_pool.set_pool_info({'sub_num': sub_num})
+    # later wrapped blocks in the parent get their own node names
+    parent_pool.set_pool_info(strat_pool.get_pool_info())
 
     return (wf, strat_pool)
 
@@ -0,0 +1,365 @@
+# Copyright (C) 2024  C-PAC Developers
+
+# This file is part of C-PAC.
+
+# C-PAC is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+
+# C-PAC is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+# License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with C-PAC. If not, see <https://www.gnu.org/licenses/>.
+"""Resampling of group analysis inputs to a reference image's grid.
+
+Images are resampled in world (scanner) coordinates, by their affines,
+with trilinear or nearest-neighbour interpolation. Images on the same
+grid (affine and shape) share one sparse interpolation matrix, computed
+once per process, so resampling an image (every volume of a 4D image at
+once) is one sparse matrix product. Images are resampled across a
+process pool, and each resampled image is cached by the SHA-256 of its
+input's contents, the reference grid and the interpolation, so repeated
+group runs skip what's already been resampled.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+RESAMPLING_VERSION = 1
+"""Version of the resampling; cached images of other versions aren't
+reused"""
+
+
+def image_grid(image):
+    """Affine and spatial shape of an image, from its header
+
+    Parameters
+    ----------
+    image : nibabel image
+
+    Returns
+    -------
+    tuple
+        (affine as a tuple of 16 floats, spatial shape)
+    """
+    return (tuple(float(value) for value in np.asarray(
+        image.affine, dtype=np.float64).ravel()), tuple(image.shape[:3]))
+
+
+def same_grid(grid, reference_grid):
+    """Whether two grids (from :func:`image_grid`) are the same
+
+    Examples
+    --------
+    >>> affine = tuple(np.eye(4).ravel())
+    >>> same_grid((affine, (2, 2, 2)), (affine, (2, 2, 2)))
+    True
+    >>> same_grid((affine, (2, 2, 2)), (affine, (2, 2, 3)))
+    False
+    """
+    return grid[1] == reference_grid[1] and np.allclose(
+        grid[0], reference_grid[0], rtol=0, atol=1e-4)
+
+
+@lru_cache(maxsize=4)
+def interpolation_matrix(source_grid, target_grid, order=1):
+    """Sparse matrix that resamples the voxels of an image on one grid
+    (flattened in C order) to another grid
+
+    Target voxels outside the source image are 0.
+
+    Parameters
+    ----------
+    source_grid, target_grid : tuple
+        from :func:`image_grid`
+
+    order : int
+        0 for nearest-neighbour, 1 for trilinear interpolation
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        (target voxels, source voxels)
+
+    Examples
+    --------
+    >>> source = (tuple(np.diag([2., 2., 2., 1.]).ravel()), (2, 2, 2))
+    >>> target = (tuple(np.eye(4).ravel()), (3, 3, 3))
+    >>> data = np.arange(8, dtype=float)
+    >>> resampled = interpolation_matrix(source, target) @ data
+    >>> resampled.reshape(3, 3, 3)[1]
+    array([[2. , 2.5, 3. ],
+           [3. , 3.5, 4. ],
+           [4. , 4.5, 5. ]])
+    >>> (interpolation_matrix(source, target, 0) @ data).reshape(3, 3, 3)[2]
+    array([[4., 5., 5.],
+           [6., 7., 7.],
+           [6., 7., 7.]])
+    """
+    from scipy import sparse
+    source_affine = np.array(source_grid[0]).reshape(4, 4)
+    target_affine = np.array(target_grid[0]).reshape(4, 4)
+    source_shape = np.array(source_grid[1])
+    n_target = int(np.prod(target_grid[1]))
+    mapping = np.linalg.solve(source_affine, target_affine)
+    coords = mapping[:3, :3] @ np.indices(target_grid[1]).reshape(3, -1) + \
+        mapping[:3, 3:]
+    last = (source_shape - 1)[:, np.newaxis]
+    # tolerate rounding error in the affines at the edges
+    inside = np.all((coords > -1e-5) & (coords < last + 1e-5), axis=0)
+    rows = np.nonzero(inside)[0]
+    coords = np.clip(coords[:, inside], 0, last)
+    if order == 0:
+        indices = np.minimum(np.floor(coords + 0.5).astype(np.int64), last)
+        columns = np.ravel_multi_index(indices, source_grid[1])
+        weights = np.ones(len(rows))
+    else:
+        base = np.minimum(np.floor(coords).astype(np.int64),
+                          np.maximum(last - 1, 0))
+        fractions = coords - base
+        corner_rows, columns, weights = [], [], []
+        for corner in np.ndindex(2, 2, 2):
+            offset = np.array(corner)[:, np.newaxis]
+            corner_weights = np.prod(np.where(offset, fractions,
+                                              1 - fractions), axis=0)
+            nonzero = corner_weights > 0
+            corner_rows.append(rows[nonzero])
+            columns.append(np.ravel_multi_index(np.minimum(
+                base[:, nonzero] + offset, last), source_grid[1]))
+            weights.append(corner_weights[nonzero])
+        rows = np.concatenate(corner_rows)
+        columns = np.concatenate(columns)
+        weights = np.concatenate(weights)
+    return sparse.csr_matrix((weights, (rows, columns)),
+                             shape=(n_target, int(np.prod(source_shape))))
+
+
+def resample_image(image_path, out_path, reference_grid, order=1):
+    """Resample an image to a grid and write it (atomically)
+
+    Parameters
+    ----------
+    image_path, out_path : str
+
+    reference_grid : tuple
+        from :func:`image_grid`
+
+    order : int
+        0 for nearest-neighbour, 1 for trilinear interpolation
+
+    Returns
+    -------
+    str
+        ``out_path``
+    """
+    import nibabel as nb
+    image = nb.load(image_path)
+    matrix = interpolation_matrix(image_grid(image), reference_grid, order)
+    dtype = image.get_data_dtype()
+    # only nearest-neighbour resampling of unscaled data keeps its values
+    if not np.issubdtype(dtype, np.floating) and (
+            order or getattr(image.dataobj, 'slope', 1) != 1 or
+            getattr(image.dataobj, 'inter', 0) != 0):
+        dtype = np.dtype(np.float32)
+    data = image.get_fdata(dtype=np.float64 if order == 0 else np.float32)
+    extra_shape = data.shape[3:]
+    resampled = (matrix @ data.reshape(matrix.shape[1], -1)).reshape(
+        reference_grid[1] + extra_shape)
+    header = image.header.copy()
+    header.set_data_dtype(dtype)
+    resampled = nb.Nifti1Image(resampled.astype(dtype),
+                               np.array(reference_grid[0]).reshape(4, 4),
+                               header)
+    resampled.header.set_zooms(resampled.header.get_zooms()[:3] +
+                               image.header.get_zooms()[3:])
+    temporary = f'{out_path}.{os.getpid()}.tmp.nii.gz'
+    nb.save(resampled, temporary)
+    os.replace(temporary, out_path)
+    return out_path
+
+
+def _resample_images(reference_grid, order, images):
+    """Resample images, in a pool's worker"""
+    return [resample_image(image_path, out_path, reference_grid, order)
+            for image_path, out_path in images]
+
+
+def file_digest(path, memo=None):
+    """SHA-256 of a file's contents
+
+    Parameters
+    ----------
+    path : str
+
+    memo : dict, optional
+        digests by real path, reused while the file's size and
+        modification time are unchanged (and updated)
+
+    Returns
+    -------
+    str
+    """
+    stat = os.stat(path)
+    real = os.path.realpath(path)
+    if memo is not None and memo.get(real, [None])[:2] == [stat.st_size,
+                                                          stat.st_mtime_ns]:
+        return memo[real][2]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as _f:
+        for chunk in iter(lambda: _f.read(1024 ** 2), b''):
+            digest.update(chunk)
+    if memo is not None:
+        memo[real] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+    return digest.hexdigest()
+
+
+def resampled_path(image_path, out_dir, roi_file=False):
+    """Where a resampled image is written: the image's path from its
+    pipeline output directory on, under
+    ``{out_dir}/resampled_input_images``
+
+    Parameters
+    ----------
+    image_path, out_dir : str
+
+    roi_file : bool
+        ROI files outside a pipeline output directory go in ``ROI_files``
+
+    Returns
+    -------
+    str
+
+    Examples
+    --------
+    >>> resampled_path('/out/pipeline_a/sub-1_ses-1/func/bold.nii.gz',
+    ...                '/work')
+    '/work/resampled_input_images/pipeline_a/sub-1_ses-1/func/bold.nii.gz'
+    >>> resampled_path('/rois/rois.nii.gz', '/work', roi_file=True)
+    '/work/resampled_input_images/ROI_files/rois.nii.gz'
+    """
+    try:
+        orig_dir = "pipeline_{0}".format(image_path.split('pipeline_')[1])
+    except IndexError:
+        if roi_file:
+            orig_dir = os.path.join("ROI_files", os.path.basename(image_path))
+        else:
+            raise IndexError(image_path)
+    return os.path.join(out_dir, 'resampled_input_images', orig_dir)
+
+
+def _link(source, destination):
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    if os.path.lexists(destination):
+        if os.path.exists(destination) and os.path.samefile(source,
+                                                            destination):
+            return
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+def resample_group_inputs(image_paths, reference_path, out_dir,
+                          roi_file=False, n_procs=1):
+    """Resample the images that aren't on a reference image's grid to
+    it, as group analysis inputs
+
+    Each resampled image is written to :func:`resampled_path` (linked to
+    a cache in ``{out_dir}/resampled_input_images/by_hash``).
+
+    Parameters
+    ----------
+    image_paths : list of str
+
+    reference_path : str
+
+    out_dir : str
+
+    roi_file : bool
+        resample with nearest-neighbour interpolation (for ROI and mask
+        files) instead of trilinear
+
+    n_procs : int
+        processes resampling at once
+
+    Returns
+    -------
+    list of str
+        the resampled images' paths, or the original paths of images
+        already on the reference grid, in order
+    """
+    import nibabel as nb
+    order = 0 if roi_file else 1
+    reference_grid = image_grid(nb.load(reference_path))
+    to_resample = []
+    for image_path in image_paths:
+        grid = image_grid(nb.load(image_path))
+        if not same_grid(grid, reference_grid):
+            print("Input image grid is {0} {1}\nTemplate image grid is {2} "
+                  "{3}\n".format(grid[1], np.array(grid[0]).reshape(4, 4),
+                                 reference_grid[1],
+                                 np.array(reference_grid[0]).reshape(4, 4)))
+            to_resample.append((image_path, grid))
+    if not to_resample:
+        return list(image_paths)
+
+    cache_dir = os.path.join(out_dir, 'resampled_input_images', 'by_hash')
+    os.makedirs(cache_dir, exist_ok=True)
+    memo_path = os.path.join(cache_dir, 'digests.json')
+    try:
+        with open(memo_path, 'r', encoding='utf-8') as _f:
+            memo = json.load(_f)
+    except (OSError, ValueError):
+        memo = {}
+    with ThreadPoolExecutor(max_workers=max(int(n_procs), 4)) as executor:
+        digests = list(executor.map(lambda image: file_digest(image[0], memo),
+                                    to_resample))
+    with open(f'{memo_path}.tmp', 'w', encoding='utf-8') as _f:
+        json.dump(memo, _f)
+    os.replace(f'{memo_path}.tmp', memo_path)
+    reference_key = json.dumps([RESAMPLING_VERSION, order, reference_grid])
+
+    # group what isn't cached yet by grid, so each process computes each
+    # interpolation matrix once
+    groups = {}
+    cached = {}
+    for (image_path, grid), digest in zip(to_resample, digests):
+        key = hashlib.sha256(f'{digest}{reference_key}'.encode(
+            'utf-8')).hexdigest()
+        cached[image_path] = os.path.join(cache_dir, f'{key}.nii.gz')
+        if not os.path.isfile(cached[image_path]):
+            groups.setdefault(grid, {})[cached[image_path]] = image_path
+    tasks = []
+    for images in groups.values():
+        images = [(image_path, cache_path)
+                  for cache_path, image_path in images.items()]
+        n_chunks = min(max(int(n_procs), 1), len(images))
+        tasks.extend((reference_grid, order, images[first::n_chunks])
+                     for first in range(n_chunks))
+    if tasks:
+        print("Resampling {0} input images to this reference:\n{1}\n".format(
+            sum(len(task[2]) for task in tasks), reference_path))
+        if int(n_procs) > 1 and len(tasks) > 1:
+            from multiprocessing import Pool
+            with Pool(min(int(n_procs), len(tasks))) as pool:
+                pool.starmap(_resample_images, tasks)
+        else:
+            for task in tasks:
+                _resample_images(*task)
+
+    resampled = {}
+    for image_path, _ in to_resample:
+        resampled[image_path] = resampled_path(image_path, out_dir, roi_file)
+        _link(cached[image_path], resampled[image_path])
+    return [resampled.get(image_path, image_path)
+            for image_path in image_paths]
@@ -7,6 +7,7 @@
 #     * Skips doctests that require files that we haven't copied over
 #     * Applies a random seed
 #     * Supports overriding memory estimates via a log file and a buffer
+#     * Records the shape of the input that memory usage scales with
 #     * Adds quotation marks around strings in dotfiles
 
 # ORIGINAL WORK'S ATTRIBUTION NOTICE:
@@ -193,8 +194,11 @@ class Node(pe.Node):
                 else:
                     self._mem_x['multiplier'] = kwargs['mem_x']
                     self._mem_x['file'] = None
+            # remember which input scales memory after _mem_x is consumed
+            self._mem_x_input = self._mem_x['file']
         else:
             delattr(self, '_mem_x')
+            self._mem_x_input = None
         setattr(self, 'skip_timeout', False)
 
     orig_sig_params = list(signature(pe.Node).parameters.items())
@@ -419,6 +423,36 @@ class Node(pe.Node):
     def _mem_x_file(self):
         return getattr(self.inputs, getattr(self, '_mem_x', {}).get('file'))
 
+    def get_input_data_shape(self):
+        """Get the shape of the input image that this Node's memory
+        usage scales with (the ``mem_x`` input), once that image exists.
+        Memoized in ``input_data_shape``.
+
+        Returns
+        -------
+        tuple or None
+        """
+        if self.input_data_shape is not Undefined:
+            return self.input_data_shape
+        field = getattr(self, '_mem_x_input', None)
+        if field is None:
+            return None
+        mem_x_path = getattr(self.inputs, field, Undefined)
+        if not _check_mem_x_path(mem_x_path) and field in getattr(
+                self, 'input_source', {}):
+            input_resultfile, sourceinfo = self.input_source[field]
+            if isinstance(sourceinfo, str):
+                try:
+                    mem_x_path = getattr(_load_resultfile(
+                        input_resultfile).outputs, sourceinfo)
+                except (AttributeError, EOFError, OSError):
+                    mem_x_path = Undefined
+        if not _check_mem_x_path(mem_x_path):
+            return None
+        self.input_data_shape = tuple(
+            int(dim) for dim in load(_grab_first_path(mem_x_path)).shape)
+        return self.input_data_shape
+
     def override_mem_gb(self, new_mem_gb):
         """Override the Node's memory estimate with a new value.
 
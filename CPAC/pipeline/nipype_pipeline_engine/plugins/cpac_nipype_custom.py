@@ -10,6 +10,8 @@ STATEMENT OF CHANGES:
 CHANGES:
     * Supports just-in-time dynamic memory allocation
     * Supports overriding memory estimates via a log file and a buffer
+    * Supports predicting memory estimates from a model learned from
+      previous runs
 
 ORIGINAL WORK'S ATTRIBUTION NOTICE:
     Copyright (c) 2009-2016, Nipype developers
@@ -45,6 +47,7 @@ from nipype.pipeline.plugins.multiproc import logger
 from numpy import flatnonzero
 from CPAC.pipeline.nipype_pipeline_engine import MapNode, UNDEFINED_SIZE
 from CPAC.utils.monitoring import log_nodes_cb
+from CPAC.utils.monitoring.memory_model import MemoryModel
 
 
 OVERHEAD_MEMORY_ESTIMATE: float = 1  # estimate of C-PAC + Nipype overhead (GB)
@@ -102,6 +105,10 @@ class CpacNipypeCustomPluginMixin():
                 1 + plugin_args['runtime']['buffer'] / 100
             ) for node_key, observation in parse_previously_observed_mem_gb(
                 plugin_args['runtime']['usage']).items()}
+        if 'memory_model' in plugin_args:
+            self.memory_model = MemoryModel.load(
+                plugin_args['memory_model']['store'],
+                plugin_args['memory_model'].get('buffer', 0))
         super().__init__(plugin_args=plugin_args)
         self.peak = 0
         self._stats = None
@@ -186,6 +193,28 @@ class CpacNipypeCustomPluginMixin():
             return True
         return False
 
+    def _predict_memory_estimate(self, node):
+        """
+        Override node memory estimate with the memory model's prediction
+        for the node and the size of its input, if known
+
+        Parameters
+        ----------
+        node : nipype.pipeline.engine.nodes.Node
+
+        Returns
+        -------
+        bool : updated?
+        """
+        input_data_shape = node.get_input_data_shape() if hasattr(
+            node, 'get_input_data_shape') else None
+        prediction = self.memory_model.predict(node.fullname,
+                                               input_data_shape)
+        if prediction is None:
+            return False
+        node.override_mem_gb(prediction)
+        return True
+
     def _prerun_check(self, graph):
         """Check if any node exeeds the available resources"""
         tasks_mem_gb = []
@@ -195,6 +224,10 @@ class CpacNipypeCustomPluginMixin():
         for node in graph.nodes():
             if hasattr(self, 'runtime'):
                 self._override_memory_estimate(node)
+            elif hasattr(self, 'memory_model') and (
+                self._predict_memory_estimate(node)
+            ):
+                pass
             elif hasattr(node, "throttle"):
                 # for a throttled node without an observation run,
                 # assume all available memory will be needed
@@ -324,6 +357,10 @@ class CpacNipypeCustomPluginMixin():
                     if not submit:
                         continue
 
+            # Predict memory from the now-available input size
+            if hasattr(self, 'memory_model'):
+                self._predict_memory_estimate(self.procs[jobid])
+
             # Check requirements of this job
             next_job_gb = min(self.procs[jobid].mem_gb, self.memory_gb)
             next_job_th = min(self.procs[jobid].n_procs, self.processors)
@@ -0,0 +1,386 @@
+# Copyright (C) 2024  C-PAC Developers
+
+# This file is part of C-PAC.
+
+# C-PAC is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+
+# C-PAC is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+# License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with C-PAC. If not, see <https://www.gnu.org/licenses/>.
+"""Persistent index of a pipeline output directory, for group analysis.
+
+The output tree is walked once, one directory level at a time with the
+directories of each level listed concurrently, and every entry is kept in
+an SQLite database with the BIDS-like entities parsed from its name and
+the output (``resource``) the group runner reads from it. Each
+directory's modification time is kept too, so later scans only list the
+directories whose entries changed (and ``stat`` the rest). Like
+``os.walk``, the scan doesn't descend into symbolic links to directories.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import fnmatch
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+INDEX_VERSION = 1
+"""Version of the index's tables; indices of other versions are rebuilt"""
+RACY_NS = 2 * 10 ** 9
+"""Directories modified this recently (in ns) before a scan are listed
+again by the next scan, as their modification times may not yet reflect
+every change"""
+
+
+def output_entities(filename):
+    """BIDS-like entities of an output filename, with its suffix and
+    extension
+
+    Parameters
+    ----------
+    filename : str
+
+    Returns
+    -------
+    dict
+
+    Examples
+    --------
+    >>> output_entities(
+    ...     'sub-1_ses-1_task-rest_space-template_desc-preproc_bold.nii.gz')
+    ... # doctest: +NORMALIZE_WHITESPACE
+    {'sub': '1', 'ses': '1', 'task': 'rest', 'space': 'template',
+     'desc': 'preproc', 'suffix': 'bold', 'extension': '.nii.gz'}
+    >>> output_entities('func')
+    {'suffix': 'func'}
+    """
+    stem, dot, extension = filename.partition('.')
+    entities = {}
+    for part in stem.split('_'):
+        key, dash, value = part.partition('-')
+        if dash:
+            entities.setdefault(key, value)
+        elif part:
+            entities['suffix'] = part
+    if dot:
+        entities['extension'] = f'.{extension}'
+    return entities
+
+
+def output_resource(path):
+    """The output the group runner reads from a path, as named in
+    ``cpac_outputs.tsv``
+
+    Parameters
+    ----------
+    path : str
+        relative to the pipeline output directory, as
+        ``{participant}_{session}/{func|anat}/{filename}``
+
+    Returns
+    -------
+    str or None
+
+    Examples
+    --------
+    >>> output_resource('sub-1_ses-1/func/sub-1_ses-1_task-rest_'
+    ...                 'space-template_desc-preproc_bold.nii.gz')
+    'space-template_desc-preproc_bold'
+    >>> output_resource('sub-1_ses-1/func') is None
+    True
+    """
+    pieces = [piece for piece in path.split('/') if piece]
+    if len(pieces) < 3:
+        return None
+    return '_'.join(pieces[2].split('.')[0].split('_')[3:])
+
+
+def default_index_path(pipeline_dir):
+    """Default location of an output directory's index, in the user's
+    cache directory
+
+    Parameters
+    ----------
+    pipeline_dir : str
+
+    Returns
+    -------
+    str
+    """
+    cache_dir = os.environ.get('XDG_CACHE_HOME',
+                               os.path.join(os.path.expanduser('~'), '.cache'))
+    digest = hashlib.sha1(
+        os.path.realpath(pipeline_dir).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, 'C-PAC', 'output_index', f'{digest}.sqlite')
+
+
+def _modified(directory):
+    """Modification time of a directory in ns, or None if it can't be
+    read or was modified too recently to be trusted"""
+    try:
+        mtime_ns = os.stat(directory).st_mtime_ns
+    except OSError:
+        return None
+    if time.time_ns() - mtime_ns < RACY_NS:
+        return None
+    return mtime_ns
+
+
+def _list_directory(directory):
+    """Entries of one directory as (name, is_dir, is_link); unreadable
+    directories are empty, as ``os.walk`` skips them"""
+    try:
+        with os.scandir(directory) as entries:
+            return [(entry.name, entry.is_dir(), entry.is_symlink())
+                    for entry in entries]
+    except OSError:
+        return []
+
+
+class OutputIndex:
+    """Index of a pipeline output directory's entries
+
+    Parameters
+    ----------
+    pipeline_dir : str
+
+    index_path : str, optional
+        SQLite database of the index (defaults to
+        :func:`default_index_path`); if it can't be written, the index
+        is kept in memory for this run only
+
+    n_threads : int
+        directories listed concurrently
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> pipeline_dir = tempfile.mkdtemp()
+    >>> os.makedirs(os.path.join(pipeline_dir, 'sub-1_ses-1', 'func'))
+    >>> for name in ['sub-1_ses-1_task-rest_desc-mean_bold.nii.gz',
+    ...              'sub-1_ses-1_task-rest_desc-mean_bold.json']:
+    ...     open(os.path.join(pipeline_dir, 'sub-1_ses-1', 'func', name),
+    ...          'w').close()
+    >>> index = OutputIndex(pipeline_dir, os.path.join(
+    ...     tempfile.mkdtemp(), 'index.sqlite'))
+    >>> index.scan()['added']
+    4
+    >>> index.files(['desc-mean_bold'])
+    ['sub-1_ses-1/func/sub-1_ses-1_task-rest_desc-mean_bold.json', \
+'sub-1_ses-1/func/sub-1_ses-1_task-rest_desc-mean_bold.nii.gz']
+    >>> index.glob_levels('desc-mean_bold')
+    [(3, True)]
+    >>> index.entities('sub-1_ses-1/func/'
+    ...                'sub-1_ses-1_task-rest_desc-mean_bold.nii.gz')['desc']
+    'mean'
+    """
+    def __init__(self, pipeline_dir, index_path=None, n_threads=16):
+        self.pipeline_dir = pipeline_dir.rstrip('/') or '/'
+        self.n_threads = max(int(n_threads), 1)
+        if index_path is None:
+            index_path = default_index_path(pipeline_dir)
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(index_path)),
+                        exist_ok=True)
+            self.connection = sqlite3.connect(index_path)
+            self._create_tables()
+        except (OSError, sqlite3.Error):
+            self.connection = sqlite3.connect(':memory:')
+            self._create_tables()
+        self.connection.create_function('fnmatchcase', 2,
+                                        fnmatch.fnmatchcase)
+
+    def _create_tables(self):
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS meta ('
+                                    'key TEXT PRIMARY KEY, value TEXT)')
+            version = self.connection.execute(
+                "SELECT value FROM meta WHERE key = 'version'").fetchone()
+            if version is None or int(version[0]) != INDEX_VERSION:
+                self.connection.execute('DROP TABLE IF EXISTS directories')
+                self.connection.execute('DROP TABLE IF EXISTS entries')
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('version', ?)",
+                    (str(INDEX_VERSION),))
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS directories ('
+                'path TEXT PRIMARY KEY, mtime_ns INTEGER)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS entries ('
+                'path TEXT PRIMARY KEY, parent TEXT NOT NULL, '
+                'is_dir INTEGER NOT NULL, is_link INTEGER NOT NULL, '
+                'depth INTEGER NOT NULL, hidden INTEGER NOT NULL, '
+                'nii INTEGER NOT NULL, output_name TEXT, resource TEXT, '
+                'entities TEXT NOT NULL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS '
+                                    'entries_parent ON entries (parent)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS '
+                                    'entries_resource ON entries (resource)')
+
+    def _directory(self, relative):
+        return os.path.join(self.pipeline_dir, relative) if relative \
+            else self.pipeline_dir
+
+    def _entry(self, parent, name, is_dir, is_link):
+        path = f'{parent}/{name}' if parent else name
+        pieces = path.split('/')
+        return (path, parent, int(is_dir), int(is_link), len(pieces),
+                int(any(piece.startswith('.') for piece in pieces)),
+                int('.nii' in path),
+                pieces[2] if len(pieces) > 2 else None,
+                output_resource(path), json.dumps(output_entities(name)))
+
+    def scan(self):
+        """Walk the output directory and update the index with what
+        changed
+
+        Returns
+        -------
+        dict
+            number of ``added`` and ``removed`` entries, and of directories
+            ``listed`` (the others were unchanged)
+        """
+        known = dict(self.connection.execute(
+            'SELECT path, mtime_ns FROM directories'))
+        visited = {}
+        relisted = {}
+        pending = ['']
+        with ThreadPoolExecutor(max_workers=self.n_threads) as executor:
+            while pending:
+                mtimes = list(executor.map(
+                    _modified, [self._directory(relative)
+                                for relative in pending]))
+                unchanged = []
+                changed = []
+                for relative, mtime_ns in zip(pending, mtimes):
+                    visited[relative] = mtime_ns
+                    if mtime_ns is not None and known.get(
+                            relative) == mtime_ns:
+                        unchanged.append(relative)
+                    else:
+                        changed.append(relative)
+                pending = []
+                for relative in unchanged:
+                    pending.extend(path for path, in self.connection.execute(
+                        'SELECT path FROM entries WHERE parent = ? AND '
+                        'is_dir = 1 AND is_link = 0', (relative,)))
+                for relative, listing in zip(changed, executor.map(
+                        _list_directory, [self._directory(relative)
+                                          for relative in changed])):
+                    relisted[relative] = [
+                        self._entry(relative, name, is_dir, is_link)
+                        for name, is_dir, is_link in listing]
+                    pending.extend(entry[0] for entry in relisted[relative]
+                                   if entry[2] and not entry[3])
+        stale = [(path,) for path in known if path not in visited]
+        previous = set()
+        for relative in list(relisted) + [path for path, in stale]:
+            previous.update(path for path, in self.connection.execute(
+                'SELECT path FROM entries WHERE parent = ?', (relative,)))
+        current = {entry[0] for entries in relisted.values()
+                   for entry in entries}
+        with self.connection:
+            self.connection.executemany('DELETE FROM entries WHERE '
+                                        'parent = ?', stale)
+            self.connection.executemany('DELETE FROM directories WHERE '
+                                        'path = ?', stale)
+            self.connection.executemany(
+                'DELETE FROM entries WHERE parent = ?',
+                [(relative,) for relative in relisted])
+            self.connection.executemany(
+                'INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [entry for entries in relisted.values() for entry in entries])
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO directories VALUES (?, ?)',
+                [(relative, visited[relative]) for relative in relisted])
+        return {'added': len(current - previous),
+                'removed': len(previous - current),
+                'listed': len(relisted)}
+
+    def files(self, resources=None):
+        """Relative paths of the files under participants' output
+        directories (``{participant}_{session}/{func|anat}/...``)
+
+        Parameters
+        ----------
+        resources : iterable of str, optional
+            only the files of these outputs (by default, every output's)
+
+        Returns
+        -------
+        list of str
+            in path order
+        """
+        query = 'SELECT path FROM entries WHERE is_dir = 0 AND depth >= 3'
+        if resources is None:
+            return [path for path, in self.connection.execute(
+                f'{query} ORDER BY path')]
+        resources = sorted(set(resources))
+        paths = []
+        for first in range(0, len(resources), 500):
+            batch = resources[first:first + 500]
+            paths.extend(path for path, in self.connection.execute(
+                f'{query} AND resource IN ({", ".join("?" * len(batch))})',
+                batch))
+        return sorted(paths)
+
+    def glob_levels(self, name):
+        """What ``glob`` would find for
+        ``{pipeline_dir}/*/*/*{name}*``, ``{pipeline_dir}/*/*/*{name}*/*``
+        and so on, up to the first level with no matches
+
+        Parameters
+        ----------
+        name : str
+
+        Returns
+        -------
+        list of tuple
+            (depth of the level's paths, whether any of them has
+            ``.nii`` in it)
+        """
+        if glob.has_magic(name):
+            condition, argument = 'fnmatchcase(output_name, ?)', f'*{name}*'
+        else:
+            condition, argument = 'instr(output_name, ?) > 0', name
+        levels = []
+        in_dir = '.nii' in self.pipeline_dir
+        for depth, nii in self.connection.execute(
+                f'SELECT depth, MAX(nii) FROM entries WHERE depth >= 3 AND '
+                f'hidden = 0 AND {condition} GROUP BY depth ORDER BY depth',
+                (argument,)):
+            if depth != 3 + len(levels):
+                break
+            levels.append((depth, bool(nii) or in_dir))
+        return levels
+
+    def entities(self, path):
+        """BIDS-like entities of an indexed path's name
+
+        Parameters
+        ----------
+        path : str
+            relative to the output directory
+
+        Returns
+        -------
+        dict
+        """
+        row = self.connection.execute(
+            'SELECT entities FROM entries WHERE path = ?', (path,)).fetchone()
+        if row is None:
+            raise KeyError(path)
+        return json.loads(row[0])
+
+    def close(self):
+        """Close the index's database"""
+        self.connection.close()
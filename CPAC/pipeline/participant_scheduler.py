@@ -0,0 +1,288 @@
+# Copyright (C) 2024  C-PAC Developers
+
+# This file is part of C-PAC.
+
+# C-PAC is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+
+# C-PAC is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+# License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with C-PAC. If not, see <https://www.gnu.org/licenses/>.
+"""Participant-level scheduler for running many participants at once.
+
+Each participant runs in a worker process of its own, so a participant
+whose process dies (e.g., killed for its memory) fails without breaking
+the others' runs. A participant is admitted when a slot is free
+(``num_participants_at_once``) and its predicted memory and cores fit in
+what the running participants leave of the machine, largest input data
+first so the longest participants don't start last. The queue is written
+to a JSON state file as it changes, with the throughput so far, and a
+later run can resume from it, skipping the participants that completed
+without scanning their data again.
+"""
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import cpu_count
+
+from CPAC.pipeline.nipype_pipeline_engine import get_data_size
+from CPAC.utils.monitoring import getLogger
+
+logger = getLogger('nipype.workflow')
+
+
+def participant_label(sub_dict):
+    """Label of a participant as used for its log directory
+
+    Parameters
+    ----------
+    sub_dict : dict
+
+    Returns
+    -------
+    str
+
+    Examples
+    --------
+    >>> participant_label({'subject_id': 'sub1', 'unique_id': 'uid1'})
+    'sub1_uid1'
+    >>> participant_label({'subject_id': 'sub1', 'unique_id': None})
+    'sub1'
+    """
+    subject_id = sub_dict['subject_id']
+    if sub_dict.get('unique_id'):
+        subject_id += f'_{sub_dict["unique_id"]}'
+    return subject_id
+
+
+def participant_data_size(sub_dict):
+    """Total number of voxels × volumes of a participant's local images,
+    to run the largest participants first
+
+    Parameters
+    ----------
+    sub_dict : dict
+
+    Returns
+    -------
+    int
+        0 if none of the images can be read locally (e.g., S3 paths)
+    """
+    paths = []
+    for scans in (sub_dict.get('func') or {}).values():
+        paths.append(scans.get('scan') if isinstance(scans, dict) else scans)
+    anat = sub_dict.get('anat')
+    paths.extend(anat.values() if isinstance(anat, dict) else [anat])
+    size = 0
+    for path in paths:
+        if isinstance(path, str) and os.path.isfile(path):
+            try:
+                size += get_data_size(path)
+            except Exception:  # pylint: disable=broad-except
+                continue
+    return size
+
+
+def _record_pid(pid_file):
+    """Append a participant's worker process ID to ``pid_file``"""
+    if pid_file:
+        with open(pid_file, 'a', encoding='utf-8') as pid:
+            print(os.getpid(), file=pid)
+
+
+class ParticipantQueue:
+    """Queue of participants run in worker processes
+
+    Parameters
+    ----------
+    sublist : list of dict
+        participant dictionaries
+
+    state_file : str
+        path of the JSON queue state file
+
+    max_parallel : int
+        most participants to run at once
+
+    participant_memory_gb : float, optional
+        predicted memory of each participant (defaults to an even share
+        of ``memory_gb``)
+
+    participant_cpus : int
+        cores of each participant
+
+    memory_gb : float, optional
+        memory available to all participants (defaults to the machine's)
+
+    cpus : int, optional
+        cores available to all participants (defaults to the machine's)
+
+    resume : bool
+        skip participants that completed according to ``state_file``
+
+    pid_file : str, optional
+        path of a file to write the participants' process IDs to
+    """
+    def __init__(self, sublist, state_file, max_parallel=1,
+                 participant_memory_gb=None, participant_cpus=1,
+                 memory_gb=None, cpus=None, resume=False, pid_file=None):
+        if memory_gb is None:
+            import psutil
+            memory_gb = psutil.virtual_memory().total / 1024 ** 3
+        self.memory_gb = memory_gb
+        self.cpus = cpus or cpu_count()
+        self.max_parallel = max(int(max_parallel), 1)
+        self.participant_memory_gb = (
+            participant_memory_gb or memory_gb / self.max_parallel)
+        self.participant_cpus = max(int(participant_cpus or 1), 1)
+        self.state_file = state_file
+        self.pid_file = pid_file
+        self.participants = {participant_label(sub): sub for sub in sublist}
+
+        previous = self.read_state(state_file) if resume else {}
+        self.completed = [label for label in previous.get('completed', [])
+                          if label in self.participants]
+        self.failed = []
+        self.running = []
+        data_size = previous.get('data_size', {})
+        self.data_size = {label: data_size[label] if label in data_size
+                          else participant_data_size(sub)
+                          for label, sub in self.participants.items()
+                          if label not in self.completed}
+        self.pending = sorted(self.data_size, key=self.data_size.get,
+                              reverse=True)
+        self.started = time.time()
+        self.finished_this_run = 0
+
+    @staticmethod
+    def read_state(state_file):
+        """Queue state written by a previous run, if any
+
+        Parameters
+        ----------
+        state_file : str
+
+        Returns
+        -------
+        dict
+        """
+        try:
+            with open(state_file, 'r', encoding='utf-8') as _f:
+                return json.load(_f)
+        except (OSError, ValueError):
+            return {}
+
+    @property
+    def throughput(self):
+        """Participants finished per hour in this run"""
+        hours = (time.time() - self.started) / 3600
+        return self.finished_this_run / hours if hours > 0 else 0.0
+
+    def admits(self):
+        """Whether the next pending participant fits now
+
+        Returns
+        -------
+        bool
+        """
+        if not self.pending:
+            return False
+        if not self.running:
+            # always run at least one participant
+            return True
+        running = len(self.running) + 1
+        return (running <= self.max_parallel and
+                running * self.participant_memory_gb <= self.memory_gb and
+                running * self.participant_cpus <= self.cpus)
+
+    def write_state(self):
+        """Write the queue state file (atomically)"""
+        state = {'pending': self.pending, 'running': self.running,
+                 'completed': self.completed, 'failed': self.failed,
+                 'data_size': {**self.read_state(self.state_file).get(
+                     'data_size', {}), **self.data_size},
+                 'participants_per_hour': round(self.throughput, 3),
+                 'updated': time.strftime('%Y-%m-%d %H:%M:%S')}
+        os.makedirs(os.path.dirname(os.path.abspath(self.state_file)),
+                    exist_ok=True)
+        temporary = f'{self.state_file}.tmp'
+        with open(temporary, 'w', encoding='utf-8') as _f:
+            json.dump(state, _f, indent=2)
+        os.replace(temporary, self.state_file)
+
+    def run(self, function, args=(), on_failure=None):
+        """Run ``function(sub_dict, *args)`` for every pending participant
+
+        Parameters
+        ----------
+        function : function
+            picklable participant-level function
+
+        args : tuple
+            further (picklable) arguments of ``function``
+
+        on_failure : function, optional
+            called as ``on_failure(sub_dict, exception)`` (in this
+            process) for each participant that fails, with a
+            ``BrokenProcessPool`` if the participant's process died
+
+        Returns
+        -------
+        int
+            exit code: 1 if any participant failed, 0 otherwise
+        """
+        exitcode = 0
+        if self.pid_file:
+            os.makedirs(os.path.dirname(os.path.abspath(self.pid_file)),
+                        exist_ok=True)
+            open(self.pid_file, 'w', encoding='utf-8').close()
+        futures = {}
+        try:
+            while self.pending or futures:
+                while self.admits():
+                    label = self.pending.pop(0)
+                    # a pool of one fresh worker per participant: if the
+                    # worker dies, only this participant's pool breaks
+                    executor = ProcessPoolExecutor(
+                        max_workers=1, initializer=_record_pid,
+                        initargs=(self.pid_file,))
+                    futures[executor.submit(
+                        function, self.participants[label], *args)] = (
+                            label, executor)
+                    self.running.append(label)
+                self.write_state()
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    label, executor = futures.pop(future)
+                    executor.shutdown()
+                    self.running.remove(label)
+                    self.finished_this_run += 1
+                    exception = future.exception()
+                    if exception is None:
+                        self.completed.append(label)
+                        continue
+                    if isinstance(exception, BrokenProcessPool):
+                        logger.error('The process running %s exited '
+                                     'abruptly', label)
+                    exitcode = 1
+                    self.failed.append(label)
+                    if on_failure is not None:
+                        on_failure(self.participants[label], exception)
+                logger.info('%d participants completed, %d failed, %d '
+                            'running, %d pending (%.2f participants/hour)',
+                            len(self.completed), len(self.failed),
+                            len(self.running), len(self.pending),
+                            self.throughput)
+        finally:
+            for _, executor in futures.values():
+                executor.shutdown(wait=False)
+        self.write_state()
+        return exitcode
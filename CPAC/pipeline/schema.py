@@ -115,6 +115,7 @@ valid_options = {
                 'method': str,
                 'components': int,
                 'filter': str,
+                'svd_method': In({'truncated', 'randomized'}),
             },
             'threshold': str,
             'tissues': [str],
@@ -375,6 +376,10 @@ latest_schema = Schema({
         'working_directory': {
             'path': str,
             'remove_working_dir': bool1_1,
+            'data_cache': {
+                'run': bool1_1,
+                'disk_budget_gb': Number,
+            },
         },
         'log_directory': {
             'run_logging': bool1_1,
@@ -410,17 +415,22 @@ latest_schema = Schema({
             'num_ants_threads': int,
             'num_OMP_threads': int,
             'num_participants_at_once': int,
+            'participant_queue': {
+                'resume': bool1_1,
+            },
             'random_seed': Maybe(Any(
                 'random',
                 All(int, Range(min=1, max=np.iinfo(np.int32).max)))),
             'observed_usage': {
                 'callback_log': Maybe(str),
                 'buffer': Number,
+                'memory_model': Maybe(str),
             },
         },
         'Amazon-AWS': {
             'aws_output_bucket_credentials': Maybe(str),
             's3_encryption': bool1_1,
+            'input_prefetch_threads': All(int, Range(min=0)),
         },
         'Debugging': {
             'verbose': bool1_1,
@@ -902,6 +912,7 @@ latest_schema = Schema({
             'run': forkable,
             'space': All(Coerce(ItemFromList),
                          Lower, In({'native', 'template'})),
+            'engine': In({'AFNI', 'native'}),
             'create_regressors': bool1_1,
             'ingress_regressors': {
                 'run': bool1_1,
@@ -998,6 +1009,7 @@ latest_schema = Schema({
         'run': bool1_1,
         'target_space': target_space,
         'cluster_size': In({7, 19, 27}),
+        'engine': In({'vectorized', 'voxelwise'}),
     },
     'post_processing': {
         'spatial_smoothing': {
@@ -1051,6 +1063,7 @@ latest_schema = Schema({
     'network_centrality': {
         'run': bool1_1,
         'memory_allocation': Number,
+        'engine': In({'AFNI', 'native'}),
         'template_specification_file': Maybe(str),
         'degree_centrality': {
             'weight_options': [In(
@@ -0,0 +1,199 @@
+# Copyright (C) 2024  C-PAC Developers
+
+# This file is part of C-PAC.
+
+# C-PAC is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+
+# C-PAC is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+# License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with C-PAC. If not, see <https://www.gnu.org/licenses/>.
+"""Strategy combination for ``ResourcePool.get_strats``.
+
+A node block's inputs each come in one or more strategies (provenance
+lists). The strategies of a node block are the combinations of one
+strategy per input, except that linked inputs (inputs given together as a
+tuple) must come from compatible forks, according to their
+``CpacVariant``s. Rather than enumerating the Cartesian product of all
+inputs' strategies and then dropping incompatible combinations, the
+combinations are built one input at a time, and a partial combination is
+abandoned as soon as two of its linked inputs are incompatible. Pairwise
+compatibility is computed once per pair of strategies.
+
+The inputs' sidecars are shared (not copied) between the strategies that
+include them; they are only read when a node block's outputs' sidecars
+are made.
+"""
+
+
+def shared_sidecar(json_info):
+    """A strategy's view of an input's sidecar, without its own inputs'
+    sidecars (``subjson``). The values are shared with the input's sidecar,
+    so it must not be modified in place.
+
+    Parameters
+    ----------
+    json_info : dict
+
+    Returns
+    -------
+    dict
+
+    Examples
+    --------
+    >>> json_info = {'Description': 'a T1w', 'CpacProvenance': ['T1w:anat'],
+    ...              'subjson': {'T1w': {}}}
+    >>> sidecar = shared_sidecar(json_info)
+    >>> sorted(sidecar)
+    ['CpacProvenance', 'Description']
+    >>> sidecar['CpacProvenance'] is json_info['CpacProvenance']
+    True
+    """
+    return {key: value for key, value in json_info.items()
+            if key != 'subjson'}
+
+
+def variant_labels(json_info, spread):
+    """Fork labels of one strategy of an input: the first node of each of
+    its ``CpacVariant``s, and ``NO-<label>`` for each other label in the
+    input's ``spread``
+
+    Parameters
+    ----------
+    json_info : dict
+        the strategy's sidecar (read only)
+
+    spread : list
+        every variant label of the input, over all its strategies
+
+    Returns
+    -------
+    list
+
+    Examples
+    --------
+    >>> variant_labels({'CpacVariant': {'desc-brain_T1w': ['brain_afni']}},
+    ...                ['brain_afni', 'NO-brain_afni', 'brain_fsl'])
+    ['brain_afni', 'NO-brain_fsl']
+    """
+    labels = []
+    for val in json_info.get('CpacVariant', {}).values():
+        labels.append(val[0] if isinstance(val, list) else val)
+    for spread_label in spread:
+        if 'NO-' in spread_label:
+            continue
+        if spread_label not in labels:
+            labels.append(f'NO-{spread_label}')
+    return labels
+
+
+def variants_conflict(xjson, yjson, x_spread, y_spread):
+    """Whether a strategy of one linked input (x) excludes a strategy of
+    another (y)
+
+    Parameters
+    ----------
+    xjson, yjson : dict
+        the strategies' sidecars (read only)
+
+    x_spread, y_spread : list
+        every variant label of each input, over all its strategies
+
+    Returns
+    -------
+    bool
+    """
+    current_spread = list(set(x_spread))
+    other_spread = list(set(y_spread))
+    current_strat = variant_labels(xjson, current_spread)
+    other_strat = variant_labels(yjson, other_spread)
+    for variant in current_spread:
+        in_current_strat = variant is None or variant in current_strat
+        in_other_strat = (variant is None and None in other_spread) or \
+            variant in other_strat
+        in_other_spread = variant in other_spread
+        if in_other_spread and in_current_strat != in_other_strat:
+            return True
+    return False
+
+
+def combine_strategies(pools, labels, linked, get_json, spreads):
+    """Combinations of one strategy per input, in the order of
+    ``itertools.product(*pools)``, without duplicates and without
+    combinations of incompatible linked inputs
+
+    Parameters
+    ----------
+    pools : list of lists
+        each input's strategies (provenance lists)
+
+    labels : list of str
+        the resource of each input
+
+    linked : list of lists
+        labels of each group of linked inputs
+
+    get_json : function
+        ``get_json(label, strategy)`` returns the sidecar of one
+        strategy of an input
+
+    spreads : dict
+        {label: every variant label of the input}
+
+    Yields
+    ------
+    pipe_idx : str
+        the combination's key, ``str(combination)``
+
+    combination : list
+        one strategy (provenance list) per input
+    """
+    # an input that's listed more than once is represented (as when the
+    # sidecars are keyed by resource) by its last occurrence
+    last = {label: position for position, label in enumerate(labels)}
+    # pairs of linked inputs to check once both are chosen
+    checks = [[] for _ in pools]
+    for group in linked:
+        for xlabel in group:
+            for ylabel in group:
+                if xlabel != ylabel:
+                    checks[max(last[xlabel], last[ylabel])].append(
+                        (last[xlabel], last[ylabel]))
+    keys = [[repr(strategy) for strategy in pool] for pool in pools]
+    conflicts = {}
+
+    def conflict(x, y, chosen):
+        key = (x, y, chosen[x], chosen[y])
+        if key not in conflicts:
+            conflicts[key] = variants_conflict(
+                get_json(labels[x], pools[x][chosen[x]]),
+                get_json(labels[y], pools[y][chosen[y]]),
+                spreads.get(labels[x], []), spreads.get(labels[y], []))
+        return conflicts[key]
+
+    seen = set()
+    chosen = [0] * len(pools)
+
+    def extend(position):
+        if position == len(pools):
+            pipe_idx = '[' + ', '.join(
+                keys[index][choice] for index, choice in enumerate(chosen)
+            ) + ']'
+            if pipe_idx not in seen:
+                seen.add(pipe_idx)
+                yield pipe_idx, [pools[index][choice]
+                                 for index, choice in enumerate(chosen)]
+            return
+        for choice in range(len(pools[position])):
+            chosen[position] = choice
+            if any(conflict(x, y, chosen) for x, y in checks[position]):
+                continue
+            yield from extend(position + 1)
+
+    yield from extend(0)
@@ -0,0 +1,90 @@
+"""Tests for copy-on-write resource pool dictionaries"""
+from copy import deepcopy
+import pickle
+
+from CPAC.pipeline.copy_on_write import CopyOnWriteDict, _sizeof, \
+    pool_memory
+
+
+class _Node:
+    """Stand-in for a workflow node, which must never be copied"""
+
+
+def _pool(n_resources=50, n_strategies=4):
+    return CopyOnWriteDict({
+        f'desc-{resource}_T1w': {
+            f'pipe{strategy}': {
+                'data': (_Node(), 'out_file'),
+                'json': {'CpacProvenance': [f'T1w:node_{strategy}'],
+                         'Description': 'x' * 100}}
+            for strategy in range(n_strategies)}
+        for resource in range(n_resources)})
+
+
+def test_copies_share_until_accessed():
+    pool = _pool()
+    entry = dict.__getitem__(pool, 'desc-0_T1w')
+    pool_copy = pool.copy()
+    assert dict.__getitem__(pool_copy, 'desc-0_T1w') is entry
+    assert pool_copy.shared == set(pool)
+
+    # writing in the copy, at every level, leaves the original alone
+    pool_copy['desc-0_T1w']['pipe0']['json']['Description'] = 'changed'
+    pool_copy['desc-0_T1w']['pipe1']['data'] = (_Node(), 'other')
+    del pool_copy['desc-1_T1w']['pipe2']
+    pool_copy['desc-new_T1w'] = {}
+    assert pool['desc-0_T1w']['pipe0']['json']['Description'] == 'x' * 100
+    assert pool['desc-0_T1w']['pipe1']['data'][1] == 'out_file'
+    assert 'pipe2' in pool['desc-1_T1w']
+    assert 'desc-new_T1w' not in pool
+
+    # and writing in the original leaves the copy alone
+    pool['desc-2_T1w']['pipe0']['json']['Sources'] = ['T1w']
+    assert 'Sources' not in pool_copy['desc-2_T1w']['pipe0']['json']
+
+    # nodes are never copied
+    assert pool_copy['desc-0_T1w']['pipe0']['data'][0] is pool[
+        'desc-0_T1w']['pipe0']['data'][0]
+    # untouched resources are still shared
+    assert 'desc-3_T1w' in pool_copy.shared
+    assert 'desc-0_T1w' not in pool_copy.shared
+
+
+def test_copy_of_copy():
+    pool = _pool(2, 2)
+    first = pool.copy()
+    first['desc-0_T1w']['pipe0']['json']['Description'] = 'first'
+    second = first.copy()
+    second['desc-0_T1w']['pipe0']['json']['Description'] = 'second'
+    assert first['desc-0_T1w']['pipe0']['json']['Description'] == 'first'
+    assert pool['desc-0_T1w']['pipe0']['json']['Description'] == 'x' * 100
+    for key, value in second.items():
+        value['pipe1']['json'].pop('Description')
+    assert all('Description' in value['pipe1']['json']
+               for value in first.values())
+
+
+def test_pickle_and_deepcopy():
+    pool = _pool(2, 2)
+    pool_copy = pool.copy()
+    for restored in (pickle.loads(pickle.dumps(pool_copy)),
+                     deepcopy(pool_copy)):
+        assert isinstance(restored, CopyOnWriteDict)
+        assert not restored.shared
+        assert restored.levels == pool_copy.levels
+        assert restored.keys() == pool.keys()
+        assert restored['desc-1_T1w']['pipe1']['json'] == pool[
+            'desc-1_T1w']['pipe1']['json']
+
+
+def test_pool_memory():
+    pool = _pool()
+    report = pool_memory(pool)
+    assert (report['resources'], report['strategies'], report['shared']) == (
+        50, 200, 0)
+    copies = [pool.copy() for _ in range(10)]
+    assert pool_memory(copies[0])['shared'] == 50
+    # the copies together hold little more than the original
+    shared = _sizeof([pool, *copies], set())
+    deep = _sizeof([pool, *[deepcopy(dict(pool)) for _ in copies]], set())
+    assert shared < 2 * _sizeof(pool, set()) < deep
@@ -7,7 +7,8 @@ from CPAC.pipeline.cpac_pipeline import initialize_nipype_wf, \
                                         build_workflow
 from CPAC.pipeline.engine import ResourcePool, ingress_raw_anat_data, \
                                  ingress_raw_func_data, \
-                                 ingress_pipeconfig_paths, initiate_rpool
+                                 ingress_pipeconfig_paths, initiate_rpool, \
+                                 wrap_block
 from CPAC.utils.bids_utils import create_cpac_data_config
 
 
@@ -168,3 +169,26 @@ test_dir = "/Users/hecheng.jin/GitHub/Test/T2preproc"
 # test_build_anat_preproc_stack(cfg, bids_dir, test_dir)
 if __name__ == '__main__':
     test_build_workflow(cfg, bids_dir, test_dir)
+
+
+def test_wrap_block_forks_pool():
+    """wrap_block sets its interface in a copy of the parent's pool"""
+    def block(wf, cfg, strat_pool, pipe_num, opt):
+        # the interface's 'bold' is the newest strategy
+        node, out = list(strat_pool.get('bold').values())[-1]['data']
+        return wf, {'desc-brain_bold': (node, f'{out}_brain')}
+
+    parent = ResourcePool()
+    parent.set_data('bold', 'bold_node', 'bold', {}, '', 'bold_ingress')
+    _, pool = wrap_block([block], {'bold': ('epi_node', 'epi'),
+                                   'desc-brain_bold': 'epi_brain'},
+                         None, None, parent, 0, None)
+    assert pool.get_data('epi_brain', quick_single=True) == ('epi_node',
+                                                             'epi_brain')
+    assert len(pool.get('bold')) == 2
+    # the parent's pool keeps its own 'bold'
+    assert len(parent.get('bold')) == 1
+    assert parent.get_data('bold', quick_single=True) == ('bold_node', 'bold')
+    assert not parent.check_rpool('epi_brain')
+    # and the next wrapped block gets a new node name
+    assert parent.get_pool_info()['sub_num'] == 1
@@ -0,0 +1,111 @@
+"""Tests for resampling group analysis inputs"""
+import os
+
+import nibabel as nb
+import numpy as np
+import pytest
+from scipy.ndimage import map_coordinates
+
+from CPAC.pipeline import group_resampling
+from CPAC.pipeline.group_resampling import image_grid, \
+    interpolation_matrix, resample_group_inputs, resampled_path
+
+REFERENCE_AFFINE = np.array([[2., 0, 0, -30], [0, 2, 0, -36],
+                             [0, 0, 2, -24], [0, 0, 0, 1]])
+REFERENCE_SHAPE = (31, 37, 25)
+
+
+def _affine(zoom, angle=0.):
+    rotation = np.eye(4)
+    rotation[:2, :2] = [[np.cos(angle), -np.sin(angle)],
+                        [np.sin(angle), np.cos(angle)]]
+    affine = np.diag([zoom, zoom, zoom, 1.])
+    affine[:3, 3] = REFERENCE_AFFINE[:3, 3]
+    return rotation @ affine
+
+
+def _map_coordinates(data, affine, order):
+    """Reference: scipy's resampling of every volume to the reference"""
+    mapping = np.linalg.solve(affine, REFERENCE_AFFINE)
+    coords = mapping[:3, :3] @ np.indices(REFERENCE_SHAPE).reshape(3, -1) + \
+        mapping[:3, 3:]
+    volumes = data.reshape(data.shape[:3] + (-1,))
+    return np.stack([map_coordinates(volumes[..., volume], coords,
+                                     order=order, mode='constant', cval=0)
+                     for volume in range(volumes.shape[-1])],
+                    axis=-1).reshape(REFERENCE_SHAPE + data.shape[3:])
+
+
+@pytest.mark.parametrize('order', [0, 1])
+@pytest.mark.parametrize('zoom,angle', [(3., 0.), (2.5, 0.1), (2., 0.)])
+def test_interpolation_matrix(order, zoom, angle):
+    data = np.random.default_rng(0).random((21, 25, 17))
+    affine = _affine(zoom, angle)
+    matrix = interpolation_matrix(image_grid(nb.Nifti1Image(data, affine)),
+                                  image_grid(nb.Nifti1Image(np.zeros(
+                                      REFERENCE_SHAPE), REFERENCE_AFFINE)),
+                                  order)
+    assert np.allclose((matrix @ data.ravel()).reshape(REFERENCE_SHAPE),
+                       _map_coordinates(data, affine, order))
+
+
+def _inputs(tmp_path):
+    rng = np.random.default_rng(1)
+    reference = str(tmp_path / 'template_2mm.nii.gz')
+    nb.save(nb.Nifti1Image(np.zeros(REFERENCE_SHAPE, dtype=np.float32),
+                           REFERENCE_AFFINE), reference)
+    images = []
+    for sub, (affine, shape) in enumerate([
+            (_affine(3.), (21, 25, 17)), (_affine(3.), (21, 25, 17)),
+            (_affine(2.5, 0.1), (25, 30, 20)),
+            (REFERENCE_AFFINE, REFERENCE_SHAPE)]):
+        path = str(tmp_path / 'output' / 'pipeline_test' /
+                   f'sub-{sub}_ses-1' / 'func' /
+                   f'sub-{sub}_ses-1_task-rest_space-template_bold.nii.gz')
+        os.makedirs(os.path.dirname(path))
+        nb.save(nb.Nifti1Image(rng.random(shape + (3,)).astype(np.float32),
+                               affine), path)
+        images.append(path)
+    return reference, images
+
+
+@pytest.mark.parametrize('n_procs', [1, 2])
+def test_resample_group_inputs(monkeypatch, tmp_path, n_procs):
+    reference, images = _inputs(tmp_path)
+    out_dir = str(tmp_path / 'working')
+    resampled = resample_group_inputs(images, reference, out_dir,
+                                      n_procs=n_procs)
+    # images on the reference grid aren't resampled
+    assert resampled[-1] == images[-1]
+    for image_path, resampled_image in zip(images[:-1], resampled[:-1]):
+        assert resampled_image == resampled_path(image_path, out_dir)
+        image = nb.load(image_path)
+        output = nb.load(resampled_image)
+        assert output.shape == REFERENCE_SHAPE + (3,)
+        assert np.allclose(output.affine, REFERENCE_AFFINE)
+        assert np.allclose(output.get_fdata(), _map_coordinates(
+            image.get_fdata(), image.affine, 1), atol=1e-6)
+
+    # cached by contents: nothing is resampled again unless it changed
+    def fail(*args):
+        raise AssertionError('resampled again')
+    monkeypatch.setattr(group_resampling, '_resample_images', fail)
+    assert resample_group_inputs(images, reference, out_dir) == resampled
+    nb.save(nb.Nifti1Image(np.ones((21, 25, 17, 3), dtype=np.float32),
+                           _affine(3.)), images[0])
+    with pytest.raises(AssertionError, match='resampled again'):
+        resample_group_inputs(images, reference, out_dir)
+
+
+def test_resample_roi(tmp_path):
+    reference, _ = _inputs(tmp_path)
+    roi = str(tmp_path / 'rois.nii.gz')
+    labels = np.random.default_rng(2).integers(0, 6, (21, 25, 17))
+    nb.save(nb.Nifti1Image(labels.astype(np.int16), _affine(3.)), roi)
+    resampled, = resample_group_inputs([roi], reference, str(tmp_path),
+                                       roi_file=True)
+    assert resampled == resampled_path(roi, str(tmp_path), roi_file=True)
+    output = nb.load(resampled)
+    assert output.get_data_dtype() == np.int16
+    assert np.array_equal(output.get_fdata(),
+                          _map_coordinates(labels, _affine(3.), 0))
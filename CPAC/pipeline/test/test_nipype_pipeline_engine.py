@@ -15,7 +15,10 @@
 # You should have received a copy of the GNU Lesser General Public
 # License along with C-PAC. If not, see <https://www.gnu.org/licenses/>.
 """Tests for C-PAC customizations to nipype.pipeline.engine."""
+import json
 import os
+import nibabel as nb
+import numpy as np
 import pytest
 from nibabel.testing import data_path
 from nipype.interfaces.utility import IdentityInterface
@@ -30,6 +33,8 @@ from CPAC.pipeline.nipype_pipeline_engine.plugins import (
     MultiProcPlugin,
 )
 from CPAC.utils.interfaces.function import Function
+from CPAC.utils.monitoring.memory_model import MemoryModel, \
+    memory_prediction_report, update_memory_model
 
 
 def get_sample_data(filepath):
@@ -117,3 +122,63 @@ def test_Workflow(tmpdir):  # pylint: disable=invalid-name
     out_node = list(out.nodes)[0]
     assert out_node.mem_gb == DEFAULT_MEM_GB + get_data_size(
         example_filepath, 'xyzt') * 0.1
+
+
+def _callback_log(path, observations):
+    with open(path, 'w', encoding='utf-8') as cbl:
+        for node_id, shape, memory in observations:
+            cbl.write(json.dumps({
+                'id': node_id, 'runtime_memory_gb': memory,
+                'estimated_memory_gb': 1, **({'input_data_shape': shape} if
+                                             shape else {})}) + '\n')
+        cbl.write(json.dumps({'data_cache': 'hit'}) + '\n')
+    return str(path)
+
+
+def test_memory_model(tmp_path):
+    store = str(tmp_path / 'memory_model.json')
+    for run, t in enumerate([100, 200, 400]):
+        update_memory_model(store, _callback_log(tmp_path / f'{run}.log', [
+            (f'cpac_sub-{run}.wf_0.regress', (10, 10, 10, t),
+             0.5 + t * 1000 * 1e-5 + 0.01 * run),
+            (f'cpac_sub-{run}.wf_0.reorient', None, 0.2 + 0.1 * run)]))
+    model = MemoryModel.load(store, buffer=10)
+    assert len(model) == 2
+    # line above all observations, plus the buffer
+    for run, t in enumerate([100, 200, 400]):
+        observed = 0.5 + t * 1000 * 1e-5 + 0.01 * run
+        predicted = model.predict('cpac_sub-9.wf_0.regress', (10, 10, 10, t))
+        assert observed * 1.1 - 1e-9 <= predicted < observed * 1.1 + 0.05
+    assert model.predict('cpac_sub-9.wf_0.regress', (10, 10, 10, 800)) > \
+        model.predict('cpac_sub-9.wf_0.regress', (10, 10, 10, 400))
+    assert model.predict('cpac_sub-9.wf_0.regress') is None
+    # size-independent nodes predict their largest observation
+    assert np.isclose(model.predict('cpac_sub-9.wf_0.reorient'), 0.4 * 1.1)
+    # unobserved nodes fall back to nodes of the same type
+    assert np.isclose(model.predict('cpac_sub-9.wf_1.reorient'), 0.4 * 1.1)
+    assert model.predict('cpac_sub-9.wf_0.unobserved') is None
+
+
+def test_memory_model_scheduling(tmp_path):
+    example_filepath = os.path.join(data_path, 'example4d.nii.gz')
+    node = Node(Function(['filepath'], ['filepath'], get_sample_data),
+                name='get_sample_data', mem_x=(0.1, 'filepath'))
+    node.inputs.filepath = example_filepath
+    assert node.get_input_data_shape() == nb.load(example_filepath).shape
+    wf = Workflow('example_workflow')
+    wf.add_nodes([node])
+    store = str(tmp_path / 'memory_model.json')
+    update_memory_model(store, _callback_log(tmp_path / 'callback.log', [
+        ('example_workflow.get_sample_data', None, 0.123)]))
+    MultiProcPlugin(plugin_args={
+        'raise_insufficient': False,
+        'memory_model': {'store': store, 'buffer': 0}
+    })._prerun_check(wf._graph)
+    assert np.isclose(node.mem_gb, 0.123)
+
+
+def test_memory_prediction_report(tmp_path):
+    text_report, rows = memory_prediction_report(_callback_log(
+        tmp_path / 'callback.log', [('wf.a', None, 0.5), ('wf.b', None, 2)]))
+    assert [row[0] for row in rows] == ['wf.b', 'wf.a']
+    assert '1 nodes used more memory than estimated' in text_report
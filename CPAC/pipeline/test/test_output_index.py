@@ -0,0 +1,136 @@
+"""Tests for the pipeline output directory index"""
+import os
+from time import perf_counter, time
+
+import pytest
+
+from CPAC.pipeline.cpac_group_runner import create_output_dict_list, \
+    gather_nifti_globs, gather_outputs
+from CPAC.pipeline.output_index import OutputIndex
+from CPAC.utils.pytest import benchmark
+
+RESOURCES = ['alff', 'desc-preproc_bold', 'desc-brain_T1w']
+
+
+def _touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'w', encoding='utf-8').close()
+
+
+def _outputs(pipeline_dir, n_participants=4):
+    for sub in range(1, n_participants + 1):
+        for ses in ['1', '2']:
+            unique_id = f'sub-{sub:04}_ses-{ses}'
+            func = os.path.join(pipeline_dir, unique_id, 'func')
+            for output in ['space-template_desc-preproc_bold', 'alff',
+                           'space-template_desc-sm-zstd_alff',
+                           'desc-confounds_timeseries']:
+                for ext in ['.nii.gz', '.json']:
+                    _touch(os.path.join(
+                        func, f'{unique_id}_task-rest_{output}{ext}'))
+            # an output directory, and hidden and linked outputs
+            _touch(os.path.join(func, f'{unique_id}_task-rest_desc-sm_alff',
+                                'run-1', 'alff.nii.gz'))
+            _touch(os.path.join(func, '.hidden', f'{unique_id}_task-rest_'
+                                'space-template_alff.nii.gz'))
+            anat = os.path.join(pipeline_dir, unique_id, 'anat')
+            _touch(os.path.join(
+                anat, f'{unique_id}_space-template_desc-brain_T1w.nii.gz'))
+            os.symlink(anat, os.path.join(func, 'linked'))
+    _touch(os.path.join(pipeline_dir, 'log', 'pipeline.log'))
+
+
+def _age(pipeline_dir):
+    """Make every directory's modification time an hour old"""
+    then = time() - 3600
+    for root, dirs, _ in os.walk(pipeline_dir):
+        for name in dirs:
+            os.utime(os.path.join(root, name), (then, then))
+    os.utime(pipeline_dir, (then, then))
+
+
+def _sorted(output_dict_list):
+    return {key: sorted(rows, key=lambda row: row['Filepath'])
+            for key, rows in output_dict_list.items()}
+
+
+@pytest.mark.parametrize('get_func', [False, True])
+def test_index_matches_glob(tmp_path, get_func):
+    pipeline_dir = str(tmp_path / 'pipeline_test')
+    _outputs(pipeline_dir)
+    index = OutputIndex(pipeline_dir, str(tmp_path / 'index.sqlite'))
+    index.scan()
+    globs = gather_nifti_globs(pipeline_dir, RESOURCES, get_func)
+    assert gather_nifti_globs(pipeline_dir, RESOURCES, get_func,
+                              index) == globs
+    expected = create_output_dict_list(globs, pipeline_dir, RESOURCES,
+                                       pull_func=get_func)
+    assert expected
+    assert _sorted(create_output_dict_list(
+        globs, pipeline_dir, RESOURCES, pull_func=get_func,
+        output_index=index)) == _sorted(expected)
+
+
+def test_gather_outputs(tmp_path):
+    pipeline_dir = str(tmp_path / 'pipeline_test')
+    _outputs(pipeline_dir)
+    output_df_dict = gather_outputs(pipeline_dir, RESOURCES, None, False,
+                                    False, index_path=str(
+                                        tmp_path / 'index.sqlite'))
+    expected = create_output_dict_list(
+        gather_nifti_globs(pipeline_dir, RESOURCES), pipeline_dir, RESOURCES)
+    assert set(output_df_dict) == set(expected)
+    for key, rows in _sorted(expected).items():
+        assert output_df_dict[key].to_dict('records') == rows
+
+
+def test_incremental_scan(tmp_path):
+    pipeline_dir = str(tmp_path / 'pipeline_test')
+    index_path = str(tmp_path / 'index.sqlite')
+    _outputs(pipeline_dir, 2)
+    _age(pipeline_dir)
+    first = OutputIndex(pipeline_dir, index_path).scan()
+    assert first['added'] and not first['removed']
+    index = OutputIndex(pipeline_dir, index_path)
+    assert index.scan() == {'added': 0, 'removed': 0, 'listed': 0}
+    files = index.files()
+
+    added = os.path.join(pipeline_dir, 'sub-0003_ses-1', 'func',
+                         'sub-0003_ses-1_task-rest_alff.nii.gz')
+    _touch(added)
+    removed = os.path.join(pipeline_dir, 'sub-0001_ses-2')
+    for root, dirs, names in os.walk(removed, topdown=False):
+        for name in names + dirs:
+            path = os.path.join(root, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                os.rmdir(path)
+            else:
+                os.remove(path)
+    os.rmdir(removed)
+    assert index.scan()['listed'] == 3
+    assert set(index.files()) == {
+        path for path in files if not path.startswith('sub-0001_ses-2')} | {
+        os.path.relpath(added, pipeline_dir)}
+    assert index.entities(os.path.relpath(added, pipeline_dir)) == {
+        'sub': '0003', 'ses': '1', 'task': 'rest', 'suffix': 'alff',
+        'extension': '.nii.gz'}
+
+
+@benchmark
+def test_output_index_benchmark(tmp_path):
+    pipeline_dir = str(tmp_path / 'pipeline_test')
+    _outputs(pipeline_dir, 300)
+    start = perf_counter()
+    expected = create_output_dict_list(
+        gather_nifti_globs(pipeline_dir, RESOURCES), pipeline_dir, RESOURCES)
+    glob_time = perf_counter() - start
+    index = OutputIndex(pipeline_dir, str(tmp_path / 'index.sqlite'))
+    start = perf_counter()
+    index.scan()
+    output_dict_list = create_output_dict_list(
+        gather_nifti_globs(pipeline_dir, RESOURCES, output_index=index),
+        pipeline_dir, RESOURCES, output_index=index)
+    index_time = perf_counter() - start
+    print(f'glob {glob_time:.2f}s, index {index_time:.2f}s')
+    assert _sorted(output_dict_list) == _sorted(expected)
+    assert index_time < glob_time
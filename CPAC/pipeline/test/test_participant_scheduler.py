@@ -0,0 +1,152 @@
+"""Tests for the participant-level scheduler"""
+import json
+import os
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+import nibabel as nb
+import numpy as np
+
+from CPAC.pipeline import nipype_pipeline_engine as pe, participant_scheduler
+from CPAC.pipeline.participant_scheduler import ParticipantQueue, \
+    participant_label
+
+
+def _work(sub_dict, out_dir):
+    """Record when a participant ran; fail participants named 'fail' and
+    kill the process of participants named 'kill'"""
+    start = time.time()
+    time.sleep(0.3)
+    if sub_dict['subject_id'].startswith('fail'):
+        raise RuntimeError(f'{sub_dict["subject_id"]} failed')
+    if sub_dict['subject_id'].startswith('kill'):
+        os._exit(9)
+    with open(os.path.join(out_dir, f'{sub_dict["subject_id"]}.json'), 'w',
+              encoding='utf-8') as _f:
+        json.dump([start, time.time()], _f)
+
+
+def _crash(sub_dict):
+    raise RuntimeError(f'{sub_dict["subject_id"]} crashed')
+
+
+def _run_workflow(sub_dict, base_dir):
+    """Run a participant's workflow, in which a node crashes"""
+    from nipype.interfaces.utility import Function
+    workflow = pe.Workflow(name=f'cpac_{participant_label(sub_dict)}',
+                           base_dir=base_dir)
+    node = pe.Node(Function(input_names=['sub_dict'], output_names=[],
+                            function=_crash), name='crash')
+    node.inputs.sub_dict = sub_dict
+    workflow.add_nodes([node])
+    workflow.config['execution']['crashdump_dir'] = base_dir
+    workflow.run(plugin='Linear')
+
+
+def _sublist(tmp_path, sizes):
+    sublist = []
+    for subject_id, volumes in sizes.items():
+        func = str(tmp_path / f'{subject_id}_bold.nii.gz')
+        nb.Nifti1Image(np.zeros((2, 2, 2, volumes), dtype=np.float32),
+                       np.eye(4)).to_filename(func)
+        sublist.append({'subject_id': subject_id, 'unique_id': 'ses-1',
+                        'anat': None, 'func': {'rest': {'scan': func}}})
+    return sublist
+
+
+def _rescan(sub_dict):
+    raise AssertionError(f'{sub_dict["subject_id"]} was rescanned')
+
+
+def _intervals(out_dir):
+    intervals = {}
+    for name in os.listdir(out_dir):
+        if name.endswith('.json'):
+            with open(os.path.join(out_dir, name), encoding='utf-8') as _f:
+                intervals[name[:-5]] = json.load(_f)
+    return intervals
+
+
+def test_largest_first(tmp_path):
+    sublist = _sublist(tmp_path, {'small': 2, 'large': 20, 'medium': 10})
+    queue = ParticipantQueue(sublist, str(tmp_path / 'state' / 'queue.json'),
+                             max_parallel=1)
+    assert queue.pending == ['large_ses-1', 'medium_ses-1', 'small_ses-1']
+    assert queue.run(_work, (str(tmp_path),)) == 0
+    intervals = _intervals(tmp_path)
+    assert sorted(intervals, key=lambda label: intervals[label][0]) == [
+        'large', 'medium', 'small']
+
+
+def test_admission_by_memory(tmp_path):
+    """Four slots, but memory for only two participants at a time"""
+    sublist = _sublist(tmp_path, {f'sub{i}': 2 for i in range(4)})
+    queue = ParticipantQueue(sublist, str(tmp_path / 'state' / 'queue.json'),
+                             max_parallel=4, participant_memory_gb=2,
+                             memory_gb=4, cpus=8)
+    assert queue.run(_work, (str(tmp_path),)) == 0
+    intervals = list(_intervals(tmp_path).values())
+    assert len(intervals) == 4
+    for start, _ in intervals:
+        assert sum(begin <= start < end for begin, end in intervals) <= 2
+
+
+def test_state_file_and_resume(monkeypatch, tmp_path):
+    state_file = str(tmp_path / 'state' / 'queue.json')
+    sublist = _sublist(tmp_path, {'sub1': 4, 'fail1': 3, 'sub2': 2})
+    failures = []
+    queue = ParticipantQueue(sublist, state_file, max_parallel=2, cpus=2)
+    assert queue.run(_work, (str(tmp_path),),
+                     lambda sub, exception: failures.append(
+                         sub['subject_id'])) == 1
+    assert failures == ['fail1']
+    with open(state_file, encoding='utf-8') as _f:
+        state = json.load(_f)
+    assert sorted(state['completed']) == ['sub1_ses-1', 'sub2_ses-1']
+    assert state['failed'] == ['fail1_ses-1']
+    assert not state['pending'] and not state['running']
+    assert state['participants_per_hour'] > 0
+    assert state['data_size']['sub1_ses-1'] == 32
+
+    # resuming neither reruns nor rescans completed participants
+    monkeypatch.setattr(participant_scheduler, 'participant_data_size',
+                        _rescan)
+    queue = ParticipantQueue(sublist, state_file, max_parallel=2,
+                             resume=True)
+    assert queue.pending == ['fail1_ses-1']
+    monkeypatch.undo()
+    assert ParticipantQueue(sublist, state_file, max_parallel=2,
+                            resume=False).pending == [
+        'sub1_ses-1', 'fail1_ses-1', 'sub2_ses-1']
+
+
+def test_crashed_workflow(tmp_path):
+    """A participant whose workflow crashes isn't recorded as completed"""
+    state_file = str(tmp_path / 'state' / 'queue.json')
+    sublist = _sublist(tmp_path, {'sub1': 2})
+    queue = ParticipantQueue(sublist, state_file, max_parallel=1)
+    assert queue.run(_run_workflow, (str(tmp_path / 'working'),)) == 1
+    assert queue.failed == ['sub1_ses-1'] and not queue.completed
+    assert ParticipantQueue(sublist, state_file, max_parallel=1,
+                            resume=True).pending == ['sub1_ses-1']
+
+
+def test_killed_worker(tmp_path):
+    """A participant whose process dies fails alone"""
+    sublist = _sublist(tmp_path, {'kill1': 8, 'sub1': 4, 'sub2': 3,
+                                  'sub3': 2})
+    failures = {}
+    pid_file = str(tmp_path / 'state' / 'pid.txt')
+    queue = ParticipantQueue(sublist, str(tmp_path / 'state' / 'queue.json'),
+                             max_parallel=2, cpus=2, pid_file=pid_file)
+    assert queue.run(_work, (str(tmp_path),),
+                     lambda sub, exception: failures.update(
+                         {sub['subject_id']: exception})) == 1
+    assert list(failures) == ['kill1']
+    assert isinstance(failures['kill1'], BrokenProcessPool)
+    assert queue.failed == ['kill1_ses-1']
+    assert sorted(queue.completed) == ['sub1_ses-1', 'sub2_ses-1',
+                                       'sub3_ses-1']
+    assert sorted(_intervals(tmp_path)) == ['sub1', 'sub2', 'sub3']
+    with open(pid_file, encoding='utf-8') as pid:
+        assert len(set(pid.read().split())) == 4
@@ -0,0 +1,126 @@
+"""Tests for combining the strategies of a node block's inputs"""
+from copy import deepcopy
+from itertools import product
+from time import perf_counter
+
+import pytest
+
+from CPAC.pipeline.strategies import combine_strategies
+from CPAC.utils.pytest import benchmark
+
+
+def _product_strategies(pools, labels, linked, get_json, spreads):
+    """Reference: the full Cartesian product, deep-copied and
+    de-duplicated, then incompatible linked inputs dropped"""
+    strat_str_list = []
+    strat_list_list = []
+    for strat_tuple in product(*pools):
+        strat_list = list(deepcopy(strat_tuple))
+        if str(strat_list) not in strat_str_list:
+            strat_str_list.append(str(strat_list))
+            strat_list_list.append(strat_list)
+    combinations = []
+    for strat_list in strat_list_list:
+        json_dct = {label: get_json(label, strat)
+                    for label, strat in zip(labels, strat_list)}
+        drop = False
+        for group in linked:
+            for xlabel in group:
+                xjson = deepcopy(json_dct[xlabel])
+                for ylabel in group:
+                    if xlabel == ylabel:
+                        continue
+                    yjson = deepcopy(json_dct[ylabel])
+                    current_strat = [val[0] for val in
+                                     xjson.get('CpacVariant', {}).values()]
+                    current_spread = list(set(spreads[xlabel]))
+                    current_strat += [f'NO-{spread_label}' for spread_label
+                                      in current_spread if 'NO-' not in
+                                      spread_label and spread_label not in
+                                      current_strat]
+                    other_strat = [val[0] for val in
+                                   yjson.get('CpacVariant', {}).values()]
+                    other_spread = list(set(spreads[ylabel]))
+                    other_strat += [f'NO-{spread_label}' for spread_label
+                                    in other_spread if 'NO-' not in
+                                    spread_label and spread_label not in
+                                    other_strat]
+                    for variant in current_spread:
+                        in_current_strat = variant in current_strat
+                        in_other_strat = variant in other_strat
+                        if variant in other_spread and (
+                                in_other_strat != in_current_strat):
+                            drop = True
+        if not drop:
+            combinations.append((str(strat_list), strat_list))
+    return combinations
+
+
+def _forks(n_forks, n_other=2):
+    """Synthetic inputs: a brain and a brain mask linked across
+    ``n_forks`` brain-extraction forks (some without a variant), and an
+    unlinked input with ``n_other`` strategies"""
+    pools = {'desc-brain_T1w': [], 'space-T1w_desc-brain_mask': [],
+             'desc-preproc_bold': []}
+    sidecars = {}
+    spreads = {label: [] for label in pools}
+    for fork in range(n_forks):
+        node = f'brain_mask_{fork}'
+        for label in ('desc-brain_T1w', 'space-T1w_desc-brain_mask'):
+            strategy = ['T1w:anat_ingress',
+                        f'space-T1w_desc-brain_mask:{node}', f'{label}:{node}']
+            json_info = {'CpacProvenance': strategy}
+            if fork % 3:
+                json_info['CpacVariant'] = {
+                    'space-T1w_desc-brain_mask': [node]}
+                spreads[label] += [node, f'NO-{node}']
+            pools[label].append(strategy)
+            sidecars[label, str(strategy)] = json_info
+    for other in range(n_other):
+        strategy = ['bold:func_ingress', f'desc-preproc_bold:node_{other}']
+        pools['desc-preproc_bold'].append(strategy)
+        sidecars['desc-preproc_bold', str(strategy)] = {
+            'CpacProvenance': strategy}
+    labels = list(pools)
+    return ([pools[label] for label in labels], labels,
+            [['desc-brain_T1w', 'space-T1w_desc-brain_mask']],
+            lambda label, strategy: sidecars[label, str(strategy)], spreads)
+
+
+@pytest.mark.parametrize('n_forks', [1, 2, 4, 7])
+def test_combine_strategies(n_forks):
+    inputs = _forks(n_forks)
+    expected = _product_strategies(*inputs)
+    assert list(combine_strategies(*inputs)) == expected
+    # forks with variants only pair with themselves
+    assert len(expected) == 2 * (n_forks + len(
+        [fork for fork in range(n_forks) if not fork % 3]) ** 2 - len(
+        [fork for fork in range(n_forks) if not fork % 3]))
+
+
+def test_combine_duplicates():
+    pools, labels, linked, get_json, spreads = _forks(2)
+    pools.append(pools[0])
+    labels.append(labels[0])
+    combinations = list(combine_strategies(pools, labels, linked, get_json,
+                                           spreads))
+    assert combinations == _product_strategies(pools, labels, linked,
+                                               get_json, spreads)
+    assert len({pipe_idx for pipe_idx, _ in combinations}) == len(
+        combinations)
+
+
+@benchmark
+@pytest.mark.parametrize('n_forks', [4, 8, 16])
+def test_combine_strategies_benchmark(n_forks):
+    inputs = _forks(n_forks, n_other=4)
+    start = perf_counter()
+    expected = _product_strategies(*inputs)
+    product_time = perf_counter() - start
+    start = perf_counter()
+    combinations = list(combine_strategies(*inputs))
+    combine_time = perf_counter() - start
+    print(f'{n_forks} forks: {len(combinations)} strategies, product '
+          f'{product_time:.4f}s, combined {combine_time:.4f}s')
+    assert combinations == expected
+    assert combine_time < product_time
@@ -18,6 +18,7 @@ from matplotlib.colors import ListedColormap
 from nipype.interfaces import afni
 from CPAC.pipeline import nipype_pipeline_engine as pe
 import nipype.interfaces.utility as util
+from CPAC.utils.data_cache import load_image_data
 
 
 def generate_qc_pages(qc_dir):
@@ -155,7 +156,7 @@ def gen_carpet_plt(gm_mask, wm_mask, csf_mask, functional_to_standard, output):
 
     carpet_plot_path = os.path.join(os.getcwd(), output + '.png')
 
-    func = nb.load(functional_to_standard).get_fdata()
+    func = load_image_data(functional_to_standard)
     gm_voxels = func[nb.load(gm_mask).get_fdata().astype(bool)]
     wm_voxels = func[nb.load(wm_mask).get_fdata().astype(bool)]
     csf_voxels = func[nb.load(csf_mask).get_fdata().astype(bool)]
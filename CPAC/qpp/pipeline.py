@@ -19,7 +19,7 @@ def detect_qpp(datasets,
                window_length, permutations,
                lower_correlation_threshold, higher_correlation_threshold,
                correlation_threshold_iteration,
-               iterations, convergence_iterations):
+               iterations, convergence_iterations, n_procs=1):
     
     from CPAC.qpp.qpp import detect_qpp
 
@@ -40,7 +40,8 @@ def detect_qpp(datasets,
         permutations,
         correlation_threshold,
         iterations,
-        convergence_iterations
+        convergence_iterations,
+        n_procs=n_procs
     )
 
     qpp = np.zeros(joint_datasets_img.shape[0:3] + (window_length,))
@@ -52,7 +53,7 @@ def detect_qpp(datasets,
     return os.path.abspath('./qpp.nii.gz')
 
 
-def create_qpp(name='qpp', working_dir=None, crash_dir=None):
+def create_qpp(name='qpp', working_dir=None, crash_dir=None, n_procs=1):
     
     if not working_dir:
         working_dir = os.path.join(os.getcwd(), 'QPP_work_dir')
@@ -94,11 +95,14 @@ def create_qpp(name='qpp', working_dir=None, crash_dir=None):
                                            'higher_correlation_threshold',
                                            'correlation_threshold_iteration',
                                            'iterations',
-                                           'convergence_iterations'],
+                                           'convergence_iterations',
+                                           'n_procs'],
                                 output_names=['qpp'],
                                 function=detect_qpp,
                                 as_module=True),
-                     name='detect_qpp')
+                     name='detect_qpp', n_procs=n_procs)
+    # the permutations' worker pool is the node's allocation
+    detect.inputs.n_procs = n_procs
     
     workflow.connect([
         (inputspec, merge, [('datasets', 'in_files')]),
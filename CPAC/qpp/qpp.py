@@ -1,3 +1,6 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
 import numpy as np
 import nibabel as nib
 import os
@@ -10,6 +13,9 @@ import numpy.matlib
 
 from CPAC.utils import check_random_state, correlation
 
+# data of the worker processes, attached from shared memory
+_shared = {}
+
 
 def smooth(x):
     """
@@ -34,14 +40,154 @@ def normalize_segment(segment, df):
     return segment
 
 
+def window_norms(data, window_length):
+    """Norm of every demeaned, flattened window of ``data``, ie of
+    ``flattened_segment(data, window_length, tr)`` after its mean has been
+    removed, for every TR a full window can start at"""
+    df = data.shape[0] * window_length
+    window = np.ones(window_length)
+    sums = np.convolve(data.sum(axis=0), window, 'valid')
+    squares = np.convolve(np.einsum('vt,vt->t', data, data), window, 'valid')
+    return np.sqrt(np.maximum(squares - sums ** 2 / df, 0))
+
+
+def template_correlation(data, template, window_length, inspectable_trs,
+                         norms):
+    """Correlation of a normalized template, as returned by
+    :func:`normalize_segment`, with the window starting at each inspectable
+    TR.
+
+    Since the template has zero mean, the windows do not need to be
+    demeaned: the dot products with every window are the diagonals of a
+    single window_length × TRs matrix product, which are then divided by
+    the precomputed :func:`window_norms`.
+    """
+    products = template.reshape(window_length, -1) @ data
+    windows = len(norms)
+    dots = products[0, :windows].copy()
+    for lag in range(1, window_length):
+        dots += products[lag, lag:lag + windows]
+    correlations = np.zeros(windows)
+    np.divide(dots, norms, out=correlations, where=norms > 0)
+    template_holder = np.zeros(data.shape[1])
+    template_holder[inspectable_trs] = correlations[inspectable_trs]
+    return template_holder
+
+
+def template_correlation_windowwise(data, template, window_length,
+                                    inspectable_trs):
+    """Reference implementation of :func:`template_correlation` that
+    flattens and normalizes every window"""
+    df = data.shape[0] * window_length
+    template_holder = np.zeros(data.shape[1])
+    for tr in inspectable_trs:
+        scan_window = normalize_segment(
+            flattened_segment(data, window_length, tr), df)
+        template_holder[tr] = np.dot(template, scan_window)
+    return template_holder
+
+
+def qpp_permutation(data, initial_tr, window_length, inspectable_trs,
+                    correlation_thresholds, convergence_iterations=1,
+                    norms=None):
+    """Iteratively refine a template, seeded with the window starting at
+    ``initial_tr``, by averaging the windows at its correlation peaks.
+
+    Template matching uses :func:`template_correlation` with the
+    :func:`window_norms` ``norms``, which are shared by all permutations,
+    or :func:`template_correlation_windowwise` if ``norms`` is None.
+
+    Returns
+    -------
+    dict
+        The final template correlation time series (``template``), its
+        ``peaks``, the ``final_iteration`` and the ``correlation_score``,
+        or an empty dictionary if fewer than two peaks were found.
+    """
+    voxels, trs = data.shape
+    df = voxels * window_length
+
+    if norms is None:
+        def match(template):
+            return template_correlation_windowwise(
+                data, template, window_length, inspectable_trs)
+    else:
+        def match(template):
+            return template_correlation(data, template, window_length,
+                                        inspectable_trs, norms)
+
+    template_holder = match(normalize_segment(
+        flattened_segment(data, window_length, initial_tr), df))
+
+    template_holder_convergence = np.zeros((convergence_iterations, trs))
+
+    for iteration, peak_threshold in enumerate(correlation_thresholds):
+
+        peaks, _ = find_peaks(template_holder, height=peak_threshold,
+                              distance=window_length)
+        peaks = np.delete(peaks,
+                          np.where(~np.isin(peaks, inspectable_trs))[0])
+
+        template_holder = smooth(template_holder)
+
+        found_peaks = np.size(peaks)
+        if found_peaks < 1:
+            break
+
+        peaks_segments = flattened_segment(data, window_length, peaks[0])
+        for peak in peaks[1:]:
+            peaks_segments = peaks_segments + \
+                flattened_segment(data, window_length, peak)
+
+        peaks_segments = peaks_segments / found_peaks
+        peaks_segments = normalize_segment(peaks_segments, df)
+
+        template_holder = match(peaks_segments)
+
+        if np.all(correlation(template_holder,
+                              template_holder_convergence) > 0.9999):
+            break
+
+        if convergence_iterations > 1:
+            template_holder_convergence[1:] = \
+                template_holder_convergence[0:-1]
+        template_holder_convergence[0] = template_holder
+
+    if found_peaks > 1:
+        return {
+            'template': template_holder,
+            'peaks': peaks,
+            'final_iteration': iteration,
+            'correlation_score': np.sum(template_holder[peaks]),
+        }
+    return {}
+
+
+def _attach_data(name, shape, dtype):
+    shm = SharedMemory(name=name)
+    _shared['shm'] = shm
+    _shared['data'] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _shared_qpp_permutation(*args, **kwargs):
+    return qpp_permutation(_shared['data'], *args, **kwargs)
+
+
 def detect_qpp(data, num_scans, window_length,
                permutations, correlation_threshold, 
                iterations, convergence_iterations=1,
-               random_state=None):
+               random_state=None, n_procs=1, windowwise=False):
     """
     This code is adapted from the paper "Quasi-periodic patterns (QP): Large-
     scale dynamics in resting state fMRI that correlate with local infraslow
     electrical activity", Shella Keilholz et al. NeuroImage, 2014.
+
+    The initial windows of all permutations are drawn up front from
+    ``random_state``, so the permutations are independent of each other and
+    give the same result whether they run serially or, with ``n_procs`` >
+    1, on a process pool sharing ``data`` through shared memory. With
+    ``windowwise=True``, every window is flattened and normalized again for
+    every template match, as in the original implementation.
     """
 
     random_state = check_random_state(random_state)
@@ -60,59 +206,30 @@ def detect_qpp(data, num_scans, window_length,
     inpectable_trs = np.arange(trs) % trs_per_scan
     inpectable_trs = np.where(inpectable_trs < trs_per_scan - window_length + 1)[0]
 
-    df = voxels * window_length
-
     initial_trs = random_state.choice(inpectable_trs, permutations)
 
-    permutation_result = [{} for _ in range(permutations)]
-    for perm in range(permutations):
-
-        template_holder = np.zeros(trs)
-        random_initial_window = normalize_segment(flattened_segment(data, window_length, initial_trs[perm]), df)
-        for tr in inpectable_trs:
-            scan_window = normalize_segment(flattened_segment(data, window_length, tr), df)
-            template_holder[tr] = np.dot(random_initial_window, scan_window)
-
-        template_holder_convergence = np.zeros((convergence_iterations, trs))
+    norms = None if windowwise else window_norms(data, window_length)
+    args = (window_length, inpectable_trs, correlation_thresholds,
+            convergence_iterations, norms)
 
-        for iteration in range(iterations):
-
-            peak_threshold = correlation_thresholds[iteration]
-
-            peaks, _ = find_peaks(template_holder, height=peak_threshold, distance=window_length)
-            peaks = np.delete(peaks, np.where(~np.isin(peaks, inpectable_trs))[0])
-
-            template_holder = smooth(template_holder)
-
-            found_peaks = np.size(peaks)
-            if found_peaks < 1:
-                break
-
-            peaks_segments = flattened_segment(data, window_length, peaks[0])
-            for peak in peaks[1:]:
-                peaks_segments = peaks_segments + flattened_segment(data, window_length, peak)
-
-            peaks_segments = peaks_segments / found_peaks
-            peaks_segments = normalize_segment(peaks_segments, df)
-
-            for tr in inpectable_trs:
-                scan_window = normalize_segment(flattened_segment(data, window_length, tr), df)
-                template_holder[tr] = np.dot(peaks_segments, scan_window)
-
-            if np.all(correlation(template_holder, template_holder_convergence) > 0.9999):
-                break
-
-            if convergence_iterations > 1:
-                template_holder_convergence[1:] = template_holder_convergence[0:-1]
-            template_holder_convergence[0] = template_holder
-
-        if found_peaks > 1:
-            permutation_result[perm] = {
-                'template': template_holder,
-                'peaks': peaks,
-                'final_iteration': iteration,
-                'correlation_score': np.sum(template_holder[peaks]),
-            }
+    if n_procs <= 1:
+        permutation_result = [qpp_permutation(data, initial_tr, *args)
+                              for initial_tr in initial_trs]
+    else:
+        shm = SharedMemory(create=True, size=data.nbytes)
+        try:
+            np.ndarray(data.shape, dtype=data.dtype,
+                       buffer=shm.buf)[:] = data
+            with ProcessPoolExecutor(
+                    max_workers=n_procs, initializer=_attach_data,
+                    initargs=(shm.name, data.shape, data.dtype)
+            ) as executor:
+                permutation_result = list(executor.map(
+                    _shared_qpp_permutation, initial_trs,
+                    *[[arg] * permutations for arg in args]))
+        finally:
+            shm.close()
+            shm.unlink()
 
     # Retrieve max correlation of template from permutations
     correlation_scores = np.array([
@@ -1,8 +1,12 @@
+import time
+
 import matplotlib.pyplot as plt
 import numpy as np
 import pytest
 import scipy.io
-from CPAC.qpp.qpp import detect_qpp
+from CPAC.qpp.qpp import detect_qpp, flattened_segment, normalize_segment, \
+    template_correlation, template_correlation_windowwise, window_norms
+from CPAC.utils.pytest import benchmark
 
 np.random.seed(10)
 
@@ -57,4 +61,71 @@ def test_qpp():
     for xc in best_selected_peaks:
         plt.axvline(x=xc, color='r')
     plt.legend()
-    plt.show()
\ No newline at end of file
+    plt.show()
+
+
+def _synthetic_qpp_data(voxels, trs, seed=0):
+    random_state = np.random.RandomState(seed)
+    x1 = np.sin(2 * np.pi * 10 * np.linspace(0, 1, trs))
+    x = np.tile(x1, (voxels, 1)) + random_state.uniform(0, 1, (voxels, trs))
+    x -= x.mean()
+    x /= x.std()
+    return x
+
+
+def test_template_correlation():
+    data = np.random.RandomState(1).standard_normal((50, 120))
+    window_length = 9
+    inspectable_trs = np.arange(0, 120 - window_length + 1, 2)
+    template = normalize_segment(
+        flattened_segment(data, window_length, 17), 50 * window_length)
+    assert np.allclose(
+        template_correlation(data, template, window_length,
+                             inspectable_trs,
+                             window_norms(data, window_length)),
+        template_correlation_windowwise(data, template, window_length,
+                                        inspectable_trs))
+
+
+@pytest.mark.parametrize('n_procs', [1, 2])
+def test_detect_qpp(n_procs):
+    data = _synthetic_qpp_data(300, 400)
+    threshold = lambda i: 0.3 if i > 2 else 0.2
+    expected = detect_qpp(data, 4, 15, 4, threshold, 5,
+                          random_state=3, windowwise=True)
+    result = detect_qpp(data, 4, 15, 4, threshold, 5,
+                        random_state=3, n_procs=n_procs)
+    assert np.allclose(result[0], expected[0])
+    assert np.array_equal(result[1], expected[1])
+    assert np.allclose(result[2], expected[2])
+
+
+@benchmark
+def test_detect_qpp_benchmark():
+    data = _synthetic_qpp_data(5000, 1200)
+    threshold = lambda i: 0.3 if i > 2 else 0.2
+    kwargs = dict(num_scans=4, window_length=30, permutations=10,
+                  correlation_threshold=threshold, iterations=10,
+                  random_state=3)
+
+    start = time.perf_counter()
+    expected = detect_qpp(data, windowwise=True, **kwargs)
+    windowwise_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result = detect_qpp(data, **kwargs)
+    vectorized_time = time.perf_counter() - start
+
+    print(f'QPP: windowwise {windowwise_time:.1f}s, '
+          f'vectorized {vectorized_time:.1f}s '
+          f'({windowwise_time / vectorized_time:.1f}× speed-up)')
+    assert np.allclose(result[0], expected[0])
+
+
+def test_create_qpp_n_procs(tmp_path):
+    """The QPP node holds the processors its permutations run on"""
+    from CPAC.qpp.pipeline import create_qpp
+    detect = create_qpp(working_dir=str(tmp_path), crash_dir=str(tmp_path),
+                        n_procs=3).get_node('detect_qpp')
+    assert detect.n_procs == 3
+    assert detect.inputs.n_procs == 3
@@ -6,7 +6,7 @@ import nipype.interfaces.utility as util
 from CPAC.reho.utils import *
 
 
-def create_reho(wf_name):
+def create_reho(wf_name, engine='vectorized'):
 
     """
     Regional Homogeneity(ReHo) approach to fMRI data analysis
@@ -16,7 +16,12 @@ def create_reho(wf_name):
     Parameters
     ----------
 
-    None
+    wf_name : string
+        Name of the workflow
+
+    engine : string
+        'vectorized' (default) to compute ReHo for all voxels with array
+        operations, or 'voxelwise' for the original voxel-by-voxel loop
 
     Returns
     -------
@@ -96,11 +101,14 @@ def create_reho(wf_name):
 
     reho_imports = ['import os', 'import sys', 'import nibabel as nb',
                     'import numpy as np',
-                    'from CPAC.reho.utils import f_kendall']
+                    'from CPAC.reho.utils import f_kendall, '
+                    'reho_neighbourhood_offsets, tied_ranks']
+    reho_function = {'vectorized': compute_reho_vectorized,
+                     'voxelwise': compute_reho}[engine]
     raw_reho_map = pe.Node(util.Function(input_names=['in_file', 'mask_file',
                                                       'cluster_size'],
                                          output_names=['out_file'],
-                                         function=compute_reho,
+                                         function=reho_function,
                                          imports=reho_imports),
                            name='reho_map', mem_gb=6.0)
 
@@ -129,7 +137,8 @@ def reho(wf, cfg, strat_pool, pipe_num, opt=None):
                   'again' % cluster_size
         raise Exception(err_msg)
 
-    reho = create_reho(f'reho_{pipe_num}')
+    reho = create_reho(f'reho_{pipe_num}',
+                       cfg.regional_homogeneity['engine'])
     reho.inputs.inputspec.cluster_size = cluster_size
 
     node, out = strat_pool.get_data("desc-preproc_bold")
@@ -168,7 +177,8 @@ def reho_space_template(wf, cfg, strat_pool, pipe_num, opt=None):
                   'again' % cluster_size
         raise Exception(err_msg)
 
-    reho = create_reho(f'reho_{pipe_num}')
+    reho = create_reho(f'reho_{pipe_num}',
+                       cfg.regional_homogeneity['engine'])
     reho.inputs.inputspec.cluster_size = cluster_size
 
     node, out = strat_pool.get_data(["space-template_res-derivative_desc-preproc_bold",
@@ -0,0 +1,76 @@
+import os
+import sys
+import time
+
+import nibabel as nb
+import numpy as np
+import pytest
+
+from CPAC.reho import utils
+from CPAC.utils.pytest import benchmark
+
+
+def _synthetic_image(tmp_path, shape, timepoints, seed=0):
+    """Write a synthetic 4D image with many tied values and a brain-ish
+    ellipsoid mask"""
+    rng = np.random.default_rng(seed)
+    data = rng.integers(0, 50, shape + (timepoints,)).astype(np.float64)
+    grid = np.indices(shape) - (np.array(shape) - 1)[:, None, None, None] / 2
+    radius = np.array(shape)[:, None, None, None] / 2.2
+    mask = ((grid / radius) ** 2).sum(axis=0) <= 1
+    in_file = str(tmp_path / 'bold.nii.gz')
+    mask_file = str(tmp_path / 'mask.nii.gz')
+    nb.Nifti1Image(data, np.eye(4)).to_filename(in_file)
+    nb.Nifti1Image(mask.astype(np.float64), np.eye(4)).to_filename(mask_file)
+    return in_file, mask_file
+
+
+@pytest.fixture
+def voxelwise(monkeypatch):
+    """compute_reho relies on the imports of its Function node"""
+    for name, module in [('nb', nb), ('np', np), ('os', os), ('sys', sys)]:
+        monkeypatch.setattr(utils, name, module, raising=False)
+    return utils.compute_reho
+
+
+def test_tied_ranks():
+    data = np.array([[3., 1, 3, 2, 1, 1, 5],
+                     [0., 1, 2, 3, 4, 5, 6]])
+    assert np.array_equal(utils.tied_ranks(data),
+                          [[5, 1, 5, 3, 1, 1, 6],
+                           [0, 1, 2, 3, 4, 5, 6]])
+
+
+@pytest.mark.parametrize('cluster_size', [7, 19, 27])
+def test_compute_reho_vectorized(monkeypatch, tmp_path, voxelwise,
+                                 cluster_size):
+    monkeypatch.chdir(tmp_path)
+    in_file, mask_file = _synthetic_image(tmp_path, (10, 12, 9), 40)
+    expected = nb.load(voxelwise(in_file, mask_file,
+                                 cluster_size)).get_fdata()
+    result = nb.load(utils.compute_reho_vectorized(
+        in_file, mask_file, cluster_size, chunk_size=50)).get_fdata()
+    assert np.count_nonzero(expected)
+    assert np.allclose(result, expected)
+
+
+@benchmark
+@pytest.mark.parametrize('resolution, shape', [
+    ('3mm', (61, 73, 61)), ('2mm', (91, 109, 91))])
+def test_reho_benchmark(monkeypatch, tmp_path, voxelwise, resolution, shape):
+    monkeypatch.chdir(tmp_path)
+    in_file, mask_file = _synthetic_image(tmp_path, shape, 150)
+
+    start = time.perf_counter()
+    expected = nb.load(voxelwise(in_file, mask_file, 27)).get_fdata()
+    voxelwise_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result = nb.load(utils.compute_reho_vectorized(
+        in_file, mask_file, 27)).get_fdata()
+    vectorized_time = time.perf_counter() - start
+
+    print(f'ReHo {resolution}: voxelwise {voxelwise_time:.1f}s, '
+          f'vectorized {vectorized_time:.1f}s '
+          f'({voxelwise_time / vectorized_time:.1f}× speed-up)')
+    assert np.allclose(result, expected)
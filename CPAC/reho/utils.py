@@ -280,3 +280,174 @@ def compute_reho(in_file, mask_file, cluster_size):
     out_file = reho_file
 
     return out_file
+
+
+def tied_ranks(data):
+    """
+    Rank each row of ``data`` along its last axis, the way
+    :func:`compute_reho` does: ranks start at 0 and every member of a
+    group of ties gets the mean rank of the group, rounded up.
+
+    Parameters
+    ----------
+
+    data : ndarray
+        voxels × timepoints
+
+    Returns
+    -------
+
+    ranks : ndarray
+        voxels × timepoints integer ranks
+
+    """
+
+    import numpy as np
+
+    n_t = data.shape[-1]
+    position = np.arange(n_t)
+
+    sort_index = np.argsort(data, axis=-1, kind='mergesort')
+    data_sorted = np.take_along_axis(data, sort_index, axis=-1)
+
+    # flag the first and last member of each group of tied values
+    first = np.ones(data.shape, dtype=bool)
+    first[:, 1:] = data_sorted[:, 1:] != data_sorted[:, :-1]
+    last = np.ones(data.shape, dtype=bool)
+    last[:, :-1] = first[:, 1:]
+
+    start = np.maximum.accumulate(np.where(first, position, 0), axis=-1)
+    end = np.minimum.accumulate(np.where(last, position, n_t)[:, ::-1],
+                                axis=-1)[:, ::-1]
+
+    ranks = np.empty(data.shape, dtype=np.int32)
+    np.put_along_axis(ranks, sort_index, (start + end + 1) // 2, axis=-1)
+
+    return ranks
+
+
+def reho_neighbourhood_offsets(shape, cluster_size):
+    """
+    Flat-index offsets of a voxel's neighbourhood in a C-ordered volume
+
+    Parameters
+    ----------
+
+    shape : tuple
+        (x, y, z) shape of the volume
+
+    cluster_size : integer
+        7 (faces), 19 (faces + edges) or 27 (faces + edges + corners)
+
+    Returns
+    -------
+
+    offsets : ndarray
+        ``cluster_size`` flat-index offsets, including 0 for the voxel
+        itself
+
+    """
+
+    import numpy as np
+
+    max_distance = {7: 1, 19: 2, 27: 3}[cluster_size]
+    steps = np.array([shape[1] * shape[2], shape[2], 1])
+
+    offsets = [np.dot(steps, (i, j, k))
+               for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1)
+               if abs(i) + abs(j) + abs(k) <= max_distance]
+
+    return np.array(offsets)
+
+
+def compute_reho_vectorized(in_file, mask_file, cluster_size,
+                            chunk_size=10000):
+
+    """
+    Computes the same ReHo map as :func:`compute_reho`, for all voxels at
+    once with array operations.
+
+    The tied ranks are computed once for the in-mask voxels, each voxel's
+    neighbourhood is gathered with a table of flat-index offsets, and
+    Kendall's coefficient of concordance is evaluated for ``chunk_size``
+    voxels at a time, which bounds the memory used.
+
+    Parameters
+    ----------
+
+    in_file : nifti file
+        4D EPI File
+
+    mask_file : nifti file
+        Mask of the EPI File(Only Compute ReHo of voxels in the mask)
+
+    cluster_size : integer
+        for a brain voxel the number of neighbouring brain voxels to use for
+        KCC.
+
+    chunk_size : integer
+        number of voxels ranked or evaluated at a time
+
+
+    Returns
+    -------
+
+    out_file : nifti file
+        ReHo map of the input EPI image
+
+    """
+
+    import os
+    import nibabel as nb
+    import numpy as np
+    from CPAC.reho.utils import reho_neighbourhood_offsets, tied_ranks
+
+    if cluster_size not in (7, 19, 27):
+        cluster_size = 27
+
+    res_img = nb.load(in_file)
+    res_mask_data = nb.load(mask_file).get_fdata()
+    (n_x, n_y, n_z, n_t) = res_img.shape
+
+    # voxels that can be neighbours, and their row in the ranks array
+    neighbours = res_mask_data.ravel() > 0
+    n_neighbours = int(neighbours.sum())
+    rank_index = np.full(n_x * n_y * n_z, n_neighbours, dtype=np.int64)
+    rank_index[neighbours] = np.arange(n_neighbours)
+
+    res_data = res_img.get_fdata().reshape(-1, n_t)[neighbours]
+    # last row stays zero, for neighbours outside the mask
+    ranks = np.zeros((n_neighbours + 1, n_t), dtype=np.int32)
+    for start in range(0, n_neighbours, chunk_size):
+        stop = min(start + chunk_size, n_neighbours)
+        ranks[start:stop] = tied_ranks(res_data[start:stop])
+    del res_data
+
+    # voxels to compute ReHo for: in the mask and not on the volume's edge
+    centers = res_mask_data.astype(int) != 0
+    edge = np.ones(centers.shape, dtype=bool)
+    edge[1:-1, 1:-1, 1:-1] = False
+    centers[edge] = False
+    centers = np.flatnonzero(centers)
+
+    offsets = reho_neighbourhood_offsets((n_x, n_y, n_z), cluster_size)
+
+    K = np.zeros(n_x * n_y * n_z)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for start in range(0, len(centers), chunk_size):
+            chunk = centers[start:start + chunk_size]
+            neighbourhood = rank_index[chunk[:, np.newaxis] + offsets]
+            k = (neighbourhood < n_neighbours).sum(axis=1)
+            sr = np.zeros((len(chunk), n_t), dtype=np.int64)
+            for column in neighbourhood.T:
+                sr += ranks[column]
+            s = np.sum(np.power(sr, 2.0), 1) - \
+                n_t * np.power(np.mean(sr, 1), 2)
+            K[chunk] = 12 * s / np.power(k, 2.0) / (np.power(n_t, 3.0) - n_t)
+
+    img = nb.Nifti1Image(K.reshape((n_x, n_y, n_z)), header=res_img.header,
+                         affine=res_img.affine)
+    reho_file = os.path.join(os.getcwd(), 'ReHo.nii.gz')
+    img.to_filename(reho_file)
+
+    return reho_file
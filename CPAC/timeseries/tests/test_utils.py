@@ -0,0 +1,92 @@
+import nibabel as nb
+import numpy as np
+import pytest
+from nilearn.connectome import ConnectivityMeasure
+from nilearn.input_data import NiftiLabelsMasker
+
+from CPAC.connectome.connectivity_matrix import compute_connectome_nilearn
+from CPAC.timeseries.timeseries_analysis import gen_roi_timeseries
+from CPAC.timeseries.utils import extract_roi_timeseries, roi_timeseries
+from CPAC.utils.ndmg_utils import ndmg_roi_timeseries
+
+
+@pytest.fixture
+def images(tmp_path):
+    rng = np.random.default_rng(0)
+    data = rng.standard_normal((8, 9, 7, 30)) * 3 + 100
+    data[0, 0, 0] = 100
+    labels = rng.integers(0, 6, data.shape[:3]).astype(np.float64)
+    labels[labels == 4] = 12
+    func_file = str(tmp_path / 'bold.nii.gz')
+    label_file = str(tmp_path / 'atlas.nii.gz')
+    nb.Nifti1Image(data, np.eye(4)).to_filename(func_file)
+    nb.Nifti1Image(labels, np.eye(4)).to_filename(label_file)
+    return data, labels, func_file, label_file
+
+
+@pytest.mark.parametrize('statistic, reduce', [('mean', np.mean),
+                                               ('median', np.median)])
+def test_roi_timeseries(images, statistic, reduce):
+    data, labels, _, _ = images
+    timeseries, rois = roi_timeseries(data, labels, statistic=statistic)
+    assert np.array_equal(rois, [1, 2, 3, 5, 12])
+    assert np.allclose(timeseries, [reduce(data[labels == roi], axis=0)
+                                    for roi in rois])
+
+    timeseries, rois = roi_timeseries(data, labels, rois=[12, 7, 1],
+                                      statistic=statistic)
+    assert np.allclose(timeseries[0], reduce(data[labels == 12], axis=0))
+    assert not timeseries[1].any()
+    assert np.allclose(timeseries[2], reduce(data[labels == 1], axis=0))
+
+
+def test_roi_timeseries_pc1(images):
+    data, labels, _, _ = images
+    timeseries, rois = roi_timeseries(data, labels, statistic='PC1')
+    for roi, component in zip(rois, timeseries):
+        roi_data = data[labels == roi]
+        roi_data = roi_data - roi_data.mean(axis=1, keepdims=True)
+        assert np.isclose(np.dot(component, component),
+                          np.linalg.eigvalsh(roi_data.T @ roi_data)[-1] /
+                          len(roi_data))
+
+
+def test_roi_timeseries_shape_mismatch(images):
+    data, labels, _, _ = images
+    with pytest.raises(IndexError):
+        roi_timeseries(data, labels[:-1])
+
+
+def test_call_sites(monkeypatch, tmp_path, images):
+    monkeypatch.chdir(tmp_path)
+    data, labels, func_file, label_file = images
+    timeseries, rois = extract_roi_timeseries(func_file, [label_file])[0]
+
+    oneD = np.genfromtxt(gen_roi_timeseries(func_file, label_file,
+                                            [True, True]),
+                         delimiter=',', names=True)
+    assert oneD.dtype.names == tuple(str(int(roi)) for roi in rois)
+    assert np.allclose(np.array(oneD.tolist()).T, timeseries, atol=1e-6)
+    assert (tmp_path / 'roi_atlas.csv').exists()
+    assert np.allclose(np.load(tmp_path / 'roi_atlas.npz')['roi_data'],
+                       timeseries, atol=1e-6)
+
+    roi_ts, ndmg_rois, _ = ndmg_roi_timeseries(func_file, label_file)
+    assert np.array_equal(ndmg_rois, rois)
+    voxels = (labels == 1) & (data.std(axis=-1) != 0)
+    assert np.allclose(roi_ts[0], data[voxels].mean(axis=0))
+
+
+@pytest.mark.parametrize('method, kind', [('Pearson', 'correlation'),
+                                          ('Partial', 'partial correlation')])
+def test_compute_connectome_nilearn(monkeypatch, tmp_path, images, method,
+                                    kind):
+    monkeypatch.chdir(tmp_path)
+    _, _, func_file, label_file = images
+    masker = NiftiLabelsMasker(labels_img=label_file, standardize=True)
+    expected = ConnectivityMeasure(kind=kind).fit_transform(
+        [masker.fit_transform(func_file)])[0]
+    np.fill_diagonal(expected, 1)
+    result = np.loadtxt(compute_connectome_nilearn(label_file, func_file,
+                                                   method, 'atlas'))
+    assert np.allclose(result, expected)
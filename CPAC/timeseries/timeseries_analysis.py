@@ -513,15 +513,15 @@ def gen_roi_timeseries(data_file, template, output_type):
         path to input roi mask in functional native space
     output_type : list
         list of two boolean values suggesting
-        the output types - numpy npz file and csv
+        the output types - csv and numpy npz file
         format
 
     Returns
     -------
-    out_list : list
-        list of 1D file, txt file, csv file and/or npz file containing
-        mean timeseries for each scan corresponding
-        to each node in roi mask
+    oneD_file : string
+        1D file containing mean timeseries for each scan corresponding
+        to each node in roi mask. A txt copy and the csv and/or npz files
+        selected by output_type are written alongside it.
 
     Raises
     ------
@@ -529,103 +529,37 @@ def gen_roi_timeseries(data_file, template, output_type):
 
     """
     import nibabel as nib
-    import csv
     import numpy as np
     import os
     import shutil
+    from CPAC.timeseries.utils import roi_timeseries, write_roi_timeseries
+    from CPAC.utils.data_cache import load_image_data
 
     unit_data = nib.load(template).get_fdata()
     # Cast as rounded-up integer
     unit_data = np.int64(np.ceil(unit_data))
-    datafile = nib.load(data_file)
-    img_data = datafile.get_fdata()
-    vol = img_data.shape[3]
+    img_data = load_image_data(data_file)
 
     if unit_data.shape != img_data.shape[:3]:
         raise Exception('\n\n[!] CPAC says: Invalid Shape Error.'
                         'Please check the voxel dimensions. '
                         'Data and roi should have the same shape.\n\n')
 
-    nodes = np.unique(unit_data).tolist()
-    sorted_list = []
-    node_dict = {}
-    out_list = []
-
     # extracting filename from input template
     tmp_file = os.path.splitext(
                     os.path.basename(template))[0]
     tmp_file = os.path.splitext(tmp_file)[0]
-    oneD_file = os.path.abspath('roi_' + tmp_file + '.1D')
-    txt_file = os.path.abspath('roi_' + tmp_file + '.txt')
-    csv_file = os.path.abspath('roi_' + tmp_file + '.csv')
-    numpy_file = os.path.abspath('roi_' + tmp_file + '.npz')
-
-    nodes.sort()
-    for n in nodes:
-        if n > 0:
-            node_array = img_data[unit_data == n]
-            node_str = 'node_{0}'.format(n)
-            avg = np.mean(node_array, axis=0)
-            avg = np.round(avg, 6)
-            list1 = [n] + avg.tolist()
-            sorted_list.append(list1)
-            node_dict[node_str] = avg.tolist()
-
-    # writing to 1Dfile
-    print("writing 1D file..")
-
-    f = open(oneD_file, 'w')
-    writer = csv.writer(f, delimiter=',')
-
-    value_list = []
-
-    new_keys = sorted([
-        int(float(key.split('node_')[1])) for key in node_dict
-    ])
-
-    roi_number_list = [str(n) for n in new_keys]
+    out_prefix = os.path.abspath('roi_' + tmp_file)
 
-    roi_number_str = []
-    for number in roi_number_list:
-        roi_number_str.append("#" + number)
+    unit_data[unit_data < 0] = 0
+    timeseries, nodes = roi_timeseries(img_data, unit_data)
 
-    for key in new_keys:
-        value_list.append(str('{0}\n'.format(node_dict['node_{0}'.format(key)])))
-
-    column_list = list(zip(*value_list))
-
-    writer.writerow(roi_number_str)
-
-    for column in column_list:
-        writer.writerow(list(column))
-    f.close()
-
-    out_list.append(oneD_file)
+    print("writing 1D file..")
+    oneD_file = write_roi_timeseries(timeseries, nodes, out_prefix,
+                                     output_type)[0]
 
     # copy the 1D contents to txt file
-    shutil.copy(oneD_file, txt_file)
-    out_list.append(txt_file)
-
-    # if csv is required
-    '''
-    if output_type[0]:
-        print("writing csv file..")
-        f = open(csv_file, 'wt')
-        writer = csv.writer(f, delimiter=',', quoting=csv.QUOTE_MINIMAL)
-        headers = ['node/volume'] + np.arange(vol).tolist()
-        writer.writerow(headers)
-        writer.writerows(sorted_list)
-        f.close()
-        out_list.append(csv_file)
-
-    # if npz file is required
-    if output_type[1]:
-        print("writing npz file..")
-        np.savez(numpy_file, roi_data=value_list, roi_numbers=roi_number_list)
-        out_list.append(numpy_file)
-
-    return out_list
-    '''
+    shutil.copy(oneD_file, out_prefix + '.txt')
 
     return oneD_file
 
@@ -665,11 +599,12 @@ def gen_voxel_timeseries(data_file, template):
     import numpy as np
     import csv
     import os
+    from CPAC.utils.data_cache import load_image_data
 
     unit = nib.load(template)
     unit_data = unit.get_fdata()
     datafile = nib.load(data_file)
-    img_data = datafile.get_fdata()
+    img_data = load_image_data(data_file)
     header_data = datafile.header
     qform = header_data.get_qform()
     sorted_list = []
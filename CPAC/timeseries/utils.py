@@ -0,0 +1,230 @@
+# Copyright (C) 2024  C-PAC Developers
+
+# This file is part of C-PAC.
+
+# C-PAC is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+
+# C-PAC is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+# License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with C-PAC. If not, see <https://www.gnu.org/licenses/>.
+"""Label-indexed ROI timeseries extraction shared by the timeseries,
+connectome and ndmg code"""
+import csv
+import os
+
+import nibabel as nb
+import numpy as np
+from scipy import sparse
+
+from CPAC.utils.data_cache import load_image_data
+
+ROI_STATISTICS = ('mean', 'median', 'PC1')
+
+
+def label_index(labels, rois=None):
+    """Flatten a label volume once into a label × voxel indicator matrix.
+
+    Parameters
+    ----------
+    labels : numpy.ndarray
+        Label volume. Voxels labelled 0 are background.
+
+    rois : array_like, optional
+        Labels to index, in order. Defaults to the sorted nonzero labels.
+
+    Returns
+    -------
+    rois : numpy.ndarray
+        Label values.
+
+    indicator : scipy.sparse.csr_matrix
+        rois × voxels matrix with a 1 for every voxel of each ROI.
+    """
+    labels = np.asarray(labels).ravel()
+    if rois is None:
+        voxels = np.flatnonzero(labels)
+        rois, rows = np.unique(labels[voxels], return_inverse=True)
+    else:
+        rois = np.asarray(rois)
+        order = np.argsort(rois, kind='stable')
+        position = np.minimum(np.searchsorted(rois[order], labels),
+                              len(rois) - 1)
+        voxels = np.flatnonzero(rois[order][position] == labels)
+        rows = order[position[voxels]]
+    indicator = sparse.csr_matrix(
+        (np.ones(len(voxels)), (rows, voxels)),
+        shape=(len(rois), labels.size))
+    return rois, indicator
+
+
+def roi_timeseries(data, labels, rois=None, statistic='mean',
+                   exclude_constant=False):
+    """Timeseries of every ROI of a label volume in a single pass.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        4D functional data, or voxels × timepoints data already flattened
+        in the order of ``labels``.
+
+    labels : numpy.ndarray
+        Label volume on the same grid as ``data``.
+
+    rois : array_like, optional
+        Labels to extract, in order. Defaults to the sorted nonzero labels.
+
+    statistic : str
+        'mean', 'median' or 'PC1' (the first principal component of the
+        demeaned voxel timeseries, scaled to the variance it explains and
+        signed to agree with the mean timeseries).
+
+    exclude_constant : bool
+        Leave out voxels with no variance over time.
+
+    Returns
+    -------
+    timeseries : numpy.ndarray
+        rois × timepoints array. ROIs without any voxels are all zeros.
+
+    rois : numpy.ndarray
+        Label values of the rows of ``timeseries``.
+    """
+    if statistic not in ROI_STATISTICS:
+        raise ValueError(f'Unknown ROI statistic "{statistic}", expected '
+                         f'one of {ROI_STATISTICS}.')
+    labels = np.asarray(labels)
+    if (data.shape[:-1] if data.ndim > 2 else data.shape[:1]) != \
+            (labels.shape if data.ndim > 2 else (labels.size,)):
+        raise IndexError('\n[!] Error: functional data and ROI mask may not '
+                         'be in the same space or be the same size.\n'
+                         f'Details: {data.shape[:-1]} != {labels.shape}')
+    data = data.reshape(-1, data.shape[-1])
+    labels = labels.ravel()
+    if exclude_constant:
+        labels = np.where(data.std(axis=1) != 0, labels, 0)
+    rois, indicator = label_index(labels, rois)
+    counts = np.asarray(indicator.sum(axis=1)).ravel()
+    means = np.zeros((len(rois), data.shape[1]))
+    np.divide(indicator @ data, counts[:, np.newaxis], out=means,
+              where=counts[:, np.newaxis] > 0)
+    if statistic == 'mean':
+        return means, rois
+
+    timeseries = np.zeros_like(means)
+    for roi, voxels in enumerate(np.split(indicator.indices,
+                                          indicator.indptr[1:-1])):
+        if not len(voxels):
+            continue
+        roi_data = data[voxels]
+        if statistic == 'median':
+            timeseries[roi] = np.median(roi_data, axis=0)
+            continue
+        roi_data = roi_data - roi_data.mean(axis=1, keepdims=True)
+        _, singular_values, components = np.linalg.svd(roi_data,
+                                                       full_matrices=False)
+        component = components[0] * singular_values[0] / \
+            np.sqrt(len(voxels))
+        if np.dot(component, means[roi]) < 0:
+            component = -component
+        timeseries[roi] = component
+    return timeseries, rois
+
+
+def extract_roi_timeseries(func_file, label_files, statistic='mean',
+                           exclude_constant=False):
+    """Load a functional image once and extract the ROI timeseries of
+    several label images from it.
+
+    Parameters
+    ----------
+    func_file : str
+        Path to the 4D functional image.
+
+    label_files : str or list of str
+        Path(s) to label images. Label images on another grid than
+        ``func_file`` are resampled to it with nearest-neighbour
+        interpolation.
+
+    statistic, exclude_constant
+        See :func:`roi_timeseries`.
+
+    Returns
+    -------
+    list of tuple
+        ``(timeseries, rois)`` for each of ``label_files``.
+    """
+    if isinstance(label_files, str):
+        label_files = [label_files]
+    func_img = nb.load(func_file)
+    data = load_image_data(func_file)
+    timeseries = []
+    for label_file in label_files:
+        label_img = nb.load(label_file)
+        if label_img.shape[:3] != data.shape[:3] or \
+                not np.allclose(label_img.affine, func_img.affine):
+            from nilearn.image import resample_to_img
+            label_img = resample_to_img(label_img, func_img,
+                                        interpolation='nearest')
+        timeseries.append(roi_timeseries(
+            data, label_img.get_fdata(), statistic=statistic,
+            exclude_constant=exclude_constant))
+    return timeseries
+
+
+def write_roi_timeseries(timeseries, rois, out_prefix, output_type=None):
+    """Write ROI timeseries as an AFNI-compatible 1D file and, optionally,
+    CSV and NPZ files.
+
+    Parameters
+    ----------
+    timeseries : numpy.ndarray
+        rois × timepoints array.
+
+    rois : array_like
+        Label value of each row of ``timeseries``.
+
+    out_prefix : str
+        Path of the outputs without extension.
+
+    output_type : list of bool, optional
+        Whether to also write the CSV and NPZ files.
+
+    Returns
+    -------
+    list of str
+        Paths to the 1D file and any CSV and NPZ files, in that order.
+    """
+    roi_numbers = [str(roi) for roi in rois]
+    oneD_file = f'{out_prefix}.1D'
+    with open(oneD_file, 'w') as f:
+        writer = csv.writer(f, delimiter=',')
+        writer.writerow([f'#{roi}' for roi in roi_numbers])
+        writer.writerows(np.round(timeseries, 6).T.tolist())
+    out_list = [oneD_file]
+
+    csv_out, npz_out = output_type or (False, False)
+    if csv_out:
+        csv_file = f'{out_prefix}.csv'
+        with open(csv_file, 'w') as f:
+            writer = csv.writer(f, delimiter=',',
+                                quoting=csv.QUOTE_MINIMAL)
+            writer.writerow(['node/volume'] +
+                            list(range(timeseries.shape[1])))
+            writer.writerows([[roi] + row for roi, row in zip(
+                roi_numbers, np.round(timeseries, 6).tolist())])
+        out_list.append(csv_file)
+
+    if npz_out:
+        npz_file = f'{out_prefix}.npz'
+        np.savez(npz_file, roi_data=np.round(timeseries, 6),
+                 roi_numbers=roi_numbers)
+        out_list.append(npz_file)
+
+    return [os.path.abspath(out) for out in out_list]
@@ -0,0 +1,396 @@
+# Copyright (C) 2024  C-PAC Developers
+
+# This file is part of C-PAC.
+
+# C-PAC is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+
+# C-PAC is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+# License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with C-PAC. If not, see <https://www.gnu.org/licenses/>.
+"""Persistent index of the images and JSON sidecars of a local BIDS dataset.
+
+The dataset is scanned one directory level at a time, listing the
+directories of each level concurrently (directory listings dominate on
+network storage). Only the files ``collect_bids_files_configs`` looks for
+are kept, each with its participant, and sidecars are only ``stat``-ed.
+The index is kept in an SQLite database keyed by path, with each
+sidecar's modification time and size; a sidecar's contents are read (and
+stored in the index) only when they're first needed, and read again only
+if the file changed. Later scans of the same dataset only insert, update
+or delete the entries that changed.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from collections.abc import Mapping
+import hashlib
+import json
+import os
+import sqlite3
+
+INDEX_VERSION = 1
+"""Version of the index's tables; indices of other versions are rebuilt"""
+SUFFIXES = ['T1w', 'T2w', 'bold', 'epi', 'phasediff', 'phase1', 'phase2',
+            'magnitude', 'magnitude1', 'magnitude2']
+"""Suffixes of the files C-PAC ingresses from BIDS"""
+
+
+def bids_file_kind(filename):
+    """Whether a filename is an image (``'nifti'``) or a JSON sidecar
+    (``'sidecar'``) C-PAC ingresses, as matched by
+    ``collect_bids_files_configs``
+
+    Parameters
+    ----------
+    filename : str
+
+    Returns
+    -------
+    str or None
+
+    Examples
+    --------
+    >>> bids_file_kind('sub-1_task-rest_bold.nii.gz')
+    'nifti'
+    >>> bids_file_kind('task-rest_bold.json')
+    'sidecar'
+    >>> bids_file_kind('sub-1_dir-AP_epi.nii.gz') is None
+    True
+    >>> bids_file_kind('sub-1_acq-fMRI_dir-AP_epi.json')
+    'sidecar'
+    >>> bids_file_kind('sub-1_scans.tsv') is None
+    True
+    """
+    for suffix in SUFFIXES:
+        if suffix == 'epi' and 'acq-fMRI' not in filename:
+            continue
+        if suffix in filename:
+            if 'nii' in filename:
+                return 'nifti'
+            if filename.endswith('json'):
+                return 'sidecar'
+    return None
+
+
+def participant_of(path):
+    """Participant label of a dataset path, if any
+
+    Parameters
+    ----------
+    path : str
+        relative to the dataset
+
+    Returns
+    -------
+    str or None
+
+    Examples
+    --------
+    >>> participant_of('site-1/sub-0001/ses-1/anat/sub-0001_ses-1_T1w.nii.gz')
+    '0001'
+    >>> participant_of('task-rest_bold.json') is None
+    True
+    """
+    for part in path.split('/'):
+        for entity in part.split('.')[0].split('_'):
+            if entity.startswith('sub-'):
+                return entity[4:]
+    return None
+
+
+def default_index_path(bids_dir):
+    """Default location of a dataset's index, in the user's cache
+    directory
+
+    Parameters
+    ----------
+    bids_dir : str
+
+    Returns
+    -------
+    str
+    """
+    cache_dir = os.environ.get('XDG_CACHE_HOME',
+                               os.path.join(os.path.expanduser('~'), '.cache'))
+    digest = hashlib.sha1(
+        os.path.realpath(bids_dir).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, 'C-PAC', 'bids_index', f'{digest}.sqlite')
+
+
+def _list_directory(directory):
+    """Subdirectories and ingressed files of one directory
+
+    Returns
+    -------
+    subdirectories : list of str
+
+    files : list of tuple
+        (name, kind, modification time in ns, size); time and size are
+        only read for sidecars
+    """
+    subdirectories = []
+    files = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=True):
+                subdirectories.append(entry.name)
+                continue
+            kind = bids_file_kind(entry.name)
+            if kind == 'sidecar':
+                try:
+                    stat = entry.stat(follow_symlinks=True)
+                except OSError:
+                    continue
+                files.append((entry.name, kind, stat.st_mtime_ns,
+                              stat.st_size))
+            elif kind is not None:
+                files.append((entry.name, kind, None, None))
+    return subdirectories, files
+
+
+def _read_sidecar(path):
+    with open(path, 'r', encoding='utf-8') as _f:
+        try:
+            return _f.read()
+        except UnicodeDecodeError as decode_error:
+            raise Exception(f'Could not decode {path}') from decode_error
+
+
+class Sidecars(Mapping):
+    """Read-only mapping of sidecar paths (relative to the dataset) to
+    their contents, read when first accessed
+
+    The first access reads every sidecar of the mapping that isn't in the
+    index yet, concurrently, and stores them in the index.
+    """
+    def __init__(self, index, paths):
+        self._index = index
+        self._paths = list(paths)
+        self._path_set = set(self._paths)
+        self._loaded = {}
+
+    def __getitem__(self, path):
+        if path not in self._loaded:
+            if path not in self._path_set:
+                raise KeyError(path)
+            self._loaded.update(self._index.load_sidecars(
+                [path for path in self._paths if path not in self._loaded]))
+        return self._loaded[path]
+
+    def __iter__(self):
+        return iter(self._paths)
+
+    def __len__(self):
+        return len(self._paths)
+
+    def for_participants(self, participants):
+        """The sidecars that apply to some participants' images
+
+        Parameters
+        ----------
+        participants : iterable of str
+            participant labels
+
+        Returns
+        -------
+        Sidecars
+        """
+        return self._index.sidecars(participants)
+
+
+class BIDSIndex:
+    """Index of a local BIDS dataset's images and JSON sidecars
+
+    Parameters
+    ----------
+    bids_dir : str
+
+    index_path : str, optional
+        SQLite database of the index (defaults to
+        :func:`default_index_path`); if it can't be written, the index
+        is kept in memory for this run only
+
+    n_threads : int
+        directories listed (and sidecars read) concurrently
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> bids_dir = tempfile.mkdtemp()
+    >>> os.makedirs(os.path.join(bids_dir, 'sub-1', 'func'))
+    >>> for name in ['sub-1/func/sub-1_task-rest_bold.nii.gz',
+    ...              'sub-1/func/sub-1_task-rest_events.tsv']:
+    ...     open(os.path.join(bids_dir, name), 'w').close()
+    >>> with open(os.path.join(bids_dir, 'task-rest_bold.json'), 'w') as _f:
+    ...     _ = _f.write('{"RepetitionTime": 2.0}')
+    >>> index = BIDSIndex(bids_dir, os.path.join(bids_dir, 'index.sqlite'))
+    >>> index.scan()
+    {'added': 2, 'updated': 0, 'removed': 0}
+    >>> index.images()
+    ['sub-1/func/sub-1_task-rest_bold.nii.gz']
+    >>> dict(index.sidecars())
+    {'task-rest_bold.json': {'RepetitionTime': 2.0}}
+    >>> BIDSIndex(bids_dir, os.path.join(bids_dir, 'index.sqlite')).scan()
+    {'added': 0, 'updated': 0, 'removed': 0}
+    """
+    def __init__(self, bids_dir, index_path=None, n_threads=16):
+        self.bids_dir = bids_dir.rstrip('/') or '/'
+        self.n_threads = max(int(n_threads), 1)
+        if index_path is None:
+            index_path = default_index_path(bids_dir)
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(index_path)),
+                        exist_ok=True)
+            self.connection = sqlite3.connect(index_path)
+            self._create_tables()
+        except (OSError, sqlite3.Error):
+            self.connection = sqlite3.connect(':memory:')
+            self._create_tables()
+
+    def _create_tables(self):
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS meta ('
+                                    'key TEXT PRIMARY KEY, value TEXT)')
+            version = self.connection.execute(
+                "SELECT value FROM meta WHERE key = 'version'").fetchone()
+            if version is None or int(version[0]) != INDEX_VERSION:
+                self.connection.execute('DROP TABLE IF EXISTS files')
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('version', ?)",
+                    (str(INDEX_VERSION),))
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS files ('
+                'path TEXT PRIMARY KEY, kind TEXT NOT NULL, participant TEXT,'
+                ' mtime_ns INTEGER, size INTEGER, contents TEXT)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS '
+                                    'files_participant ON files (participant)')
+
+    def scan(self):
+        """List the dataset and update the index with what changed
+
+        Returns
+        -------
+        dict
+            number of ``added``, ``updated`` and ``removed`` entries
+        """
+        found = {}
+        pending = [('', self.bids_dir)]
+        visited = set()
+        with ThreadPoolExecutor(max_workers=self.n_threads) as executor:
+            while pending:
+                level = []
+                for relative, directory in pending:
+                    # followed symlinks can loop
+                    real = os.path.realpath(directory)
+                    if real not in visited:
+                        visited.add(real)
+                        level.append((relative, directory))
+                pending = []
+                for (relative, directory), (subdirectories, files) in zip(
+                        level, executor.map(_list_directory,
+                                            [directory for _, directory
+                                             in level])):
+                    for name in subdirectories:
+                        pending.append((f'{relative}{name}/',
+                                        os.path.join(directory, name)))
+                    for name, kind, mtime_ns, size in files:
+                        found[f'{relative}{name}'] = (kind, mtime_ns, size)
+        indexed = {path: (kind, mtime_ns, size) for path, kind, mtime_ns,
+                   size in self.connection.execute(
+                       'SELECT path, kind, mtime_ns, size FROM files')}
+        removed = [(path,) for path in indexed if path not in found]
+        added = [(path, kind, participant_of(path), mtime_ns, size) for
+                 path, (kind, mtime_ns, size) in found.items()
+                 if path not in indexed]
+        updated = [(kind, mtime_ns, size, path) for
+                   path, (kind, mtime_ns, size) in found.items()
+                   if path in indexed and indexed[path] != (kind, mtime_ns,
+                                                            size)]
+        with self.connection:
+            self.connection.executemany('DELETE FROM files WHERE path = ?',
+                                        removed)
+            self.connection.executemany(
+                'INSERT INTO files (path, kind, participant, mtime_ns, size) '
+                'VALUES (?, ?, ?, ?, ?)', added)
+            # changed sidecars are read again when next needed
+            self.connection.executemany(
+                'UPDATE files SET kind = ?, mtime_ns = ?, size = ?, '
+                'contents = NULL WHERE path = ?', updated)
+        return {'added': len(added), 'updated': len(updated),
+                'removed': len(removed)}
+
+    def _paths(self, kind, participants=None):
+        query = 'SELECT path FROM files WHERE kind = ?'
+        if participants is None:
+            rows = self.connection.execute(f'{query} ORDER BY path', (kind,))
+            return [path for path, in rows]
+        participants = sorted(participants)
+        rows = self.connection.execute(
+            f'{query} AND (participant IS NULL OR participant IN '
+            f'({", ".join("?" * len(participants))})) ORDER BY path',
+            (kind, *participants))
+        return [path for path, in rows]
+
+    def images(self):
+        """Relative paths of the dataset's images
+
+        Returns
+        -------
+        list of str
+        """
+        return self._paths('nifti')
+
+    def sidecars(self, participants=None):
+        """Sidecars that apply to some participants' images
+
+        Parameters
+        ----------
+        participants : iterable of str, optional
+            participant labels; sidecars of the whole dataset (outside
+            the participants' directories) are always included; defaults
+            to all participants
+
+        Returns
+        -------
+        Sidecars
+        """
+        return Sidecars(self, self._paths('sidecar', participants))
+
+    def load_sidecars(self, paths):
+        """Contents of sidecars, read from the dataset if they're not in
+        the index (and stored in it)
+
+        Parameters
+        ----------
+        paths : list of str
+
+        Returns
+        -------
+        dict
+        """
+        contents = {}
+        for first in range(0, len(paths), 500):
+            batch = paths[first:first + 500]
+            contents.update(self.connection.execute(
+                'SELECT path, contents FROM files WHERE contents IS NOT NULL '
+                f'AND path IN ({", ".join("?" * len(batch))})', batch))
+        unread = [path for path in paths if path not in contents]
+        with ThreadPoolExecutor(max_workers=self.n_threads) as executor:
+            read = list(executor.map(
+                _read_sidecar, [os.path.join(self.bids_dir, path)
+                                for path in unread]))
+        with self.connection:
+            self.connection.executemany(
+                'UPDATE files SET contents = ? WHERE path = ?',
+                zip(read, unread))
+        contents.update(zip(unread, read))
+        return {path: json.loads(contents[path]) for path in paths}
+
+    def close(self):
+        """Close the index's database"""
+        self.connection.close()
@@ -22,6 +22,10 @@ from warnings import warn
 
 import yaml
 
+from CPAC.utils.bids_index import BIDSIndex, Sidecars, participant_of
+from CPAC.utils.s3_listing import fetch_s3_json, list_s3_objects
+from CPAC.utils.s3_prefetch import s3_client
+
 
 def bids_decode_fname(file_path, dbg=False, raise_error=True):
     f_dict = {}
@@ -732,11 +736,19 @@ def bids_gen_cpac_sublist(bids_dir, paths_list, config_dict, creds_path,
     return sublist
 
 
-def collect_bids_files_configs(bids_dir, aws_input_creds=''):
+def collect_bids_files_configs(bids_dir, aws_input_creds='',
+                               index_path=None, n_threads=16):
     """
     :param bids_dir:
     :param aws_input_creds:
-    :return:
+    :param index_path: SQLite index of a local ``bids_dir`` (see
+      :class:`CPAC.utils.bids_index.BIDSIndex`); only what changed since
+      the index was last updated is scanned again
+    :param n_threads: concurrent listings and sidecar requests of an S3
+      ``bids_dir`` (see :mod:`CPAC.utils.s3_listing`)
+    :return: relative paths of the images, and a mapping of the JSON
+      sidecars' relative paths to their contents (for a local
+      ``bids_dir``, read when first accessed)
     """
 
     file_paths = []
@@ -756,51 +768,34 @@ def collect_bids_files_configs(bids_dir, aws_input_creds=''):
                 raise IOError("Could not find aws_input_creds (%s)" %
                               (aws_input_creds))
 
-        from indi_aws import fetch_creds
-        bucket = fetch_creds.return_bucket(aws_input_creds, bucket_name)
+        client = s3_client(aws_input_creds, n_threads)
 
-        print(f"gathering files from S3 bucket ({bucket}) for {prefix}")
+        print(f"gathering files from S3 bucket ({bucket_name}) for {prefix}")
 
-        for s3_obj in bucket.objects.filter(Prefix=prefix):
+        sidecars = {}
+        for s3_obj in list_s3_objects(client, bucket_name, prefix,
+                                      n_threads):
             for suf in suffixes:
-                if suf in str(s3_obj.key):
-                    if suf == 'epi' and 'acq-fMRI' not in s3_obj.key:
+                if suf in s3_obj['Key']:
+                    if suf == 'epi' and 'acq-fMRI' not in s3_obj['Key']:
                         continue
-                    if str(s3_obj.key).endswith("json"):
-                        try:
-                            config_dict[s3_obj.key.replace(prefix, "")
-                                        .lstrip('/')] = json.loads(
-                                            s3_obj.get()["Body"].read())
-                        except Exception as e:
-                            print("Error retrieving %s (%s)" %
-                                  (s3_obj.key.replace(prefix, ""),
-                                  e.message))
-                            raise
-                    elif 'nii' in str(s3_obj.key):
-                        file_paths.append(str(s3_obj.key)
-                                          .replace(prefix,'').lstrip('/'))
+                    if s3_obj['Key'].endswith("json"):
+                        sidecars[s3_obj['Key']] = s3_obj
+                    elif 'nii' in s3_obj['Key']:
+                        file_paths.append(s3_obj['Key']
+                                          .replace(prefix, '').lstrip('/'))
+
+        # fetch the sidecars concurrently (unless cached)
+        for key, contents in fetch_s3_json(client, bucket_name,
+                                           list(sidecars.values()),
+                                           n_threads).items():
+            config_dict[key.replace(prefix, "").lstrip('/')] = contents
 
     else:
-        for root, dirs, files in os.walk(bids_dir, topdown=False, followlinks=True):
-            if files:
-                for f in files:
-                    for suf in suffixes:
-                        if suf == 'epi' and 'acq-fMRI' not in f:
-                            continue
-                        if 'nii' in f and suf in f:
-                            file_paths += [os.path.join(root, f)
-                                           .replace(bids_dir, '').lstrip('/')]
-                        if f.endswith('json') and suf in f:
-                            try:
-                                config_dict.update(
-                                    {os.path.join(root.replace(bids_dir, '')
-                                     .lstrip('/'), f):
-                                         json.load(
-                                             open(os.path.join(root, f), 'r')
-                                         )})
-                            except UnicodeDecodeError:
-                                raise Exception("Could not decode {0}".format(
-                                    os.path.join(root, f)))
+        index = BIDSIndex(bids_dir, index_path)
+        index.scan()
+        file_paths = index.images()
+        config_dict = index.sidecars()
 
     if not file_paths and not config_dict:
         raise IOError("Didn't find any files in {0}. Please verify that the "
@@ -1015,6 +1010,10 @@ def create_cpac_data_config(bids_dir, participant_labels=None,
                 for participant_label in participant_labels
             )
         ]
+        if isinstance(config, Sidecars):
+            # only read the sidecars of the selected participants
+            config = config.for_participants(
+                {participant_of(file_path) for file_path in file_paths})
 
     if not file_paths:
         print("Did not find data for {0}".format(
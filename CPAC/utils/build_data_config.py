@@ -27,12 +27,18 @@ def gather_file_paths(base_directory, verbose=False):
     return path_list
 
 
-def pull_s3_sublist(data_folder, creds_path=None, keep_prefix=True):
+def pull_s3_sublist(data_folder, creds_path=None, keep_prefix=True,
+                    n_threads=16):
     """Return a list of input data file paths that are available on an AWS S3
-    bucket on the cloud."""
+    bucket on the cloud.
+
+    The prefix's "subdirectories" are listed concurrently (see
+    :func:`CPAC.utils.s3_listing.list_s3_objects`); the paths are in the
+    order of a single listing."""
 
     import os
-    from indi_aws import fetch_creds
+    from CPAC.utils.s3_listing import list_s3_objects
+    from CPAC.utils.s3_prefetch import s3_client
 
     if creds_path:
         creds_path = os.path.abspath(creds_path)
@@ -44,7 +50,6 @@ def pull_s3_sublist(data_folder, creds_path=None, keep_prefix=True):
     print("Pulling from {0} ...".format(data_folder))
 
     s3_list = []
-    bucket = fetch_creds.return_bucket(creds_path, bucket_name)
 
     # ensure slash at end of bucket_prefix, so that if the final
     # directory name is a substring in other directory names, these
@@ -53,12 +58,13 @@ def pull_s3_sublist(data_folder, creds_path=None, keep_prefix=True):
         bucket_prefix += "/"
 
     # Build S3-subjects to download
-    for bk in bucket.objects.filter(Prefix=bucket_prefix):
+    for s3_obj in list_s3_objects(s3_client(creds_path, n_threads),
+                                  bucket_name, bucket_prefix, n_threads):
         if keep_prefix:
-            fullpath = os.path.join("s3://", bucket_name, str(bk.key))
+            fullpath = os.path.join("s3://", bucket_name, s3_obj['Key'])
             s3_list.append(fullpath)
         else:
-            s3_list.append(str(bk.key).replace(bucket_prefix, ""))
+            s3_list.append(s3_obj['Key'].replace(bucket_prefix, ""))
 
     print("Finished pulling from S3. " \
           "{0} file paths found.".format(len(s3_list)))
@@ -198,48 +204,6 @@ def download_single_s3_path(s3_path, download_dir=None, creds_path=None,
     return local_dl
 
 
-def pull_s3_sublist(data_folder, creds_path=None, keep_prefix=True):
-
-    import os
-    from indi_aws import fetch_creds
-
-    if creds_path:
-        creds_path = os.path.abspath(creds_path)
-
-    s3_path = data_folder.split("s3://")[1]
-    bucket_name = s3_path.split("/")[0]
-    bucket_prefix = s3_path.split(bucket_name + "/")[1]
-
-    print("Pulling from {0} ...".format(data_folder))
-
-    s3_list = []
-    bucket = fetch_creds.return_bucket(creds_path, bucket_name)
-
-    # ensure slash at end of bucket_prefix, so that if the final
-    # directory name is a substring in other directory names, these
-    # other directories will not be pulled into the file list
-    if "/" not in bucket_prefix[-1]:
-        bucket_prefix += "/"
-
-    # Build S3-subjects to download
-    for bk in bucket.objects.filter(Prefix=bucket_prefix):
-        if keep_prefix:
-            fullpath = os.path.join("s3://", bucket_name, str(bk.key))
-            s3_list.append(fullpath)
-        else:
-            s3_list.append(str(bk.key).replace(bucket_prefix, ""))
-
-    print("Finished pulling from S3. " \
-          "{0} file paths found.".format(len(s3_list)))
-
-    if not s3_list:
-        err = "\n\n[!] No input data found matching your data settings in " \
-              "the AWS S3 bucket provided:\n{0}\n\n".format(data_folder)
-        raise Exception(err)
-
-    return s3_list
-
-
 def generate_group_analysis_files(data_config_outdir, data_config_name):
     """Create the group-level analysis inclusion list.
     """
@@ -16,6 +16,8 @@ License for more details.
 
 You should have received a copy of the GNU Lesser General Public
 License along with C-PAC. If not, see <https://www.gnu.org/licenses/>."""
+import hashlib
+import json
 import os
 import re
 from typing import Optional
@@ -200,6 +202,11 @@ class Configuration:
         else:
             self.key_type_error(key)
 
+    def __setattr__(self, name, value):
+        # any change invalidates the cached fingerprint
+        self.__dict__.pop('_fingerprint', None)
+        super().__setattr__(name, value)
+
     def __setitem__(self, key, value):
         if isinstance(key, str):
             setattr(self, key, value)
@@ -246,7 +253,41 @@ class Configuration:
 
     def dict(self):
         '''Show contents of a C-PAC configuration as a dict'''
-        return {k: v for k, v in self.__dict__.items() if not callable(v)}
+        return {k: v for k, v in self.__dict__.items() if not callable(v)
+                and k != '_fingerprint'}
+
+    def fingerprint(self) -> str:
+        '''SHA-1 hash of the canonical (key-sorted) JSON of this
+        configuration, computed once and cached until the configuration
+        is changed through attribute or item assignment.
+
+        Nested values changed in place (e.g.,
+        ``c.pipeline_setup['pipeline_name'] = 'name'``) can't be
+        detected; set nested keys with a tuple of keys
+        (``c['pipeline_setup', 'pipeline_name'] = 'name'``) instead.
+
+        Returns
+        -------
+        str
+
+        Examples
+        --------
+        >>> c = Configuration({})
+        >>> c.fingerprint() == hashlib.sha1(json.dumps(
+        ...     c.dict(), sort_keys=True).encode('utf-8')).hexdigest()
+        True
+        >>> fingerprint = c.fingerprint()
+        >>> c['pipeline_setup', 'pipeline_name'] = 'new_pipeline'
+        >>> c.fingerprint() == fingerprint
+        False
+        >>> c['pipeline_setup', 'pipeline_name'] = 'cpac-blank-template'
+        >>> c.fingerprint() == fingerprint
+        True
+        '''
+        if '_fingerprint' not in self.__dict__:
+            self.__dict__['_fingerprint'] = hashlib.sha1(json.dumps(
+                self.dict(), sort_keys=True).encode('utf-8')).hexdigest()
+        return self.__dict__['_fingerprint']
 
     def keys(self):
         '''Show toplevel keys of a C-PAC configuration dict'''
@@ -0,0 +1,215 @@
+# Copyright (C) 2024  C-PAC Developers
+
+# This file is part of C-PAC.
+
+# C-PAC is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+
+# C-PAC is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+# License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with C-PAC. If not, see <https://www.gnu.org/licenses/>.
+"""Per-participant cache of decompressed image data.
+
+When enabled (``pipeline_setup: working_directory: data_cache: run``),
+the first Python-function node to load an image through
+:func:`load_image_data` converts it to an uncompressed float32 ``.npy``
+file in the participant's working directory, keyed by a hash of the
+image file, and every later load of the same image memory-maps that file
+instead of decompressing the image again. Cache hits, misses and
+evictions are recorded in the callback log.
+
+The cache is configured through environment variables so that it reaches
+the node functions in every worker process.
+"""
+import fcntl
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+from datetime import datetime
+
+import nibabel as nb
+import numpy as np
+
+from CPAC.utils.monitoring.custom_logging import getLogger
+
+DATA_CACHE_DIR = 'CPAC_DATA_CACHE_DIR'
+DATA_CACHE_BUDGET = 'CPAC_DATA_CACHE_DISK_BUDGET_GB'
+
+
+def set_up_data_cache(cache_dir=None, disk_budget_gb=None):
+    """Enable the data cache for this process and the node processes it
+    starts, or disable it if ``cache_dir`` is None
+
+    Parameters
+    ----------
+    cache_dir : str or None
+
+    disk_budget_gb : float
+        maximum size of the cached arrays
+    """
+    if cache_dir is None:
+        os.environ.pop(DATA_CACHE_DIR, None)
+        os.environ.pop(DATA_CACHE_BUDGET, None)
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ[DATA_CACHE_DIR] = os.path.abspath(cache_dir)
+    os.environ[DATA_CACHE_BUDGET] = str(disk_budget_gb)
+
+
+def file_hash(path, chunk_size=2 ** 24):
+    """SHA-1 hash of a file's contents"""
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class DataCache:
+    """Memory-mapped float32 copies of images, evicted least recently used
+    first to stay within a disk budget
+
+    Parameters
+    ----------
+    cache_dir : str
+
+    disk_budget_gb : float
+    """
+    def __init__(self, cache_dir, disk_budget_gb):
+        self.cache_dir = cache_dir
+        self.disk_budget = float(disk_budget_gb) * 1024 ** 3
+
+    def __repr__(self):
+        return (f'DataCache({self.cache_dir!r}, '
+                f'{self.disk_budget / 1024 ** 3})')
+
+    @contextmanager
+    def _lock(self, name):
+        with open(os.path.join(self.cache_dir, f'.{name}.lock'), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _log(self, event, in_file, key, nbytes):
+        getLogger('callback').debug(json.dumps({
+            'data_cache': event,
+            'in_file': in_file,
+            'key': key,
+            'size_gb': nbytes / 1024 ** 3,
+            'time': datetime.now().isoformat(),
+        }))
+
+    def entries(self):
+        """Cached arrays, least recently used first
+
+        Returns
+        -------
+        list of (str, int)
+            path and size in bytes of each cached array
+        """
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.npy'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, entry.path, stat.st_size))
+        return [(path, size) for _, path, size in sorted(entries)]
+
+    def _evict(self, nbytes):
+        """Remove least recently used arrays until ``nbytes`` more fit in
+        the disk budget. Arrays already memory-mapped by a node stay
+        readable until that node closes them."""
+        entries = self.entries()
+        total = sum(size for _, size in entries)
+        for path, size in entries:
+            if total + nbytes <= self.disk_budget:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            total -= size
+            self._log('evict', None, os.path.basename(path)[:-4], size)
+
+    def load(self, in_file):
+        """Load the data of an image, from the cache if possible
+
+        Parameters
+        ----------
+        in_file : str
+            path to an image
+
+        Returns
+        -------
+        numpy.ndarray
+            read-only float32 memory map of the image data, or an
+            in-memory float32 array if the image does not fit in the
+            disk budget
+        """
+        key = file_hash(in_file)
+        path = os.path.join(self.cache_dir, f'{key}.npy')
+        with self._lock(key):
+            if os.path.exists(path):
+                os.utime(path)
+                data = np.load(path, mmap_mode='r')
+                self._log('hit', in_file, key, data.nbytes)
+                return data
+            data = nb.load(in_file).get_fdata(dtype=np.float32)
+            if data.nbytes > self.disk_budget:
+                self._log('bypass', in_file, key, data.nbytes)
+                return data
+            with self._lock('budget'):
+                self._evict(data.nbytes)
+                tmp_path = f'{path[:-4]}.{os.getpid()}.tmp'
+                np.save(tmp_path, data)
+                os.replace(f'{tmp_path}.npy', path)
+            self._log('miss', in_file, key, data.nbytes)
+        return np.load(path, mmap_mode='r')
+
+
+def get_data_cache():
+    """The data cache configured by :func:`set_up_data_cache`, if any
+
+    Returns
+    -------
+    DataCache or None
+    """
+    cache_dir = os.environ.get(DATA_CACHE_DIR)
+    if cache_dir is None:
+        return None
+    return DataCache(cache_dir, os.environ.get(DATA_CACHE_BUDGET, 0))
+
+
+def load_image_data(in_file, dtype=np.float64):
+    """Drop-in replacement for ``nb.load(in_file).get_fdata()`` that reads
+    through the data cache when it is enabled.
+
+    With the cache enabled, the data are returned as a read-only float32
+    memory map, so callers must not modify them in place.
+
+    Parameters
+    ----------
+    in_file : str
+
+    dtype : numpy dtype, optional
+        dtype of the data when the cache is disabled
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    cache = get_data_cache()
+    if cache is None:
+        return nb.load(in_file).get_fdata(dtype=dtype)
+    return cache.load(in_file)
@@ -0,0 +1,412 @@
+# Copyright (C) 2024  C-PAC Developers
+
+# This file is part of C-PAC.
+
+# C-PAC is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+
+# C-PAC is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+# License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with C-PAC. If not, see <https://www.gnu.org/licenses/>.
+"""Incremental analytics of callback logs (``callback.log``).
+
+A :class:`CallbackLog` tails a callback log: each :meth:`~CallbackLog.update`
+reads only what was appended since the last one (holding back a partly
+written last line), and adds each node's record to columns (start and
+finish times, estimated and runtime memory and threads) that grow in
+place. Gantt charts, resource time series, over-usage reports and
+critical paths are computed from the columns with ``numpy``, and the
+latest status of each node (as served by the monitoring server) is kept
+as records arrive.
+"""
+from datetime import datetime
+import json
+import os
+import threading
+import warnings
+
+import numpy as np
+
+COLUMNS = {'estimated_memory_gb': ('estimated_memory_gb', 1.0),
+           'runtime_memory_gb': ('runtime_memory_gb', 0.0),
+           'estimated_threads': ('num_threads', 1.0),
+           'runtime_threads': ('runtime_threads', 0.0)}
+"""Numeric columns: {column: (record key, value if the key is missing)};
+values that aren't numbers (like ``'N/A'``) are ``NaN``"""
+NAT = np.datetime64('NaT', 'us')
+
+
+class _Column:
+    """Array that grows in place (doubling its capacity)"""
+    def __init__(self, dtype):
+        self._data = np.empty(1024, dtype=dtype)
+        self.size = 0
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=self._data.dtype)
+        needed = self.size + len(values)
+        if needed > len(self._data):
+            grown = np.empty(max(needed, 2 * len(self._data)),
+                             dtype=self._data.dtype)
+            grown[:self.size] = self._data[:self.size]
+            self._data = grown
+        self._data[self.size:needed] = values
+        self.size = needed
+
+    @property
+    def values(self):
+        return self._data[:self.size]
+
+
+def _number(record, key, default):
+    if key not in record:
+        return default
+    try:
+        return float(record[key])
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _timestamp(value):
+    """A logged time as ``datetime64[us]`` (``NaT`` if it isn't one)"""
+    if not isinstance(value, str):
+        return NAT
+    try:
+        timestamp = datetime.fromisoformat(value)
+    except ValueError:
+        return NAT
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone().replace(tzinfo=None)
+    return np.datetime64(timestamp, 'us')
+
+
+def _timestamps(values):
+    """Logged times as ``datetime64[us]``, parsed at once where possible"""
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            return np.array(values, dtype='datetime64[us]')
+    except (TypeError, ValueError, DeprecationWarning):
+        return np.array([_timestamp(value) for value in values],
+                        dtype='datetime64[us]')
+
+
+class CallbackLog:
+    """Columns and node statuses of a callback log, updated incrementally
+
+    Parameters
+    ----------
+    path : str
+        path to ``callback.log``
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'callback.log')
+    >>> with open(path, 'w', encoding='utf-8') as log:
+    ...     _ = log.write(json.dumps({
+    ...         'id': 'wf.a', 'hash': '1', 'start': '2024-01-01T00:00:00',
+    ...         'finish': '2024-01-01T00:01:00', 'runtime_memory_gb': 2.5,
+    ...         'estimated_memory_gb': 2, 'runtime_threads': 1,
+    ...         'num_threads': 1}) + '\\n{"id": "wf.b", "ha')
+    >>> cblog = CallbackLog(path)
+    >>> cblog.update()
+    1
+    >>> with open(path, 'a', encoding='utf-8') as log:
+    ...     _ = log.write('sh": "2", "start": "2024-01-01T00:01:00", '
+    ...                   '"finish": "2024-01-01T00:03:00"}\\n')
+    >>> cblog.update()
+    1
+    >>> cblog.excessive()
+    {'wf.a': [2.5, 2, None, None]}
+    >>> [node['id'] for node in cblog.critical_path()]
+    ['wf.a', 'wf.b']
+    >>> cblog.resource_timeseries('estimated_memory_gb').tolist()
+    [2.0, 1.0, 0.0]
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._reset()
+
+    def _reset(self):
+        self._inode = None
+        self._offset = 0
+        self._partial = b''
+        self._records = []
+        self._status = {}
+        self._start = _Column('datetime64[us]')
+        self._finish = _Column('datetime64[us]')
+        self._numbers = {column: _Column(np.float64) for column in COLUMNS}
+        self._queries = {}
+
+    @classmethod
+    def of(cls, callback_log):
+        """A :class:`CallbackLog` of a path (read to its end), or the
+        given one
+
+        Parameters
+        ----------
+        callback_log : str or CallbackLog
+
+        Returns
+        -------
+        CallbackLog
+        """
+        if isinstance(callback_log, cls):
+            return callback_log
+        cblog = cls(callback_log)
+        cblog.update(complete=True)
+        return cblog
+
+    def __len__(self):
+        return len(self._records)
+
+    def update(self, complete=False):
+        """Read what was appended to the log since the last update
+
+        Parameters
+        ----------
+        complete : bool
+            also read a last line without a line break (when the log is
+            finished); otherwise it's read once it's finished
+
+        Returns
+        -------
+        int
+            node records added
+        """
+        with self._lock:
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                return 0
+            if stat.st_ino != self._inode or stat.st_size < self._offset:
+                # a new or truncated log
+                self._reset()
+                self._inode = stat.st_ino
+            data = b''
+            if stat.st_size > self._offset:
+                with open(self.path, 'rb') as log:
+                    log.seek(self._offset)
+                    data = log.read()
+                self._offset += len(data)
+            lines = (self._partial + data).split(b'\n')
+            self._partial = lines.pop()
+            if complete and self._partial:
+                lines.append(self._partial)
+                self._partial = b''
+            return self._ingest(lines)
+
+    def _ingest(self, lines):
+        records = []
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # not a record (or a damaged one)
+                continue
+            if not isinstance(record, dict) or 'id' not in record or \
+                    'data_cache' in record:
+                continue
+            records.append(record)
+            self._update_status(record)
+        if records:
+            self._records.extend(records)
+            self._start.extend(_timestamps([record.get('start') for
+                                             record in records]))
+            self._finish.extend(_timestamps([record.get('finish') for
+                                              record in records]))
+            for column, (key, default) in COLUMNS.items():
+                self._numbers[column].extend([
+                    _number(record, key, default) for record in records])
+            self._queries = {}
+        return len(records)
+
+    def _update_status(self, record):
+        """Latest status of a node, as served by the monitoring server:
+        the first logged hash, with the run's timing, or the timing of a
+        cached rerun with the same hash as ``cached``"""
+        if 'hash' not in record:
+            return
+        timed = 'start' in record and 'finish' in record
+        status = self._status.get(record['id'])
+        if status is None:
+            status = self._status[record['id']] = {'hash': record['hash']}
+            if timed:
+                status['start'] = record['start']
+                status['finish'] = record['finish']
+        elif timed:
+            if status['hash'] == record['hash']:
+                status['cached'] = {'start': record['start'],
+                                    'finish': record['finish']}
+            else:
+                # the pipeline changed, and the node has a new hash
+                status['start'] = record['start']
+                status['finish'] = record['finish']
+
+    def status(self):
+        """Latest status of each node
+
+        Returns
+        -------
+        dict
+            {node ID: {'hash', and 'start', 'finish' and 'cached' if
+            logged}}
+        """
+        with self._lock:
+            return {node_id: dict(status)
+                    for node_id, status in self._status.items()}
+
+    def _query(self, key, compute):
+        with self._lock:
+            if key not in self._queries:
+                self._queries[key] = compute()
+            return self._queries[key]
+
+    def _timed(self):
+        """Indices of the records with start and finish times"""
+        return self._query('timed', lambda: np.flatnonzero(
+            ~np.isnat(self._start.values) & ~np.isnat(self._finish.values)))
+
+    def span(self):
+        """First start and last finish of the logged nodes
+
+        Returns
+        -------
+        tuple of datetime.datetime, or None if no node has timing
+        """
+        timed = self._timed()
+        if not len(timed):
+            return None
+        return (self._start.values[timed].min().item(),
+                self._finish.values[timed].max().item())
+
+    def gantt_nodes(self):
+        """Records of the nodes with timing, in log order, with
+        ``datetime`` start and finish times and their ``duration`` in
+        seconds
+
+        Returns
+        -------
+        list of dict
+        """
+        def compute():
+            timed = self._timed()
+            starts = self._start.values[timed].astype(object)
+            finishes = self._finish.values[timed].astype(object)
+            durations = (self._finish.values[timed] - self._start.values[
+                timed]) / np.timedelta64(1, 's')
+            nodes = []
+            for index, start, finish, duration in zip(timed, starts,
+                                                      finishes, durations):
+                node = dict(self._records[index])
+                node['start'] = start
+                node['finish'] = finish
+                node.setdefault('duration', float(duration))
+                nodes.append(node)
+            return nodes
+        return self._query('gantt', compute)
+
+    def resource_timeseries(self, resource):
+        """Total of a resource over the nodes running at each time it
+        changes
+
+        Parameters
+        ----------
+        resource : str
+            ``'estimated_memory_gb'``, ``'runtime_memory_gb'``,
+            ``'estimated_threads'`` or ``'runtime_threads'``
+
+        Returns
+        -------
+        pandas.Series
+            totals, indexed by time
+        """
+        import pandas as pd
+
+        def compute():
+            timed = self._timed()
+            amounts = np.nan_to_num(self._numbers[resource].values[timed])
+            times = np.concatenate([self._start.values[timed],
+                                    self._finish.values[timed]])
+            order = np.argsort(times, kind='stable')
+            times = times[order]
+            totals = np.cumsum(np.concatenate([amounts, -amounts])[order])
+            # the total after every event at the same time
+            last = np.append(times[1:] != times[:-1], True)
+            times, totals = times[last], totals[last]
+            changed = np.append(True, np.diff(totals) != 0)
+            return pd.Series(totals[changed],
+                             index=pd.DatetimeIndex(times[changed]))
+        return self._query(('timeseries', resource), compute)
+
+    def excessive(self):
+        """Nodes that used more memory than estimated
+
+        Returns
+        -------
+        dict
+            {node ID: [runtime memory, estimated memory, runtime threads
+            - 1 and thread limit if over the limit (or None)]}
+        """
+        def compute():
+            numbers = {column: values.values for column, values in
+                       self._numbers.items()}
+            with np.errstate(invalid='ignore'):
+                memory = numbers['runtime_memory_gb'] > numbers[
+                    'estimated_memory_gb']
+                threads = numbers['runtime_threads'] - 1 > numbers[
+                    'estimated_threads']
+            excessive = {}
+            for index in np.flatnonzero(memory):
+                record = self._records[index]
+                excessive[record['id']] = [
+                    record.get('runtime_memory_gb', 0),
+                    record.get('estimated_memory_gb', 1),
+                    record.get('runtime_threads', 0) - 1 if threads[index]
+                    else None,
+                    record.get('num_threads', 1) if threads[index] else None]
+            return excessive
+        return dict(self._query('excessive', compute))
+
+    def critical_path(self):
+        """Chain of nodes that determined the run's duration, inferred from
+        their timing (callback logs don't record the graph's edges): from
+        the last node to finish, each node is preceded by the node that
+        finished last before it started
+
+        Returns
+        -------
+        list of dict
+            ``id``, ``start``, ``finish`` and ``duration`` (in seconds) of
+            each node on the path, in order
+        """
+        def compute():
+            timed = self._timed()
+            if not len(timed):
+                return []
+            starts = self._start.values[timed]
+            finishes = self._finish.values[timed]
+            order = np.argsort(finishes, kind='stable')
+            sorted_finishes = finishes[order]
+            position = len(order) - 1
+            path = []
+            while position >= 0:
+                current = order[position]
+                path.append(current)
+                position = min(int(np.searchsorted(
+                    sorted_finishes, starts[current], side='right')) - 1,
+                    position - 1)
+            return [{'id': self._records[timed[current]]['id'],
+                     'start': starts[current].item(),
+                     'finish': finishes[current].item(),
+                     'duration': (finishes[current] - starts[current]) /
+                     np.timedelta64(1, 's')} for current in reversed(path)]
+        return self._query('critical_path', compute)
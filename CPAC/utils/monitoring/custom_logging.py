@@ -42,6 +42,27 @@ def failed_to_start(log_dir, exception):
     logger.exception(exception)
 
 
+class WorkflowRunError(RuntimeError):
+    """A participant's workflow started but failed to run"""
+
+
+def failed_to_run(log_dir, exception):
+    """Launch a failed-to-run logger for a run that started but failed.
+    Must be called from within an ``except`` block.
+
+    Parameters
+    ----------
+    log_dir : str
+        path to logging directory
+
+    exception : Exception
+    """
+    logger = set_up_logger('failedToRun', 'failedToRun.log', 'error',
+                           log_dir, True)
+    logger.exception('C-PAC run failed')
+    logger.exception(exception)
+
+
 def getLogger(name):  # pylint: disable=invalid-name
     """Function to get a mock logger if one exists, falling back on
     real loggers.
@@ -5,6 +5,7 @@
 # CHANGES:
 #     * Resolves bugs preventing the original from generating the chart
 #     * Handles when chart-drawing is called but no nodes were run (all cached)
+#     * Reads callback logs with CPAC.utils.monitoring.callback_log
 
 # ORIGINAL WORK'S ATTRIBUTION NOTICE:
 #     Copyright (c) 2015-2019, Nipype developers
@@ -50,8 +51,9 @@ from collections import OrderedDict
 from datetime import datetime
 from warnings import warn
 
-from nipype.utils.draw_gantt_chart import draw_lines, draw_resource_bar, \
-                                          log_to_dict
+from nipype.utils.draw_gantt_chart import draw_lines, draw_resource_bar
+
+from CPAC.utils.monitoring.callback_log import CallbackLog
 
 
 def create_event_dict(start_time, nodes_list):
@@ -285,7 +287,7 @@ def generate_gantt_chart(
 
     Parameters
     ----------
-    logfile : string
+    logfile : string or CallbackLog
         filepath to the callback log file to plot the gantt chart of
     cores : integer
         the number of cores given to the workflow via the 'n_procs'
@@ -394,39 +396,25 @@ def generate_gantt_chart(
     </div>
     """  # noqa: E501
 
-    # Read in json-log to get list of node dicts
-    nodes_list = log_to_dict(logfile)
-
-    # Only include nodes with timing information, and covert timestamps
-    # from strings to datetimes
-    try:
-        nodes_list = _timing(nodes_list)
-    except ProcessLookupError:
-        warn(str(ProcessLookupError))
-        nodes_list = []
+    # Read in json-log to get the nodes with timing information, with
+    # datetime timestamps
+    cblog = CallbackLog.of(logfile)
+    nodes_list = cblog.gantt_nodes()
 
     if not nodes_list:
         return
 
-    for node in nodes_list:
-        if "duration" not in node:
-            node["duration"] = (node["finish"] - node["start"]).total_seconds()
-
     # Create the header of the report with useful information
-    start_node = nodes_list[0]
-    last_node = nodes_list[-1]
-    duration = (last_node["finish"] - start_node["start"]).total_seconds()
-
-    # Get events based dictionary of node run stats
-    events = create_event_dict(start_node["start"], nodes_list)
+    start, finish = cblog.span()
+    duration = (finish - start).total_seconds()
 
     # Summary strings of workflow at top
     html_string += (
-        "<p>Start: " + start_node["start"].strftime("%Y-%m-%d %H:%M:%S")
+        "<p>Start: " + start.strftime("%Y-%m-%d %H:%M:%S")
         + "</p>"
     )
     html_string += (
-        "<p>Finish: " + last_node["finish"].strftime("%Y-%m-%d %H:%M:%S")
+        "<p>Finish: " + finish.strftime("%Y-%m-%d %H:%M:%S")
         + "</p>"
     )
     html_string += "<p>Duration: " + "{0:.2f}".format(duration / 60) \
@@ -436,10 +424,10 @@ def generate_gantt_chart(
     html_string += close_header
     # Draw nipype nodes Gantt chart and runtimes
     html_string += draw_lines(
-        start_node["start"], duration, minute_scale, space_between_minutes
+        start, duration, minute_scale, space_between_minutes
     )
     html_string += draw_nodes(
-        start_node["start"],
+        start,
         nodes_list,
         cores,
         minute_scale,
@@ -448,14 +436,13 @@ def generate_gantt_chart(
     )
 
     # Get memory timeseries
-    estimated_mem_ts = calculate_resource_timeseries(
-        events, "estimated_memory_gb")
-    runtime_mem_ts = calculate_resource_timeseries(events, "runtime_memory_gb")
+    estimated_mem_ts = cblog.resource_timeseries("estimated_memory_gb")
+    runtime_mem_ts = cblog.resource_timeseries("runtime_memory_gb")
     # Plot gantt chart
     resource_offset = 120 + 30 * cores
     html_string += draw_resource_bar(
-        start_node["start"],
-        last_node["finish"],
+        start,
+        finish,
         estimated_mem_ts,
         space_between_minutes,
         minute_scale,
@@ -464,8 +451,8 @@ def generate_gantt_chart(
         "Memory",
     )
     html_string += draw_resource_bar(
-        start_node["start"],
-        last_node["finish"],
+        start,
+        finish,
         runtime_mem_ts,
         space_between_minutes,
         minute_scale,
@@ -475,14 +462,12 @@ def generate_gantt_chart(
     )
 
     # Get threads timeseries
-    estimated_threads_ts = calculate_resource_timeseries(
-        events, "estimated_threads")
-    runtime_threads_ts = calculate_resource_timeseries(
-        events, "runtime_threads")
+    estimated_threads_ts = cblog.resource_timeseries("estimated_threads")
+    runtime_threads_ts = cblog.resource_timeseries("runtime_threads")
     # Plot gantt chart
     html_string += draw_resource_bar(
-        start_node["start"],
-        last_node["finish"],
+        start,
+        finish,
         estimated_threads_ts,
         space_between_minutes,
         minute_scale,
@@ -491,8 +476,8 @@ def generate_gantt_chart(
         "Threads",
     )
     html_string += draw_resource_bar(
-        start_node["start"],
-        last_node["finish"],
+        start,
+        finish,
         runtime_threads_ts,
         space_between_minutes,
         minute_scale,
@@ -507,7 +492,7 @@ def generate_gantt_chart(
     </body>"""
 
     # save file
-    with open(logfile + ".html", "w") as html_file:
+    with open(cblog.path + ".html", "w") as html_file:
         html_file.write(html_string)
 
 
@@ -517,7 +502,7 @@ def resource_overusage_report(cblog):
 
     Parameters
     ----------
-    cblog: str
+    cblog: str or CallbackLog
         path to callback.log
 
     Returns
@@ -526,20 +511,7 @@ def resource_overusage_report(cblog):
 
     excessive: dict
     '''
-    cb_dict_list = log_to_dict(cblog)
-    excessive = {node['id']: [
-        node['runtime_memory_gb']if node.get('runtime_memory_gb', 0)
-        > node.get('estimated_memory_gb', 1) else None,
-        node['estimated_memory_gb'] if node.get('runtime_memory_gb', 0)
-        > node.get('estimated_memory_gb', 1) else None,
-        node['runtime_threads'] - 1 if node.get('runtime_threads', 0) - 1
-        > node.get('num_threads', 1) else None,
-        node['num_threads'] if node.get('runtime_threads', 0) - 1
-        > node.get('num_threads', 1) else None
-    ] for node in [node for node in cb_dict_list if (
-        node.get('runtime_memory_gb', 0) > node.get('estimated_memory_gb', 1)
-        # or node.get('runtime_threads', 0) - 1 > node.get('num_threads', 1)
-    )]}
+    excessive = CallbackLog.of(cblog).excessive()
     text_report = ''
     if excessive:
         text_report += 'The following nodes used excessive resources:\n'
@@ -569,8 +541,8 @@ def resource_report(callback_log, num_cores, logger=None):
 
     Parameters
     ----------
-    callback_log: str
-        path to callback.log
+    callback_log: str or CallbackLog
+        path to callback.log, or the log read from it
 
     num_cores: int
     logger: Logger
@@ -581,78 +553,20 @@ def resource_report(callback_log, num_cores, logger=None):
     None
     '''
     e_msg = ''
+    cblog = CallbackLog.of(callback_log)
     try:
-        txt_report = resource_overusage_report(callback_log)[0]
+        txt_report = resource_overusage_report(cblog)[0]
         if txt_report:
-            with open(callback_log + '.resource_overusage.txt',
+            with open(cblog.path + '.resource_overusage.txt',
                       'w') as resource_overusage_file:
                 resource_overusage_file.write(txt_report)
     except Exception as exception:  # pylint: disable=broad-except
-        e_msg += f'Excessive usage report failed for {callback_log} ' \
+        e_msg += f'Excessive usage report failed for {cblog.path} ' \
                  f'({str(exception)})\n'
-    generate_gantt_chart(callback_log, num_cores)
+    generate_gantt_chart(cblog, num_cores)
     if e_msg:
         if logger is not None:
             logger.warning(e_msg, exc_info=1)
         else:
             warn(e_msg, category=ResourceWarning)
 
-
-def _timing(nodes_list):
-    """Covert timestamps from strings to datetimes
-
-    Parameters
-    ----------
-    nodes_list : list of dicts
-
-    Returns
-    -------
-    nodes_list : list of dicts
-
-    Examples
-    --------
-    >>> node_list = [{"start": "2022-04-16T14:43:36.286896",
-    ...               "finish": "2022-04-16T14:43:36"},
-    ...              {"start": "2022-04-16T14:43:38",
-    ...               "finish": "2022-04-16T14:43:38.529389"}]
-    >>> all(isinstance(v, str) for node in node_list for v in node.values())
-    True
-    >>> any(isinstance(v, datetime) for node in node_list for
-    ...     v in node.values())
-    False
-    >>> all(isinstance(v, datetime) for node in _timing(node_list) for
-    ...     v in node.values())
-    True
-    """
-    try:
-        return [_timing_timestamp(node) for node in nodes_list if
-                "start" in node and "finish" in node]
-    except ValueError:
-        # Drop any problematic nodes
-        new_node_list = []
-        for node in nodes_list:
-            if "start" in node and "finish" in node:
-                try:
-                    new_node_list.append(_timing_timestamp(node))
-                except ValueError:
-                    pass
-        return new_node_list
-
-
-def _timing_timestamp(node):
-    """Convert timestamps in a node from string to datetime
-
-    Parameters
-    ----------
-    node : dict
-
-    Returns
-    -------
-    dict
-    """
-    if node is None or node.items() is None:
-        raise ProcessLookupError('No logged nodes have timing information.')
-    return {k: (datetime.strptime(v, "%Y-%m-%dT%H:%M:%S.%f") if '.' in v else
-                datetime.fromisoformat(v)) if (k in {"start", "finish"} and
-                                               isinstance(v, str)) else
-            v for k, v in node.items()}
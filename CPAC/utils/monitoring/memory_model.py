@@ -0,0 +1,349 @@
+# Copyright (C) 2024  C-PAC Developers
+
+# This file is part of C-PAC.
+
+# C-PAC is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+
+# C-PAC is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+# License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with C-PAC. If not, see <https://www.gnu.org/licenses/>.
+"""Memory model learned from the callback logs of previous runs.
+
+The model stores the observed peak memory (``runtime_memory_gb``) of every
+node together with the size of the input its memory scales with
+(``input_data_shape``, see ``Node.get_input_data_shape``), and fits, for
+each node, the smallest line ``intercept + slope * size`` that lies above
+all of its observations. Nodes that were never observed fall back to the
+observations of other nodes with the same name (the same node type in
+another sub-workflow or strategy).
+"""
+import fcntl
+import json
+import os
+import re
+from contextlib import contextmanager
+
+import numpy as np
+
+MAX_OBSERVATIONS = 100
+"""Most recent observations kept per node"""
+
+
+def node_key(node_id):
+    """Drop the participant-specific top-level workflow from a node ID
+
+    Parameters
+    ----------
+    node_id : str
+
+    Returns
+    -------
+    str
+
+    Examples
+    --------
+    >>> node_key('cpac_sub-1_ses-1.func_preproc_0.func_reorient')
+    'func_preproc_0.func_reorient'
+    """
+    return node_id.split('.', 1)[-1]
+
+
+def node_type(key):
+    """Name of a node without its workflow or MapNode subnode index
+
+    Parameters
+    ----------
+    key : str
+
+    Returns
+    -------
+    str
+
+    Examples
+    --------
+    >>> node_type('func_preproc_0.func_reorient')
+    'func_reorient'
+    >>> node_type('nuisance_regressors_0.aCompCor_cosine_filter._cosine3')
+    '_cosine'
+    """
+    return re.sub(r'\d+$', '', key.rsplit('.', 1)[-1])
+
+
+def _size(input_data_shape):
+    if input_data_shape in (None, 'N/A') or not len(input_data_shape):
+        return None
+    return float(np.prod(input_data_shape))
+
+
+def _fit(observations):
+    """Fit the smallest line above a set of (size, memory) observations
+
+    Parameters
+    ----------
+    observations : list of 2-lists
+        [size or None, memory (GB)]
+
+    Returns
+    -------
+    intercept, slope : float
+        ``slope`` is 0 if the observations don't show memory increasing
+        with size
+    """
+    memory = np.array([obs[1] for obs in observations], dtype=float)
+    sized = [(obs[0], obs[1]) for obs in observations if obs[0] is not None]
+    if len({size for size, _ in sized}) > 1:
+        size, sized_memory = np.array(sized, dtype=float).T
+        slope, intercept = np.polyfit(size, sized_memory, 1)
+        if slope > 0:
+            intercept += (sized_memory - (intercept + slope * size)).max()
+            unsized = memory[[obs[0] is None for obs in observations]]
+            return max([intercept, *unsized]), slope
+    return memory.max(), 0.
+
+
+class MemoryModel:
+    """Per-node memory predictions from previously observed usage
+
+    Parameters
+    ----------
+    observations : dict, optional
+        {node key: [[size or None, memory (GB)], ...]}
+
+    buffer : float, optional
+        percent added to every prediction
+    """
+    def __init__(self, observations=None, buffer=0):
+        self.observations = observations or {}
+        self.buffer = buffer
+        self._fits = {}
+
+    def __len__(self):
+        return len(self.observations)
+
+    def __repr__(self):
+        return f'MemoryModel({len(self)} nodes, buffer={self.buffer}%)'
+
+    @classmethod
+    def load(cls, path, buffer=0):
+        """Load a model from a JSON store, empty if the store doesn't
+        exist yet
+
+        Parameters
+        ----------
+        path : str
+
+        buffer : float, optional
+
+        Returns
+        -------
+        MemoryModel
+        """
+        if not os.path.exists(path):
+            return cls(buffer=buffer)
+        with open(path, 'r', encoding='utf-8') as store:
+            return cls(json.load(store), buffer)
+
+    def save(self, path):
+        """Write the model's observations to a JSON store
+
+        Parameters
+        ----------
+        path : str
+        """
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as store:
+            json.dump(self.observations, store)
+        os.replace(tmp_path, path)
+
+    def add_callback_log(self, callback_log):
+        """Add the observations of a callback log
+
+        Parameters
+        ----------
+        callback_log : str
+            path to callback.log
+
+        Returns
+        -------
+        int
+            number of observations added
+        """
+        added = 0
+        with open(callback_log, 'r', encoding='utf-8') as cbl:
+            for line in cbl:
+                try:
+                    node = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if not isinstance(node, dict) or 'id' not in node or \
+                        not isinstance(node.get('runtime_memory_gb'),
+                                       (int, float)):
+                    continue
+                observations = self.observations.setdefault(
+                    node_key(node['id']), [])
+                observations.append([
+                    _size(node.get('input_data_shape')),
+                    node['runtime_memory_gb']])
+                del observations[:-MAX_OBSERVATIONS]
+                added += 1
+        self._fits = {}
+        return added
+
+    def _fit_for(self, key):
+        if key not in self._fits:
+            if key in self.observations:
+                self._fits[key] = _fit(self.observations[key])
+            else:
+                _type = node_type(key)
+                same_type = [obs for other, observations in
+                             self.observations.items() if
+                             node_type(other) == _type for
+                             obs in observations]
+                self._fits[key] = _fit(same_type) if same_type else None
+        return self._fits[key]
+
+    def predict(self, node_id, input_data_shape=None):
+        """Predict the memory usage of a node
+
+        Parameters
+        ----------
+        node_id : str
+            node fullname or callback log ID
+
+        input_data_shape : tuple, optional
+            shape of the input the node's memory scales with
+
+        Returns
+        -------
+        float or None
+            predicted memory (GB) including the buffer, or None if the
+            node (type) was never observed, or the prediction depends on
+            an input size that isn't known yet
+        """
+        fit = self._fit_for(node_key(node_id))
+        if fit is None:
+            return None
+        intercept, slope = fit
+        size = _size(input_data_shape)
+        if slope and size is None:
+            return None
+        return (intercept + slope * (size or 0)) * (1 + self.buffer / 100)
+
+
+@contextmanager
+def _locked(path):
+    with open(f'{path}.lock', 'w', encoding='utf-8') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def update_memory_model(path, callback_log):
+    """Add a run's observations to a memory model store. Safe to call
+    from participants running in parallel.
+
+    Parameters
+    ----------
+    path : str
+        path to the JSON store
+
+    callback_log : str
+        path to callback.log
+
+    Returns
+    -------
+    int
+        number of observations added
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with _locked(path):
+        model = MemoryModel.load(path)
+        added = model.add_callback_log(callback_log)
+        model.save(path)
+    return added
+
+
+def memory_prediction_report(callback_log):
+    """Compare each node's memory estimate with its observed peak
+
+    Parameters
+    ----------
+    callback_log : str
+        path to callback.log
+
+    Returns
+    -------
+    text_report : str
+        summary, empty if no node has both an estimate and an observation
+
+    rows : list of tuple
+        (node ID, estimated memory (GB), observed memory (GB)), most
+        underestimated first
+    """
+    rows = []
+    with open(callback_log, 'r', encoding='utf-8') as cbl:
+        for line in cbl:
+            try:
+                node = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if isinstance(node, dict) and 'id' in node and all(
+                isinstance(node.get(field), (int, float)) for field in
+                ('estimated_memory_gb', 'runtime_memory_gb')
+            ):
+                rows.append((node['id'], node['estimated_memory_gb'],
+                             node['runtime_memory_gb']))
+    if not rows:
+        return '', rows
+    rows.sort(key=lambda row: row[1] - row[2])
+    estimated, observed = np.array([row[1:] for row in rows]).T
+    ratios = observed[estimated > 0] / estimated[estimated > 0]
+    under = rows[:int((estimated < observed).sum())]
+    text_report = '\n'.join([
+        f'Memory estimates for {len(rows)} nodes: {estimated.sum():.2f} GB '
+        f'estimated, {observed.sum():.2f} GB observed in total; median '
+        f'observed/estimated ratio '
+        f'{np.median(ratios) if len(ratios) else np.nan:.2f}.',
+        f'{len(under)} nodes used more memory than estimated' +
+        (':' if under else '.'),
+        *[f'\t{node_id}: {estimate:.3f} GB estimated, {observation:.3f} GB '
+          'observed' for node_id, estimate, observation in under[:10]]])
+    return text_report, rows
+
+
+def write_memory_prediction_report(callback_log, logger=None):
+    """Log a summary of predicted vs. observed memory and write the full
+    comparison to ``callback.log.memory_prediction.tsv``
+
+    Parameters
+    ----------
+    callback_log : str
+        path to callback.log
+
+    logger : Logger, optional
+
+    Returns
+    -------
+    str or None
+        path to the TSV, if any nodes were compared
+    """
+    text_report, rows = memory_prediction_report(callback_log)
+    if not rows:
+        return None
+    tsv = f'{callback_log}.memory_prediction.tsv'
+    with open(tsv, 'w', encoding='utf-8') as report:
+        report.write('node\testimated_memory_gb\truntime_memory_gb\n')
+        report.writelines(f'{node_id}\t{estimate}\t{observation}\n' for
+                          node_id, estimate, observation in rows)
+    if logger is not None:
+        logger.info('%s\nFull report: %s', text_report, tsv)
+    return tsv
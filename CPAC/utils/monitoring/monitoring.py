@@ -9,6 +9,7 @@ import threading
 from traits.trait_base import Undefined
 
 from CPAC.pipeline import nipype_pipeline_engine as pe
+from .callback_log import CallbackLog
 from .custom_logging import getLogger
 
 
@@ -105,54 +106,31 @@ class LoggingRequestHandler(socketserver.BaseRequestHandler):
             )
         )
 
+        # each participant's callback log is read incrementally, across
+        # requests, with only what was logged since the last request read
+        callback_logs = self.server.callback_logs
+
         for log in logs:
             subject = log.split('/')[-1]
-            tree[subject] = {}
 
             callback_file = os.path.join(log, "callback.log")
 
             if not os.path.exists(callback_file):
                 continue
 
-            with open(callback_file, 'rb') as lf:
-                for l in lf.readlines():  # noqa: E741
-                    l = l.strip()  # noqa: E741
-                    try:
-                        node = json.loads(l)
-                        if node["id"] not in tree[subject]:
-                            tree[subject][node["id"]] = {
-                                "hash": node["hash"]
-                            }
-                            if "start" in node and "finish" in node:
-                                tree[subject][node["id"]]["start"] = node[
-                                    "start"]
-                                tree[subject][node["id"]]["finish"] = node[
-                                    "finish"]
-
-                        else:
-                            if "start" in node and "finish" in node:
-                                if tree[subject][node["id"]]["hash"] == node[
-                                    "hash"
-                                ]:
-                                    tree[subject][node["id"]]["cached"] = {
-                                        "start": node["start"],
-                                        "finish": node["finish"],
-                                    }
-
-                                # pipeline was changed, and we have a new hash
-                                else:
-                                    tree[subject][node["id"]]["start"] = node[
-                                        "start"]
-                                    tree[subject][node["id"]]["finish"] = node[
-                                        "finish"]
-
-                    except:
-                        break
-
-                tree = {s: t for s, t in tree.items() if t}
+            # requests are handled in concurrent threads
+            with self.server.callback_logs_lock:
+                if callback_file not in callback_logs:
+                    callback_logs[callback_file] = CallbackLog(callback_file)
+                callback_log = callback_logs[callback_file]
+            callback_log.update()
+            tree[subject] = callback_log.status()
+
+        tree = {s: t for s, t in tree.items() if t}
 
         headers = 'HTTP/1.1 200 OK\nConnection: close\n\n'
-        self.request.sendall(headers + json.dumps(tree) + "\n")
+        self.request.sendall(
+            (headers + json.dumps(tree) + "\n").encode('utf-8'))
 
 
 class LoggingHTTPServer(socketserver.ThreadingTCPServer, object):
@@ -166,6 +144,8 @@ class LoggingHTTPServer(socketserver.ThreadingTCPServer, object):
 
         self.logging_dir = logging_dir
         self.pipeline_name = pipeline_name
+        self.callback_logs = {}
+        self.callback_logs_lock = threading.Lock()
 
 
 def monitor_server(pipeline_name, logging_dir, host='0.0.0.0', port=8080):
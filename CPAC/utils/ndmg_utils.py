@@ -57,29 +57,17 @@ def ndmg_roi_timeseries(func_file, label_file):
     # Adapted from ndmg v0.1.1
     # Copyright 2016 NeuroData (http://neurodata.io)
     """
+    from CPAC.timeseries.utils import roi_timeseries
+    from CPAC.utils.data_cache import load_image_data
     labeldata = nb.load(label_file).get_fdata()
     # rois are all the nonzero unique values the parcellation can take
     rois = np.sort(np.unique(labeldata[labeldata > 0]))
-    funcdata = nb.load(func_file).get_fdata()
-
-    # initialize time series to [numrois]x[numtimepoints]
-    roi_ts = np.zeros((len(rois), funcdata.shape[3]))
-    # iterate over the unique possible rois. note that the rois
-    # could have nonstandard values, so assign indices w enumerate
-    for idx, roi in enumerate(rois):
-        roibool = labeldata == roi  # get a bool where our voxels in roi
-        try:
-            roi_vts = funcdata[roibool, :]
-        except IndexError as e:
-            err = '\n[!] Error: functional data and ROI mask may not be in ' \
-                  'the same space or be the same size.\nDetails: ' \
-                  '{0}'.format(e)
-            raise IndexError(err)
-        # take the mean for the voxel timeseries, and ignore voxels with
-        # no variance
-        ts = roi_vts[roi_vts.std(axis=1) != 0, :].mean(axis=0)
-        if ts.size != 0:
-            roi_ts[idx, :] = ts
+    funcdata = load_image_data(func_file)
+
+    # take the mean for the voxel timeseries, and ignore voxels with
+    # no variance
+    roi_ts, rois = roi_timeseries(funcdata, labeldata, rois,
+                                  exclude_constant=True)
 
     roits_file = os.path.join(os.getcwd(), 'timeseries.npz')
     np.savez(roits_file, ts=roi_ts, rois=rois)
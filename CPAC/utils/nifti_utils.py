@@ -89,3 +89,41 @@ def inverse_nifti_values(image):
     out_data[zeros] = 0
 
     return nib.nifti1.Nifti1Image(out_data, img.affine)
+
+
+def write_masked_timeseries(timeseries, mask, reference, out_file):
+    """
+    Write in-mask voxel timeseries to a float32 4D NIfTI image one volume
+    at a time, without building the full 4D array in memory
+
+    Parameters
+    ----------
+    timeseries : array of shape (voxels, timepoints)
+        timeseries of the voxels of ``mask``, in ``mask[mask]`` order
+
+    mask : boolean array of shape (x, y, z)
+
+    reference : nibabel.nifti1.Nifti1Image
+        image whose header and affine are copied
+
+    out_file : str
+        path to write (``.nii`` or ``.nii.gz``)
+
+    Returns
+    -------
+    out_file : str
+    """
+    header = reference.header.copy()
+    header.set_data_shape(mask.shape + (timeseries.shape[1],))
+    header.set_data_dtype(np.float32)
+    header.set_slope_inter(np.nan, np.nan)
+    header['vox_offset'] = 0
+    out_dtype = header.get_data_dtype()
+    volume = np.zeros(mask.shape, dtype=out_dtype)
+    with nib.openers.ImageOpener(out_file, 'wb') as out:
+        header.write_to(out)
+        out.write(b'\0' * (int(header['vox_offset']) - out.tell()))
+        for index in range(timeseries.shape[1]):
+            volume[mask] = timeseries[:, index]
+            out.write(volume.tobytes(order='F'))
+    return out_file
@@ -15,6 +15,7 @@
 # You should have received a copy of the GNU Lesser General Public
 # License along with C-PAC. If not, see <https://www.gnu.org/licenses/>.
 """Utilities for Pytest integration"""
+import os
 try:
     import pytest
     HAVE_PYTEST = True
@@ -30,3 +31,12 @@ def skipif(condition, reason):
             return pytest.mark.skipif(condition, reason)(func)
         return func  # return undecorated function
     return decorator  # return conditionally decorated function
+
+
+def benchmark(func):
+    """Only run a benchmark test if ``CPAC_BENCHMARK`` is set"""
+    if HAVE_PYTEST:
+        return pytest.mark.skipif(not os.environ.get('CPAC_BENCHMARK'),
+                                  reason='set CPAC_BENCHMARK to run '
+                                         'benchmarks')(func)
+    return func
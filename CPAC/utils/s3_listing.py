@@ -0,0 +1,200 @@
+# Copyright (C) 2024  C-PAC Developers
+
+# This file is part of C-PAC.
+
+# C-PAC is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+
+# C-PAC is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+# License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with C-PAC. If not, see <https://www.gnu.org/licenses/>.
+"""Concurrent listing of S3 prefixes and fetching of JSON sidecars.
+
+A prefix is split into shards by its "subdirectories" (``sub-*/`` in a
+BIDS dataset), found with delimited listings, and the shards are listed
+concurrently; the objects are returned in key order, as a single listing
+returns them. JSON objects are fetched on a bounded thread pool and kept
+in a local cache keyed by their ETags, so unchanged sidecars aren't
+fetched again; listings are cached too, for reuse within
+``max_listing_age`` seconds.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+import time
+
+MAX_SHARD_DEPTH = 3
+"""Most levels of "subdirectories" to descend to find shards"""
+
+
+def s3_cache_dir():
+    """Default cache directory of S3 listings and sidecars
+
+    Returns
+    -------
+    str
+    """
+    return os.path.join(os.environ.get(
+        'XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+        'C-PAC', 's3')
+
+
+def _write_atomically(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = f'{path}.{os.getpid()}.tmp'
+    with open(temporary, 'w', encoding='utf-8') as _f:
+        _f.write(text)
+    os.replace(temporary, path)
+
+
+def _list(client, bucket_name, prefix, delimiter=None):
+    """One (paginated) listing of a prefix
+
+    Returns
+    -------
+    objects : list of dict
+        ``Key``, ``ETag`` and ``Size`` of each object
+
+    prefixes : list of str
+        common prefixes, if ``delimiter``
+    """
+    kwargs = {'Bucket': bucket_name, 'Prefix': prefix}
+    if delimiter:
+        kwargs['Delimiter'] = delimiter
+    objects = []
+    prefixes = []
+    for page in client.get_paginator('list_objects_v2').paginate(**kwargs):
+        objects.extend({'Key': s3_obj['Key'],
+                        'ETag': s3_obj.get('ETag', '').strip('"'),
+                        'Size': s3_obj.get('Size')}
+                       for s3_obj in page.get('Contents', []))
+        prefixes.extend(common['Prefix']
+                        for common in page.get('CommonPrefixes', []))
+    return objects, prefixes
+
+
+def list_s3_objects(client, bucket_name, prefix, n_threads=16,
+                    cache_dir=None, max_listing_age=None):
+    """Every object under an S3 prefix, listed concurrently by shard
+
+    Parameters
+    ----------
+    client : botocore.client.S3
+
+    bucket_name : str
+
+    prefix : str
+
+    n_threads : int
+        shards listed concurrently
+
+    cache_dir : str, optional
+        listing cache directory (defaults to :func:`s3_cache_dir`)
+
+    max_listing_age : float, optional
+        reuse a cached listing of the same prefix this many seconds old
+        or newer (by default, always list)
+
+    Returns
+    -------
+    list of dict
+        ``Key``, ``ETag`` and ``Size`` of each object, in key order
+    """
+    cache_path = os.path.join(
+        cache_dir or s3_cache_dir(), 'listings', hashlib.sha1(
+            f'{bucket_name}/{prefix}'.encode('utf-8')).hexdigest() + '.json')
+    if max_listing_age is not None:
+        try:
+            with open(cache_path, 'r', encoding='utf-8') as _f:
+                cached = json.load(_f)
+            if time.time() - cached['time'] <= max_listing_age:
+                return cached['objects']
+        except (OSError, ValueError, KeyError):
+            pass
+    n_threads = max(int(n_threads), 1)
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        objects, shards = _list(client, bucket_name, prefix, '/')
+        depth = 1
+        # split the prefix until there are enough shards to list at once
+        while shards and len(shards) < n_threads and depth < MAX_SHARD_DEPTH:
+            listings = list(executor.map(
+                lambda shard: _list(client, bucket_name, shard, '/'), shards))
+            shards = []
+            for shard_objects, shard_prefixes in listings:
+                objects.extend(shard_objects)
+                shards.extend(shard_prefixes)
+            depth += 1
+        for shard_objects, _ in executor.map(
+                lambda shard: _list(client, bucket_name, shard), shards):
+            objects.extend(shard_objects)
+    # S3 lists keys in UTF-8 byte order, which is code point order
+    objects.sort(key=lambda s3_obj: s3_obj['Key'])
+    try:
+        _write_atomically(cache_path, json.dumps({'time': time.time(),
+                                                  'objects': objects}))
+    except OSError:
+        pass
+    return objects
+
+
+def fetch_s3_json(client, bucket_name, objects, n_threads=16,
+                  cache_dir=None):
+    """Contents of JSON objects, fetched concurrently unless cached by
+    ETag
+
+    Parameters
+    ----------
+    client : botocore.client.S3
+
+    bucket_name : str
+
+    objects : list of dict
+        ``Key`` and ``ETag`` of each object (as from
+        :func:`list_s3_objects`)
+
+    n_threads : int
+        concurrent requests
+
+    cache_dir : str, optional
+        sidecar cache directory (defaults to :func:`s3_cache_dir`)
+
+    Returns
+    -------
+    dict
+        {key: parsed JSON}
+    """
+    object_dir = os.path.join(cache_dir or s3_cache_dir(), 'objects',
+                              bucket_name)
+
+    def fetch(s3_obj):
+        cache_path = os.path.join(object_dir, s3_obj['ETag']) if s3_obj.get(
+            'ETag') else None
+        if cache_path and os.path.isfile(cache_path):
+            with open(cache_path, 'r', encoding='utf-8') as _f:
+                return json.load(_f)
+        try:
+            response = client.get_object(Bucket=bucket_name,
+                                         Key=s3_obj['Key'])
+            text = response['Body'].read().decode('utf-8')
+            contents = json.loads(text)
+        except Exception as exception:
+            print(f"Error retrieving {s3_obj['Key']} ({exception})")
+            raise
+        etag = response.get('ETag', '').strip('"')
+        if etag:
+            try:
+                _write_atomically(os.path.join(object_dir, etag), text)
+            except OSError:
+                pass
+        return contents
+
+    with ThreadPoolExecutor(max_workers=max(int(n_threads), 1)) as executor:
+        return dict(zip([s3_obj['Key'] for s3_obj in objects],
+                        executor.map(fetch, objects)))
@@ -0,0 +1,307 @@
+# Copyright (C) 2024  C-PAC Developers
+
+# This file is part of C-PAC.
+
+# C-PAC is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+
+# C-PAC is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public
+# License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with C-PAC. If not, see <https://www.gnu.org/licenses/>.
+"""Concurrent download of participants' S3 inputs before their workflows run.
+
+``check_for_s3`` downloads each S3 input inside its own node. Prefetching
+resolves every S3 path in the participants' data configuration entries and
+downloads them concurrently, through one client with a shared connection
+pool, retries and multipart transfers, into the same layout
+(``<dl_dir>/<bucket>/<key>``), and checks each file's size and ETag. The
+nodes then find the files already present and skip their downloads.
+"""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import os
+
+from CPAC.utils.monitoring import getLogger
+
+logger = getLogger('nipype.workflow')
+
+S3_PREFIX = 's3://'
+"""Prefix of S3 paths (case-insensitive, as in ``check_for_s3``)"""
+MULTIPART_CONCURRENCY = 4
+"""Concurrent parts of each multipart download"""
+
+
+def s3_inputs(sub_dict):
+    """All S3 paths in a participant's data configuration entry
+
+    Parameters
+    ----------
+    sub_dict : dict
+
+    Returns
+    -------
+    list of str
+        in the order found, without duplicates
+
+    Examples
+    --------
+    >>> s3_inputs({'subject_id': '1', 'anat': 's3://bucket/sub-1/T1w.nii.gz',
+    ...            'func': {'rest': {'scan': 'S3://bucket/sub-1/bold.nii.gz',
+    ...                              'scan_parameters': '/local/params.json'}},
+    ...            'fmap': {'epi_AP': {'scan': 's3://bucket/sub-1/AP.nii.gz'}},
+    ...            'creds_path': None})
+    ['s3://bucket/sub-1/T1w.nii.gz', 'S3://bucket/sub-1/bold.nii.gz', \
+'s3://bucket/sub-1/AP.nii.gz']
+    """
+    paths = []
+    if isinstance(sub_dict, dict):
+        values = sub_dict.values()
+    elif isinstance(sub_dict, (list, tuple)):
+        values = sub_dict
+    else:
+        values = [sub_dict]
+    for value in values:
+        if isinstance(value, str):
+            if value.lower().startswith(S3_PREFIX) and value not in paths:
+                paths.append(value)
+        elif isinstance(value, (dict, list, tuple)):
+            paths.extend(path for path in s3_inputs(value)
+                         if path not in paths)
+    return paths
+
+
+def s3_local_path(file_path, dl_dir):
+    """Where ``check_for_s3`` downloads an S3 path to
+
+    Parameters
+    ----------
+    file_path : str
+
+    dl_dir : str
+
+    Returns
+    -------
+    bucket_name : str
+
+    s3_key : str
+
+    local_path : str
+
+    Examples
+    --------
+    >>> s3_local_path('S3://bucket/sub-1/anat/T1w.nii.gz', '/tmp/work')
+    ('bucket', 'sub-1/anat/T1w.nii.gz', '/tmp/work/bucket/sub-1/anat/T1w.nii.gz')
+    """
+    bucket_name, s3_key = file_path[len(S3_PREFIX):].split('/', 1)
+    return bucket_name, s3_key, os.path.join(dl_dir, bucket_name, s3_key)
+
+
+def s3_client(creds_path=None, max_connections=10, max_attempts=5):
+    """An S3 client, shared by the download threads
+
+    Parameters
+    ----------
+    creds_path : str, optional
+        AWS credentials file (as in the data configuration); without it,
+        the default AWS credentials are used if there are any, otherwise
+        anonymous access
+
+    max_connections : int
+        size of the client's connection pool
+
+    max_attempts : int
+        attempts per request, with the standard retry mode's backoff
+
+    Returns
+    -------
+    botocore.client.S3
+    """
+    import boto3
+    from botocore import UNSIGNED
+    from botocore.config import Config
+
+    config = Config(max_pool_connections=max_connections,
+                    retries={'max_attempts': max_attempts,
+                             'mode': 'standard'})
+    if creds_path and creds_path.lower() not in ('none', 'null'):
+        from indi_aws import fetch_creds
+        access_key_id, secret_access_key = fetch_creds.return_aws_keys(
+            creds_path)
+        session = boto3.session.Session(
+            aws_access_key_id=access_key_id,
+            aws_secret_access_key=secret_access_key)
+    else:
+        session = boto3.session.Session()
+        if session.get_credentials() is None:
+            config = config.merge(Config(signature_version=UNSIGNED))
+    return session.client('s3', config=config)
+
+
+def file_etag(path, part_size=None):
+    """The ETag S3 gives a file uploaded in one part (MD5) or in parts of
+    ``part_size`` bytes (MD5 of the parts' MD5s, with the part count)
+
+    Parameters
+    ----------
+    path : str
+
+    part_size : int, optional
+
+    Returns
+    -------
+    str
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> with tempfile.NamedTemporaryFile(delete=False) as _f:
+    ...     _ = _f.write(b'C-PAC')
+    >>> file_etag(_f.name)
+    '5c137a538fd470e7e66f5520fbbf8d73'
+    >>> file_etag(_f.name, part_size=2)
+    'e3a51e67285577dbdac547cde14f94ab-3'
+    >>> os.remove(_f.name)
+    """
+    parts = []
+    with open(path, 'rb') as _f:
+        if part_size is None:
+            md5 = hashlib.md5()
+            for chunk in iter(lambda: _f.read(8 * 1024 ** 2), b''):
+                md5.update(chunk)
+            return md5.hexdigest()
+        for chunk in iter(lambda: _f.read(part_size), b''):
+            parts.append(hashlib.md5(chunk).digest())
+    return f'{hashlib.md5(b"".join(parts)).hexdigest()}-{len(parts)}'
+
+
+def verify_download(client, bucket_name, s3_key, local_path, head=None):
+    """Whether a local file matches an S3 object's size and ETag
+
+    Parameters
+    ----------
+    client : botocore.client.S3
+
+    bucket_name, s3_key, local_path : str
+
+    head : dict, optional
+        the object's ``head_object`` response, if already requested
+
+    Returns
+    -------
+    bool
+    """
+    if not os.path.isfile(local_path):
+        return False
+    if head is None:
+        head = client.head_object(Bucket=bucket_name, Key=s3_key)
+    if os.path.getsize(local_path) != head['ContentLength']:
+        return False
+    etag = head.get('ETag', '').strip('"')
+    if '-' in etag:
+        part_size = client.head_object(Bucket=bucket_name, Key=s3_key,
+                                       PartNumber=1)['ContentLength']
+        return file_etag(local_path, part_size) == etag
+    return file_etag(local_path) == etag
+
+
+def _download(client, transfer_config, file_path, dl_dir):
+    """Download one S3 object unless a matching copy is already present"""
+    bucket_name, s3_key, local_path = s3_local_path(file_path, dl_dir)
+    head = client.head_object(Bucket=bucket_name, Key=s3_key)
+    if verify_download(client, bucket_name, s3_key, local_path, head):
+        return local_path, False
+    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+    # download next to the destination so a partial file is never found
+    # by a node
+    partial_path = f'{local_path}.prefetch'
+    client.download_file(bucket_name, s3_key, partial_path,
+                         Config=transfer_config)
+    if not verify_download(client, bucket_name, s3_key, partial_path, head):
+        os.remove(partial_path)
+        raise IOError(f'Download of {file_path} does not match its size '
+                      'or ETag.')
+    os.replace(partial_path, local_path)
+    return local_path, True
+
+
+def prefetch_s3_inputs(sublist, dl_dir, creds_path=None, n_threads=8,
+                       multipart_threshold_mb=64):
+    """Download the S3 inputs of one or more participants concurrently
+
+    Parameters
+    ----------
+    sublist : dict or list of dict
+        data configuration entries of the participants about to run
+
+    dl_dir : str
+        download directory (the working directory, as for
+        ``check_for_s3``)
+
+    creds_path : str, optional
+        AWS credentials file; defaults to each participant's
+        ``creds_path``
+
+    n_threads : int
+        concurrent downloads (and connections)
+
+    multipart_threshold_mb : int
+        objects at least this large are downloaded in concurrent parts of
+        this size
+
+    Returns
+    -------
+    downloaded : dict
+        {S3 path: local path} of every input that's present locally
+
+    failed : dict
+        {S3 path: error} of every input that couldn't be downloaded; its
+        node will try again (and report the error)
+    """
+    from boto3.s3.transfer import TransferConfig
+
+    if isinstance(sublist, dict):
+        sublist = [sublist]
+    by_creds = {}
+    for sub_dict in sublist:
+        creds = creds_path or sub_dict.get('creds_path')
+        paths = by_creds.setdefault(creds, [])
+        paths.extend(path for path in s3_inputs(sub_dict)
+                     if path not in paths)
+    downloaded = {}
+    failed = {}
+    n_threads = max(int(n_threads), 1)
+    transfer_config = TransferConfig(
+        multipart_threshold=multipart_threshold_mb * 1024 ** 2,
+        multipart_chunksize=multipart_threshold_mb * 1024 ** 2,
+        max_concurrency=MULTIPART_CONCURRENCY, use_threads=True)
+    for creds, paths in by_creds.items():
+        if not paths:
+            continue
+        try:
+            client = s3_client(
+                creds, max_connections=n_threads * MULTIPART_CONCURRENCY)
+        except Exception as exception:  # pylint: disable=broad-except
+            failed.update({path: exception for path in paths})
+            continue
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            futures = {executor.submit(_download, client, transfer_config,
+                                       path, dl_dir): path for path in paths}
+            for future in as_completed(futures):
+                path = futures[future]
+                try:
+                    local_path, fetched = future.result()
+                except Exception as exception:  # pylint: disable=broad-except
+                    failed[path] = exception
+                    logger.warning('Could not prefetch %s: %s', path,
+                                   exception)
+                    continue
+                downloaded[path] = local_path
+                if fetched:
+                    logger.info('Prefetched %s', path)
+    return downloaded, failed
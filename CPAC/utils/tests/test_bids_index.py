@@ -0,0 +1,118 @@
+"""Tests for the persistent BIDS index"""
+import json
+import os
+
+from CPAC.utils.bids_index import BIDSIndex, SUFFIXES
+from CPAC.utils.bids_utils import collect_bids_files_configs, \
+    create_cpac_data_config
+
+
+def _walk(bids_dir):
+    """Reference: the images and sidecars found by walking the dataset"""
+    file_paths = set()
+    config_dict = {}
+    for root, _, files in os.walk(bids_dir, followlinks=True):
+        for f in files:
+            for suf in SUFFIXES:
+                if suf == 'epi' and 'acq-fMRI' not in f:
+                    continue
+                relative = os.path.join(root, f).replace(bids_dir,
+                                                         '').lstrip('/')
+                if 'nii' in f and suf in f:
+                    file_paths.add(relative)
+                if f.endswith('json') and suf in f:
+                    with open(os.path.join(root, f), encoding='utf-8') as _f:
+                        config_dict[relative] = json.load(_f)
+    return file_paths, config_dict
+
+
+def _write(path, contents=''):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as _f:
+        _f.write(contents if isinstance(contents, str) else
+                 json.dumps(contents))
+
+
+def _dataset(bids_dir):
+    _write(os.path.join(bids_dir, 'task-rest_bold.json'),
+           {'RepetitionTime': 2.0, 'TaskName': 'rest'})
+    _write(os.path.join(bids_dir, 'dataset_description.json'),
+           {'Name': 'test'})
+    for sub in ['01', '02', '03']:
+        for ses in ['1', '2']:
+            prefix = os.path.join(bids_dir, f'sub-{sub}', f'ses-{ses}')
+            entities = f'sub-{sub}_ses-{ses}'
+            _write(os.path.join(prefix, 'anat', f'{entities}_T1w.nii.gz'))
+            _write(os.path.join(prefix, 'anat', f'{entities}_T1w.json'),
+                   {'RepetitionTime': 2.3})
+            for run in ['1', '2']:
+                _write(os.path.join(
+                    prefix, 'func', f'{entities}_task-rest_run-{run}_'
+                    'bold.nii.gz'))
+                _write(os.path.join(
+                    prefix, 'func', f'{entities}_task-rest_run-{run}_'
+                    'events.tsv'))
+            _write(os.path.join(prefix, 'fmap',
+                                f'{entities}_acq-fMRI_dir-AP_epi.nii.gz'))
+            _write(os.path.join(prefix, 'fmap',
+                                f'{entities}_acq-fMRI_dir-AP_epi.json'),
+                   {'RepetitionTime': 6.0, 'PhaseEncodingDirection': 'j-'})
+            _write(os.path.join(prefix, 'fmap',
+                                f'{entities}_acq-dwi_dir-AP_epi.nii.gz'))
+        _write(os.path.join(bids_dir, f'sub-{sub}',
+                            f'sub-{sub}_task-rest_bold.json'),
+               {'RepetitionTime': 2.0, 'SliceTiming': [0, 1]})
+    # followed symlinks that loop back are listed once
+    os.symlink(bids_dir, os.path.join(bids_dir, 'sub-01', 'loop'))
+
+
+def test_index_matches_walk(tmp_path):
+    bids_dir = str(tmp_path / 'bids')
+    _dataset(bids_dir)
+    os.remove(os.path.join(bids_dir, 'sub-01', 'loop'))
+    file_paths, config = collect_bids_files_configs(
+        bids_dir, index_path=str(tmp_path / 'index.sqlite'))
+    expected_paths, expected_config = _walk(bids_dir)
+    assert set(file_paths) == expected_paths
+    assert len(file_paths) == len(expected_paths)
+    assert dict(config) == expected_config
+
+
+def test_incremental_scan(tmp_path):
+    bids_dir = str(tmp_path / 'bids')
+    index_path = str(tmp_path / 'index.sqlite')
+    _dataset(bids_dir)
+    first = BIDSIndex(bids_dir, index_path).scan()
+    assert first['added'] == 3 * 2 * 6 + 3 + 1
+    index = BIDSIndex(bids_dir, index_path)
+    assert index.scan() == {'added': 0, 'updated': 0, 'removed': 0}
+    dict(index.sidecars())
+
+    sidecar = os.path.join(bids_dir, 'sub-02', 'sub-02_task-rest_bold.json')
+    _write(sidecar, {'RepetitionTime': 0.8, 'SliceTiming': [0, 0.4]})
+    os.utime(sidecar, ns=(0, 1))
+    os.remove(os.path.join(bids_dir, 'sub-03', 'ses-2', 'anat',
+                           'sub-03_ses-2_T1w.nii.gz'))
+    _write(os.path.join(bids_dir, 'sub-04', 'anat', 'sub-04_T1w.nii.gz'))
+    index = BIDSIndex(bids_dir, index_path)
+    assert index.scan() == {'added': 1, 'updated': 1, 'removed': 1}
+    assert index.sidecars()['sub-02/sub-02_task-rest_bold.json'][
+        'RepetitionTime'] == 0.8
+    assert 'sub-03/ses-2/anat/sub-03_ses-2_T1w.nii.gz' not in index.images()
+    assert 'sub-04/anat/sub-04_T1w.nii.gz' in index.images()
+
+
+def test_lazy_sidecars(monkeypatch, tmp_path):
+    bids_dir = str(tmp_path / 'bids')
+    _dataset(bids_dir)
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    sub_list = create_cpac_data_config(bids_dir, participant_labels=['02'])
+    assert {sub['subject_id'] for sub in sub_list} == {'sub-02'}
+    assert sub_list[0]['func']['rest_run-1']['scan_parameters'][
+        'SliceTiming'] == [0, 1]
+    # only the dataset's and the participant's sidecars were read
+    index = BIDSIndex(bids_dir)
+    read = {path for path, in index.connection.execute(
+        'SELECT path FROM files WHERE contents IS NOT NULL')}
+    assert read == {path for path in index.sidecars() if
+                    not path.startswith(('sub-01', 'sub-03'))}
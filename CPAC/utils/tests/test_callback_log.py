@@ -0,0 +1,241 @@
+"""Tests for incremental callback log analytics"""
+from datetime import datetime, timedelta
+import json
+import os
+import socket
+import threading
+import warnings
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from CPAC.utils.monitoring import LoggingHTTPServer
+from CPAC.utils.monitoring.callback_log import CallbackLog
+from CPAC.utils.monitoring.draw_gantt_chart import \
+    calculate_resource_timeseries, create_event_dict, resource_report
+from CPAC.utils.pytest import benchmark
+
+START = datetime(2024, 1, 1, 8)
+
+
+def _records(n_nodes, seed=0):
+    """Node records as log_nodes_cb logs them, with initial and data
+    cache lines"""
+    rng = np.random.default_rng(seed)
+    records = [{'id': f'cpac_sub-1.wf.node_{node}', 'hash': 'initial'}
+               for node in range(n_nodes // 10)]
+    for node in range(n_nodes):
+        # distinct microseconds, so no two events coincide
+        start = START + timedelta(seconds=int(rng.integers(0, 3600)),
+                                  microseconds=2 * node)
+        finish = start + timedelta(seconds=int(rng.integers(1, 600)),
+                                   microseconds=1)
+        record = {'id': f'cpac_sub-1.wf.node_{node % (n_nodes - 5)}',
+                  'hash': 'initial' if node % 7 else f'{node}',
+                  'start': start.isoformat(), 'finish': finish.isoformat(),
+                  'runtime_threads': int(rng.integers(1, 4)),
+                  'runtime_memory_gb': round(float(rng.random() * 3), 3),
+                  'estimated_memory_gb': round(float(rng.random() * 3), 3),
+                  'num_threads': int(rng.integers(1, 3))}
+        if node % 11 == 0:
+            del record['estimated_memory_gb']
+        records.append(record)
+        if node % 13 == 0:
+            records.append({'data_cache': 'hit', 'in_file': 'in.nii.gz'})
+    records.append({'id': 'cpac_sub-1.wf.failed', 'hash': 'failed',
+                    'start': None, 'finish': None, 'error': True,
+                    'runtime_threads': 'N/A', 'runtime_memory_gb': 'N/A',
+                    'estimated_memory_gb': 1, 'num_threads': 1})
+    return records
+
+
+def _write(path, records):
+    with open(path, 'w', encoding='utf-8') as log:
+        for record in records:
+            log.write(json.dumps(record) + '\n')
+    return str(path)
+
+
+def _timed(records):
+    """Reference: the nodes with timing, as the Gantt chart read them"""
+    nodes = []
+    for record in records:
+        if isinstance(record.get('start'), str) and isinstance(
+                record.get('finish'), str):
+            node = dict(record)
+            node['start'] = datetime.fromisoformat(node['start'])
+            node['finish'] = datetime.fromisoformat(node['finish'])
+            nodes.append(node)
+    return nodes
+
+
+def _excessive(records):
+    """Reference: the over-usage report's original selection"""
+    return {node['id']: [
+        node['runtime_memory_gb'] if node.get('runtime_memory_gb', 0)
+        > node.get('estimated_memory_gb', 1) else None,
+        node.get('estimated_memory_gb', 1) if node.get(
+            'runtime_memory_gb', 0) > node.get('estimated_memory_gb', 1)
+        else None,
+        node['runtime_threads'] - 1 if node.get('runtime_threads', 0) - 1
+        > node.get('num_threads', 1) else None,
+        node['num_threads'] if node.get('runtime_threads', 0) - 1
+        > node.get('num_threads', 1) else None
+    ] for node in records if 'id' in node and not isinstance(
+        node.get('runtime_memory_gb'), str) and node.get(
+            'runtime_memory_gb', 0) > node.get('estimated_memory_gb', 1)}
+
+
+def _status(records):
+    """Reference: the monitoring server's original node statuses"""
+    tree = {}
+    for node in records:
+        if 'data_cache' in node:
+            continue
+        if node['id'] not in tree:
+            tree[node['id']] = {'hash': node['hash']}
+            if 'start' in node and 'finish' in node:
+                tree[node['id']]['start'] = node['start']
+                tree[node['id']]['finish'] = node['finish']
+        elif 'start' in node and 'finish' in node:
+            if tree[node['id']]['hash'] == node['hash']:
+                tree[node['id']]['cached'] = {'start': node['start'],
+                                              'finish': node['finish']}
+            else:
+                tree[node['id']]['start'] = node['start']
+                tree[node['id']]['finish'] = node['finish']
+    return tree
+
+
+def test_matches_reference(tmp_path):
+    records = _records(500)
+    cblog = CallbackLog.of(_write(tmp_path / 'callback.log', records))
+    nodes = _timed(records)
+    assert len(cblog) == len(records) - len(
+        [record for record in records if 'data_cache' in record])
+    assert [node['id'] for node in cblog.gantt_nodes()] == [
+        node['id'] for node in nodes]
+    events = create_event_dict(nodes[0]['start'], nodes)
+    for resource in ['estimated_memory_gb', 'runtime_memory_gb',
+                     'estimated_threads', 'runtime_threads']:
+        expected = calculate_resource_timeseries(events, resource)
+        timeseries = cblog.resource_timeseries(resource)
+        assert list(timeseries.index) == list(pd.DatetimeIndex(
+            expected.index))
+        assert np.allclose(timeseries.values, expected.values)
+    assert cblog.excessive() == _excessive(records)
+    assert cblog.status() == _status(records)
+
+
+def test_incremental(tmp_path):
+    records = _records(200, seed=1)
+    path = str(tmp_path / 'callback.log')
+    content = ''.join(json.dumps(record) + '\n' for record in records)
+    cblog = CallbackLog(path)
+    with open(path, 'w', encoding='utf-8') as log:
+        # appended in pieces that split lines
+        for first in range(0, len(content), 997):
+            log.write(content[first:first + 997])
+            log.flush()
+            cblog.update()
+    reference = CallbackLog.of(path)
+    assert len(cblog) == len(reference)
+    assert cblog.status() == reference.status()
+    assert cblog.excessive() == reference.excessive()
+    assert cblog.resource_timeseries('runtime_memory_gb').equals(
+        reference.resource_timeseries('runtime_memory_gb'))
+    # a truncated (restarted) log is read again
+    _write(path, records[:3])
+    assert cblog.update() == 3
+    assert len(cblog) == 3
+
+
+def test_critical_path(tmp_path):
+    def node(name, start, finish):
+        return {'id': name, 'hash': name,
+                'start': (START + timedelta(minutes=start)).isoformat(),
+                'finish': (START + timedelta(minutes=finish)).isoformat()}
+    cblog = CallbackLog.of(_write(tmp_path / 'callback.log', [
+        node('a', 0, 10), node('side', 1, 4), node('b', 10, 30),
+        node('short', 11, 12), node('zero', 30, 30), node('c', 30, 45)]))
+    assert [step['id'] for step in cblog.critical_path()] == [
+        'a', 'b', 'zero', 'c']
+    assert [step['duration'] for step in cblog.critical_path()] == [
+        600, 1200, 0, 900]
+
+
+@pytest.mark.parametrize('read', [False, True])
+def test_resource_report(tmp_path, read):
+    records = _records(50)
+    records[-2]['runtime_memory_gb'] = 99
+    path = _write(tmp_path / 'callback.log', records)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', ResourceWarning)
+        resource_report(CallbackLog.of(path) if read else path, 4)
+    with open(f'{path}.html', encoding='utf-8') as html:
+        assert html.read().count("class='node'") == len(_timed(records))
+    with open(f'{path}.resource_overusage.txt', encoding='utf-8') as report:
+        assert '99 > ' in report.read()
+
+
+def _request(port):
+    with socket.create_connection(('localhost', port)) as connection:
+        response = b''
+        while True:
+            chunk = connection.recv(65536)
+            if not chunk:
+                break
+            response += chunk
+    return json.loads(response.decode('utf-8').split('\n\n', 1)[1])
+
+
+def test_monitor_server(tmp_path):
+    records = _records(100)
+    for subject in ['sub-1_ses-1', 'sub-2_ses-1']:
+        os.makedirs(tmp_path / 'pipeline_test' / subject)
+    path = _write(tmp_path / 'pipeline_test' / 'sub-1_ses-1' /
+                  'callback.log', records[:60])
+    httpd = LoggingHTTPServer('test', str(tmp_path), 'localhost', 0)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    try:
+        port = httpd.server_address[1]
+        assert _request(port) == {'sub-1_ses-1': _status(records[:60])}
+        with open(path, 'a', encoding='utf-8') as log:
+            for record in records[60:]:
+                log.write(json.dumps(record) + '\n')
+        assert _request(port) == {'sub-1_ses-1': _status(records)}
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+@benchmark
+def test_callback_log_benchmark(tmp_path):
+    records = _records(50000)
+    path = _write(tmp_path / 'callback.log', records)
+    start = perf_counter()
+    with open(path, encoding='utf-8') as log:
+        nodes = _timed([json.loads(line) for line in log])
+    expected = calculate_resource_timeseries(
+        create_event_dict(nodes[0]['start'], nodes), 'runtime_memory_gb')
+    reference_time = perf_counter() - start
+    cblog = CallbackLog(path)
+    start = perf_counter()
+    cblog.update()
+    timeseries = cblog.resource_timeseries('runtime_memory_gb')
+    engine_time = perf_counter() - start
+    with open(path, 'a', encoding='utf-8') as log:
+        log.write(json.dumps(records[-2]) + '\n')
+    start = perf_counter()
+    cblog.update()
+    cblog.resource_timeseries('runtime_memory_gb')
+    cblog.excessive()
+    cblog.critical_path()
+    update_time = perf_counter() - start
+    print(f'reference {reference_time:.2f}s, engine {engine_time:.2f}s, '
+          f'update and queries {update_time * 1000:.1f}ms')
+    assert np.allclose(timeseries.values, expected.values)
+    assert engine_time < reference_time
@@ -0,0 +1,26 @@
+"""Tests for the cached Configuration fingerprint"""
+from copy import copy
+import pickle
+
+from CPAC.utils.configuration import Configuration
+
+
+def test_fingerprint_cache():
+    cfg = Configuration({})
+    fingerprint = cfg.fingerprint()
+    assert '_fingerprint' not in cfg.dict()
+    assert '_fingerprint' not in cfg.keys()
+    assert cfg.fingerprint() is fingerprint
+
+    # copies and pickles fingerprint the same configuration
+    assert copy(cfg).fingerprint() == fingerprint
+    assert pickle.loads(pickle.dumps(cfg)).fingerprint() == fingerprint
+
+    # item and attribute assignment invalidate the cache
+    cfg['subject_id'] = 'sub-1'
+    with_subject = cfg.fingerprint()
+    assert with_subject != fingerprint
+    cfg['pipeline_setup', 'system_config', 'num_participants_at_once'] = 2
+    assert cfg.fingerprint() != with_subject
+    cfg.update('subject_id', 'sub-2')
+    assert cfg.fingerprint() != with_subject
@@ -0,0 +1,87 @@
+import json
+import os
+
+import nibabel as nb
+import numpy as np
+import pytest
+
+from CPAC.utils.data_cache import DATA_CACHE_BUDGET, DATA_CACHE_DIR, \
+    load_image_data, set_up_data_cache
+from CPAC.utils.monitoring.custom_logging import set_up_logger
+
+
+@pytest.fixture
+def images(tmp_path):
+    rng = np.random.default_rng(0)
+    paths = []
+    for i in range(3):
+        paths.append(str(tmp_path / f'bold_{i}.nii.gz'))
+        nb.Nifti1Image(rng.standard_normal((6, 5, 4, 32)),
+                       np.eye(4)).to_filename(paths[-1])
+    return paths
+
+
+@pytest.fixture
+def callback_log(tmp_path):
+    logger = set_up_logger('callback', 'callback.log', 'debug',
+                           str(tmp_path), mock=True)
+    yield tmp_path / 'callback.log'
+    logger.delete()
+
+
+def cache_events(callback_log):
+    with open(callback_log, encoding='utf-8') as log:
+        return [event['data_cache'] for event in map(json.loads, log)]
+
+
+@pytest.fixture
+def data_cache(tmp_path):
+    def _set_up(disk_budget_gb):
+        set_up_data_cache(str(tmp_path / 'data_cache'), disk_budget_gb)
+        return tmp_path / 'data_cache'
+    yield _set_up
+    set_up_data_cache(None)
+    assert DATA_CACHE_DIR not in os.environ
+    assert DATA_CACHE_BUDGET not in os.environ
+
+
+def test_disabled(images):
+    assert np.array_equal(load_image_data(images[0]),
+                          nb.load(images[0]).get_fdata())
+
+
+def test_hit_and_miss(images, callback_log, data_cache):
+    cache_dir = data_cache(1)
+    first = load_image_data(images[0])
+    second = load_image_data(images[0])
+    assert isinstance(second, np.memmap)
+    assert second.dtype == np.float32
+    assert not second.flags.writeable
+    assert np.allclose(first, nb.load(images[0]).get_fdata())
+    assert np.array_equal(first, second)
+    assert len(list(cache_dir.glob('*.npy'))) == 1
+    assert cache_events(callback_log) == ['miss', 'hit']
+
+
+def test_eviction(images, callback_log, data_cache):
+    image_gb = 6 * 5 * 4 * 32 * 4 / 1024 ** 3
+    cache_dir = data_cache(2.5 * image_gb)
+    load_image_data(images[0])
+    load_image_data(images[1])
+    load_image_data(images[0])
+    # images[1] is now the least recently used
+    load_image_data(images[2])
+    assert cache_events(callback_log) == ['miss', 'miss', 'hit', 'evict',
+                                          'miss']
+    assert len(list(cache_dir.glob('*.npy'))) == 2
+    load_image_data(images[0])
+    assert cache_events(callback_log)[-1] == 'hit'
+
+
+def test_bypass(images, callback_log, data_cache):
+    cache_dir = data_cache(1e-6)
+    data = load_image_data(images[0])
+    assert not isinstance(data, np.memmap)
+    assert np.allclose(data, nb.load(images[0]).get_fdata())
+    assert not list(cache_dir.glob('*.npy'))
+    assert cache_events(callback_log) == ['bypass']
@@ -0,0 +1,121 @@
+"""Tests for concurrent S3 listing and sidecar fetching, against moto's S3"""
+import json
+import os
+
+import pytest
+
+from CPAC.utils.bids_utils import collect_bids_files_configs
+from CPAC.utils.build_data_config import pull_s3_sublist
+from CPAC.utils.s3_listing import fetch_s3_json, list_s3_objects
+from CPAC.utils.s3_prefetch import s3_client
+
+moto = pytest.importorskip('moto')
+
+BUCKET = 'fcp-indi-test'
+PREFIX = 'data/Projects/TEST/'
+
+
+@pytest.fixture
+def bucket(monkeypatch, tmp_path):
+    for key, value in {'AWS_ACCESS_KEY_ID': 'testing',
+                       'AWS_SECRET_ACCESS_KEY': 'testing',
+                       'AWS_DEFAULT_REGION': 'us-east-1',
+                       'XDG_CACHE_HOME': str(tmp_path / 'cache')}.items():
+        monkeypatch.setenv(key, value)
+    with moto.mock_aws():
+        client = s3_client()
+        client.create_bucket(Bucket=BUCKET)
+        keys = [f'{PREFIX}task-rest_bold.json', f'{PREFIX}participants.tsv',
+                'data/Projects/TEST2/sub-01/anat/sub-01_T1w.nii.gz']
+        for sub in ['01', '02', '10', 'A1']:
+            for ses in ['1', '2']:
+                prefix = f'{PREFIX}sub-{sub}/ses-{ses}/'
+                entities = f'sub-{sub}_ses-{ses}'
+                keys += [f'{prefix}anat/{entities}_T1w.nii.gz',
+                         f'{prefix}anat/{entities}_T1w.json',
+                         f'{prefix}func/{entities}_task-rest_bold.nii.gz',
+                         f'{prefix}func/{entities}_task-rest_events.tsv',
+                         f'{prefix}fmap/{entities}_magnitude1.nii.gz',
+                         f'{prefix}fmap/{entities}_phasediff.json',
+                         f'{prefix}fmap/{entities}_acq-fMRI_dir-PA_epi.json']
+        for key in keys:
+            body = json.dumps({'RepetitionTime': 2.0, 'Key': key}) if \
+                key.endswith('.json') else b'\0'
+            client.put_object(Bucket=BUCKET, Key=key, Body=body)
+        yield client
+
+
+def _sequential(client, prefix):
+    """Reference: a single listing, then one GET per sidecar"""
+    import boto3
+    objects = [s3_obj.key for s3_obj in
+               boto3.resource('s3').Bucket(BUCKET).objects.filter(
+                   Prefix=prefix)]
+    sidecars = {key: json.loads(client.get_object(
+        Bucket=BUCKET, Key=key)['Body'].read()) for key in objects
+        if key.endswith('.json')}
+    return objects, sidecars
+
+
+@pytest.mark.parametrize('n_threads', [1, 3, 16])
+def test_list_s3_objects(bucket, tmp_path, n_threads):
+    expected, sidecars = _sequential(bucket, PREFIX)
+    objects = list_s3_objects(bucket, BUCKET, PREFIX, n_threads,
+                              cache_dir=str(tmp_path))
+    assert [s3_obj['Key'] for s3_obj in objects] == expected
+    fetched = fetch_s3_json(bucket, BUCKET, [
+        s3_obj for s3_obj in objects if s3_obj['Key'].endswith('.json')],
+        n_threads, cache_dir=str(tmp_path))
+    assert fetched == sidecars
+    assert list(fetched) == list(sidecars)
+
+
+def test_caches(bucket, tmp_path):
+    objects = list_s3_objects(bucket, BUCKET, PREFIX,
+                              cache_dir=str(tmp_path))
+    sidecars = [s3_obj for s3_obj in objects
+                if s3_obj['Key'].endswith('.json')]
+    fetched = fetch_s3_json(bucket, BUCKET, sidecars,
+                            cache_dir=str(tmp_path))
+    # cached by ETag: deleted objects are still read from the cache, and
+    # a fresh enough listing is reused
+    for s3_obj in objects:
+        bucket.delete_object(Bucket=BUCKET, Key=s3_obj['Key'])
+    assert fetch_s3_json(bucket, BUCKET, sidecars,
+                         cache_dir=str(tmp_path)) == fetched
+    assert list_s3_objects(bucket, BUCKET, PREFIX, cache_dir=str(tmp_path),
+                           max_listing_age=3600) == objects
+    assert not list_s3_objects(bucket, BUCKET, PREFIX,
+                               cache_dir=str(tmp_path))
+
+
+def test_pull_s3_sublist(bucket):
+    expected, _ = _sequential(bucket, PREFIX)
+    assert pull_s3_sublist(f's3://{BUCKET}/{PREFIX.rstrip("/")}') == [
+        os.path.join('s3://', BUCKET, key) for key in expected]
+    assert pull_s3_sublist(f's3://{BUCKET}/{PREFIX}', keep_prefix=False) == [
+        key.replace(PREFIX, '') for key in expected]
+
+
+def test_collect_bids_files_configs(bucket):
+    prefix = PREFIX.rstrip('/')
+    expected, sidecars = _sequential(bucket, prefix)
+    suffixes = ['T1w', 'T2w', 'bold', 'epi', 'phasediff', 'phase1',
+                'phase2', 'magnitude', 'magnitude1', 'magnitude2']
+    expected_paths = []
+    expected_config = {}
+    for key in expected:
+        for suf in suffixes:
+            if suf in key:
+                if suf == 'epi' and 'acq-fMRI' not in key:
+                    continue
+                if key.endswith('json'):
+                    expected_config[key.replace(prefix, '').lstrip(
+                        '/')] = sidecars[key]
+                elif 'nii' in key:
+                    expected_paths.append(key.replace(prefix, '').lstrip('/'))
+    file_paths, config = collect_bids_files_configs(f's3://{BUCKET}/{prefix}',
+                                                    n_threads=4)
+    assert file_paths == expected_paths
+    assert config == expected_config
+    assert list(config) == list(expected_config)
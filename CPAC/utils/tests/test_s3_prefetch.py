@@ -0,0 +1,85 @@
+"""Tests for prefetching participants' S3 inputs, against moto's S3"""
+from io import BytesIO
+import os
+
+import pytest
+
+from CPAC.utils.s3_prefetch import prefetch_s3_inputs, s3_client, \
+    s3_local_path
+
+moto = pytest.importorskip('moto')
+
+BUCKET = 'fcp-indi-test'
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    from boto3.s3.transfer import TransferConfig
+    for key, value in {'AWS_ACCESS_KEY_ID': 'testing',
+                       'AWS_SECRET_ACCESS_KEY': 'testing',
+                       'AWS_DEFAULT_REGION': 'us-east-1'}.items():
+        monkeypatch.setenv(key, value)
+    with moto.mock_aws():
+        client = s3_client()
+        client.create_bucket(Bucket=BUCKET)
+        objects = {f'sub-{sub}/func/sub-{sub}_bold.nii.gz': os.urandom(1024)
+                   for sub in range(1, 4)}
+        objects['sub-1/anat/sub-1_T1w.nii.gz'] = os.urandom(11 * 1024 ** 2)
+        for key, body in objects.items():
+            client.put_object(Bucket=BUCKET, Key=key, Body=body)
+        # a multipart object, as large uploads are
+        multipart = 'sub-2/anat/sub-2_T1w.nii.gz'
+        objects[multipart] = os.urandom(11 * 1024 ** 2)
+        client.upload_fileobj(BytesIO(objects[multipart]), BUCKET, multipart,
+                              Config=TransferConfig(
+                                  multipart_threshold=5 * 1024 ** 2,
+                                  multipart_chunksize=5 * 1024 ** 2))
+        assert '-' in client.head_object(Bucket=BUCKET,
+                                         Key=multipart)['ETag']
+        yield objects
+
+
+def _sublist():
+    return [{'subject_id': str(sub), 'unique_id': 'ses-1',
+             'anat': f's3://{BUCKET}/sub-{sub}/anat/sub-{sub}_T1w.nii.gz',
+             'func': {'rest': {
+                 'scan': f's3://{BUCKET}/sub-{sub}/func/sub-{sub}_bold.nii.gz',
+                 'scan_parameters': None}},
+             'creds_path': None} for sub in (1, 2)]
+
+
+def test_prefetch(bucket, tmp_path):
+    dl_dir = str(tmp_path)
+    downloaded, failed = prefetch_s3_inputs(_sublist(), dl_dir, n_threads=4,
+                                            multipart_threshold_mb=5)
+    assert not failed
+    assert len(downloaded) == 4
+    for s3_path, local_path in downloaded.items():
+        _, s3_key, expected_path = s3_local_path(s3_path, dl_dir)
+        assert local_path == expected_path
+        with open(local_path, 'rb') as _f:
+            assert _f.read() == bucket[s3_key]
+    assert not [name for _, _, names in os.walk(dl_dir) for name in names
+                if name.endswith('.prefetch')]
+
+    # present, matching files aren't downloaded again; others are
+    anat = downloaded[_sublist()[0]['anat']]
+    func = downloaded[_sublist()[0]['func']['rest']['scan']]
+    anat_mtime = os.stat(anat).st_mtime_ns
+    with open(func, 'wb') as _f:
+        _f.write(b'partial')
+    downloaded, failed = prefetch_s3_inputs(_sublist(), dl_dir)
+    assert not failed
+    assert os.stat(anat).st_mtime_ns == anat_mtime
+    with open(func, 'rb') as _f:
+        assert _f.read() == bucket['sub-1/func/sub-1_bold.nii.gz']
+
+
+def test_prefetch_missing(bucket, tmp_path):
+    sublist = _sublist()
+    sublist[1]['anat'] = f's3://{BUCKET}/sub-2/anat/missing_T1w.nii.gz'
+    downloaded, failed = prefetch_s3_inputs(sublist, str(tmp_path))
+    assert list(failed) == [sublist[1]['anat']]
+    assert len(downloaded) == 3
+    assert not os.path.exists(s3_local_path(sublist[1]['anat'],
+                                            str(tmp_path))[2])